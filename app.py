@@ -41,16 +41,36 @@ from typing import Dict, Any, List
 import json as json_module
 
 from wacc_calculator import WACCCalculator, WACCComponents
+import wacc_sensitivity
 from data_extractors import WACCDataManager
+from data_extractors.etf_index import get_etf_index
 from wacc_data_connector import WACCDataConnector
 from field_categories_manager import FieldCategoriesManager
 from data_source_manager import DataSourceManager
 from geographic_mappings import GEOGRAPHIC_MAPPING, get_country_region
+from db_pool import get_pool, pool_stats
+from scripts.build_sector_multiples import load_sector_multiples
+from scripts.migrate_typed_damodaran_global import is_typed as damodaran_global_is_typed
+from report_engine import build_report_sectors
+from result_cache import cached_json_route, result_cache, watch_path
+from company_snapshot import get_company_snapshot
+from dashboard_kpis import compute_dashboard_kpis, load_dashboard_kpis
+from search_index import fts_query, match_condition, search_index_ready
+from json_response import NumpyJSONProvider, compress_response, json_response
+from consolidation_stats import latest_rows, records, yearly_stats
+from llm_executor import (DEFAULT_MAX_TOKENS as LLM_MAX_TOKENS, CompletionCache, LLMExecutor,
+                          resolve_model as resolve_llm_model)
+from streaming_export import (FORMATS as EXPORT_FORMATS, available_formats, column_widths, declared_types,
+                              export_stream, iter_chunks, peek)
+from keyset_pagination import (cached_count, count_cache, decode_cursor, encode_cursor, get_anchor,
+                               historico_codes, keyset_condition, order_by, put_anchor, signature)
 
 # Configurar aplicação Flask
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24).hex())
 app.config['JSON_AS_ASCII'] = False
+app.json = NumpyJSONProvider(app)
+app.after_request(compress_response)
 
 # Detectar ambiente: Google App Engine vs Local
 IS_GAE = os.environ.get('GAE_ENV', '').startswith('standard')
@@ -61,14 +81,23 @@ IS_GAE = os.environ.get('GAE_ENV', '').startswith('standard')
 # Path centralizado do banco de dados
 DB_PATH = os.environ.get('DB_PATH', 'data/damodaran_data_new.db')
 
-def get_db(db_path=None):
-    """Abre conexão SQLite. No GAE usa modo immutable para evitar journal no filesystem read-only."""
+def get_db(db_path=None, readonly=True):
+    """Retorna conexão SQLite do pool local da thread (somente leitura).
+
+    conn.close() devolve a conexão ao pool. No GAE usa modo immutable para evitar
+    journal no filesystem read-only. Com readonly=False abre uma conexão avulsa
+    gravável (fechada de fato no close()).
+    """
     path = db_path or DB_PATH
-    if IS_GAE:
-        abs_path = os.path.abspath(path)
-        uri = 'file:' + abs_path + '?immutable=1'
-        return sqlite3.connect(uri, uri=True)
-    return sqlite3.connect(path)
+    if not readonly:
+        if IS_GAE:
+            uri = 'file:' + os.path.abspath(path) + '?immutable=1'
+            return sqlite3.connect(uri, uri=True)
+        return sqlite3.connect(path)
+    return get_pool(path, readonly=True, immutable=IS_GAE).acquire()
+
+# Escritas no banco fora dos jobs do app também invalidam o cache de resultados
+watch_path(DB_PATH)
 
 # No GAE, cache vai para /tmp (filesystem efêmero mas gravável)
 if IS_GAE:
@@ -135,9 +164,9 @@ def _gcs_sync_cache():
         logger.warning(f"Falha ao sincronizar cache com GCS: {e}")
 
 def get_cache_db():
-    """Conexão SQLite gravável para operações de cache de relatórios."""
+    """Conexão SQLite gravável (pool separado) para operações de cache de relatórios."""
     _gcs_restore_cache()
-    return sqlite3.connect(CACHE_DB_PATH)
+    return get_pool(CACHE_DB_PATH, readonly=False).acquire()
 
 # Configurar logging
 import logging
@@ -152,6 +181,18 @@ if IS_GAE:
 else:
     logger.info("Rodando em ambiente local")
 
+# As consultas leem as métricas da damodaran_global sem CAST: exigem a tabela tipada
+try:
+    _conn = get_db()
+    try:
+        if not damodaran_global_is_typed(_conn):
+            logger.warning("damodaran_global com métricas em TEXT — rode "
+                           "scripts/migrate_typed_damodaran_global.py --execute")
+    finally:
+        _conn.close()
+except sqlite3.Error as e:
+    logger.warning(f"Não foi possível verificar o schema da damodaran_global: {e}")
+
 # Inicializar calculadora WACC
 calculator = WACCCalculator(cache_dir=str(CACHE_DIR))
 data_manager = WACCDataManager(cache_dir=str(CACHE_DIR))
@@ -166,91 +207,80 @@ class CompanyAnalyzer:
     
     def get_connection(self):
         return get_db(self.db_path)
+
+    def snapshot(self):
+        """Snapshot colunar de damodaran_global + about (recarregado se o banco mudar)."""
+        return get_company_snapshot(self.db_path, self.get_connection)
+
     def get_companies_data(self, filters=None):
         """Obtém dados das empresas com filtros aplicados"""
-        conn = self.get_connection()
-        
-        query = """
-        SELECT 
-            dg.*,
-            cbd.about
-        FROM damodaran_global dg
-        LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
-        WHERE 1=1
+        return self.snapshot().frame_for(filters)
+
+    def get_companies_records(self, filters=None):
+        """Mesmo resultado de get_companies_data, já como registros JSON (NaN → None).
+
+        Os dicts são compartilhados com o snapshot: somente leitura.
         """
-        
-        params = []
-        
-        if filters:
-            # Filtros geográficos hierárquicos
-            if 'countries' in filters:
-                placeholders = ','.join(['?' for _ in filters['countries']])
-                query += f" AND dg.country IN ({placeholders})"
-                params.extend(filters['countries'])
-            elif 'subregions' in filters:
-                placeholders = ','.join(['?' for _ in filters['subregions']])
-                query += f" AND dg.sub_group IN ({placeholders})"
-                params.extend(filters['subregions'])
-            elif 'regions' in filters:
-                placeholders = ','.join(['?' for _ in filters['regions']])
-                query += f" AND dg.broad_group IN ({placeholders})"
-                params.extend(filters['regions'])
-            
-            # Filtros de setor hierárquicos
-            if 'industries' in filters:
-                placeholders = ','.join(['?' for _ in filters['industries']])
-                query += f" AND dg.industry IN ({placeholders})"
-                params.extend(filters['industries'])
-            elif 'subsectors' in filters:
-                placeholders = ','.join(['?' for _ in filters['subsectors']])
-                query += f" AND dg.industry_group IN ({placeholders})"
-                params.extend(filters['subsectors'])
-            elif 'sectors' in filters:
-                placeholders = ','.join(['?' for _ in filters['sectors']])
-                query += f" AND dg.primary_sector IN ({placeholders})"
-                params.extend(filters['sectors'])
-            
-            # Filtros de market cap
-            if 'min_market_cap' in filters:
-                query += " AND dg.market_cap >= ?"
-                params.append(float(filters['min_market_cap']))
-            if 'max_market_cap' in filters:
-                query += " AND dg.market_cap <= ?"
-                params.append(float(filters['max_market_cap']))
-        
-        query += " ORDER BY dg.market_cap DESC"
-        
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-        
-        return df
+        return self.snapshot().records_for(filters)
+
+    def find_company(self, name=None, ticker=None):
+        """Registro de uma empresa pelo nome exato (ou ticker), via índice hash."""
+        return self.snapshot().find(name=name, ticker=ticker)
     
-    def calculate_benchmarks(self, df, group_by='industry'):
-        """Calcula benchmarks estatísticos"""
-        if df.empty:
-            return []
-        
-        numeric_columns = ['market_cap', 'revenue', 'net_income', 'roe', 'roa', 'pe_ratio', 'operating_margin', 'beta']
-        
+    BENCHMARK_COLUMNS = ['market_cap', 'revenue', 'net_income', 'roe', 'roa', 'pe_ratio', 'operating_margin', 'beta']
+
+    def calculate_benchmarks(self, group_by='industry', filters=None):
+        """Calcula benchmarks estatísticos por grupo de damodaran_global.
+
+        Média, mediana, quartis e extremos saem do GROUP BY (MEDIAN e
+        PERCENTILE_CONT de sqlite_aggregates), sem carregar a tabela no pandas.
+        """
+        filters = filters or {}
+        conn = self.get_connection()
+        try:
+            columns = {r[1] for r in conn.execute("PRAGMA table_info(damodaran_global)")}
+            if group_by not in columns:
+                raise ValueError(f"Coluna de agrupamento inválida: {group_by}")
+            metrics = [c for c in self.BENCHMARK_COLUMNS if c in columns]
+
+            conditions = [f"{group_by} IS NOT NULL"]
+            params = []
+            for key in ('country', 'industry'):
+                if filters.get(key):
+                    conditions.append(f"{key} = ?")
+                    params.append(filters[key])
+
+            select = [f"{group_by}", "COUNT(*)"]
+            for col in metrics:
+                select += [f"COUNT({col})", f"AVG({col})", f"MEDIAN({col})",
+                           f"PERCENTILE_CONT({col}, 0.25)", f"PERCENTILE_CONT({col}, 0.75)",
+                           f"MIN({col})", f"MAX({col})"]
+            rows = conn.execute(f"""
+                SELECT {', '.join(select)}
+                FROM damodaran_global
+                WHERE {' AND '.join(conditions)}
+                GROUP BY {group_by}
+                ORDER BY {group_by}
+            """, params).fetchall()
+        finally:
+            conn.close()
+
         benchmarks = []
-        for group_name, group_df in df.groupby(group_by):
-            benchmark = {'name': group_name, 'company_count': len(group_df)}
-            
-            for col in numeric_columns:
-                if col in group_df.columns:
-                    values = pd.to_numeric(group_df[col], errors='coerce').dropna()
-                    if len(values) > 0:
-                        benchmark[col] = {
-                            'mean': float(values.mean()),
-                            'median': float(values.median()),
-                            'q1': float(values.quantile(0.25)),
-                            'q3': float(values.quantile(0.75)),
-                            'min': float(values.min()),
-                            'max': float(values.max())
-                        }
-            
+        for row in rows:
+            benchmark = {'name': row[0], 'company_count': row[1]}
+            for i, col in enumerate(metrics):
+                n, mean, median, q1, q3, vmin, vmax = row[2 + 7 * i:9 + 7 * i]
+                if n:
+                    benchmark[col] = {
+                        'mean': float(mean),
+                        'median': float(median),
+                        'q1': float(q1),
+                        'q3': float(q3),
+                        'min': float(vmin),
+                        'max': float(vmax)
+                    }
             benchmarks.append(benchmark)
-        
+
         return benchmarks
 
 # Inicializar analisador de empresas
@@ -687,6 +717,56 @@ def api_calculate_wacc():
         }), 500
 
 
+@app.route('/api/wacc/sensitivity', methods=['POST'])
+def api_wacc_sensitivity():
+    """Sensibilidade (tornado, heatmap, grade) e Monte Carlo do WACC.
+
+    Corpo: `base` (componentes; se faltar algum, completa via calculate_wacc
+    com sector/country/market_value_*), `ranges` {param: {min, max, steps} |
+    {values}}, `distributions` {param: {dist, ...}}, `heatmap` {x, y},
+    `simulations` (padrão 100k), `seed` e `grid` (bool). Grades acima do
+    limite voltam como resumo amostrado, com o motivo em `grid_skipped`.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        base = data.get('base') or data.get('custom_components') or {}
+        if not isinstance(base, dict):
+            raise ValueError("base deve ser um objeto JSON")
+        base = {k: v for k, v in base.items() if v is not None and v != ''}
+
+        if any(p not in base for p in wacc_sensitivity.PARAMS):
+            market_value_equity = data.get('market_value_equity')
+            market_value_debt = data.get('market_value_debt')
+            components = calculator.calculate_wacc(
+                sector=data.get('sector'),
+                country=data.get('country', 'Brazil'),
+                market_value_equity=float(market_value_equity) if market_value_equity else None,
+                market_value_debt=float(market_value_debt) if market_value_debt else None,
+                custom_components={k: float(v) for k, v in base.items()},
+            )
+            base = {p: getattr(components, p) for p in wacc_sensitivity.PARAMS}
+
+        result = wacc_sensitivity.run(
+            base,
+            ranges=data.get('ranges'),
+            distributions=data.get('distributions'),
+            heatmap_axes=data.get('heatmap'),
+            simulations=data.get('simulations') or wacc_sensitivity.DEFAULT_SIMULATIONS,
+            seed=data.get('seed'),
+            include_grid=bool(data.get('grid', True)),
+        )
+        return json_response({'success': True, **result})
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erro na sensibilidade do WACC: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @app.route('/api/get_market_data')
 def api_get_market_data():
     """API endpoint para obter dados de mercado em tempo real."""
@@ -904,6 +984,9 @@ def api_health():
             'success': True,
             'status': 'healthy',
             'extractors': health_status,
+            'db_pools': pool_stats(),
+            'result_cache': result_cache.stats(),
+            'drill_count_cache': count_cache.stats(),
             'timestamp': datetime.now().isoformat()
         })
         
@@ -1032,17 +1115,17 @@ def get_benchmark_companies():
         
         query = """
         SELECT dg.company_name, dg.ticker, dg.exchange, dg.country, dg.broad_group,
-               CAST(dg.beta AS REAL) as beta,
-               CAST(dg.debt_equity AS REAL) as debt_equity,
-               CAST(dg.market_cap AS REAL) as market_cap,
-               CAST(dg.operating_margin AS REAL) as operating_margin,
-               CAST(dg.revenue AS REAL) as revenue,
-               CAST(dg.ev_ebitda AS REAL) as ev_ebitda,
-               CAST(dg.ev_ebit AS REAL) as ev_ebit,
-               CAST(dg.ev_revenue AS REAL) as ev_sales,
-               CAST(dg.effective_tax_rate AS REAL) as effective_tax_rate,
-               CAST(dg.marginal_tax_rate AS REAL) as marginal_tax_rate,
-               CAST(dg.cash_firm_value AS REAL) as cash_firm_value,
+               dg.beta,
+               dg.debt_equity,
+               dg.market_cap,
+               dg.operating_margin,
+               dg.revenue,
+               dg.ev_ebitda,
+               dg.ev_ebit,
+               dg.ev_revenue as ev_sales,
+               dg.effective_tax_rate,
+               dg.marginal_tax_rate,
+               dg.cash_firm_value,
                dg.bottom_up_beta_for_sector,
                dg.sic_desc,
                dg.sic_round,
@@ -1064,17 +1147,22 @@ def get_benchmark_companies():
             params.extend(countries)
         
         if min_mc is not None:
-            query += " AND CAST(dg.market_cap AS REAL) >= ?"
+            query += " AND dg.market_cap >= ?"
             params.append(min_mc)
         if max_mc is not None:
-            query += " AND CAST(dg.market_cap AS REAL) <= ?"
+            query += " AND dg.market_cap <= ?"
             params.append(max_mc)
         
         if search:
-            query += " AND (dg.company_name LIKE ? OR dg.ticker LIKE ?)"
-            params.extend([f'%{search}%', f'%{search}%'])
+            fts = match_condition(conn, 'damodaran_fts', 'dg.id', search, ('ticker', 'company_name'))
+            if fts:
+                query += f" AND {fts[0]}"
+                params.extend(fts[1])
+            else:
+                query += " AND (dg.company_name LIKE ? OR dg.ticker LIKE ?)"
+                params.extend([f'%{search}%', f'%{search}%'])
         
-        query += " ORDER BY CAST(dg.market_cap AS REAL) DESC"
+        query += " ORDER BY dg.market_cap DESC"
         
         df = pd.read_sql_query(query, conn, params=params)
         conn.close()
@@ -1136,16 +1224,16 @@ def calculate_benchmark():
         placeholders = ','.join(['?' for _ in tickers])
         query = f"""
         SELECT dg.company_name, dg.ticker, dg.exchange, dg.country,
-               CAST(dg.beta AS REAL) as beta,
-               CAST(dg.debt_equity AS REAL) as debt_equity,
-               CAST(dg.market_cap AS REAL) as market_cap,
-               CAST(dg.operating_margin AS REAL) as operating_margin,
-               CAST(dg.ev_ebitda AS REAL) as ev_ebitda,
-               CAST(dg.ev_ebit AS REAL) as ev_ebit,
-               CAST(dg.ev_revenue AS REAL) as ev_sales,
-               CAST(dg.effective_tax_rate AS REAL) as effective_tax_rate,
-               CAST(dg.marginal_tax_rate AS REAL) as marginal_tax_rate,
-               CAST(dg.cash_firm_value AS REAL) as cash_firm_value,
+               dg.beta,
+               dg.debt_equity,
+               dg.market_cap,
+               dg.operating_margin,
+               dg.ev_ebitda,
+               dg.ev_ebit,
+               dg.ev_revenue as ev_sales,
+               dg.effective_tax_rate,
+               dg.marginal_tax_rate,
+               dg.cash_firm_value,
                dg.bottom_up_beta_for_sector,
                dg.sic_desc,
                dg.sic_round,
@@ -1669,7 +1757,7 @@ def get_industry_groups():
                 primary_sector,
                 COUNT(*) as company_count,
                 AVG(CASE WHEN beta IS NOT NULL AND beta != '' 
-                    THEN CAST(beta as REAL) ELSE NULL END) as avg_beta
+                    THEN beta ELSE NULL END) as avg_beta
             FROM damodaran_global 
             WHERE industry_group IS NOT NULL AND industry_group != ''
             GROUP BY industry_group, primary_sector
@@ -1779,7 +1867,7 @@ def get_primary_sectors():
                 COUNT(*) as company_count,
                 COUNT(DISTINCT industry_group) as industry_group_count,
                 AVG(CASE WHEN beta IS NOT NULL AND beta != '' 
-                    THEN CAST(beta as REAL) ELSE NULL END) as avg_beta
+                    THEN beta ELSE NULL END) as avg_beta
             FROM damodaran_global 
             WHERE primary_sector IS NOT NULL AND primary_sector != ''
             GROUP BY primary_sector
@@ -1842,7 +1930,7 @@ def get_subdivision_hierarchy():
                 industry,
                 COUNT(*) as company_count,
                 AVG(CASE WHEN beta IS NOT NULL AND beta != '' 
-                    THEN CAST(beta as REAL) ELSE NULL END) as avg_beta
+                    THEN beta ELSE NULL END) as avg_beta
             FROM damodaran_global 
             WHERE primary_sector IS NOT NULL AND primary_sector != ''
                 AND industry_group IS NOT NULL AND industry_group != ''
@@ -2073,25 +2161,9 @@ def get_companies():
             filters['max_market_cap'] = request.args.get('max_market_cap')
             print("Filtro de market cap máximo:", filters['max_market_cap'])
         
-        print("Filtros finais enviados para get_companies_data:", filters)
-        
-        df = company_analyzer.get_companies_data(filters)
+        print("Filtros finais enviados para get_companies_records:", filters)
         
-        print("Resultado do get_companies_data:")
-        print(f"  - Tipo: {type(df)}")
-        print(f"  - Vazio: {df.empty if hasattr(df, 'empty') else 'N/A'}")
-        print(f"  - Tamanho: {len(df) if hasattr(df, '__len__') else 'N/A'}")
-        if hasattr(df, 'columns'):
-            print(f"  - Colunas: {list(df.columns)}")
-        
-        if df.empty:
-            print("DataFrame vazio - retornando lista vazia")
-            return jsonify([])
-        
-        # Substituir valores NaN por None para serialização JSON válida
-        df = df.replace({np.nan: None})
-        
-        result = df.to_dict('records')
+        result = company_analyzer.get_companies_records(filters)
         print(f"Retornando {len(result)} empresas")
         
         return jsonify(result)
@@ -2117,8 +2189,7 @@ def get_benchmarks():
         if request.args.get('industry'):
             filters['industry'] = request.args.get('industry')
         
-        df = company_analyzer.get_companies_data(filters)
-        benchmarks = company_analyzer.calculate_benchmarks(df, group_by)
+        benchmarks = company_analyzer.calculate_benchmarks(group_by, filters)
         
         return jsonify({
             'success': True,
@@ -2136,16 +2207,11 @@ def get_company_analysis(company_name):
     """API para análise detalhada de uma empresa específica"""
     try:
         # Busca dados da empresa
-        df = company_analyzer.get_companies_data()
-        company_data = df[df['company_name'] == company_name]
+        company = company_analyzer.find_company(name=company_name, ticker=company_name)
         
-        if company_data.empty:
+        if company is None:
             return jsonify({'success': False, 'error': 'Empresa não encontrada'})
         
-        # Substituir valores NaN por None para serialização JSON válida
-        company_data = company_data.replace({np.nan: None})
-        company = company_data.iloc[0].to_dict()
-        
         return jsonify({
             'success': True,
             'company': company
@@ -2165,16 +2231,32 @@ def api_company_search():
             return jsonify({'success': True, 'results': []})
 
         conn = get_db()
-        rows = conn.execute("""
-            SELECT yahoo_code, company_name, yahoo_sector, yahoo_industry, yahoo_country,
-                   market_cap, currency
-            FROM company_basic_data
-            WHERE yahoo_code LIKE ? OR company_name LIKE ?
-            ORDER BY
-                CASE WHEN yahoo_code LIKE ? THEN 0 ELSE 1 END,
-                market_cap DESC NULLS LAST
-            LIMIT 15
-        """, (f'{q}%', f'%{q}%', f'{q}%')).fetchall()
+        match = fts_query(q, ('yahoo_code', 'company_name'))
+        if match and search_index_ready(conn, 'company_fts'):
+            # Índice trigram: prefixo do código primeiro, depois bm25 e market cap
+            rows = conn.execute("""
+                SELECT cbd.yahoo_code, cbd.company_name, cbd.yahoo_sector, cbd.yahoo_industry,
+                       cbd.yahoo_country, cbd.market_cap, cbd.currency
+                FROM company_fts f
+                JOIN company_basic_data cbd ON cbd.id = f.rowid
+                WHERE company_fts MATCH ?
+                ORDER BY
+                    CASE WHEN cbd.yahoo_code LIKE ? THEN 0 ELSE 1 END,
+                    bm25(company_fts),
+                    cbd.market_cap DESC NULLS LAST
+                LIMIT 15
+            """, (match, f'{q}%')).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT yahoo_code, company_name, yahoo_sector, yahoo_industry, yahoo_country,
+                       market_cap, currency
+                FROM company_basic_data
+                WHERE yahoo_code LIKE ? OR company_name LIKE ?
+                ORDER BY
+                    CASE WHEN yahoo_code LIKE ? THEN 0 ELSE 1 END,
+                    market_cap DESC NULLS LAST
+                LIMIT 15
+            """, (f'{q}%', f'%{q}%', f'{q}%')).fetchall()
         conn.close()
 
         results = []
@@ -2546,34 +2628,11 @@ def api_yahoo_dashboard_summary():
                     'last_updated']
             stats = dict(zip(cols, row))
         else:
-            stats = {}
-            cur.execute("SELECT COUNT(*) FROM company_basic_data")
-            stats['total_companies'] = cur.fetchone()[0]
-
-            for col, key in [
-                ('about', 'with_about'), ('yahoo_sector', 'with_sector'),
-                ('yahoo_industry', 'with_industry'), ('yahoo_country', 'with_country'),
-                ('enterprise_value', 'with_ev'), ('market_cap', 'with_mcap'),
-                ('currency', 'with_currency'), ('yahoo_website', 'with_website'),
-            ]:
-                cur.execute(f"SELECT COUNT(*) FROM company_basic_data WHERE {col} IS NOT NULL AND TRIM(CAST({col} AS TEXT)) != ''")
-                stats[key] = cur.fetchone()[0]
-
-            cur.execute("SELECT COUNT(DISTINCT yahoo_sector) FROM company_basic_data WHERE yahoo_sector IS NOT NULL")
-            stats['distinct_sectors'] = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(DISTINCT yahoo_industry) FROM company_basic_data WHERE yahoo_industry IS NOT NULL")
-            stats['distinct_industries'] = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(DISTINCT yahoo_country) FROM company_basic_data WHERE yahoo_country IS NOT NULL")
-            stats['distinct_countries'] = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(DISTINCT currency) FROM company_basic_data WHERE currency IS NOT NULL")
-            stats['distinct_currencies'] = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(DISTINCT atividade_anloc) FROM damodaran_global WHERE atividade_anloc IS NOT NULL")
-            stats['distinct_atividades'] = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(DISTINCT sic_desc) FROM damodaran_global WHERE sic_desc IS NOT NULL AND sic_desc != ''")
-            stats['distinct_sic_descs'] = cur.fetchone()[0]
-
-            cur.execute("SELECT MAX(updated_at) FROM company_basic_data")
-            stats['last_updated'] = cur.fetchone()[0]
+            # Sem filtros: KPIs pré-calculados (uma leitura pela PK), ou uma
+            # varredura por tabela se a dashboard_kpi_cache ainda não existe
+            stats = load_dashboard_kpis(conn)
+            if stats is None:
+                stats = compute_dashboard_kpis(conn)
 
         conn.close()
         return jsonify({'success': True, 'stats': stats})
@@ -2594,19 +2653,19 @@ def api_yahoo_dashboard_sectors():
             SELECT 
                 cbd.yahoo_sector AS sector,
                 COUNT(*) AS count,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.ev_revenue AS REAL)) AS avg_ev_revenue,
-                AVG(CAST(dg.pb_ratio AS REAL)) AS avg_pb,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin,
-                AVG(CAST(dg.net_profit_margin AS REAL)) AS avg_net_margin,
-                AVG(CAST(dg.gross_margin AS REAL)) AS avg_gross_margin,
-                AVG(CAST(dg.revenue_growth AS REAL)) AS avg_rev_growth,
-                AVG(CAST(dg.beta AS REAL)) AS avg_beta,
-                AVG(CAST(dg.dividend_yield AS REAL)) AS avg_div_yield,
-                AVG(CAST(dg.debt_equity AS REAL)) AS avg_debt_equity,
-                0 AS med_pe
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.ev_revenue) AS avg_ev_revenue,
+                AVG(dg.pb_ratio) AS avg_pb,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.operating_margin) AS avg_op_margin,
+                AVG(dg.net_profit_margin) AS avg_net_margin,
+                AVG(dg.gross_margin) AS avg_gross_margin,
+                AVG(dg.revenue_growth) AS avg_rev_growth,
+                AVG(dg.beta) AS avg_beta,
+                AVG(dg.dividend_yield) AS avg_div_yield,
+                AVG(dg.debt_equity) AS avg_debt_equity,
+                MEDIAN(dg.pe_ratio) AS med_pe
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
@@ -2615,8 +2674,7 @@ def api_yahoo_dashboard_sectors():
         """
         df = pd.read_sql_query(query, conn, params=filter_params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'sectors': df.to_dict('records')})
+        return json_response({'success': True, 'sectors': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2643,18 +2701,18 @@ def api_yahoo_dashboard_industries():
                 cbd.yahoo_industry AS industry,
                 cbd.yahoo_sector AS sector,
                 COUNT(*) AS count,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.ev_revenue AS REAL)) AS avg_ev_revenue,
-                AVG(CAST(dg.pb_ratio AS REAL)) AS avg_pb,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin,
-                AVG(CAST(dg.net_profit_margin AS REAL)) AS avg_net_margin,
-                AVG(CAST(dg.gross_margin AS REAL)) AS avg_gross_margin,
-                AVG(CAST(dg.revenue_growth AS REAL)) AS avg_rev_growth,
-                AVG(CAST(dg.beta AS REAL)) AS avg_beta,
-                AVG(CAST(dg.dividend_yield AS REAL)) AS avg_div_yield,
-                AVG(CAST(dg.debt_equity AS REAL)) AS avg_debt_equity
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.ev_revenue) AS avg_ev_revenue,
+                AVG(dg.pb_ratio) AS avg_pb,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.operating_margin) AS avg_op_margin,
+                AVG(dg.net_profit_margin) AS avg_net_margin,
+                AVG(dg.gross_margin) AS avg_gross_margin,
+                AVG(dg.revenue_growth) AS avg_rev_growth,
+                AVG(dg.beta) AS avg_beta,
+                AVG(dg.dividend_yield) AS avg_div_yield,
+                AVG(dg.debt_equity) AS avg_debt_equity
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
@@ -2664,8 +2722,7 @@ def api_yahoo_dashboard_industries():
         """
         df = pd.read_sql_query(query, conn, params=params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'industries': df.to_dict('records')})
+        return json_response({'success': True, 'industries': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2683,12 +2740,12 @@ def api_yahoo_dashboard_countries():
             SELECT 
                 cbd.yahoo_country AS country,
                 COUNT(*) AS count,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin,
-                AVG(CAST(dg.beta AS REAL)) AS avg_beta,
-                AVG(CAST(dg.revenue_growth AS REAL)) AS avg_rev_growth,
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.operating_margin) AS avg_op_margin,
+                AVG(dg.beta) AS avg_beta,
+                AVG(dg.revenue_growth) AS avg_rev_growth,
                 COUNT(DISTINCT cbd.yahoo_sector) AS sectors_count,
                 COUNT(DISTINCT cbd.yahoo_industry) AS industries_count
             FROM damodaran_global dg
@@ -2700,8 +2757,7 @@ def api_yahoo_dashboard_countries():
         """
         df = pd.read_sql_query(query, conn, params=filter_params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'countries': df.to_dict('records')})
+        return json_response({'success': True, 'countries': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2721,17 +2777,17 @@ def api_yahoo_dashboard_atividades():
             SELECT 
                 dg.atividade_anloc AS atividade,
                 COUNT(*) AS count,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.ev_revenue AS REAL)) AS avg_ev_revenue,
-                AVG(CAST(dg.pb_ratio AS REAL)) AS avg_pb,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin,
-                AVG(CAST(dg.net_profit_margin AS REAL)) AS avg_net_margin,
-                AVG(CAST(dg.gross_margin AS REAL)) AS avg_gross_margin,
-                AVG(CAST(dg.revenue_growth AS REAL)) AS avg_rev_growth,
-                AVG(CAST(dg.beta AS REAL)) AS avg_beta,
-                AVG(CAST(dg.debt_equity AS REAL)) AS avg_debt_equity
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.ev_revenue) AS avg_ev_revenue,
+                AVG(dg.pb_ratio) AS avg_pb,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.operating_margin) AS avg_op_margin,
+                AVG(dg.net_profit_margin) AS avg_net_margin,
+                AVG(dg.gross_margin) AS avg_gross_margin,
+                AVG(dg.revenue_growth) AS avg_rev_growth,
+                AVG(dg.beta) AS avg_beta,
+                AVG(dg.debt_equity) AS avg_debt_equity
             FROM damodaran_global dg
             {join_clause}
             {where}
@@ -2741,8 +2797,7 @@ def api_yahoo_dashboard_atividades():
         """
         df = pd.read_sql_query(query, conn, params=filter_params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'atividades': df.to_dict('records')})
+        return json_response({'success': True, 'atividades': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2773,10 +2828,10 @@ def api_yahoo_dashboard_cross():
                 cbd.yahoo_sector AS sector,
                 cbd.yahoo_country AS country,
                 COUNT(*) AS count,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.operating_margin) AS avg_op_margin
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
@@ -2787,8 +2842,7 @@ def api_yahoo_dashboard_cross():
         """
         df = pd.read_sql_query(query, conn, params=params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'cross': df.to_dict('records')})
+        return json_response({'success': True, 'cross': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2810,12 +2864,12 @@ def api_yahoo_dashboard_treemap():
                 COUNT(*) AS count,
                 COALESCE(SUM(CAST(cbd.market_cap AS REAL)), 0) AS total_market_cap,
                 COALESCE(SUM(CAST(cbd.enterprise_value AS REAL)), 0) AS total_ev,
-                AVG(CAST(dg.pe_ratio AS REAL)) AS avg_pe,
-                AVG(CAST(dg.ev_ebitda AS REAL)) AS avg_ev_ebitda,
-                AVG(CAST(dg.operating_margin AS REAL)) AS avg_op_margin,
-                AVG(CAST(dg.roe AS REAL)) AS avg_roe,
-                AVG(CAST(dg.revenue_growth AS REAL)) AS avg_rev_growth,
-                AVG(CAST(dg.beta AS REAL)) AS avg_beta
+                AVG(dg.pe_ratio) AS avg_pe,
+                AVG(dg.ev_ebitda) AS avg_ev_ebitda,
+                AVG(dg.operating_margin) AS avg_op_margin,
+                AVG(dg.roe) AS avg_roe,
+                AVG(dg.revenue_growth) AS avg_rev_growth,
+                AVG(dg.beta) AS avg_beta
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
@@ -2825,8 +2879,7 @@ def api_yahoo_dashboard_treemap():
         """
         df = pd.read_sql_query(query, conn, params=filter_params)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
-        return jsonify({'success': True, 'items': df.to_dict('records')})
+        return json_response({'success': True, 'items': df})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -2846,6 +2899,7 @@ def api_yahoo_drill_companies():
         order = request.args.get('order', 'asc')
         page = max(1, int(request.args.get('page', 1)))
         per_page = min(100, max(10, int(request.args.get('per_page', 50))))
+        cursor = request.args.get('cursor', '')
         # Filtro especial: campo com/sem dados
         has_field = request.args.get('has_field', '')  # ex: 'about', 'yahoo_sector'
         has_value = request.args.get('has_value', '')   # '1' = com dados, '0' = sem dados
@@ -2873,9 +2927,15 @@ def api_yahoo_drill_companies():
         params.extend(filter_params)
 
         if search:
-            conditions.append("(dg.company_name LIKE ? OR dg.ticker LIKE ? OR cbd.yahoo_code LIKE ?)")
-            s = f"%{search}%"
-            params.extend([s, s, s])
+            by_name = match_condition(conn, 'damodaran_fts', 'dg.id', search, ('ticker', 'company_name'))
+            by_code = match_condition(conn, 'company_fts', 'cbd.id', search, ('yahoo_code',))
+            if by_name and by_code:
+                conditions.append(f"({by_name[0]} OR {by_code[0]})")
+                params.extend(by_name[1] + by_code[1])
+            else:
+                conditions.append("(dg.company_name LIKE ? OR dg.ticker LIKE ? OR cbd.yahoo_code LIKE ?)")
+                s = f"%{search}%"
+                params.extend([s, s, s])
         if has_field and has_value in ('0', '1'):
             field_map = {
                 'about': 'cbd.about',
@@ -2908,50 +2968,79 @@ def api_yahoo_drill_companies():
             'ev_ebitda': 'dg.ev_ebitda',
             'operating_margin': 'dg.operating_margin'
         }
-        sort_col = valid_sorts.get(sort, 'dg.company_name')
+        if sort not in valid_sorts:
+            sort = 'company_name'
+        sort_col = valid_sorts[sort]
         sort_dir = 'DESC' if order.lower() == 'desc' else 'ASC'
 
-        # Count total
+        # Count total (em cache por assinatura do filtro)
         count_query = f"""
             SELECT COUNT(*) FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
         """
-        count_df = pd.read_sql_query(count_query, conn, params=params)
-        total = int(count_df.iloc[0, 0])
+        total = cached_count(conn, 'yahoo_drill/companies', count_query, params)
+
+        # Keyset: cursor explícito ou o fim da página anterior já servida
+        sig = signature(where, params, sort_col, sort_dir, per_page)
+        anchored = not cursor
+        if anchored and page > 1:
+            cursor = get_anchor('yahoo_drill/companies', sig, page)
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if cursor:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError as e:  # cursor adulterado/truncado: erro do cliente
+                return jsonify({'success': False, 'error': str(e)}), 400
+            cond, cond_params = keyset_condition(sort_col, 'dg.id', sort_dir, after)
+            page_conditions.append(cond)
+            page_params.extend(cond_params)
+            limit_sql = "LIMIT ?"
+            page_params.append(per_page)
+        else:
+            limit_sql = "LIMIT ? OFFSET ?"
+            page_params.extend([per_page, (page - 1) * per_page])
+        page_where = "WHERE " + " AND ".join(page_conditions) if page_conditions else ""
 
-        # Paginated data
-        offset = (page - 1) * per_page
         query = f"""
             SELECT 
                 dg.company_name, dg.ticker, cbd.yahoo_code,
                 cbd.yahoo_sector, cbd.yahoo_industry, cbd.yahoo_country,
                 cbd.market_cap, cbd.enterprise_value,
-                CAST(dg.pe_ratio AS REAL) AS pe_ratio,
-                CAST(dg.ev_ebitda AS REAL) AS ev_ebitda,
-                CAST(dg.ev_revenue AS REAL) AS ev_revenue,
-                CAST(dg.operating_margin AS REAL) AS operating_margin,
-                CAST(dg.beta AS REAL) AS beta,
+                dg.pe_ratio,
+                dg.ev_ebitda,
+                dg.ev_revenue,
+                dg.operating_margin,
+                dg.beta,
                 dg.atividade_anloc,
-                CASE WHEN EXISTS(SELECT 1 FROM company_financials_historical cfh WHERE cfh.yahoo_code = cbd.yahoo_code LIMIT 1) THEN 1 ELSE 0 END AS has_historico
+                dg.id AS _row_id
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
-            {where}
-            ORDER BY {sort_col} {sort_dir}
-            LIMIT ? OFFSET ?
+            {page_where}
+            ORDER BY {order_by(sort_col, 'dg.id', sort_dir)}
+            {limit_sql}
         """
-        params.extend([per_page, offset])
-        df = pd.read_sql_query(query, conn, params=params)
+        df = pd.read_sql_query(query, conn, params=page_params)
+        df['has_historico'] = df['yahoo_code'].isin(historico_codes(conn)).astype(int)
         conn.close()
-        df = df.replace({np.nan: None, np.inf: None, -np.inf: None})
 
-        return jsonify({
+        next_cursor = None
+        if len(df) == per_page:
+            last = df.iloc[-1]
+            next_cursor = encode_cursor(last[sort], int(last['_row_id']))
+            if anchored:
+                put_anchor('yahoo_drill/companies', sig, page + 1, next_cursor)
+        df = df.drop(columns='_row_id')
+
+        return json_response({
             'success': True,
-            'companies': df.to_dict('records'),
+            'companies': df,
             'total': total,
             'page': page,
             'per_page': per_page,
-            'pages': (total + per_page - 1) // per_page
+            'pages': (total + per_page - 1) // per_page,
+            'next_cursor': next_cursor
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -2987,7 +3076,7 @@ def api_yahoo_drill_distribution():
         col_expr, label = valid_metrics[metric]
         conn = get_db()
         params = []
-        conditions = [f"CAST({col_expr} AS REAL) IS NOT NULL"]
+        conditions = [f"{col_expr} IS NOT NULL"]
 
         if sector:
             conditions.append("cbd.yahoo_sector = ?")
@@ -3009,55 +3098,47 @@ def api_yahoo_drill_distribution():
 
         where = "WHERE " + " AND ".join(conditions)
 
-        query = f"""
-            SELECT 
-                dg.company_name, dg.ticker,
-                CAST({col_expr} AS REAL) AS value
+        # Estatísticas e histograma agregados no SQLite (sqlite_aggregates):
+        # só as 10 maiores/menores linhas chegam ao Python
+        base = f"""
             FROM damodaran_global dg
             LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
             {where}
-            ORDER BY value
         """
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-
-        if df.empty:
+        row = conn.execute(f"""
+            SELECT COUNT({col_expr}), AVG({col_expr}), MEDIAN({col_expr}), STDEV({col_expr}),
+                   MIN({col_expr}), MAX({col_expr}),
+                   PERCENTILE_CONT({col_expr}, 0.25), PERCENTILE_CONT({col_expr}, 0.75),
+                   HISTOGRAM({col_expr}, 0, 0.01)
+            {base}
+        """, params).fetchone()
+
+        if not row[0]:
+            conn.close()
             return jsonify({'success': True, 'label': label, 'stats': None, 'histogram': [], 'top10': [], 'bottom10': []})
 
-        values = df['value'].dropna()
-
-        # Stats
+        count, mean, median, std, vmin, vmax, p25, p75, histogram_json = row
         stats = {
-            'count': int(len(values)),
-            'mean': float(values.mean()),
-            'median': float(values.median()),
-            'std': float(values.std()) if len(values) > 1 else 0,
-            'min': float(values.min()),
-            'max': float(values.max()),
-            'p25': float(values.quantile(0.25)),
-            'p75': float(values.quantile(0.75))
+            'count': int(count),
+            'mean': float(mean),
+            'median': float(median),
+            'std': std if std is not None else 0,
+            'min': float(vmin),
+            'max': float(vmax),
+            'p25': float(p25),
+            'p75': float(p75)
         }
 
-        # Histogram (10 bins, excluir outliers extremos)
-        q01 = values.quantile(0.01)
-        q99 = values.quantile(0.99)
-        trimmed = values[(values >= q01) & (values <= q99)]
-        if len(trimmed) > 0:
-            counts, bin_edges = np.histogram(trimmed, bins=min(15, max(5, len(trimmed) // 10)))
-            histogram = []
-            for i in range(len(counts)):
-                histogram.append({
-                    'bin_start': round(float(bin_edges[i]), 2),
-                    'bin_end': round(float(bin_edges[i + 1]), 2),
-                    'count': int(counts[i])
-                })
-        else:
-            histogram = []
+        # Histograma (5–15 faixas, excluindo o 1% de cada ponta)
+        histogram = json_module.loads(histogram_json)
 
         # Top 10 and Bottom 10
-        df_sorted = df.dropna(subset=['value']).sort_values('value', ascending=False)
-        top10 = df_sorted.head(10).replace({np.nan: None, np.inf: None, -np.inf: None}).to_dict('records')
-        bottom10 = df_sorted.tail(10).replace({np.nan: None, np.inf: None, -np.inf: None}).to_dict('records')
+        rows_query = f"SELECT dg.company_name, dg.ticker, {col_expr} AS value {base} ORDER BY value {{}} LIMIT 10"
+        top10 = [dict(zip(('company_name', 'ticker', 'value'), r))
+                 for r in conn.execute(rows_query.format('DESC'), params)]
+        bottom10 = [dict(zip(('company_name', 'ticker', 'value'), r))
+                    for r in conn.execute(rows_query.format('ASC'), params)][::-1]
+        conn.close()
 
         return jsonify({
             'success': True,
@@ -3119,9 +3200,8 @@ def api_yahoo_drill_coverage():
             LIMIT 20
         """, conn)
         conn.close()
-        sample_df = sample_df.replace({np.nan: None})
 
-        return jsonify({
+        return json_response({
             'success': True,
             'field': field,
             'label': label,
@@ -3129,7 +3209,7 @@ def api_yahoo_drill_coverage():
             'with_data': with_data,
             'without_data': without_data,
             'pct': round(with_data / total * 100, 1) if total > 0 else 0,
-            'sample_without': sample_df.to_dict('records')
+            'sample_without': sample_df
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -3180,7 +3260,7 @@ def exporta_data_page():
 
 @app.route('/api/export_excel', methods=['POST'])
 def api_export_excel():
-    """API endpoint para exportar dados filtrados para Excel."""
+    """API endpoint para exportar dados filtrados (xlsx, csv ou parquet) em streaming."""
     try:
         data = request.get_json()
         if not data:
@@ -3188,9 +3268,12 @@ def api_export_excel():
 
         fields = data.get('fields', [])
         filters = data.get('filters', {})
+        fmt = (data.get('format') or 'xlsx').lower()
 
         if not fields:
             return jsonify({'success': False, 'error': 'Nenhum campo selecionado'}), 400
+        if fmt not in available_formats():
+            return jsonify({'success': False, 'error': f'Formato inválido: {fmt} (use {", ".join(available_formats())})'}), 400
 
         # Sanitizar nomes de colunas (prevenir SQL injection)
         conn = get_db()
@@ -3217,7 +3300,7 @@ def api_export_excel():
                 select_parts.append(f'dg.{f}')
 
         select_clause = ', '.join(select_parts)
-        query = f"SELECT {select_clause} FROM damodaran_global dg"
+        query = "FROM damodaran_global dg"
 
         if need_cbd_join:
             query += " LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker"
@@ -3264,13 +3347,7 @@ def api_export_excel():
             query += " AND dg.market_cap <= ?"
             params.append(float(filters['max_market_cap']))
 
-        query += " ORDER BY dg.market_cap DESC"
-
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-
-        if df.empty:
-            return jsonify({'success': False, 'error': 'Nenhum dado encontrado com os filtros aplicados'}), 404
+        from_where = query
 
         # Gerar labels para colunas (usar field_categories_manager)
         col_labels = {}
@@ -3279,40 +3356,29 @@ def api_export_excel():
             for fname, fdata in cat_data.get('fields', {}).items():
                 col_labels[fname] = fdata.get('label', fname)
         col_labels['about'] = 'Sobre a Empresa'
+        header = [col_labels.get(f, f) for f in safe_fields]
+
+        # Larguras (xlsx) e tipos (parquet) saem do SQL, antes de abrir o cursor
+        widths = types = None
+        if fmt == 'xlsx':
+            widths = column_widths(conn, from_where, select_parts, header, params)
+        elif fmt == 'parquet':
+            dg_types = declared_types(conn, 'damodaran_global')
+            types = ['TEXT' if f == 'about' else dg_types.get(f) for f in safe_fields]
+
+        # Cursor lido em blocos; a conexão volta ao pool no fim do stream
+        chunks = iter_chunks(conn, f"SELECT {select_clause} {from_where} ORDER BY dg.market_cap DESC", params)
+        first, chunks = peek(chunks)
+        if first is None:
+            return jsonify({'success': False, 'error': 'Nenhum dado encontrado com os filtros aplicados'}), 404
 
-        # Renomear colunas para labels
-        rename_map = {}
-        for col in df.columns:
-            rename_map[col] = col_labels.get(col, col)
-        df = df.rename(columns=rename_map)
-
-        # Gerar Excel em memória
-        from io import BytesIO
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Dados Exportados')
-
-            # Ajustar largura das colunas
-            worksheet = writer.sheets['Dados Exportados']
-            for idx, col in enumerate(df.columns):
-                col_letter = worksheet.cell(row=1, column=idx+1).column_letter
-                max_length = max(
-                    df[col].astype(str).str.len().max() if len(df) > 0 else 0,
-                    len(str(col))
-                )
-                worksheet.column_dimensions[col_letter].width = min(max_length + 2, 50)
-
-        output.seek(0)
-
-        from flask import send_file
-        from datetime import datetime as dt
-        filename = f"exportacao_dados_{dt.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
+        body = export_stream(fmt, header, chunks, sheet_name='Dados Exportados', widths=widths,
+                             types=types, csv_delimiter=';', csv_bom=True)
+        filename = f"exportacao_dados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        return Response(
+            stream_with_context(body),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers={'Content-Disposition': f'attachment; filename={filename}'},
         )
 
     except Exception as e:
@@ -3414,8 +3480,6 @@ def api_export_preview():
         df = pd.read_sql_query(preview_query, conn, params=params)
         conn.close()
 
-        df = df.replace({np.nan: None})
-
         # Labels
         col_labels = {}
         all_cats = field_manager.get_all_categories()
@@ -3425,14 +3489,12 @@ def api_export_preview():
         col_labels['about'] = 'Sobre a Empresa'
 
         columns = [{'field': f, 'label': col_labels.get(f, f)} for f in safe_fields]
-        rows = df.to_dict('records')
-
-        return jsonify({
+        return json_response({
             'success': True,
             'total_count': total_count,
-            'preview_count': len(rows),
+            'preview_count': len(df),
             'columns': columns,
-            'rows': rows
+            'rows': df
         })
 
     except Exception as e:
@@ -3684,8 +3746,13 @@ def api_historico_search():
         filter_conds = ["cfh.period_type = 'annual'"]
         filter_params = []
         if q:
-            filter_conds.append("(cfh.yahoo_code LIKE ? OR cfh.company_name LIKE ?)")
-            filter_params.extend([f'%{q}%', f'%{q}%'])
+            fts = match_condition(conn, 'company_fts', 'cbd.id', q, ('yahoo_code', 'company_name'))
+            if fts:
+                filter_conds.append(fts[0])
+                filter_params.extend(fts[1])
+            else:
+                filter_conds.append("(cfh.yahoo_code LIKE ? OR cfh.company_name LIKE ?)")
+                filter_params.extend([f'%{q}%', f'%{q}%'])
         if sector:
             filter_conds.append("cbd.yahoo_sector = ?")
             filter_params.append(sector)
@@ -3811,6 +3878,8 @@ def api_historico_sector_evolution():
             SELECT cbd.yahoo_sector AS sector, cfh.fiscal_year,
                    AVG(cfh.{metric}) AS avg_value,
                    MEDIAN(cfh.{metric}) AS med_value,
+                   PERCENTILE_CONT(cfh.{metric}, 0.25) AS p25_value,
+                   PERCENTILE_CONT(cfh.{metric}, 0.75) AS p75_value,
                    COUNT(*) AS n
             FROM company_financials_historical cfh
             JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
@@ -3820,12 +3889,7 @@ def api_historico_sector_evolution():
             GROUP BY cbd.yahoo_sector, cfh.fiscal_year
             ORDER BY cbd.yahoo_sector, cfh.fiscal_year
         """
-        try:
-            cur = conn.execute(query)
-        except Exception:
-            # SQLite doesn't have MEDIAN, use AVG only
-            query = query.replace(f'MEDIAN(cfh.{metric}) AS med_value,', '')
-            cur = conn.execute(query)
+        cur = conn.execute(query)  # MEDIAN/PERCENTILE_CONT: sqlite_aggregates
 
         cols = [d[0] for d in cur.description]
         rows = [dict(zip(cols, r)) for r in cur.fetchall()]
@@ -3932,6 +3996,7 @@ def api_historico_drill_companies():
         order = request.args.get('order', 'asc')
         page = max(1, int(request.args.get('page', 1)))
         per_page = min(100, max(10, int(request.args.get('per_page', 50))))
+        cursor = request.args.get('cursor', '')
 
         conn = get_db()
         params = []
@@ -3959,9 +4024,14 @@ def api_historico_drill_companies():
                 conditions.append(f"cbd.yahoo_country IN ({placeholders})")
                 params.extend(sub_countries)
         if search:
-            conditions.append("(cfh.yahoo_code LIKE ? OR cfh.company_name LIKE ?)")
-            s = f"%{search}%"
-            params.extend([s, s])
+            fts = match_condition(conn, 'company_fts', 'cbd.id', search, ('yahoo_code', 'company_name'))
+            if fts:
+                conditions.append(fts[0])
+                params.extend(fts[1])
+            else:
+                conditions.append("(cfh.yahoo_code LIKE ? OR cfh.company_name LIKE ?)")
+                s = f"%{search}%"
+                params.extend([s, s])
         if has_ev == '1':
             conditions.append("cfh.enterprise_value_estimated IS NOT NULL")
         elif has_ev == '0':
@@ -3972,15 +4042,16 @@ def api_historico_drill_companies():
 
         where = "WHERE " + " AND ".join(conditions)
 
+        # sort → (expressão SQL, coluna do resultado)
         valid_sorts = {
-            'company_name': 'cfh.company_name',
-            'yahoo_code': 'cfh.yahoo_code',
-            'sector': 'cbd.yahoo_sector',
-            'country': 'cbd.yahoo_country',
-            'periods': 'periods',
-            'max_year': 'max_year',
+            'company_name': ('cfh.company_name', 'company_name'),
+            'yahoo_code': ('cfh.yahoo_code', 'yahoo_code'),
+            'sector': ('cbd.yahoo_sector', 'yahoo_sector'),
+            'country': ('cbd.yahoo_country', 'yahoo_country'),
+            'periods': ('periods', 'periods'),
+            'max_year': ('max_year', 'max_year'),
         }
-        sort_col = valid_sorts.get(sort, 'cfh.company_name')
+        sort_col, sort_key = valid_sorts.get(sort, valid_sorts['company_name'])
         sort_dir = 'DESC' if order.lower() == 'desc' else 'ASC'
 
         count_query = f"""
@@ -3989,10 +4060,29 @@ def api_historico_drill_companies():
             JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
             {where}
         """
-        cur = conn.execute(count_query, params)
-        total = cur.fetchone()[0]
+        total = cached_count(conn, 'historico_drill/companies', count_query, params)
+
+        # Keyset (no HAVING: periods/max_year são agregados)
+        sig = signature(where, params, sort_col, sort_dir, per_page)
+        anchored = not cursor
+        if anchored and page > 1:
+            cursor = get_anchor('historico_drill/companies', sig, page)
+        page_params = list(params)
+        if cursor:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError as e:  # cursor adulterado/truncado: erro do cliente
+                return jsonify({'success': False, 'error': str(e)}), 400
+            cond, cond_params = keyset_condition(sort_col, 'cfh.yahoo_code', sort_dir, after)
+            having = f"HAVING {cond}"
+            page_params.extend(cond_params)
+            limit_sql = "LIMIT ?"
+            page_params.append(per_page)
+        else:
+            having = ""
+            limit_sql = "LIMIT ? OFFSET ?"
+            page_params.extend([per_page, (page - 1) * per_page])
 
-        offset = (page - 1) * per_page
         query = f"""
             SELECT cfh.yahoo_code, cfh.company_name,
                    cbd.yahoo_sector, cbd.yahoo_industry, cbd.yahoo_country,
@@ -4006,22 +4096,30 @@ def api_historico_drill_companies():
             LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
             {where}
             GROUP BY cfh.yahoo_code
-            ORDER BY {sort_col} {sort_dir}
-            LIMIT ? OFFSET ?
+            {having}
+            ORDER BY {order_by(sort_col, 'cfh.yahoo_code', sort_dir)}
+            {limit_sql}
         """
-        params.extend([per_page, offset])
-        cur = conn.execute(query, params)
+        cur = conn.execute(query, page_params)
         cols = [d[0] for d in cur.description]
         companies = [dict(zip(cols, r)) for r in cur.fetchall()]
         conn.close()
 
+        next_cursor = None
+        if len(companies) == per_page:
+            last = companies[-1]
+            next_cursor = encode_cursor(last[sort_key], last['yahoo_code'])
+            if anchored:
+                put_anchor('historico_drill/companies', sig, page + 1, next_cursor)
+
         return jsonify({
             'success': True,
             'companies': companies,
             'total': total,
             'page': page,
             'per_page': per_page,
-            'pages': (total + per_page - 1) // per_page
+            'pages': (total + per_page - 1) // per_page,
+            'next_cursor': next_cursor
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -4161,10 +4259,8 @@ def api_historico_consolidated():
         if df.empty:
             return jsonify({'success': True, 'years': [], 'companies': [], 'aggregated': {}, 'ranking': []})
 
-        df = df.replace({np.nan: None})
-
         # Filtrar registros com problemas críticos de qualidade se solicitado
-        df_agg = df.copy()
+        df_agg = df
         excluded_count = 0
         if exclude_critical and 'data_quality' in df_agg.columns:
             mask = df_agg['data_quality'].fillna('').str.contains('critical', case=False)
@@ -4205,81 +4301,41 @@ def api_historico_consolidated():
             'free_cash_flow_ttm', 'net_income_ttm', 'ttm_quarters_count',
         ]
 
-        # Agregar por ano
-        years = sorted(df_agg['fiscal_year'].dropna().unique().tolist())
-        aggregated = {}
-        for metric in metrics:
-            if metric not in df_agg.columns:
-                continue
-            agg = {}
-            for year in years:
-                year_data = df_agg[df_agg['fiscal_year'] == year][metric].dropna()
-                if len(year_data) == 0:
-                    continue
-                arr = year_data.values.astype(float)
-                agg[int(year)] = {
-                    'avg': float(np.mean(arr)),
-                    'median': float(np.median(arr)),
-                    'min': float(np.min(arr)),
-                    'max': float(np.max(arr)),
-                    'p25': float(np.percentile(arr, 25)),
-                    'p75': float(np.percentile(arr, 75)),
-                    'count': int(len(arr)),
-                    'sum': float(np.sum(arr)),
-                }
-            if agg:
-                aggregated[metric] = agg
+        # Agregar por ano: um passe agrupado sobre a matriz de métricas
+        years = sorted(pd.to_numeric(df_agg['fiscal_year'], errors='coerce').dropna().unique().tolist())
+        if not years:
+            return jsonify({'success': True, 'years': [], 'companies': [], 'aggregated': {}, 'ranking': [],
+                            'excluded_critical': excluded_count})
+        aggregated = yearly_stats(df_agg, metrics)
 
-        # Lista de empresas com info
+        # Lista de empresas com info (período mais recente de cada código)
+        periods = df_agg.groupby('yahoo_code', sort=False).size()
+        latest = latest_rows(df_agg)
         companies_info = []
-        for code in df_agg['yahoo_code'].unique():
-            cdf = df_agg[df_agg['yahoo_code'] == code]
-            latest = cdf.sort_values('fiscal_year', ascending=False).iloc[0]
+        for rec in records(latest, ['yahoo_code', 'company_name', 'yahoo_sector', 'yahoo_industry',
+                                    'damodaran_region', 'yahoo_country', 'original_currency']):
             companies_info.append({
-                'yahoo_code': code,
-                'company_name': latest.get('company_name'),
-                'sector': latest.get('yahoo_sector'),
-                'industry': latest.get('yahoo_industry'),
-                'region': latest.get('damodaran_region'),
-                'country': latest.get('yahoo_country'),
-                'currency': latest.get('original_currency'),
-                'periods': int(len(cdf)),
+                'yahoo_code': rec['yahoo_code'],
+                'company_name': rec['company_name'],
+                'sector': rec['yahoo_sector'],
+                'industry': rec['yahoo_industry'],
+                'region': rec['damodaran_region'],
+                'country': rec['yahoo_country'],
+                'currency': rec['original_currency'],
+                'periods': int(periods[rec['yahoo_code']]),
             })
 
-        # Ranking: última período por empresa com métricas chave
+        # Ranking: último ano com métricas chave
         latest_year = max(years)
-        latest_df = df_agg[df_agg['fiscal_year'] == latest_year].copy()
-        ranking = []
-        for _, row in latest_df.iterrows():
-            ranking.append({
-                'yahoo_code': row.get('yahoo_code'),
-                'company_name': row.get('company_name'),
-                'sector': row.get('yahoo_sector'),
-                'industry': row.get('yahoo_industry'),
-                'region': row.get('damodaran_region'),
-                'total_revenue_usd': row.get('total_revenue_usd'),
-                'ebitda_usd': row.get('ebitda_usd'),
-                'net_income_usd': row.get('net_income_usd'),
-                'free_cash_flow_usd': row.get('free_cash_flow_usd'),
-                'enterprise_value_usd': row.get('enterprise_value_usd'),
-                'ebitda_margin': row.get('ebitda_margin'),
-                'net_margin': row.get('net_margin'),
-                'ev_ebitda': row.get('ev_ebitda'),
-                'ev_ebit': row.get('ev_ebit'),
-                'ev_revenue': row.get('ev_revenue'),
-                'debt_equity': row.get('debt_equity'),
-                'fcf_revenue_ratio': row.get('fcf_revenue_ratio'),
-                'short_term_debt': row.get('short_term_debt'),
-                'long_term_debt': row.get('long_term_debt'),
-                'diluted_average_shares': row.get('diluted_average_shares'),
-                'data_quality': row.get('data_quality'),
-            })
-
-        # Limpar NaN dos rankings
-        for item in ranking:
-            for k, v in item.items():
-                if isinstance(v, float) and (v != v):
-                    item[k] = None
+        latest_df = df_agg[df_agg['fiscal_year'] == latest_year].rename(columns={
+            'yahoo_sector': 'sector', 'yahoo_industry': 'industry', 'damodaran_region': 'region'})
+        ranking = latest_df.reindex(columns=[
+            'yahoo_code', 'company_name', 'sector', 'industry', 'region',
+            'total_revenue_usd', 'ebitda_usd', 'net_income_usd', 'free_cash_flow_usd',
+            'enterprise_value_usd', 'ebitda_margin', 'net_margin', 'ev_ebitda', 'ev_ebit',
+            'ev_revenue', 'debt_equity', 'fcf_revenue_ratio', 'short_term_debt',
+            'long_term_debt', 'diluted_average_shares', 'data_quality',
+        ])
 
         # Dados detalhados por empresa (opcional)
         detail_records = []
@@ -4287,21 +4343,9 @@ def api_historico_consolidated():
             detail_cols = ['yahoo_code', 'company_name', 'fiscal_year', 'fiscal_quarter',
                            'period_type', 'original_currency',
                            'yahoo_sector', 'yahoo_industry', 'damodaran_region', 'yahoo_country'] + metrics
-            available_cols = [c for c in detail_cols if c in df.columns]
-            detail_df = df[available_cols].copy()
-            for col in detail_df.columns:
-                if detail_df[col].dtype in ['float64', 'float32']:
-                    detail_df[col] = detail_df[col].where(detail_df[col].notna(), None)
-                    # Replace inf/-inf
-                    detail_df[col] = detail_df[col].replace([np.inf, -np.inf], None)
-            detail_records = detail_df.to_dict('records')
-            # Clean NaN
-            for rec in detail_records:
-                for k, v in rec.items():
-                    if isinstance(v, float) and (v != v):
-                        rec[k] = None
+            detail_records = df[[c for c in detail_cols if c in df.columns]]
 
-        return jsonify({
+        return json_response({
             'success': True,
             'years': [int(y) for y in years],
             'companies': companies_info,
@@ -4461,27 +4505,32 @@ def api_analise_setor_data():
         # Determine grouping column
         if group_by == 'country':
             group_col = 'cbd.yahoo_country'
-            group_alias = 'group_name'
         elif group_by == 'region':
-            group_col = 'cbd.yahoo_country'
-            group_alias = 'country'
+            # Região calculada no próprio GROUP BY: médias e quantis saem
+            # exatos por região, sem reagregar os países em Python
+            conn.create_function(
+                'country_region', 1,
+                lambda c: get_country_region(c or '')['region'], deterministic=True)
+            group_col = 'country_region(cbd.yahoo_country)'
         else:
             group_col = 'cbd.yahoo_sector'
-            group_alias = 'group_name'
 
-        # Build metric aggregations
+        # Build metric aggregations (MEDIAN/PERCENTILE_CONT: sqlite_aggregates)
         metric_aggs = []
         for m in allowed_metrics:
             metric_aggs.append(f"AVG(cfh.{m}) AS avg_{m}")
             metric_aggs.append(f"MIN(cfh.{m}) AS min_{m}")
             metric_aggs.append(f"MAX(cfh.{m}) AS max_{m}")
+            metric_aggs.append(f"MEDIAN(cfh.{m}) AS med_{m}")
+            metric_aggs.append(f"PERCENTILE_CONT(cfh.{m}, 0.25) AS p25_{m}")
+            metric_aggs.append(f"PERCENTILE_CONT(cfh.{m}, 0.75) AS p75_{m}")
             metric_aggs.append(f"SUM(CASE WHEN cfh.{m} IS NOT NULL THEN 1 ELSE 0 END) AS n_{m}")
         metric_sql = ', '.join(metric_aggs)
 
         sic_join = "LEFT JOIN damodaran_global dg ON dg.ticker = cbd.ticker" if sic_descs else ""
 
         query = f"""
-            SELECT {group_col} AS {group_alias},
+            SELECT {group_col} AS group_name,
                    cfh.fiscal_year,
                    COUNT(DISTINCT cfh.company_basic_data_id) AS num_companies,
                    COUNT(*) AS num_records,
@@ -4490,8 +4539,8 @@ def api_analise_setor_data():
             JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
             {sic_join}
             WHERE {where}
-            GROUP BY {group_col}, cfh.fiscal_year
-            ORDER BY {group_col}, cfh.fiscal_year
+            GROUP BY 1, cfh.fiscal_year
+            ORDER BY 1, cfh.fiscal_year
         """
 
         cur = conn.execute(query, params)
@@ -4499,51 +4548,6 @@ def api_analise_setor_data():
         rows = [dict(zip(cols, r)) for r in cur.fetchall()]
         conn.close()
 
-        # Se group_by == 'region', agregar countries em regions
-        if group_by == 'region':
-            region_data = {}
-            for r in rows:
-                geo = get_country_region(r.get('country', '') or '')
-                region_name = geo['region']
-                year = r['fiscal_year']
-                key = (region_name, year)
-                if key not in region_data:
-                    region_data[key] = {'group_name': region_name, 'fiscal_year': year,
-                                        'num_companies': 0, 'num_records': 0}
-                    for m in allowed_metrics:
-                        region_data[key][f'_sum_{m}'] = 0.0
-                        region_data[key][f'_n_{m}'] = 0
-                        region_data[key][f'min_{m}'] = None
-                        region_data[key][f'max_{m}'] = None
-                region_data[key]['num_companies'] += r['num_companies']
-                region_data[key]['num_records'] += r['num_records']
-                for m in allowed_metrics:
-                    avg_v = r.get(f'avg_{m}')
-                    n_v = r.get(f'n_{m}', 0) or 0
-                    mn = r.get(f'min_{m}')
-                    mx = r.get(f'max_{m}')
-                    if avg_v is not None and n_v > 0:
-                        region_data[key][f'_sum_{m}'] += avg_v * n_v
-                        region_data[key][f'_n_{m}'] += n_v
-                    if mn is not None:
-                        cur_min = region_data[key][f'min_{m}']
-                        region_data[key][f'min_{m}'] = mn if cur_min is None else min(cur_min, mn)
-                    if mx is not None:
-                        cur_max = region_data[key][f'max_{m}']
-                        region_data[key][f'max_{m}'] = mx if cur_max is None else max(cur_max, mx)
-            rows = []
-            for key, data in region_data.items():
-                row = {'group_name': data['group_name'], 'fiscal_year': data['fiscal_year'],
-                       'num_companies': data['num_companies'], 'num_records': data['num_records']}
-                for m in allowed_metrics:
-                    total_n = data[f'_n_{m}']
-                    row[f'avg_{m}'] = data[f'_sum_{m}'] / total_n if total_n > 0 else None
-                    row[f'n_{m}'] = total_n
-                    row[f'min_{m}'] = data[f'min_{m}']
-                    row[f'max_{m}'] = data[f'max_{m}']
-                rows.append(row)
-            rows.sort(key=lambda x: (x['group_name'], x['fiscal_year']))
-
         # Clean NaN/Inf
         for r in rows:
             for k, v in r.items():
@@ -4695,14 +4699,20 @@ def api_data_consistency_validate():
 
 @app.route('/api/data_consistency/update_quality', methods=['POST'])
 def api_data_consistency_update():
-    """Atualiza o campo data_quality no banco com base nos problemas encontrados."""
+    """Atualiza o campo data_quality no banco com base nos problemas encontrados.
+
+    Body JSON opcional: { changed_only: true } reavalia só os registros
+    alterados desde a última validação (row_version).
+    """
     try:
-        from scripts.validate_data_consistency import run_validation, update_data_quality
-        conn = get_db()
-        results = run_validation(conn)
-        updated = update_data_quality(conn, results)
-        conn.close()
-        return jsonify({'success': True, 'updated': updated})
+        from scripts.validate_data_consistency import apply_data_quality
+        data = request.get_json(silent=True) or {}
+        conn = get_db(readonly=False)
+        try:
+            stats = apply_data_quality(conn, changed_only=bool(data.get('changed_only')))
+        finally:
+            conn.close()
+        return jsonify({'success': True, 'updated': stats['flagged'], **stats})
     except Exception as e:
         logger.error(f"Erro ao atualizar data_quality: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -4799,8 +4809,13 @@ def api_etfs_list():
         conds, params = _etf_cross_filter_where(request.args)
 
         if search:
-            conds.append("(e.ticker LIKE ? OR e.name LIKE ?)")
-            params.extend([f'%{search}%', f'%{search}%'])
+            fts = match_condition(conn, 'etf_fts', 'e.rowid', search, ('ticker', 'name'))
+            if fts:
+                conds.append(fts[0])
+                params.extend(fts[1])
+            else:
+                conds.append("(e.ticker LIKE ? OR e.name LIKE ?)")
+                params.extend([f'%{search}%', f'%{search}%'])
 
         where = (" AND " + " AND ".join(conds)) if conds else ""
 
@@ -5096,16 +5111,40 @@ def api_etfs_tags_stats():
 
 @app.route('/api/etfs/tags/search', methods=['GET'])
 def api_etfs_tags_search():
-    """Busca ETFs por tag (type + value)."""
+    """Busca ETFs por tag (type + value) ou por texto livre em nome/tags (q)."""
     try:
         tag_type = request.args.get('type', '').strip()
         tag_value = request.args.get('value', '').strip()
-        if not tag_type:
-            return jsonify({'success': False, 'error': 'Parâmetro type é obrigatório'}), 400
+        q = request.args.get('q', '').strip()
+        if not tag_type and not q:
+            return jsonify({'success': False, 'error': 'Parâmetro type (ou q) é obrigatório'}), 400
 
         conn = get_db()
         conn.row_factory = sqlite3.Row
-        if tag_value:
+        if q:
+            # Texto livre: substring no nome ou em qualquer tag do ETF
+            # (índice trigram; termos curtos ou índice ausente → LIKE)
+            match = fts_query(q, ('name', 'tags'))
+            if match and search_index_ready(conn, 'etf_fts'):
+                where, params = "etf_fts MATCH ?", [match]
+                source = "etf_fts f JOIN etfs e ON e.rowid = f.rowid"
+                rank = "bm25(etf_fts),"
+            else:
+                like = f'%{q}%'
+                where = "(e.name LIKE ? OR EXISTS (SELECT 1 FROM etf_tags t WHERE t.etf_ticker = e.ticker AND t.tag_value LIKE ?))"
+                params, source, rank = [like, like], "etfs e", ""
+            if tag_type:
+                where += " AND EXISTS (SELECT 1 FROM etf_tags t WHERE t.etf_ticker = e.ticker AND t.tag_type = ?)"
+                params.append(tag_type)
+            rows = conn.execute(f"""
+                SELECT e.ticker AS etf_ticker, e.name, e.category, e.aum,
+                       (SELECT group_concat(tag_value, ' | ') FROM etf_tags t WHERE t.etf_ticker = e.ticker) AS tags
+                FROM {source}
+                WHERE {where}
+                ORDER BY {rank} e.aum DESC NULLS LAST
+                LIMIT 100
+            """, params).fetchall()
+        elif tag_value:
             rows = conn.execute("""
                 SELECT t.etf_ticker, t.tag_type, t.tag_value, t.confidence, t.source,
                        e.name, e.category, e.issuer
@@ -5237,6 +5276,11 @@ def api_etf_detail(ticker):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def _etf_index():
+    """Índice invertido de holdings (reconstruído quando etf_holdings muda)."""
+    return get_etf_index(DB_PATH, connect=get_db)
+
+
 @app.route('/api/etfs/search', methods=['GET'])
 def api_etfs_reverse_search():
     """Busca reversa: em quais ETFs um ticker aparece?"""
@@ -5245,26 +5289,12 @@ def api_etfs_reverse_search():
         if not q:
             return jsonify({'success': False, 'error': 'Parâmetro q é obrigatório'}), 400
 
-        conn = get_db()
-        conn.row_factory = sqlite3.Row
-
-        rows = conn.execute("""
-            SELECT h.etf_ticker, e.name as etf_name, e.category, e.aum,
-                   h.weight, h.holding_name, h.holding_ticker,
-                   e.data_source, e.total_holdings
-            FROM etf_holdings h
-            JOIN etfs e ON e.ticker = h.etf_ticker
-            WHERE h.holding_ticker LIKE ?
-               OR h.holding_name LIKE ?
-            ORDER BY h.weight DESC
-        """, (f'%{q}%', f'%{q}%')).fetchall()
-
-        conn.close()
+        rows = _etf_index().search(q)
 
         return jsonify({
             'success': True,
             'query': q,
-            'results': [dict(r) for r in rows],
+            'results': rows,
             'total': len(rows),
         })
     except Exception as e:
@@ -5281,30 +5311,15 @@ def api_etfs_overlap():
         if not etf1 or not etf2:
             return jsonify({'success': False, 'error': 'Parâmetros etf1 e etf2 são obrigatórios'}), 400
 
-        conn = get_db()
-        conn.row_factory = sqlite3.Row
-
-        h1 = conn.execute(
-            "SELECT holding_ticker, holding_name, weight FROM etf_holdings WHERE etf_ticker = ?", (etf1,)
-        ).fetchall()
-        h2 = conn.execute(
-            "SELECT holding_ticker, holding_name, weight FROM etf_holdings WHERE etf_ticker = ?", (etf2,)
-        ).fetchall()
-
-        n1 = conn.execute("SELECT name FROM etfs WHERE ticker = ?", (etf1,)).fetchone()
-        n2 = conn.execute("SELECT name FROM etfs WHERE ticker = ?", (etf2,)).fetchone()
-        conn.close()
-
-        t1 = {r['holding_ticker'] for r in h1 if r['holding_ticker']}
-        t2 = {r['holding_ticker'] for r in h2 if r['holding_ticker']}
-        common = t1 & t2
-        union = t1 | t2
-        pct = round(len(common) / len(union) * 100, 2) if union else 0
+        idx = _etf_index()
+        w1 = idx.holdings_of(etf1)
+        w2 = idx.holdings_of(etf2)
+        ov = idx.overlap([etf1, etf2])
+        n1 = idx.etf_meta.get(etf1)
+        n2 = idx.etf_meta.get(etf2)
 
-        w1 = {r['holding_ticker']: dict(r) for r in h1 if r['holding_ticker']}
-        w2 = {r['holding_ticker']: dict(r) for r in h2 if r['holding_ticker']}
         common_detail = []
-        for tk in sorted(common):
+        for tk in sorted(ov['common_tickers']):
             common_detail.append({
                 'ticker': tk,
                 'name': (w1.get(tk) or w2.get(tk, {})).get('holding_name', ''),
@@ -5317,10 +5332,11 @@ def api_etfs_overlap():
             'success': True,
             'etf1': etf1, 'etf1_name': n1['name'] if n1 else etf1,
             'etf2': etf2, 'etf2_name': n2['name'] if n2 else etf2,
-            'holdings_etf1': len(t1),
-            'holdings_etf2': len(t2),
-            'common': len(common),
-            'overlap_pct': pct,
+            'holdings_etf1': len(w1),
+            'holdings_etf2': len(w2),
+            'common': ov['common'],
+            'overlap_pct': ov['pct'],
+            'weighted_overlap': ov['weighted_overlap'],
             'common_holdings': common_detail[:100],
         })
     except Exception as e:
@@ -5328,6 +5344,34 @@ def api_etfs_overlap():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/etfs/top_overlap', methods=['GET'])
+def api_etfs_top_overlap():
+    """Top K ETFs mais sobrepostos a um ETF (via índice invertido)."""
+    try:
+        ticker = request.args.get('ticker', '').strip().upper()
+        if not ticker:
+            return jsonify({'success': False, 'error': 'Parâmetro ticker é obrigatório'}), 400
+        k = min(max(int(request.args.get('k', 10)), 1), 100)
+        by = request.args.get('by', 'weighted')
+        if by not in ('weighted', 'pct', 'common'):
+            return jsonify({'success': False, 'error': "Parâmetro by deve ser weighted, pct ou common"}), 400
+
+        idx = _etf_index()
+        if ticker not in idx.etf_pos:
+            return jsonify({'success': False, 'error': 'ETF não encontrado'}), 404
+
+        return jsonify({
+            'success': True,
+            'ticker': ticker,
+            'holdings': len(idx.holdings_of(ticker)),
+            'by': by,
+            'results': idx.top_overlapping(ticker, k=k, by=by),
+        })
+    except Exception as e:
+        logger.error(f"Erro na API ETF top_overlap: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/etfs/compare', methods=['GET'])
 def api_etfs_compare():
     """Compara N ETFs side-by-side (overlap + pesos)."""
@@ -5339,21 +5383,9 @@ def api_etfs_compare():
         if len(tickers) < 2:
             return jsonify({'success': False, 'error': 'Pelo menos 2 ETFs necessários'}), 400
 
-        conn = get_db()
-        conn.row_factory = sqlite3.Row
-
-        etf_meta = {}
-        etf_holdings = {}
-        for tk in tickers:
-            etf = conn.execute("SELECT ticker, name, category, aum, total_holdings, data_source FROM etfs WHERE ticker = ?", (tk,)).fetchone()
-            if etf:
-                etf_meta[tk] = dict(etf)
-            rows = conn.execute(
-                "SELECT holding_ticker, holding_name, weight, sector, asset_class, country FROM etf_holdings WHERE etf_ticker = ? ORDER BY weight DESC",
-                (tk,),
-            ).fetchall()
-            etf_holdings[tk] = {r['holding_ticker']: dict(r) for r in rows if r['holding_ticker']}
-        conn.close()
+        idx = _etf_index()
+        etf_meta = {tk: dict(idx.etf_meta[tk]) for tk in tickers if tk in idx.etf_meta}
+        etf_holdings = {tk: idx.holdings_of(tk) for tk in tickers}
 
         # Encontrar tickers válidos
         valid = [t for t in tickers if t in etf_meta]
@@ -5363,17 +5395,15 @@ def api_etfs_compare():
         # Overlap matrix
         overlap_matrix = {}
         for i, t1 in enumerate(valid):
-            s1 = set(etf_holdings.get(t1, {}).keys())
             for t2 in valid[i+1:]:
-                s2 = set(etf_holdings.get(t2, {}).keys())
-                common = s1 & s2
-                union = s1 | s2
-                pct = round(len(common) / len(union) * 100, 2) if union else 0
-                overlap_matrix[f"{t1}|{t2}"] = {'common': len(common), 'pct': pct}
+                ov = idx.overlap([t1, t2])
+                overlap_matrix[f"{t1}|{t2}"] = {
+                    'common': ov['common'], 'pct': ov['pct'], 'weighted': ov['weighted_overlap'],
+                }
 
         # Holdings presentes em todos os ETFs
-        all_sets = [set(etf_holdings.get(t, {}).keys()) for t in valid]
-        common_all = set.intersection(*all_sets) if all_sets else set()
+        ov_all = idx.overlap(valid)
+        common_all = ov_all['common_tickers']
 
         # Top common holdings com pesos por ETF
         common_detail = []
@@ -5402,6 +5432,7 @@ def api_etfs_compare():
             'tickers': valid,
             'overlap_matrix': overlap_matrix,
             'common_all': len(common_all),
+            'weighted_overlap_all': ov_all['weighted_overlap'],
             'common_holdings': common_detail[:100],
             'sector_breakdown': sector_breakdown,
         })
@@ -5412,39 +5443,46 @@ def api_etfs_compare():
 
 @app.route('/api/etfs/export', methods=['GET'])
 def api_etfs_export():
-    """Exporta holdings de um ou mais ETFs como CSV."""
+    """Exporta holdings de um ou mais ETFs (CSV por padrão; format=xlsx|parquet)."""
     try:
         raw = request.args.get('tickers', '').strip().upper()
         if not raw:
             return jsonify({'success': False, 'error': 'Parâmetro tickers é obrigatório'}), 400
         tickers = [t.strip() for t in raw.split(',') if t.strip()][:20]
+        fmt = request.args.get('format', 'csv').lower()
+        if fmt not in available_formats():
+            return jsonify({'success': False, 'error': f'Formato inválido: {fmt} (use {", ".join(available_formats())})'}), 400
+
+        columns = ['etf_ticker', 'holding_ticker', 'holding_name', 'weight', 'shares', 'market_value',
+                   'sector', 'asset_class', 'country', 'cusip', 'isin', 'report_date']
+        header = ['ETF', 'Ticker', 'Nome', 'Peso (%)', 'Shares', 'Market Value',
+                  'Setor', 'Asset Class', 'País', 'CUSIP', 'ISIN', 'Data']
 
         conn = get_db()
         placeholders = ','.join('?' * len(tickers))
-        rows = conn.execute(f"""
-            SELECT h.etf_ticker, h.holding_ticker, h.holding_name, h.weight,
-                   h.shares, h.market_value, h.sector, h.asset_class,
-                   h.country, h.cusip, h.isin, h.report_date
-            FROM etf_holdings h
-            WHERE h.etf_ticker IN ({placeholders})
+        from_where = f"FROM etf_holdings h WHERE h.etf_ticker IN ({placeholders})"
+        select_parts = [f'h.{c}' for c in columns]
+
+        widths = types = None
+        if fmt == 'xlsx':
+            widths = column_widths(conn, from_where, select_parts, header, tickers)
+        elif fmt == 'parquet':
+            holding_types = declared_types(conn, 'etf_holdings')
+            types = [holding_types.get(c) for c in columns]
+
+        chunks = iter_chunks(conn, f"""
+            SELECT {', '.join(select_parts)}
+            {from_where}
             ORDER BY h.etf_ticker, h.weight DESC
-        """, tickers).fetchall()
-        conn.close()
+        """, tickers)
 
-        import io as _io
-        import csv as _csv
-        output = _io.StringIO()
-        writer = _csv.writer(output)
-        writer.writerow(['ETF', 'Ticker', 'Nome', 'Peso (%)', 'Shares', 'Market Value',
-                        'Setor', 'Asset Class', 'País', 'CUSIP', 'ISIN', 'Data'])
-        for r in rows:
-            writer.writerow(list(r))
-
-        from flask import Response
-        resp = Response(output.getvalue(), mimetype='text/csv')
+        body = export_stream(fmt, header, chunks, sheet_name='Holdings', widths=widths, types=types)
         fname = tickers[0] if len(tickers) == 1 else 'etfs_export'
-        resp.headers['Content-Disposition'] = f'attachment; filename={fname}_holdings.csv'
-        return resp
+        return Response(
+            stream_with_context(body),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers={'Content-Disposition': f'attachment; filename={fname}_holdings.{fmt}'},
+        )
     except Exception as e:
         logger.error(f"Erro na API ETF export: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -5461,6 +5499,7 @@ def estudoanloc_page():
 
 
 @app.route('/api/estudoanloc/cross_sector', methods=['POST'])
+@cached_json_route('cross_sector')
 def api_estudoanloc_cross_sector():
     """Calcula múltiplos agregados por setor para comparação cross-sector."""
     try:
@@ -5688,6 +5727,7 @@ def api_estudoanloc_industries():
 
 
 @app.route('/api/estudoanloc/calculate', methods=['POST'])
+@cached_json_route('calculate')
 def api_estudoanloc_calculate():
     """Calcula múltiplos setoriais com filtros configuráveis e fallback TTM."""
     try:
@@ -5710,189 +5750,16 @@ def api_estudoanloc_calculate():
 
         import datetime
         current_year = datetime.date.today().year
-        is_current_multiples = (fiscal_year >= current_year)
 
         conn = get_db()
 
-        # === STEP 1: Carregar dados ===
-        industry_filter = ""
-        if selected_industries:
-            placeholders = ','.join('?' * len(selected_industries))
-            industry_filter = f"AND cbd.yahoo_industry IN ({placeholders})"
-
-        if is_current_multiples:
-            # --- MODO MÚLTIPLOS ATUAIS (FY corrente/futuro) ---
-            # Financeiros: TTM mais recente (Q2025/Q2026) || Annual do ano anterior
-            # EV: cfh.enterprise_value_estimated (mesma moeda que financials)
-            # 1a) TTM: busca último quarterly com TTM completo (fiscal_year mais recente)
-            params_ttm = [min_ttm_quarters, sector]
-            if selected_industries:
-                params_ttm.extend(selected_industries)
-
-            ttm_sql = f"""
-                WITH latest_q AS (
-                    SELECT q.company_basic_data_id AS cid,
-                           MAX(q.period_date) AS max_date
-                    FROM company_financials_historical q
-                    JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
-                    WHERE q.period_type = 'quarterly'
-                      AND q.ttm_quarters_count >= ?
-                      AND q.total_revenue_ttm IS NOT NULL
-                      AND q.ebitda_ttm IS NOT NULL
-                      AND cbd2.yahoo_sector = ?
-                    GROUP BY q.company_basic_data_id
-                )
-                SELECT q.company_basic_data_id AS cid,
-                       cbd.ticker, cbd.yahoo_industry AS industry,
-                       cbd.yahoo_country AS country,
-                       dg.sub_group AS region,
-                       q.total_revenue_ttm AS revenue,
-                       q.ebitda_ttm AS ebitda,
-                       q.ebitda_ttm AS ebitda_raw,
-                       q.free_cash_flow_ttm AS fcf,
-                       q.enterprise_value_estimated AS ev,
-                       q.enterprise_value_usd AS ev_usd,
-                       q.total_revenue_usd AS revenue_usd,
-                       q.ebitda_usd AS ebitda_usd,
-                       q.free_cash_flow_usd AS fcf_usd,
-                       'Current+TTM' AS data_source
-                FROM company_financials_historical q
-                JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
-                JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
-                LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                WHERE q.period_type = 'quarterly'
-                  AND q.enterprise_value_estimated IS NOT NULL
-                  {industry_filter}
-            """
-            df_ttm = pd.read_sql_query(ttm_sql, conn, params=params_ttm)
-
-            # 1b) Annual fallback: ano anterior com EV atual
-            prev_year = fiscal_year - 1
-            ttm_cids = set(df_ttm['cid'].tolist()) if not df_ttm.empty else set()
-
-            params_annual = [prev_year, sector]
-            if selected_industries:
-                params_annual.extend(selected_industries)
-
-            annual_sql = f"""
-                SELECT cfh.company_basic_data_id AS cid,
-                       cbd.ticker, cbd.yahoo_industry AS industry,
-                       cbd.yahoo_country AS country,
-                       dg.sub_group AS region,
-                       cfh.total_revenue AS revenue,
-                       cfh.normalized_ebitda AS ebitda,
-                       cfh.free_cash_flow AS fcf,
-                       cfh.enterprise_value_estimated AS ev,
-                       cfh.enterprise_value_usd AS ev_usd,
-                       cfh.total_revenue_usd AS revenue_usd,
-                       cfh.ebitda_usd AS ebitda_usd,
-                       cfh.free_cash_flow_usd AS fcf_usd,
-                       'Current+FY{prev_year}' AS data_source
-                FROM company_financials_historical cfh
-                JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
-                LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                WHERE cfh.period_type = 'annual'
-                  AND cfh.fiscal_year = ?
-                  AND cbd.yahoo_sector = ?
-                  AND cfh.enterprise_value_estimated IS NOT NULL
-                  {industry_filter}
-            """
-            df_annual = pd.read_sql_query(annual_sql, conn, params=params_annual)
-
-            # Excluir do annual quem já tem TTM
-            if not df_annual.empty and ttm_cids:
-                df_annual = df_annual[~df_annual['cid'].isin(ttm_cids)]
-
-        else:
-            # --- MODO HISTÓRICO (ano com dados consolidados) ---
-            params_annual_sql = [fiscal_year, sector]
-            if selected_industries:
-                params_annual_sql.extend(selected_industries)
-
-            annual_sql = f"""
-                SELECT cfh.company_basic_data_id AS cid,
-                       cbd.ticker, cbd.yahoo_industry AS industry,
-                       cbd.yahoo_country AS country,
-                       dg.sub_group AS region,
-                       cfh.total_revenue AS revenue,
-                       cfh.normalized_ebitda AS ebitda,
-                       cfh.free_cash_flow AS fcf,
-                       cfh.enterprise_value_estimated AS ev,
-                       cfh.enterprise_value_usd AS ev_usd,
-                       cfh.total_revenue_usd AS revenue_usd,
-                       cfh.ebitda_usd AS ebitda_usd,
-                       cfh.free_cash_flow_usd AS fcf_usd,
-                       'Annual' AS data_source
-                FROM company_financials_historical cfh
-                JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
-                LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                WHERE cfh.period_type = 'annual'
-                  AND cfh.fiscal_year = ?
-                  AND cbd.yahoo_sector = ?
-                  {industry_filter}
-            """
-            df_annual = pd.read_sql_query(annual_sql, conn, params=params_annual_sql)
-
-            # === STEP 2: Carregar dados TTM (fallback) ===
-            df_ttm = pd.DataFrame()
-            if use_ttm_fallback:
-                annual_cids = set(df_annual['cid'].tolist()) if not df_annual.empty else set()
-
-                ttm_sql = f"""
-                    WITH latest_q AS (
-                        SELECT q.company_basic_data_id AS cid,
-                               MAX(q.period_date) AS max_date
-                        FROM company_financials_historical q
-                        JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
-                        WHERE q.period_type = 'quarterly'
-                          AND q.fiscal_year = ?
-                          AND q.ttm_quarters_count >= ?
-                          AND q.total_revenue_ttm IS NOT NULL
-                          AND cbd2.yahoo_sector = ?
-                        GROUP BY q.company_basic_data_id
-                    )
-                    SELECT q.company_basic_data_id AS cid,
-                           cbd.ticker, cbd.yahoo_industry AS industry,
-                           cbd.yahoo_country AS country,
-                           dg.sub_group AS region,
-                           q.total_revenue_ttm AS revenue,
-                           q.ebitda_ttm AS ebitda,
-                           q.ebitda_ttm AS ebitda_raw,
-                           q.free_cash_flow_ttm AS fcf,
-                           q.enterprise_value_estimated AS ev,
-                           q.enterprise_value_usd AS ev_usd,
-                           q.total_revenue_usd AS revenue_usd,
-                           q.ebitda_usd AS ebitda_usd,
-                           q.free_cash_flow_usd AS fcf_usd,
-                           'TTM' AS data_source
-                    FROM company_financials_historical q
-                    JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
-                    JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
-                    LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                    WHERE q.period_type = 'quarterly'
-                      AND q.fiscal_year = ?
-                      AND q.ttm_quarters_count >= ?
-                      {industry_filter}
-                """
-                params_ttm = [fiscal_year, min_ttm_quarters, sector, fiscal_year, min_ttm_quarters]
-                if selected_industries:
-                    params_ttm.extend(selected_industries)
-
-                df_ttm_raw = pd.read_sql_query(ttm_sql, conn, params=params_ttm)
-                # Excluir empresas que já têm dado anual
-                if not df_ttm_raw.empty and annual_cids:
-                    df_ttm = df_ttm_raw[~df_ttm_raw['cid'].isin(annual_cids)]
-                elif not df_ttm_raw.empty:
-                    df_ttm = df_ttm_raw
-
+        # === STEP 1-3: Carregar annual + TTM (snapshot materializado ou histórico) ===
+        df = load_sector_multiples(conn, sector, fiscal_year, current_year,
+                                   use_ttm_fallback=use_ttm_fallback,
+                                   min_ttm_quarters=min_ttm_quarters,
+                                   industries=selected_industries)
         conn.close()
 
-        # === STEP 3: Combinar annual + TTM ===
-        frames = [df_annual]
-        if not df_ttm.empty:
-            frames.append(df_ttm)
-        df = pd.concat(frames, ignore_index=True)
-
         if df.empty:
             empty_stats = {'label': '', 'n': 0, 'n_annual': 0, 'n_ttm': 0,
                            'ev_ebitda': {'median': None, 'p25': None, 'p75': None, 'mean': None, 'n': 0},
@@ -6099,6 +5966,7 @@ def api_estudoanloc_calculate():
 
 
 @app.route('/api/estudoanloc/evolution', methods=['POST'])
+@cached_json_route('evolution')
 def api_estudoanloc_evolution():
     """Calcula evolução de múltiplos ao longo de vários anos."""
     try:
@@ -6122,11 +5990,6 @@ def api_estudoanloc_evolution():
         import datetime
         current_year = datetime.date.today().year
 
-        industry_filter = ""
-        if selected_industries:
-            placeholders = ','.join('?' * len(selected_industries))
-            industry_filter = f"AND cbd.yahoo_industry IN ({placeholders})"
-
         def calc_year_stats(subset):
             """Calcula estatísticas para um subconjunto."""
             n = len(subset)
@@ -6158,119 +6021,10 @@ def api_estudoanloc_evolution():
 
         evolution = []
         for yr in sorted(years):
-            is_current = (yr >= current_year)
-
-            if is_current:
-                # --- MODO MÚLTIPLOS ATUAIS ---
-                params_ttm_evo = [min_ttm_quarters, sector]
-                if selected_industries:
-                    params_ttm_evo.extend(selected_industries)
-
-                ttm_evo_sql = f"""
-                    WITH latest_q AS (
-                        SELECT q.company_basic_data_id AS cid, MAX(q.period_date) AS max_date
-                        FROM company_financials_historical q
-                        JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
-                        WHERE q.period_type = 'quarterly'
-                          AND q.ttm_quarters_count >= ? AND q.total_revenue_ttm IS NOT NULL
-                          AND q.ebitda_ttm IS NOT NULL AND cbd2.yahoo_sector = ?
-                        GROUP BY q.company_basic_data_id
-                    )
-                    SELECT q.company_basic_data_id AS cid,
-                           cbd.yahoo_country AS country, dg.sub_group AS region,
-                           q.total_revenue_ttm AS revenue, q.ebitda_ttm AS ebitda,
-                           q.free_cash_flow_ttm AS fcf, q.enterprise_value_estimated AS ev,
-                           q.enterprise_value_usd AS ev_usd,
-                           'Current+TTM' AS data_source
-                    FROM company_financials_historical q
-                    JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
-                    JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
-                    LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                    WHERE q.period_type = 'quarterly' AND q.enterprise_value_estimated IS NOT NULL
-                    {industry_filter}
-                """
-                df_t = pd.read_sql_query(ttm_evo_sql, conn, params=params_ttm_evo)
-
-                prev_year = yr - 1
-                ttm_cids = set(df_t['cid'].tolist()) if not df_t.empty else set()
-                params_a_evo = [prev_year, sector]
-                if selected_industries:
-                    params_a_evo.extend(selected_industries)
-                annual_evo_sql = f"""
-                    SELECT cfh.company_basic_data_id AS cid,
-                           cbd.yahoo_country AS country, dg.sub_group AS region,
-                           cfh.total_revenue AS revenue, cfh.normalized_ebitda AS ebitda,
-                           cfh.free_cash_flow AS fcf, cfh.enterprise_value_estimated AS ev,
-                           cfh.enterprise_value_usd AS ev_usd,
-                           'Current+FY{prev_year}' AS data_source
-                    FROM company_financials_historical cfh
-                    JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
-                    LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                    WHERE cfh.period_type = 'annual' AND cfh.fiscal_year = ? AND cbd.yahoo_sector = ?
-                      AND cfh.enterprise_value_estimated IS NOT NULL
-                    {industry_filter}
-                """
-                df_a = pd.read_sql_query(annual_evo_sql, conn, params=params_a_evo)
-                if not df_a.empty and ttm_cids:
-                    df_a = df_a[~df_a['cid'].isin(ttm_cids)]
-
-            else:
-                # --- MODO HISTÓRICO ---
-                params_a = [yr, sector]
-                if selected_industries:
-                    params_a.extend(selected_industries)
-                annual_sql = f"""
-                    SELECT cfh.company_basic_data_id AS cid,
-                           cbd.yahoo_country AS country, dg.sub_group AS region,
-                           cfh.total_revenue AS revenue, cfh.normalized_ebitda AS ebitda,
-                           cfh.free_cash_flow AS fcf, cfh.enterprise_value_estimated AS ev,
-                           cfh.enterprise_value_usd AS ev_usd, 'Annual' AS data_source
-                    FROM company_financials_historical cfh
-                    JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
-                    LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                    WHERE cfh.period_type = 'annual' AND cfh.fiscal_year = ? AND cbd.yahoo_sector = ?
-                    {industry_filter}
-                """
-                df_a = pd.read_sql_query(annual_sql, conn, params=params_a)
-
-                df_t = pd.DataFrame()
-                if use_ttm_fallback:
-                    annual_cids = set(df_a['cid'].tolist()) if not df_a.empty else set()
-                    params_t = [yr, min_ttm_quarters, sector, yr, min_ttm_quarters]
-                    if selected_industries:
-                        params_t.extend(selected_industries)
-                    ttm_sql = f"""
-                        WITH latest_q AS (
-                            SELECT q.company_basic_data_id AS cid, MAX(q.period_date) AS max_date
-                            FROM company_financials_historical q
-                            JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
-                            WHERE q.period_type = 'quarterly' AND q.fiscal_year = ?
-                              AND q.ttm_quarters_count >= ? AND q.total_revenue_ttm IS NOT NULL
-                              AND cbd2.yahoo_sector = ?
-                            GROUP BY q.company_basic_data_id
-                        )
-                        SELECT q.company_basic_data_id AS cid,
-                               cbd.yahoo_country AS country, dg.sub_group AS region,
-                               q.total_revenue_ttm AS revenue, q.ebitda_ttm AS ebitda,
-                               q.free_cash_flow_ttm AS fcf, q.enterprise_value_estimated AS ev,
-                               q.enterprise_value_usd AS ev_usd, 'TTM' AS data_source
-                        FROM company_financials_historical q
-                        JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
-                        JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
-                        LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-                        WHERE q.period_type = 'quarterly' AND q.fiscal_year = ? AND q.ttm_quarters_count >= ?
-                        {industry_filter}
-                    """
-                    df_t_raw = pd.read_sql_query(ttm_sql, conn, params=params_t)
-                    if not df_t_raw.empty and annual_cids:
-                        df_t = df_t_raw[~df_t_raw['cid'].isin(annual_cids)]
-                    elif not df_t_raw.empty:
-                        df_t = df_t_raw
-
-            frames = [df_a]
-            if not df_t.empty:
-                frames.append(df_t)
-            df = pd.concat(frames, ignore_index=True)
+            df = load_sector_multiples(conn, sector, yr, current_year,
+                                       use_ttm_fallback=use_ttm_fallback,
+                                       min_ttm_quarters=min_ttm_quarters,
+                                       industries=selected_industries)
 
             if df.empty:
                 evolution.append({'year': yr, 'global': calc_year_stats(pd.DataFrame()),
@@ -6513,6 +6267,7 @@ def api_estudoanloc_companies_multiyear():
 
 
 @app.route('/api/estudoanloc/companies_full', methods=['POST'])
+@cached_json_route('companies_full')
 def api_estudoanloc_companies_full():
     """Retorna base analítica completa: todas empresas × todos períodos anuais + TTM."""
     try:
@@ -6699,6 +6454,7 @@ def api_estudoanloc_companies_full():
 
 
 @app.route('/api/estudoanloc/insights', methods=['POST'])
+@cached_json_route('insights')
 def api_estudoanloc_insights():
     """Gera insights heurísticos (Fase 5.1) com base nos dados calculados."""
     try:
@@ -7316,19 +7072,20 @@ Formate suas respostas com parágrafos curtos para legibilidade."""
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-def _call_llm_chat(provider, api_key, messages, system_prompt):
+def _call_llm_chat(provider, api_key, messages, system_prompt, model=None, max_tokens=LLM_MAX_TOKENS):
     """Chama a LLM escolhida (Gemini, OpenAI ou Anthropic) no modo chat."""
+    model = resolve_llm_model(provider, model)
     if provider == 'gemini':
         import google.generativeai as genai
         genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash',
-                                       system_instruction=system_prompt)
+        gemini = genai.GenerativeModel(model, system_instruction=system_prompt,
+                                        generation_config={'max_output_tokens': max_tokens})
         # Converter messages para formato Gemini
         gemini_history = []
         for msg in messages[:-1]:
             role = 'user' if msg['role'] == 'user' else 'model'
             gemini_history.append({'role': role, 'parts': [msg['content']]})
-        chat = model.start_chat(history=gemini_history)
+        chat = gemini.start_chat(history=gemini_history)
         response = chat.send_message(messages[-1]['content'])
         return response.text
 
@@ -7339,7 +7096,7 @@ def _call_llm_chat(provider, api_key, messages, system_prompt):
         for msg in messages:
             oai_messages.append({'role': msg['role'], 'content': msg['content']})
         response = client.chat.completions.create(
-            model='gpt-4o-mini', messages=oai_messages, temperature=0.3)
+            model=model, messages=oai_messages, temperature=0.3, max_tokens=max_tokens)
         return response.choices[0].message.content
 
     elif provider == 'anthropic':
@@ -7347,7 +7104,7 @@ def _call_llm_chat(provider, api_key, messages, system_prompt):
         client = anthropic.Anthropic(api_key=api_key)
         anth_messages = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
         response = client.messages.create(
-            model='claude-sonnet-4-20250514', max_tokens=4096,
+            model=model, max_tokens=max_tokens,
             system=system_prompt, messages=anth_messages)
         return response.content[0].text
 
@@ -7355,6 +7112,11 @@ def _call_llm_chat(provider, api_key, messages, system_prompt):
         raise ValueError(f"Provedor LLM não suportado: {provider}")
 
 
+# Pool + dedup + cache (llm_completion_cache) das chamadas do relatório.
+# Em testes: `report_llm.call = FakeProvider(...)`.
+report_llm = LLMExecutor(_call_llm_chat, CompletionCache(get_cache_db))
+
+
 def _generate_heuristic_insights(stats, by_industry, by_region, by_country,
                                   top_companies, bottom_companies, sector, fiscal_year):
     """Gera insights baseados em heurísticas (sem API externa)."""
@@ -7535,280 +7297,6 @@ IMPORTANTE: Baseie-se EXCLUSIVAMENTE nos dados fornecidos. Não invente números
 # ESTUDO ANLOC - RELAT&Oacute;RIO PERI&Oacute;DICO (Quarterly Market Study)
 # ==============================================================================
 
-LATAM_COUNTRIES = [
-    'Brazil', 'Mexico', 'Argentina', 'Chile', 'Colombia', 'Peru', 'Uruguay',
-    'Paraguay', 'Bolivia', 'Ecuador', 'Venezuela', 'Costa Rica', 'Panama',
-    'Guatemala', 'Honduras', 'El Salvador', 'Nicaragua', 'Dominican Republic',
-    'Puerto Rico', 'Cuba'
-]
-
-
-def _report_calc_sector_stats(conn, sector, fiscal_year, min_ev=100_000_000, max_ev_ebitda=60,
-                               require_positive_ebitda=True, selected_industries=None,
-                               manual_excluded_tickers=None):
-    """Calcula estatísticas de múltiplos para um setor, segmentado por geografia.
-    Retorna também lista de tickers excluídos com motivo."""
-    current_year = datetime.now().year
-    is_current = (fiscal_year >= current_year)
-    excluded_tickers = []
-
-    if is_current:
-        query = """
-            SELECT cbd.id as company_id, cbd.ticker, cbd.company_name,
-                   cbd.yahoo_sector, cbd.yahoo_industry, cbd.yahoo_country as country,
-                   COALESCE(dg.sub_group, 'Other') as region,
-                   cfh.enterprise_value_estimated as ev,
-                   cfh.total_revenue as revenue, cfh.normalized_ebitda as ebitda,
-                   cfh.free_cash_flow as fcf, cfh.period_type
-            FROM company_basic_data cbd
-            JOIN company_financials_historical cfh ON cfh.yahoo_code = cbd.yahoo_code
-            LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-            WHERE cbd.yahoo_sector = ?
-              AND cfh.enterprise_value_estimated IS NOT NULL AND cfh.enterprise_value_estimated > 0
-              AND cfh.total_revenue IS NOT NULL AND cfh.total_revenue > 0
-              AND (cfh.period_type = 'annual' OR (cfh.period_type = 'annual' AND cfh.fiscal_year = ?))
-        """
-        params = [sector, fiscal_year - 1]
-    else:
-        query = """
-            SELECT cbd.id as company_id, cbd.ticker, cbd.company_name,
-                   cbd.yahoo_sector, cbd.yahoo_industry, cbd.yahoo_country as country,
-                   COALESCE(dg.sub_group, 'Other') as region,
-                   cfh.enterprise_value_estimated as ev,
-                   cfh.total_revenue as revenue, cfh.normalized_ebitda as ebitda,
-                   cfh.free_cash_flow as fcf, cfh.period_type
-            FROM company_basic_data cbd
-            JOIN company_financials_historical cfh ON cfh.yahoo_code = cbd.yahoo_code
-            LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
-            WHERE cbd.yahoo_sector = ?
-              AND cfh.fiscal_year = ? AND cfh.period_type = 'annual'
-              AND cfh.enterprise_value_estimated IS NOT NULL AND cfh.enterprise_value_estimated > 0
-              AND cfh.total_revenue IS NOT NULL AND cfh.total_revenue > 0
-        """
-        params = [sector, fiscal_year]
-
-    df = pd.read_sql_query(query, conn, params=params)
-    if df.empty:
-        return None
-
-    if is_current:
-        type_priority = {'quarterly': 0, 'annual': 1}
-        df['_prio'] = df['period_type'].map(type_priority).fillna(2)
-        df = df.sort_values('_prio').drop_duplicates(subset=['company_id'], keep='first').drop(columns=['_prio'])
-
-    # --- Filtro: indústrias selecionadas ---
-    if selected_industries:
-        mask_ind = ~df['yahoo_industry'].isin(selected_industries)
-        for _, row in df[mask_ind].iterrows():
-            excluded_tickers.append({
-                'ticker': row['ticker'], 'company_name': row['company_name'],
-                'sector': sector, 'industry': row.get('yahoo_industry', ''),
-                'country': row.get('country', ''), 'motivo': 'Indústria não selecionada',
-                'detalhe': f"Indústria: {row.get('yahoo_industry', 'N/D')}"
-            })
-        df = df[df['yahoo_industry'].isin(selected_industries)]
-
-    # --- Filtro: exclusão manual de tickers ---
-    if manual_excluded_tickers:
-        manual_set = set(t.upper().strip() for t in manual_excluded_tickers)
-        # Match both full ticker (e.g. NasdaqGS:AAPL) and short ticker (e.g. AAPL)
-        def _ticker_in_manual(t):
-            t_upper = t.upper().strip()
-            if t_upper in manual_set:
-                return True
-            # Also check the part after colon (exchange prefix)
-            if ':' in t_upper:
-                short = t_upper.split(':', 1)[1]
-                if short in manual_set:
-                    return True
-            return False
-        mask_manual = df['ticker'].apply(_ticker_in_manual)
-        for _, row in df[mask_manual].iterrows():
-            excluded_tickers.append({
-                'ticker': row['ticker'], 'company_name': row['company_name'],
-                'sector': sector, 'industry': row.get('yahoo_industry', ''),
-                'country': row.get('country', ''), 'motivo': 'Exclusão manual',
-                'detalhe': 'Removido manualmente pelo usuário'
-            })
-        df = df[~mask_manual]
-
-    # --- Filtro: EV mínimo ---
-    if min_ev:
-        mask_ev = df['ev'] < min_ev
-        for _, row in df[mask_ev].iterrows():
-            excluded_tickers.append({
-                'ticker': row['ticker'], 'company_name': row['company_name'],
-                'sector': sector, 'industry': row.get('yahoo_industry', ''),
-                'country': row.get('country', ''), 'motivo': f'EV < USD {min_ev/1e6:.0f}M',
-                'detalhe': f"EV: USD {row['ev']/1e6:.1f}M < mínimo USD {min_ev/1e6:.0f}M"
-            })
-        df = df[~mask_ev]
-
-    df['ev_ebitda'] = np.where((df['ebitda'] > 0) & (df['ev'] > 0), df['ev'] / df['ebitda'], np.nan)
-    df['ev_revenue'] = np.where(df['revenue'] > 0, df['ev'] / df['revenue'], np.nan)
-
-    # --- Filtro: EBITDA positivo obrigatório ---
-    if require_positive_ebitda:
-        mask_neg_ebitda = (df['ebitda'] <= 0) | df['ebitda'].isna()
-        for _, row in df[mask_neg_ebitda].iterrows():
-            excluded_tickers.append({
-                'ticker': row['ticker'], 'company_name': row['company_name'],
-                'sector': sector, 'industry': row.get('yahoo_industry', ''),
-                'country': row.get('country', ''), 'motivo': 'EBITDA ≤ 0',
-                'detalhe': f"EBITDA: {row['ebitda']:.0f}" if pd.notna(row.get('ebitda')) else 'EBITDA: N/D'
-            })
-        df = df[~mask_neg_ebitda]
-
-    # --- Filtro: Teto EV/EBITDA ---
-    if max_ev_ebitda:
-        mask_ceiling = df['ev_ebitda'] > max_ev_ebitda
-        for _, row in df[mask_ceiling].iterrows():
-            excluded_tickers.append({
-                'ticker': row['ticker'], 'company_name': row['company_name'],
-                'sector': sector, 'industry': row.get('yahoo_industry', ''),
-                'country': row.get('country', ''), 'motivo': f'EV/EBITDA > {max_ev_ebitda}x',
-                'detalhe': f"EV/EBITDA: {row['ev_ebitda']:.1f}x > teto {max_ev_ebitda}x"
-            })
-        df.loc[mask_ceiling, 'ev_ebitda'] = np.nan
-
-    if len(df) == 0:
-        return None
-
-    def _stats(subset):
-        result = {'n': len(subset)}
-        for m in ['ev_ebitda', 'ev_revenue']:
-            vals = subset[m].dropna()
-            if len(vals) >= 1:
-                result[m] = {
-                    'median': round(float(np.median(vals)), 2),
-                    'mean': round(float(np.mean(vals)), 2),
-                    'p25': round(float(np.percentile(vals, 25)), 2),
-                    'p75': round(float(np.percentile(vals, 75)), 2),
-                    'n': int(len(vals))
-                }
-            else:
-                result[m] = None
-        return result
-
-    # Global
-    global_stats = _stats(df)
-    global_stats['label'] = 'Global'
-
-    # LATAM
-    df_latam = df[df['country'].isin(LATAM_COUNTRIES)]
-    latam_stats = _stats(df_latam) if len(df_latam) >= 2 else {'n': len(df_latam), 'ev_ebitda': None, 'ev_revenue': None}
-    latam_stats['label'] = 'LATAM'
-
-    # Brasil
-    df_br = df[df['country'] == 'Brazil']
-    br_stats = _stats(df_br) if len(df_br) >= 2 else {'n': len(df_br), 'ev_ebitda': None, 'ev_revenue': None}
-    br_stats['label'] = 'Brasil'
-
-    # Spreads
-    def _spread(local, ref, metric):
-        lv = local.get(metric, {})
-        rv = ref.get(metric, {})
-        if lv and rv and lv.get('median') and rv.get('median') and rv['median'] != 0:
-            diff = lv['median'] - rv['median']
-            pct = round((diff / abs(rv['median'])) * 100, 1)
-            return {'diff': round(diff, 2), 'pct': pct, 'direction': 'premium' if pct > 0 else 'discount'}
-        return None
-
-    spreads = {
-        'latam_vs_global': {m: _spread(latam_stats, global_stats, m) for m in ['ev_ebitda', 'ev_revenue']},
-        'br_vs_global': {m: _spread(br_stats, global_stats, m) for m in ['ev_ebitda', 'ev_revenue']},
-        'br_vs_latam': {m: _spread(br_stats, latam_stats, m) for m in ['ev_ebitda', 'ev_revenue']},
-    }
-
-    # Por industria
-    by_industry = []
-    for ind, grp in df.groupby('yahoo_industry'):
-        if len(grp) >= 2:
-            s = _stats(grp)
-            s['label'] = ind
-            # Também calcular para Brasil
-            grp_br = grp[grp['country'] == 'Brazil']
-            if len(grp_br) >= 1:
-                br_s = _stats(grp_br)
-                s['brazil_ev_ebitda'] = br_s.get('ev_ebitda')
-                s['brazil_ev_revenue'] = br_s.get('ev_revenue')
-                s['brazil_n'] = br_s['n']
-            else:
-                s['brazil_ev_ebitda'] = None
-                s['brazil_ev_revenue'] = None
-                s['brazil_n'] = 0
-            by_industry.append(s)
-    by_industry.sort(key=lambda x: x['n'], reverse=True)
-
-    # Top empresas brasileiras
-    df_br_top = df_br.dropna(subset=['ev_ebitda']).sort_values('ev_ebitda', ascending=False)
-    top_br = df_br_top.head(10)[['ticker', 'company_name', 'yahoo_industry', 'ev_ebitda', 'ev_revenue', 'ev']].to_dict('records')
-
-    return {
-        'sector': sector,
-        'global': global_stats,
-        'latam': latam_stats,
-        'brazil': br_stats,
-        'spreads': spreads,
-        'by_industry': by_industry,
-        'top_brazil_companies': top_br,
-        'total_companies': len(df),
-        'excluded_tickers': excluded_tickers
-    }
-
-
-def _report_evolution_sector(conn, sector, year_start=2021, year_end=2025, min_ev=100_000_000, max_ev_ebitda=60):
-    """Calcula evolução temporal de múltiplos para um setor (Global, LATAM, Brasil) + por indústria."""
-    results = []
-    for yr in range(year_start, year_end + 1):
-        query = """
-            SELECT cbd.id as company_id, cbd.yahoo_country as country,
-                   cbd.yahoo_industry as industry,
-                   cfh.enterprise_value_estimated as ev,
-                   cfh.total_revenue as revenue, cfh.normalized_ebitda as ebitda
-            FROM company_basic_data cbd
-            JOIN company_financials_historical cfh ON cfh.yahoo_code = cbd.yahoo_code
-            WHERE cbd.yahoo_sector = ? AND cfh.fiscal_year = ? AND cfh.period_type = 'annual'
-              AND cfh.enterprise_value_estimated > 0 AND cfh.total_revenue > 0
-        """
-        df = pd.read_sql_query(query, conn, params=[sector, yr])
-        if min_ev:
-            df = df[df['ev'] >= min_ev]
-
-        df['ev_ebitda'] = np.where((df['ebitda'] > 0) & (df['ev'] > 0), df['ev'] / df['ebitda'], np.nan)
-        df['ev_revenue'] = np.where(df['revenue'] > 0, df['ev'] / df['revenue'], np.nan)
-        if max_ev_ebitda:
-            df.loc[df['ev_ebitda'] > max_ev_ebitda, 'ev_ebitda'] = np.nan
-
-        def _med(subset, metric):
-            vals = subset[metric].dropna()
-            return round(float(np.median(vals)), 2) if len(vals) >= 2 else None
-
-        yr_data = {
-            'year': yr,
-            'global': {'ev_ebitda': _med(df, 'ev_ebitda'), 'ev_revenue': _med(df, 'ev_revenue'), 'n': len(df)},
-            'latam': {'ev_ebitda': _med(df[df['country'].isin(LATAM_COUNTRIES)], 'ev_ebitda'),
-                      'ev_revenue': _med(df[df['country'].isin(LATAM_COUNTRIES)], 'ev_revenue'),
-                      'n': len(df[df['country'].isin(LATAM_COUNTRIES)])},
-            'brazil': {'ev_ebitda': _med(df[df['country'] == 'Brazil'], 'ev_ebitda'),
-                       'ev_revenue': _med(df[df['country'] == 'Brazil'], 'ev_revenue'),
-                       'n': len(df[df['country'] == 'Brazil'])}
-        }
-        # Por indústria
-        by_industry = {}
-        for ind in df['industry'].dropna().unique():
-            sub = df[df['industry'] == ind]
-            if len(sub) >= 2:
-                by_industry[ind] = {
-                    'ev_ebitda': _med(sub, 'ev_ebitda'),
-                    'ev_revenue': _med(sub, 'ev_revenue'),
-                    'n': len(sub)
-                }
-        yr_data['by_industry'] = by_industry
-        results.append(yr_data)
-    return results
-
-
 @app.route('/estudoanloc/relatorio')
 def estudoanloc_relatorio_page():
     """Página do Relatório Periódico - Estudo Anloc de Múltiplos de Mercado."""
@@ -8042,17 +7530,23 @@ def api_estudoanloc_relatorio_company_lookup():
                 ORDER BY cfh.fiscal_year DESC
             """, params_list).fetchall()
         elif search_term:
-            rows = conn.execute("""
+            fts = match_condition(conn, 'company_fts', 'cbd.id', search_term, ('ticker', 'company_name'))
+            if fts:
+                where_clause, search_params = fts
+            else:
+                where_clause = "(cbd.ticker LIKE ? OR cbd.company_name LIKE ?)"
+                search_params = [f'%{search_term}%', f'%{search_term}%']
+            rows = conn.execute(f"""
                 SELECT cbd.ticker, cbd.company_name, cbd.yahoo_sector, cbd.yahoo_industry,
                        cbd.yahoo_country, cfh.enterprise_value_estimated, cbd.market_cap,
                        cfh.total_revenue, cfh.normalized_ebitda, cfh.free_cash_flow,
                        cfh.period_type, cfh.fiscal_year
                 FROM company_basic_data cbd
                 LEFT JOIN company_financials_historical cfh ON cfh.yahoo_code = cbd.yahoo_code
-                WHERE (cbd.ticker LIKE ? OR cbd.company_name LIKE ?)
+                WHERE {where_clause}
                 ORDER BY cfh.fiscal_year DESC
                 LIMIT 50
-            """, (f'%{search_term}%', f'%{search_term}%')).fetchall()
+            """, search_params).fetchall()
         else:
             conn.close()
             return jsonify({'success': True, 'companies': []})
@@ -8105,29 +7599,17 @@ def api_estudoanloc_generate_report():
 
         target_sectors = selected_sectors if selected_sectors else all_sectors
 
-        # Dados por setor
-        sectors_data = []
-        all_excluded = []
-        for sector in target_sectors:
-            sector_stats = _report_calc_sector_stats(
-                conn, sector, fiscal_year,
-                min_ev=min_ev, max_ev_ebitda=max_ev_ebitda,
-                require_positive_ebitda=require_positive_ebitda,
-                selected_industries=selected_industries,
-                manual_excluded_tickers=manual_excluded_tickers
-            )
-            if sector_stats:
-                # Coletar excluídos e remover da lista de dados do setor
-                sector_excluded = sector_stats.pop('excluded_tickers', [])
-                all_excluded.extend(sector_excluded)
-                # Evolução temporal
-                year_start = min(evolution_years) if evolution_years else 2021
-                year_end = max(evolution_years) if evolution_years else 2025
-                sector_stats['evolution'] = _report_evolution_sector(
-                    conn, sector, year_start=year_start, year_end=year_end,
-                    min_ev=min_ev, max_ev_ebitda=max_ev_ebitda
-                )
-                sectors_data.append(sector_stats)
+        # Dados de todos os setores (uma query + estatísticas agrupadas)
+        year_start = min(evolution_years) if evolution_years else 2021
+        year_end = max(evolution_years) if evolution_years else 2025
+        sectors_data, all_excluded = build_report_sectors(
+            conn, target_sectors, fiscal_year, datetime.now().year,
+            min_ev=min_ev, max_ev_ebitda=max_ev_ebitda,
+            require_positive_ebitda=require_positive_ebitda,
+            selected_industries=selected_industries,
+            manual_excluded_tickers=manual_excluded_tickers,
+            year_start=year_start, year_end=year_end
+        )
 
         if not sectors_data:
             return jsonify({'success': False, 'error': 'Sem dados disponíveis para os setores selecionados'}), 404
@@ -8149,18 +7631,28 @@ def api_estudoanloc_generate_report():
             })
         ranking.sort(key=lambda x: x.get('ev_ebitda_median') or 0, reverse=True)
 
-        # Gerar narrativa com Claude se solicitado
+        # Gerar narrativa com Claude se solicitado (narrativas e comentários em
+        # paralelo; respostas em cache por prompt)
         llm_narratives = {}
         graph_comments = {}
         if use_llm and api_key:
-            try:
-                llm_narratives = _generate_report_narratives(api_key, sectors_data, ranking, fiscal_year)
-            except Exception as e:
-                logger.warning(f"LLM narrative generation failed: {e}")
-            try:
-                graph_comments = _generate_graph_comments(api_key, sectors_data, ranking, fiscal_year)
-            except Exception as e:
-                logger.warning(f"Graph comments generation failed: {e}")
+            use_llm_cache = not data.get('refresh_llm', False)
+            jobs = {}
+            for name, build, label in (('narratives', _report_narratives_prompt, 'LLM narrative generation'),
+                                       ('graph_comments', _graph_comments_prompt, 'Graph comments generation')):
+                try:
+                    prompt = build(sectors_data, ranking, fiscal_year)
+                    jobs[name] = (_submit_report_prompt(api_key, prompt, use_cache=use_llm_cache), label)
+                except Exception as e:
+                    logger.warning(f"{label} failed: {e}")
+            llm_results = {}
+            for name, (job, label) in jobs.items():
+                try:
+                    llm_results[name] = _parse_report_json(job.result(), name)
+                except Exception as e:
+                    logger.warning(f"{label} failed: {e}")
+            llm_narratives = llm_results.get('narratives', {})
+            graph_comments = llm_results.get('graph_comments', {})
 
         # Consultar datas de atualização dos dados
         data_freshness = {}
@@ -8173,6 +7665,7 @@ def api_estudoanloc_generate_report():
             data_freshness['last_any_update'] = r[0] if r and r[0] else None
         except Exception:
             pass
+        conn.close()
 
         generated_at = datetime.now().isoformat()
         quarter = f'Q{(datetime.now().month - 1) // 3 + 1}/{datetime.now().year}'
@@ -8432,11 +7925,58 @@ def _repair_truncated_json(text):
         raise
 
 
-def _generate_report_narratives(api_key, sectors_data, ranking, fiscal_year):
-    """Gera narrativas analíticas usando Claude para o relatório."""
-    import anthropic
-    client = anthropic.Anthropic(api_key=api_key)
+_REPORT_JSON_SYSTEM = "Voc\u00ea \u00e9 um analista financeiro s\u00eanior. Responda SOMENTE com JSON v\u00e1lido, sem markdown."
+
+
+def _submit_report_prompt(api_key, prompt, use_cache=True):
+    """Envia um prompt do relatório ao pool de LLM (Future com o texto)."""
+    return report_llm.submit('anthropic', api_key, [{'role': 'user', 'content': prompt}],
+                             _REPORT_JSON_SYSTEM, max_tokens=8192, use_cache=use_cache,
+                             validate=_is_complete_report_json)
+
+
+def _strip_json_fences(text):
+    """Texto da resposta sem cercas markdown (```json ... ```)."""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else text[3:]
+        if text.endswith('```'):
+            text = text[:-3]
+        if text.startswith('json'):
+            text = text[4:]
+        text = text.strip()
+    return text
+
+
+def _is_complete_report_json(text):
+    """Resposta é um objeto/lista JSON completo (sem reparo de truncamento).
+
+    Usado como `validate` do cache de LLM: respostas truncadas ou fora do
+    formato ainda são aproveitadas uma vez por `_parse_report_json`, mas não
+    ficam no cache.
+    """
+    return isinstance(json_module.loads(_strip_json_fences(text)), (dict, list))
+
+
+def _parse_report_json(text, label, validate_urls=True):
+    """JSON da resposta da LLM (sem cercas markdown, reparado se truncado)."""
+    text = _strip_json_fences(text)
+
+    import json as json_mod
+    try:
+        result = json_mod.loads(text)
+    except json_mod.JSONDecodeError:
+        result = _repair_truncated_json(text)
+    if validate_urls:
+        try:
+            _validate_and_tag_urls(result)
+        except Exception as e:
+            logger.warning(f"URL validation failed for {label}: {e}")
+    return result
+
 
+def _report_narratives_prompt(sectors_data, ranking, fiscal_year):
+    """Prompt das narrativas analíticas do relatório (contexto estatístico incluso)."""
     # Preparar contexto compacto
     ctx_lines = [f"ESTUDO DE MULTIPLOS DE MERCADO - Ano fiscal: {fiscal_year}",
                  f"Total de setores: {len(sectors_data)}\n"]
@@ -8541,32 +8081,7 @@ DIRETRIZES DE COMPLIANCE (OBRIGATÓRIAS):
 - Distinguir explicitamente entre fatos (dados) e interpretação analítica.
 - Este material é informativo e educacional. Não constitui recomendação de investimento."""
 
-    response = client.messages.create(
-        model='claude-sonnet-4-20250514',
-        max_tokens=8192,
-        system="Voc\u00ea \u00e9 um analista financeiro s\u00eanior. Responda SOMENTE com JSON v\u00e1lido, sem markdown.",
-        messages=[{'role': 'user', 'content': prompt}]
-    )
-
-    text = response.content[0].text.strip()
-    if text.startswith('```'):
-        text = text.split('\n', 1)[1] if '\n' in text else text[3:]
-        if text.endswith('```'):
-            text = text[:-3]
-        if text.startswith('json'):
-            text = text[4:]
-        text = text.strip()
-
-    import json as json_mod
-    try:
-        result = json_mod.loads(text)
-    except json_mod.JSONDecodeError:
-        result = _repair_truncated_json(text)
-    try:
-        _validate_and_tag_urls(result)
-    except Exception as e:
-        logger.warning(f"URL validation failed for narratives: {e}")
-    return result
+    return prompt
 
 
 # ========================================================================
@@ -8919,11 +8434,8 @@ DIRETRIZES DE COMPLIANCE (OBRIGATÓRIAS):
 # AI GRAPH COMMENTS - Análises específicas por gráfico
 # ========================================================================
 
-def _generate_graph_comments(api_key, sectors_data, ranking, fiscal_year):
-    """Gera comentários analíticos específicos para cada gráfico do relatório."""
-    import anthropic
-    client = anthropic.Anthropic(api_key=api_key)
-
+def _graph_comments_prompt(sectors_data, ranking, fiscal_year):
+    """Prompt dos comentários analíticos específicos de cada gráfico do relatório."""
     # Preparar dados resumidos
     ranking_txt = "\n".join([
         f"  {r['sector']}: Global {r.get('ev_ebitda_median','N/D')}x | BR {r.get('br_ev_ebitda','N/D')}x | Spread {r.get('br_spread_pct','N/D')}%"
@@ -8992,32 +8504,7 @@ DIRETRIZES DE COMPLIANCE (OBRIGATÓRIAS):
 - Use linguagem condicional: "os dados indicam", "observa-se", "pode refletir".
 - Este material é informativo e não constitui recomendação de investimento."""
 
-    response = client.messages.create(
-        model='claude-sonnet-4-20250514',
-        max_tokens=8192,
-        system="Você é um analista financeiro sênior. Responda SOMENTE com JSON válido, sem markdown.",
-        messages=[{'role': 'user', 'content': prompt}]
-    )
-
-    text = response.content[0].text.strip()
-    if text.startswith('```'):
-        text = text.split('\n', 1)[1] if '\n' in text else text[3:]
-        if text.endswith('```'):
-            text = text[:-3]
-        if text.startswith('json'):
-            text = text[4:]
-        text = text.strip()
-
-    import json as json_mod
-    try:
-        result = json_mod.loads(text)
-    except json_mod.JSONDecodeError:
-        result = _repair_truncated_json(text)
-    try:
-        _validate_and_tag_urls(result)
-    except Exception as e:
-        logger.warning(f"URL validation failed for graph_comments: {e}")
-    return result
+    return prompt
 
 
 # ========================================================================
@@ -9040,9 +8527,6 @@ def api_estudoanloc_sector_deep_analysis():
         if not api_key:
             return jsonify({'success': False, 'error': 'API key não configurada'}), 400
 
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-
         # Construir contexto detalhado do setor
         ctx_parts = [f"ANÁLISE APROFUNDADA DO SETOR: {sector_name}", f"Ano fiscal: {fiscal_year}\n"]
 
@@ -9169,27 +8653,12 @@ DIRETRIZES DE COMPLIANCE (OBRIGATÓRIAS):
 - Use linguagem condicional: "os dados indicam", "sugere", "pode refletir".
 - Este material é informativo e não constitui recomendação de investimento."""
 
-        response = client.messages.create(
-            model='claude-sonnet-4-20250514',
-            max_tokens=8192,
-            system="Você é um analista financeiro sênior especializado em valuation setorial. Responda SOMENTE com JSON válido, sem markdown.",
-            messages=[{'role': 'user', 'content': prompt}]
-        )
-
-        text = response.content[0].text.strip()
-        if text.startswith('```'):
-            text = text.split('\n', 1)[1] if '\n' in text else text[3:]
-            if text.endswith('```'):
-                text = text[:-3]
-            if text.startswith('json'):
-                text = text[4:]
-            text = text.strip()
-
-        import json as json_mod
-        try:
-            result = json_mod.loads(text)
-        except json_mod.JSONDecodeError:
-            result = _repair_truncated_json(text)
+        text = report_llm.complete(
+            'anthropic', api_key, [{'role': 'user', 'content': prompt}],
+            "Você é um analista financeiro sênior especializado em valuation setorial. Responda SOMENTE com JSON válido, sem markdown.",
+            max_tokens=8192, use_cache=not data.get('refresh_llm', False),
+            validate=_is_complete_report_json)
+        result = _parse_report_json(text, 'sector_deep_analysis', validate_urls=False)
         return jsonify({'success': True, 'analysis': result})
 
     except Exception as e:
@@ -9275,7 +8744,7 @@ def api_company_updates_start():
         data = request.get_json()
         job_type = data.get('job_type', '')
         filters = data.get('filters', {})
-        result = start_job(job_type, filters)
+        result = start_job(job_type, filters, job_types=data.get('job_types'))
         return jsonify(result)
     except Exception as e:
         logger.error(f"Erro start job: {e}")
@@ -9284,10 +8753,10 @@ def api_company_updates_start():
 
 @app.route('/api/company-updates/progress', methods=['GET'])
 def api_company_updates_progress():
-    """Retorna o progresso do job ativo."""
+    """Retorna o progresso de um job (padrão: o mais recente)."""
     try:
         from company_update_manager import get_progress
-        progress = get_progress()
+        progress = get_progress(request.args.get('job_id', type=int))
         return jsonify({'success': True, 'progress': progress})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -9295,10 +8764,10 @@ def api_company_updates_progress():
 
 @app.route('/api/company-updates/cancel', methods=['POST'])
 def api_company_updates_cancel():
-    """Cancela o job ativo."""
+    """Cancela um job (padrão: todos os ativos)."""
     try:
         from company_update_manager import cancel_job
-        result = cancel_job()
+        result = cancel_job((request.get_json(silent=True) or {}).get('job_id'))
         return jsonify(result)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -0,0 +1,168 @@
+"""
+company_snapshot.py — Snapshot colunar em memória de damodaran_global.
+
+`CompanyAnalyzer.get_companies_data` rodava `SELECT dg.*, cbd.about ...
+ORDER BY market_cap DESC` a cada request, e `/api/company/<nome>/analysis`
+carregava a tabela inteira para escolher uma linha. Aqui a mesma consulta
+roda uma vez e fica em memória:
+
+- colunas tipadas (arrays NumPy; numéricas em float64/int64);
+- códigos categóricos para país/região/setor (filtros viram `np.isin`
+  sobre inteiros em vez de comparações de string);
+- registros já prontos para JSON (NaN → None), na ordem do ORDER BY;
+- índices hash nome → linha e ticker → linha (primeira ocorrência, que é
+  a de maior market cap, como no `df[...].iloc[0]` antigo).
+
+O snapshot é recarregado quando o arquivo do banco (ou o -wal) muda.
+"""
+from __future__ import annotations
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_QUERY = """
+    SELECT
+        dg.*,
+        cbd.about
+    FROM damodaran_global dg
+    LEFT JOIN company_basic_data cbd ON cbd.ticker = dg.ticker
+    ORDER BY dg.market_cap DESC
+"""
+
+# Colunas com poucos valores distintos → códigos inteiros
+CATEGORICAL_COLUMNS = ("country", "sub_group", "broad_group",
+                       "industry", "industry_group", "primary_sector")
+
+# Filtro da API → coluna (mesma hierarquia do SQL antigo: o primeiro presente vence)
+GEO_FILTERS = (("countries", "country"), ("subregions", "sub_group"), ("regions", "broad_group"))
+SECTOR_FILTERS = (("industries", "industry"), ("subsectors", "industry_group"), ("sectors", "primary_sector"))
+
+
+def _file_stamp(path: str) -> tuple:
+    stamp = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class CompanySnapshot:
+    """damodaran_global + about em colunas NumPy, na ordem de market cap."""
+
+    def __init__(self, frame: pd.DataFrame, stamp=None):
+        self.stamp = stamp
+        self.frame = frame.reset_index(drop=True)
+        self.size = len(self.frame)
+        self.columns = {c: self.frame[c].to_numpy() for c in self.frame.columns}
+
+        self.codes: dict[str, np.ndarray] = {}
+        self.code_of: dict[str, dict] = {}
+        for col in CATEGORICAL_COLUMNS:
+            if col in self.frame.columns:
+                codes, uniques = pd.factorize(self.frame[col])
+                self.codes[col] = codes
+                self.code_of[col] = {v: i for i, v in enumerate(uniques)}
+
+        # Filtro de market cap em float (texto não numérico → NaN, fica de fora)
+        self.market_cap = (pd.to_numeric(self.frame["market_cap"], errors="coerce").to_numpy(dtype=float)
+                           if "market_cap" in self.frame.columns else np.full(self.size, np.nan))
+
+        self.records = self.frame.replace({np.nan: None}).to_dict("records")
+
+        self.by_name: dict = {}
+        self.by_ticker: dict = {}
+        for col, index in (("company_name", self.by_name), ("ticker", self.by_ticker)):
+            if col in self.frame.columns:
+                for i, v in enumerate(self.columns[col]):
+                    if v is not None and v == v:
+                        index.setdefault(v, i)
+
+    @classmethod
+    def load(cls, conn, stamp=None) -> "CompanySnapshot":
+        return cls(pd.read_sql_query(SNAPSHOT_QUERY, conn), stamp)
+
+    # ── Filtros ──────────────────────────────────────────────────
+    def _isin(self, col: str, values) -> np.ndarray:
+        if col not in self.codes:
+            return np.zeros(self.size, dtype=bool)
+        code_of = self.code_of[col]
+        wanted = [code_of[v] for v in values if v in code_of]
+        return np.isin(self.codes[col], wanted)
+
+    def mask(self, filters: dict | None = None) -> np.ndarray:
+        """Máscara booleana equivalente ao WHERE de get_companies_data."""
+        mask = np.ones(self.size, dtype=bool)
+        if not filters:
+            return mask
+        for group in (GEO_FILTERS, SECTOR_FILTERS):
+            for key, col in group:
+                if key in filters:
+                    mask &= self._isin(col, filters[key])
+                    break
+        with np.errstate(invalid="ignore"):
+            if "min_market_cap" in filters:
+                mask &= self.market_cap >= float(filters["min_market_cap"])
+            if "max_market_cap" in filters:
+                mask &= self.market_cap <= float(filters["max_market_cap"])
+        return mask
+
+    def positions(self, filters: dict | None = None) -> np.ndarray:
+        return np.flatnonzero(self.mask(filters))
+
+    def frame_for(self, filters: dict | None = None) -> pd.DataFrame:
+        """DataFrame próprio do chamador (pode ser alterado sem afetar o snapshot).
+
+        Sem filtros é uma cópia rasa: com Copy-on-Write (pandas 3) os dados só
+        são duplicados se o chamador escrever nela.
+        """
+        if not filters:
+            return self.frame.copy(deep=False)
+        return self.frame.take(self.positions(filters)).reset_index(drop=True)
+
+    def records_for(self, filters: dict | None = None) -> list[dict]:
+        """Registros compartilhados com o snapshot: somente leitura (ex.: jsonify).
+
+        A lista é nova, mas os dicts são os do cache de todas as requisições;
+        quem precisar alterar um registro deve copiá-lo (`dict(r)`).
+        """
+        if not filters:
+            return list(self.records)
+        records = self.records
+        return [records[i] for i in self.positions(filters)]
+
+    # ── Lookup de uma empresa ────────────────────────────────────
+    def find(self, name: str | None = None, ticker: str | None = None) -> dict | None:
+        """Registro por nome exato (ou ticker); None se não encontrado."""
+        pos = self.by_name.get(name) if name is not None else None
+        if pos is None and ticker is not None:
+            pos = self.by_ticker.get(ticker)
+        return dict(self.records[pos]) if pos is not None else None
+
+
+# ─── Cache por banco ─────────────────────────────────────────────────────────
+
+_snapshots: dict[str, CompanySnapshot] = {}
+_lock = threading.Lock()
+
+
+def get_company_snapshot(db_path: str, connect) -> CompanySnapshot:
+    """Snapshot de `db_path`, recarregado quando o arquivo do banco muda."""
+    stamp = _file_stamp(db_path)
+    snap = _snapshots.get(db_path)
+    if snap is not None and snap.stamp == stamp:
+        return snap
+    with _lock:
+        snap = _snapshots.get(db_path)
+        if snap is None or snap.stamp != stamp:
+            conn = connect()
+            try:
+                snap = _snapshots[db_path] = CompanySnapshot.load(conn, stamp)
+            finally:
+                conn.close()
+    return snap
@@ -2,26 +2,30 @@
 company_update_manager.py — Backend para atualização de dados de empresas.
 
 Gerencia jobs de atualização com:
-- Tabela update_jobs para histórico
-- SSE para progress em tempo real
+- Tabela update_jobs para histórico e fila persistente de tarefas
+- Grafo de etapas (job_scheduler.py): etapas independentes e shards por
+  setor/país rodam em paralelo como subprocessos
+- Progresso estruturado (scripts/job_progress.py) em tempo real
 - Filtros por setor/indústria/país/exchange
-- Execução de scripts existentes como subprocessos
 """
 from __future__ import annotations
 
-import json
 import os
 import sqlite3
-import subprocess
 import sys
 import threading
-import time
 from datetime import datetime
 from pathlib import Path
-from typing import Generator
+
+from dashboard_kpis import refresh_dashboard_kpis
+from job_scheduler import JobScheduler, TaskSpec
+from result_cache import bump_data_version
+from scripts.build_sector_multiples import invalidate_snapshot
+from scripts.validate_data_consistency import refresh_data_quality
+from search_index import ensure_search_index
 
 DB_PATH = Path("data/damodaran_data_new.db")
-PROGRESS_FILE = Path("cache/_company_update_progress.json")
+JOBS_STATE_DIR = Path("cache/_jobs")  # progresso (JSON) e log de cada tarefa
 
 
 # ─── Setup DB ──────────────────────────────────────────────────────────────────
@@ -64,6 +68,13 @@ def ensure_update_tables(db_path: Path | None = None):
         CREATE INDEX IF NOT EXISTS idx_price_history_date ON price_history(price_date);
         CREATE INDEX IF NOT EXISTS idx_update_jobs_type ON update_jobs(job_type);
     """)
+    # Migração: colunas da fila de tarefas (linhas com parent_id são tarefas de um job)
+    existing = {r[1] for r in conn.execute("PRAGMA table_info(update_jobs)")}
+    for col in ("parent_id INTEGER", "task_key TEXT", "label TEXT", "command TEXT",
+                "resource TEXT", "depends_on TEXT", "worker TEXT"):
+        if col.split()[0] not in existing:
+            conn.execute(f"ALTER TABLE update_jobs ADD COLUMN {col}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_update_jobs_parent ON update_jobs(parent_id, status)")
     conn.commit()
     conn.close()
 
@@ -130,7 +141,7 @@ def get_database_stats(db_path: Path | None = None) -> dict:
         rows = conn.execute("""
             SELECT id, job_type, status, total_items, processed_items, success_items, 
                    error_items, started_at, completed_at, duration_seconds, filters
-            FROM update_jobs ORDER BY id DESC LIMIT 20
+            FROM update_jobs WHERE parent_id IS NULL ORDER BY id DESC LIMIT 20
         """).fetchall()
         for r in rows:
             stats["recent_jobs"].append({
@@ -341,81 +352,248 @@ def get_filtered_stats(filters: dict, db_path: Path | None = None) -> dict:
 
 # ─── Job Execution ─────────────────────────────────────────────────────────────
 
-# Active job tracking
-_active_job: dict | None = None
-_job_lock = threading.Lock()
-
+# Etapas que só leem/escrevem o SQLite (um escritor por vez); as demais vão à rede
+DB_STAGES = {"calculate_ttm", "recalculate_ratios", "recalculate_fx", "sector_multiples"}
+# Buscas divididas em shards por setor (ou por país, se o setor já foi filtrado)
+SHARDED_STAGES = {"historical_annual", "historical_quarterly"}
+MAX_SHARDS = 16
+
+# Quem depende de quem quando várias etapas são pedidas juntas. Etapas fora
+# desta tabela (ou cujas dependências não foram pedidas) rodam em paralelo.
+STAGE_DEPS = {
+    "prices": ("basic_data",),  # mesmo script e mesmas linhas de company_basic_data
+    "calculate_ttm": ("historical_annual", "historical_quarterly"),
+    "recalculate_ratios": ("calculate_ttm",),
+    "recalculate_fx": ("recalculate_ratios",),
+    "sector_multiples": ("recalculate_fx",),
+}
+STAGE_ORDER = ("discover_tickers", "basic_data", "prices", "etf_holdings",
+               "historical_annual", "historical_quarterly",
+               "calculate_ttm", "recalculate_ratios", "recalculate_fx", "sector_multiples")
+JOB_LABELS = {
+    "discover_tickers": "Descoberta",
+    "basic_data": "Cadastral Yahoo",
+    "prices": "Preços",
+    "etf_holdings": "Holdings ETFs",
+    "historical_annual": "Financeiro Anual",
+    "historical_quarterly": "Financeiro Trimestral",
+    "calculate_ttm": "TTM",
+    "recalculate_ratios": "Ratios",
+    "recalculate_fx": "FX Rates",
+    "sector_multiples": "Snapshot múltiplos",
+}
+# Etapas que gravam company_financials_historical, lida pelo
+# sector_multiples_snapshot: pedir qualquer uma encadeia a reconstrução do
+# snapshot no fim do grafo (senão o Estudo Anloc segue com números antigos)
+SNAPSHOT_SOURCES = {"historical_annual", "historical_quarterly", "calculate_ttm",
+                    "recalculate_ratios", "recalculate_fx"}
+PIPELINE_STAGES = ("historical_annual", "historical_quarterly", "calculate_ttm",
+                   "recalculate_ratios", "recalculate_fx", "sector_multiples")
+
+_scheduler: JobScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def _on_job_done(job_id: int, job_type: str, db_path: str):
+    """Pós-job: mesmo jobs com erro/cancelados podem ter gravado parte dos dados."""
+    try:
+        refresh_data_quality(db_path)  # só as linhas gravadas desde a última validação
+    except sqlite3.Error:
+        pass  # a próxima execução pega as mesmas linhas (row_version não avançou)
+    bump_data_version(f"update_job:{job_type}:{job_id}")
+    try:
+        refresh_dashboard_kpis(db_path)
+    except sqlite3.Error:
+        pass  # mantém os KPIs anteriores; o próximo job tenta de novo
+    try:
+        ensure_search_index(db_path)  # scripts do job podem ter recriado tabelas
+    except sqlite3.Error:
+        pass  # as buscas voltam ao LIKE até a próxima tentativa
+    try:
+        _invalidate_stale_snapshot(job_id, db_path)
+    except sqlite3.Error:
+        pass
 
-def _write_progress(data: dict):
-    """Escreve progresso para arquivo JSON."""
-    PROGRESS_FILE.parent.mkdir(exist_ok=True)
-    PROGRESS_FILE.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
 
+def _invalidate_stale_snapshot(job_id: int, db_path: str):
+    """Snapshot encadeado que não concluiu (fonte falhou/cancelada) → descarta.
 
-def get_progress() -> dict | None:
-    """Lê progresso atual."""
-    if PROGRESS_FILE.exists():
-        try:
-            return json.loads(PROGRESS_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            pass
-    return None
+    As fontes podem ter gravado parte dos dados; sem o snapshot os endpoints
+    do Estudo Anloc usam as queries diretas até a próxima reconstrução.
+    """
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    try:
+        row = conn.execute(
+            "SELECT status FROM update_jobs WHERE parent_id = ? AND job_type = 'sector_multiples'",
+            (job_id,)).fetchone()
+        if row is not None and row[0] != "completed":
+            invalidate_snapshot(conn)
+    finally:
+        conn.close()
 
 
-def start_job(job_type: str, filters: dict, db_path: Path | None = None) -> dict:
-    """Inicia um job de atualização em background."""
-    global _active_job
-    
-    with _job_lock:
-        if _active_job and _active_job.get("status") == "running":
-            return {"success": False, "error": "Já existe um job em execução", "job": _active_job}
-    
-    db = str(db_path or DB_PATH)
+def get_scheduler(db_path: Path | None = None) -> JobScheduler:
+    """Scheduler do processo (criado na 1ª chamada, retomando a fila do banco)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            db = str(db_path or DB_PATH)
+            ensure_update_tables(Path(db))
+            limits = {"network": int(os.environ.get("UPDATE_JOB_PARALLEL", 3))}
+            _scheduler = JobScheduler(db, limits=limits, workdir=Path(__file__).parent,
+                                      state_dir=JOBS_STATE_DIR, on_job_done=_on_job_done)
+            _scheduler.resume()
+        return _scheduler
+
+
+def get_progress(job_id: int | None = None) -> dict | None:
+    """Progresso do job (padrão: o mais recente)."""
+    scheduler = get_scheduler()
+    if job_id is None:
+        conn = sqlite3.connect(scheduler.db_path)
+        try:
+            row = conn.execute("SELECT MAX(id) FROM update_jobs WHERE parent_id IS NULL").fetchone()
+        finally:
+            conn.close()
+        job_id = row[0] if row else None
+        if job_id is None:
+            return None
+    return scheduler.progress(job_id)
+
+
+def _shards(filters: dict, db: str) -> list[dict]:
+    """Filtros de cada shard das buscas (lista vazia = não dividir).
+
+    Divide por setor; se o setor já está filtrado, por país. Empresas sem
+    valor na coluna ficam num shard próprio (`unclassified`).
+    """
+    if filters.get("sector") and filters.get("country"):
+        return []
+    dim, column = ("country", "yahoo_country") if filters.get("sector") else ("sector", "yahoo_sector")
+    where = ["yahoo_code IS NOT NULL AND yahoo_code != ''", "COALESCE(yahoo_no_data, 0) = 0"]
+    params = []
+    for key, col in (("sector", "yahoo_sector"), ("industry", "yahoo_industry"), ("country", "yahoo_country")):
+        if filters.get(key):
+            where.append(f"{col} = ?")
+            params.append(filters[key])
     conn = sqlite3.connect(db)
-    ensure_update_tables(Path(db))
-    
-    # Criar registro do job
-    filters_json = json.dumps(filters, ensure_ascii=False)
-    cur = conn.execute(
-        "INSERT INTO update_jobs (job_type, status, filters, started_at) VALUES (?, 'running', ?, ?)",
-        (job_type, filters_json, datetime.now().isoformat())
-    )
-    job_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    
-    # Montar comando
-    cmd = _build_command(job_type, filters)
-    if not cmd:
-        return {"success": False, "error": f"Tipo de job desconhecido: {job_type}"}
-    
-    # Iniciar em background
-    _active_job = {
-        "id": job_id,
-        "job_type": job_type,
-        "status": "running",
-        "filters": filters,
-        "started_at": datetime.now().isoformat(),
-    }
-    
-    _write_progress({
+    try:
+        rows = conn.execute(f"""
+            SELECT NULLIF({column}, ''), COUNT(*) FROM company_basic_data
+            WHERE {' AND '.join(where)} GROUP BY 1 ORDER BY 2 DESC
+        """, params).fetchall()
+    finally:
+        conn.close()
+    if len(rows) < 2 or len(rows) > MAX_SHARDS:
+        return []
+    return [dict(filters, **{dim: value}) if value is not None else dict(filters, unclassified=dim)
+            for value, _ in rows]
+
+
+def _shard_label(filters: dict, base: dict) -> str:
+    if filters.get("unclassified"):
+        return f"sem {'setor' if filters['unclassified'] == 'sector' else 'país'}"
+    return filters.get("country") if base.get("sector") else filters.get("sector")
+
+
+def plan_tasks(job_types: list[str], filters: dict, db: str, pipeline: bool = False) -> list[TaskSpec]:
+    """Grafo de tarefas para as etapas pedidas.
+
+    Buscas históricas viram um shard (subprocesso) por setor/país. No
+    pipeline, o TTM de cada setor roda assim que anual + trimestral daquele
+    setor terminam, e um TTM incremental final cobre o restante.
+    """
+    stages = [s for s in STAGE_ORDER if s in set(job_types)]
+    unknown = set(job_types) - set(STAGE_ORDER)
+    if unknown:
+        raise ValueError(f"Tipo de job desconhecido: {', '.join(sorted(unknown))}")
+    if SNAPSHOT_SOURCES & set(stages) and "sector_multiples" not in stages:
+        stages.append("sector_multiples")  # depende das fontes via STAGE_DEPS
+
+    shards = _shards(filters, db) if SHARDED_STAGES & set(stages) else []
+    specs: list[TaskSpec] = []
+    keys_by_stage: dict[str, list[str]] = {}
+
+    def deps_of(stage: str) -> tuple:
+        # Dependências pedidas; as não pedidas são atravessadas (transitivo)
+        out, todo = [], list(STAGE_DEPS.get(stage, ()))
+        while todo:
+            dep = todo.pop(0)
+            if dep in keys_by_stage:
+                out.extend(keys_by_stage[dep])
+            elif dep not in stages:
+                todo.extend(STAGE_DEPS.get(dep, ()))
+        return tuple(dict.fromkeys(out))
+
+    sharded = [s for s in stages if s in SHARDED_STAGES] if shards else []
+    for stage in stages:
+        resource = "db" if stage in DB_STAGES else "network"
+        if stage in sharded:
+            if stage != sharded[0]:
+                continue
+            # Fila intercalada por shard (anual e trimestral do mesmo setor
+            # lado a lado): o TTM de cada setor fica liberado mais cedo
+            for shard in shards:
+                label = _shard_label(shard, filters)
+                for sharded_stage in sharded:
+                    key = f"{sharded_stage}:{label}"
+                    specs.append(TaskSpec(key, sharded_stage, _build_command(sharded_stage, shard),
+                                          deps_of(sharded_stage), resource,
+                                          f"{JOB_LABELS[sharded_stage]} — {label}"))
+                    keys_by_stage.setdefault(sharded_stage, []).append(key)
+            continue
+
+        cmd = _build_command(stage, filters)
+        deps = deps_of(stage)
+        if stage == "calculate_ttm" and pipeline:
+            cmd = cmd + ["--incremental"]
+            if shards and not filters.get("sector") and keys_by_stage.keys() >= SHARDED_STAGES:
+                # TTM por setor em paralelo com as buscas dos outros setores
+                sector_ttm = []
+                for shard in shards:
+                    if not shard.get("sector"):
+                        continue
+                    key = f"calculate_ttm:{shard['sector']}"
+                    shard_deps = tuple(f"{s}:{shard['sector']}" for s in sorted(SHARDED_STAGES))
+                    specs.append(TaskSpec(key, stage, _build_command(stage, shard) + ["--incremental"],
+                                          shard_deps, "db", f"{JOB_LABELS[stage]} — {shard['sector']}"))
+                    sector_ttm.append(key)
+                deps = tuple(dict.fromkeys(deps + tuple(sector_ttm)))
+        specs.append(TaskSpec(stage, stage, cmd, deps, resource, JOB_LABELS.get(stage, stage)))
+        keys_by_stage[stage] = [stage]
+    return specs
+
+
+def start_job(job_type: str, filters: dict, db_path: Path | None = None,
+              job_types: list[str] | None = None) -> dict:
+    """Enfileira um job (uma etapa, várias etapas ou o pipeline completo).
+
+    Jobs não se bloqueiam mais: as tarefas entram na fila do scheduler e
+    rodam conforme dependências e limites de concorrência.
+    """
+    db = str(db_path or DB_PATH)
+    scheduler = get_scheduler(Path(db))
+    if job_type == "full_pipeline":
+        stages, pipeline = list(PIPELINE_STAGES), True
+    elif job_type == "batch":
+        stages, pipeline = list(job_types or []), False
+    else:
+        stages, pipeline = [job_type], False
+    try:
+        specs = plan_tasks(stages, filters, db, pipeline=pipeline)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    if not specs:
+        return {"success": False, "error": "Nenhuma etapa selecionada"}
+
+    job_id = scheduler.submit(job_type, dict(filters, job_types=stages) if job_type == "batch" else filters, specs)
+    return {
+        "success": True,
         "job_id": job_id,
-        "job_type": job_type,
-        "status": "running",
-        "phase": "Iniciando...",
-        "pct": 0,
-        "current": 0,
-        "total": 0,
-    })
-    
-    thread = threading.Thread(
-        target=_run_job_thread,
-        args=(job_id, job_type, cmd, db),
-        daemon=True,
-    )
-    thread.start()
-    
-    return {"success": True, "job_id": job_id, "command": " ".join(cmd)}
+        "tasks": [{"key": s.key, "label": s.label, "depends_on": list(s.deps), "resource": s.resource}
+                  for s in specs],
+        "command": " ".join(specs[0].cmd) if len(specs) == 1 else f"{len(specs)} tarefas",
+    }
 
 
 def _build_command(job_type: str, filters: dict) -> list[str] | None:
@@ -440,6 +618,10 @@ def _build_command(job_type: str, filters: dict) -> list[str] | None:
             args.extend(["--industry", industry])
         if country:
             args.extend(["--country", country])
+        if filters.get("unclassified"):
+            args.extend(["--unclassified", filters["unclassified"]])
+        if filters.get("processes"):
+            args.extend(["--processes", str(filters["processes"])])
         if force:
             args.append("--force")
         return args
@@ -493,174 +675,18 @@ def _build_command(job_type: str, filters: dict) -> list[str] | None:
             cmd.extend(["--sector", sector])
         return cmd
     
-    elif job_type == "full_pipeline":
-        # Pipeline inicia com annual fetch, demais steps encadeados em _run_pipeline_continuation
-        return [python, "scripts/fetch_historical_financials.py"] + _hist_args()
+    elif job_type == "sector_multiples":
+        return [python, "scripts/build_sector_multiples.py"]
     
-    return None
-
-
-def _run_job_thread(job_id: int, job_type: str, cmd: list[str], db_path: str):
-    """Executa o job em thread separada, monitorando saída."""
-    global _active_job
-    start_time = time.time()
+    elif job_type == "etf_holdings":
+        return [python, "scripts/batch_extract_holdings.py"]
     
-    try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            encoding="utf-8",
-            errors="replace",
-            bufsize=1,
-            cwd=str(Path(__file__).parent),
-        )
-        
-        output_lines = []
-        processed = 0
-        success = 0
-        errors = 0
-        total = 0
-        
-        for line in process.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            output_lines.append(line)
-            
-            # Parse progress from script output
-            if "Processando" in line or "Processing" in line:
-                processed += 1
-            if "OK" in line or "✓" in line or "sucesso" in line.lower():
-                success += 1
-            if "ERRO" in line or "Error" in line or "✗" in line:
-                errors += 1
-            if "Total:" in line or "empresas" in line.lower():
-                import re
-                match = re.search(r'(\d[\d,.]+)\s*(empresas|companies|total)', line.lower())
-                if match:
-                    try:
-                        total = int(match.group(1).replace(",", "").replace(".", ""))
-                    except ValueError:
-                        pass
-            
-            # Update progress
-            pct = min(99, int(100 * processed / max(total, 1))) if total > 0 else 0
-            _write_progress({
-                "job_id": job_id,
-                "job_type": job_type,
-                "status": "running",
-                "phase": line[:120],
-                "pct": pct,
-                "current": processed,
-                "total": total,
-                "success": success,
-                "errors": errors,
-            })
-        
-        process.wait()
-        duration = time.time() - start_time
-        final_status = "completed" if process.returncode == 0 else "error"
-        
-        # Se é pipeline completo, encadear próximo passo
-        if job_type == "full_pipeline" and process.returncode == 0:
-            _run_pipeline_continuation(job_id, db_path, output_lines)
-        
-        # Atualizar DB
-        conn = sqlite3.connect(db_path)
-        conn.execute("""
-            UPDATE update_jobs SET 
-                status = ?, total_items = ?, processed_items = ?, 
-                success_items = ?, error_items = ?,
-                completed_at = ?, duration_seconds = ?,
-                error_log = ?
-            WHERE id = ?
-        """, (final_status, total, processed, success, errors,
-              datetime.now().isoformat(), duration,
-              "\n".join(output_lines[-50:]) if output_lines else None,
-              job_id))
-        conn.commit()
-        conn.close()
-        
-        _write_progress({
-            "job_id": job_id,
-            "job_type": job_type,
-            "status": final_status,
-            "phase": "Concluído!" if final_status == "completed" else "Erro",
-            "pct": 100 if final_status == "completed" else pct,
-            "current": processed,
-            "total": total,
-            "success": success,
-            "errors": errors,
-            "duration": round(duration, 1),
-        })
-        
-    except Exception as e:
-        duration = time.time() - start_time
-        conn = sqlite3.connect(db_path)
-        conn.execute(
-            "UPDATE update_jobs SET status='error', error_log=?, completed_at=?, duration_seconds=? WHERE id=?",
-            (str(e), datetime.now().isoformat(), duration, job_id)
-        )
-        conn.commit()
-        conn.close()
-        
-        _write_progress({
-            "job_id": job_id,
-            "job_type": job_type,
-            "status": "error",
-            "phase": f"Erro: {e}",
-            "pct": 0,
-        })
-    finally:
-        with _job_lock:
-            _active_job = None
+    return None
 
 
-def _run_pipeline_continuation(job_id: int, db_path: str, prev_output: list):
-    """Encadeia steps do pipeline: quarterly → TTM → ratios → FX."""
-    python = sys.executable
-    steps = [
-        ("quarterly", [python, "scripts/fetch_historical_financials.py", "--quarterly", "--workers", "3", "--max-rps", "2"]),
-        ("TTM", [python, "scripts/calculate_ttm.py"]),
-        ("Ratios", [python, "scripts/recalculate_ratios.py"]),
-        ("FX", [python, "scripts/recalculate_fx_rates.py"]),
-    ]
-    
-    for step_name, cmd in steps:
-        _write_progress({
-            "job_id": job_id,
-            "job_type": "full_pipeline",
-            "status": "running",
-            "phase": f"Pipeline: {step_name}...",
-            "pct": 50,
-        })
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True, text=True, encoding="utf-8", errors="replace",
-            cwd=str(Path(__file__).parent),
-        )
-        prev_output.append(f"--- {step_name} ---")
-        prev_output.append(result.stdout[-500:] if result.stdout else "")
-        if result.returncode != 0:
-            prev_output.append(f"ERRO: {result.stderr[-300:]}")
-            break
-
-
-def cancel_job() -> dict:
-    """Cancela o job ativo."""
-    global _active_job
-    with _job_lock:
-        if _active_job:
-            _active_job["status"] = "cancelled"
-            _write_progress({
-                "job_id": _active_job.get("id"),
-                "status": "cancelled",
-                "phase": "Cancelado pelo usuário",
-                "pct": 0,
-            })
-            _active_job = None
-            return {"success": True}
+def cancel_job(job_id: int | None = None) -> dict:
+    """Cancela o job (ou todos os ativos): encerra os subprocessos e esvazia a fila."""
+    cancelled = get_scheduler().cancel(job_id)
+    if cancelled:
+        return {"success": True, "cancelled": cancelled}
     return {"success": False, "error": "Nenhum job ativo"}
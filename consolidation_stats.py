@@ -0,0 +1,105 @@
+"""
+consolidation_stats.py — Estatísticas vetorizadas do /api/historico/consolidated.
+
+A consolidação percorria ~60 métricas × cada ano fiscal refiltrando
+`df[df['fiscal_year'] == ano]` a cada vez (O(métricas × anos × linhas)),
+montava a lista de empresas com um filtro + sort por código e o ranking com
+`iterrows()`. Selecionar um setor inteiro (milhares de códigos) levava
+segundos. Aqui:
+
+- `yearly_stats()` converte as métricas numa matriz float (linhas × métricas),
+  ordena as linhas por ano uma vez e calcula avg/median/min/max/p25/p75/
+  count/sum de todas as métricas de um ano com operações NaN-aware sobre a
+  fatia contígua — um passe agrupado em vez de um filtro por métrica;
+- `latest_rows()` escolhe o período mais recente de cada código com um sort
+  estável + `drop_duplicates`, sem laço por empresa;
+- `records()` devolve dicts com None no lugar de NaN/inf para o jsonify.
+"""
+from __future__ import annotations
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+STATS = ("avg", "median", "min", "max", "p25", "p75", "count", "sum")
+
+
+def float_matrix(df: pd.DataFrame, columns: list) -> np.ndarray:
+    """Colunas como matriz float64 (textos não numéricos → NaN)."""
+    if not columns:
+        return np.empty((len(df), 0))
+    return np.column_stack([pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+                            for c in columns])
+
+
+def yearly_stats(df: pd.DataFrame, metrics: list, year_col: str = "fiscal_year") -> dict:
+    """{métrica: {ano: {avg, median, min, max, p25, p75, count, sum}}}.
+
+    Métricas ausentes do DataFrame são ignoradas; anos sem valores não
+    aparecem na métrica, e métricas sem nenhum valor não aparecem no dict.
+    """
+    metrics = [m for m in metrics if m in df.columns]
+    years = pd.to_numeric(df[year_col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    keep = ~np.isnan(years)
+    if not metrics or not keep.any():
+        return {}
+
+    order = np.argsort(years[keep], kind="stable")
+    years = years[keep][order]
+    matrix = float_matrix(df, metrics)[keep][order]
+    uniq, starts = np.unique(years, return_index=True)
+    bounds = list(starts[1:]) + [len(years)]
+
+    result = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # colunas só com NaN no ano
+        for year, start, end in zip(uniq, starts, bounds):
+            block = matrix[start:end]
+            counts = np.count_nonzero(~np.isnan(block), axis=0)
+            if not counts.any():
+                continue
+            avg = np.nanmean(block, axis=0)
+            median = np.nanmedian(block, axis=0)
+            p25, p75 = np.nanpercentile(block, [25, 75], axis=0)
+            lo = np.nanmin(block, axis=0)
+            hi = np.nanmax(block, axis=0)
+            total = np.nansum(block, axis=0)
+            for j in np.flatnonzero(counts):
+                result.setdefault(metrics[j], {})[int(year)] = {
+                    "avg": float(avg[j]),
+                    "median": float(median[j]),
+                    "min": float(lo[j]),
+                    "max": float(hi[j]),
+                    "p25": float(p25[j]),
+                    "p75": float(p75[j]),
+                    "count": int(counts[j]),
+                    "sum": float(total[j]),
+                }
+    return result
+
+
+def latest_rows(df: pd.DataFrame, key: str = "yahoo_code", order: tuple = ("fiscal_year", "fiscal_quarter")) -> pd.DataFrame:
+    """Linha mais recente de cada `key`, na ordem em que os códigos aparecem.
+
+    "Mais recente" = maior fiscal_year e, no empate (períodos trimestrais),
+    maior fiscal_quarter; NaN conta como mais antigo.
+    """
+    cols = [c for c in order if c in df.columns]
+    if df.empty or not cols:
+        return df.drop_duplicates(key)
+    first_seen = pd.Series(np.arange(len(df)), index=df.index).groupby(df[key].to_numpy()).transform("min")
+    ranked = df.assign(_first_seen=first_seen.to_numpy())
+    ranked = ranked.sort_values(cols, ascending=False, kind="stable", na_position="last")
+    ranked = ranked.drop_duplicates(key).sort_values("_first_seen", kind="stable")
+    return ranked.drop(columns="_first_seen")
+
+
+def records(df: pd.DataFrame, columns: list) -> list[dict]:
+    """`to_dict('records')` com None no lugar de NaN/inf (colunas ausentes → None)."""
+    out = df.reindex(columns=columns)
+    numeric = out.select_dtypes(include="number").columns
+    if len(numeric):
+        out[numeric] = out[numeric].replace([np.inf, -np.inf], np.nan)
+    out = out.astype(object).where(out.notna(), None)
+    return out.to_dict("records")
@@ -0,0 +1,112 @@
+"""
+dashboard_kpis.py — KPIs do dashboard Yahoo (/api/yahoo_dashboard_summary).
+
+Sem filtros, o resumo fazia ~16 consultas COUNT separadas (uma por
+estatística "with_*"/"distinct_*"), cada uma varrendo company_basic_data ou
+damodaran_global. Aqui todas as contagens de cobertura e de distintos saem
+de UMA varredura por tabela, e o resultado fica numa tabela pequena
+`dashboard_kpi_cache` (uma linha por escopo), atualizada ao fim dos jobs de
+atualização. A página inicial passa a custar uma leitura pela PK.
+
+Depois de rodar scripts do pipeline manualmente:
+  python dashboard_kpis.py [--db caminho]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sqlite3
+from datetime import datetime
+
+KPI_TABLE = "dashboard_kpi_cache"
+DEFAULT_SCOPE = "yahoo_summary"
+
+# Colunas de company_basic_data → chave "with_*" (preenchida e não vazia)
+COVERAGE_COLUMNS = (
+    ("about", "with_about"), ("yahoo_sector", "with_sector"),
+    ("yahoo_industry", "with_industry"), ("yahoo_country", "with_country"),
+    ("enterprise_value", "with_ev"), ("market_cap", "with_mcap"),
+    ("currency", "with_currency"), ("yahoo_website", "with_website"),
+)
+
+# Colunas de company_basic_data → chave "distinct_*"
+DISTINCT_COLUMNS = (
+    ("yahoo_sector", "distinct_sectors"), ("yahoo_industry", "distinct_industries"),
+    ("yahoo_country", "distinct_countries"), ("currency", "distinct_currencies"),
+)
+
+
+def compute_dashboard_kpis(conn: sqlite3.Connection) -> dict:
+    """Calcula os KPIs sem filtro com uma varredura por tabela."""
+    select = ["COUNT(*)"]
+    select += [f"COALESCE(SUM({col} IS NOT NULL AND TRIM(CAST({col} AS TEXT)) != ''), 0)"
+               for col, _ in COVERAGE_COLUMNS]
+    select += [f"COUNT(DISTINCT {col})" for col, _ in DISTINCT_COLUMNS]
+    select.append("MAX(updated_at)")
+    row = conn.execute(f"SELECT {', '.join(select)} FROM company_basic_data").fetchone()
+
+    stats = {"total_companies": row[0]}
+    i = 1
+    for _, key in COVERAGE_COLUMNS:
+        stats[key] = row[i]
+        i += 1
+    for _, key in DISTINCT_COLUMNS:
+        stats[key] = row[i]
+        i += 1
+    last_updated = row[i]
+
+    atividades, sic_descs = conn.execute("""
+        SELECT COUNT(DISTINCT atividade_anloc), COUNT(DISTINCT NULLIF(sic_desc, ''))
+        FROM damodaran_global
+    """).fetchone()
+    stats["distinct_atividades"] = atividades
+    stats["distinct_sic_descs"] = sic_descs
+    stats["last_updated"] = last_updated
+    return stats
+
+
+def ensure_kpi_table(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {KPI_TABLE} (
+            scope TEXT PRIMARY KEY,
+            stats_json TEXT NOT NULL,
+            computed_at TEXT NOT NULL
+        )
+    """)
+
+
+def load_dashboard_kpis(conn: sqlite3.Connection, scope: str = DEFAULT_SCOPE) -> dict | None:
+    """KPIs gravados (None se a tabela/linha ainda não existe)."""
+    try:
+        row = conn.execute(f"SELECT stats_json FROM {KPI_TABLE} WHERE scope = ?", (scope,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def refresh_dashboard_kpis(db_path: str, scope: str = DEFAULT_SCOPE) -> dict:
+    """Recalcula e grava os KPIs (chamado ao fim dos jobs de atualização)."""
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    try:
+        stats = compute_dashboard_kpis(conn)
+        ensure_kpi_table(conn)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {KPI_TABLE} (scope, stats_json, computed_at) VALUES (?, ?, ?)",
+            (scope, json.dumps(stats, ensure_ascii=False), datetime.now().isoformat()),
+        )
+        conn.commit()
+        return stats
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula a tabela dashboard_kpi_cache")
+    parser.add_argument("--db", type=str, default="data/damodaran_data_new.db", help="Caminho do banco")
+    args = parser.parse_args()
+    stats = refresh_dashboard_kpis(args.db)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,27 +7,31 @@ import logging
 import requests
 import pandas as pd
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
+from datetime import datetime
+from typing import Callable, Dict, Any, Optional, List
 import time
 import json
 
+from .http_cache import CachedResponse, HTTPCache, get_http_cache
+
 class BaseExtractor(ABC):
     """Classe base abstrata para todos os extratores de dados."""
     
-    def __init__(self, name: str, base_url: str, cache_duration: int = 3600):
+    def __init__(self, name: str, base_url: str, cache_duration: int = 3600,
+                 http_cache: Optional[HTTPCache] = None):
         """
         Inicializa o extrator base.
         
         Args:
             name: Nome do extrator
             base_url: URL base da fonte de dados
-            cache_duration: Duração do cache em segundos (padrão: 1 hora)
+            cache_duration: Duração do cache de resultados em segundos (padrão: 1 hora)
+            http_cache: Cache persistente (padrão: o compartilhado do processo)
         """
         self.name = name
         self.base_url = base_url
         self.cache_duration = cache_duration
-        self.cache = {}
+        self.http_cache = http_cache or get_http_cache()
         self.session = requests.Session()
         self.logger = self._setup_logger()
         
@@ -51,32 +55,25 @@ class BaseExtractor(ABC):
         
         return logger
     
-    def _is_cache_valid(self, cache_key: str) -> bool:
-        """Verifica se o cache ainda é válido."""
-        if cache_key not in self.cache:
-            return False
-        
-        cached_time = self.cache[cache_key].get('timestamp')
-        if not cached_time:
-            return False
-        
-        return (datetime.now() - cached_time).seconds < self.cache_duration
-    
     def _get_from_cache(self, cache_key: str) -> Optional[Any]:
-        """Recupera dados do cache se válidos."""
-        if self._is_cache_valid(cache_key):
+        """Recupera dados do cache persistente se mais novos que `cache_duration`."""
+        data = self.http_cache.get_result(cache_key, max_age=self.cache_duration)
+        if data is not None:
             self.logger.info(f"Dados recuperados do cache: {cache_key}")
-            return self.cache[cache_key]['data']
-        return None
+        return data
     
     def _save_to_cache(self, cache_key: str, data: Any) -> None:
-        """Salva dados no cache."""
-        self.cache[cache_key] = {
-            'data': data,
-            'timestamp': datetime.now()
-        }
+        """Salva dados no cache persistente (compartilhado entre instâncias)."""
+        self.http_cache.put_result(cache_key, data, namespace=self.name)
         self.logger.info(f"Dados salvos no cache: {cache_key}")
     
+    def _parse_cached(self, response: CachedResponse, label: str, parse: Callable[[CachedResponse], Any]) -> Any:
+        """`parse(response)`, reaproveitado enquanto o corpo da resposta não mudar."""
+        if response.from_cache:
+            self.logger.info(f"Conteúdo inalterado ({label}), reutilizando parse")
+        return self.http_cache.memo(f"parse:{label}:{response.key}", response.digest,
+                                    lambda: parse(response), namespace=self.name)
+    
     def _make_request(self, url: str, params: Dict = None, timeout: int = 30) -> requests.Response:
         """Faz uma requisição HTTP com tratamento de erros."""
         try:
@@ -88,11 +85,27 @@ class BaseExtractor(ABC):
             self.logger.error(f"Erro na requisição para {url}: {e}")
             raise
     
-    def _retry_request(self, url: str, params: Dict = None, max_retries: int = 3, delay: int = 1) -> requests.Response:
-        """Faz requisição com retry automático."""
+    def _cached_request(self, url: str, params: Dict = None, headers: Dict = None,
+                        data_type: Optional[str] = None, timeout: int = 30) -> CachedResponse:
+        """GET pelo cache HTTP persistente (TTL por `data_type`, revalidação condicional)."""
+        response = self.http_cache.get(
+            url, params, data_type=data_type, ttl=None if data_type else self.cache_duration,
+            session=self.session, headers=headers, timeout=timeout, namespace=self.name,
+        )
+        if response.from_cache:
+            state = "revalidada (304)" if response.revalidated else "vencida, rede indisponível" if response.stale else "fresca"
+            self.logger.info(f"Resposta em cache ({state}): {url}")
+        else:
+            self.logger.info(f"Fazendo requisição para: {url}")
+        response.raise_for_status()
+        return response
+    
+    def _retry_request(self, url: str, params: Dict = None, max_retries: int = 3, delay: int = 1,
+                       headers: Dict = None, data_type: Optional[str] = None) -> CachedResponse:
+        """Faz requisição (via cache HTTP) com retry automático."""
         for attempt in range(max_retries):
             try:
-                return self._make_request(url, params)
+                return self._cached_request(url, params, headers=headers, data_type=data_type)
             except requests.exceptions.RequestException as e:
                 if attempt == max_retries - 1:
                     raise
@@ -158,16 +171,19 @@ class BaseExtractor(ABC):
             }
     
     def clear_cache(self) -> None:
-        """Limpa o cache do extrator."""
-        self.cache.clear()
+        """Limpa o cache do extrator (respostas e resultados deste extrator)."""
+        self.http_cache.clear(namespace=self.name)
         self.logger.info("Cache limpo")
     
     def get_cache_info(self) -> Dict[str, Any]:
         """Retorna informações sobre o cache."""
+        info = self.http_cache.info(namespace=self.name)
         return {
-            'cache_size': len(self.cache),
-            'cache_keys': list(self.cache.keys()),
-            'cache_duration': self.cache_duration
+            'cache_size': len(info['results']),
+            'cache_keys': info['results'],
+            'cache_duration': self.cache_duration,
+            'cached_responses': info['responses'],
+            'cache_path': info['path'],
         }
     
     def __str__(self) -> str:
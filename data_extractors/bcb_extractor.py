@@ -49,6 +49,8 @@ class BCBExtractor(BaseExtractor):
     def extract_data(self, series_code: int, **kwargs) -> Dict[str, Any]:
         """Extrai dados de uma série específica do SGS."""
         cache_key = f"bcb_sgs_{series_code}"
+        if 'start_date' in kwargs or 'end_date' in kwargs:
+            cache_key += f"_{kwargs.get('start_date', '')}_{kwargs.get('end_date', '')}"
         
         # Verificar cache primeiro
         cached_data = self._get_from_cache(cache_key)
@@ -66,8 +68,8 @@ class BCBExtractor(BaseExtractor):
             if 'end_date' in kwargs:
                 params['dataFinal'] = kwargs['end_date']
             
-            # Fazer requisição
-            response = self._retry_request(url, params)
+            # Fazer requisição (série inalterada não é baixada de novo)
+            response = self._retry_request(url, params, data_type='bcb_sgs')
             data_list = response.json()
             
             if not data_list:
@@ -177,7 +179,7 @@ class BCBExtractor(BaseExtractor):
             if reference_date:
                 params['$filter'] += f" and DataReferencia eq '{reference_date}'"
             
-            response = self._retry_request(url, params)
+            response = self._retry_request(url, params, data_type='bcb_focus')
             data = response.json()
             
             if 'value' not in data or not data['value']:
@@ -76,30 +76,34 @@ class DamodaranExtractor(BaseExtractor):
         url = self.direct_data_urls[excel_key]
         
         try:
-            # Fazer download do arquivo Excel
-            response = self._retry_request(url)
-            
-            # Ler Excel em memória
-            excel_data = pd.read_excel(io.BytesIO(response.content), sheet_name=None)
-            
-            # Processar baseado no tipo de dados
-            if data_type == 'country_risk':
-                return self._process_country_risk_data(excel_data)
-            elif data_type == 'industry_betas':
-                return self._process_industry_betas_data(excel_data)
-            elif data_type == 'market_risk_premium':
-                return self._process_market_risk_premium_data(excel_data)
-            elif data_type == 'cost_of_capital':
-                return self._process_cost_of_capital_data(excel_data)
-            elif data_type == 'size_premium':
-                return self._process_size_premium_data(excel_data)
-            else:
-                return self._process_generic_excel_data(excel_data, data_type)
+            # Download via cache HTTP: planilha inalterada volta como 304 e o
+            # parse anterior é reaproveitado
+            response = self._retry_request(url, data_type='damodaran_excel')
+            return self._parse_cached(response, data_type,
+                                      lambda r: self._parse_excel(data_type, r.content))
                 
         except Exception as e:
             self.logger.error(f"Erro ao processar Excel {data_type}: {e}")
             raise
     
+    def _parse_excel(self, data_type: str, content: bytes) -> Dict[str, Any]:
+        """Lê a planilha em memória e processa conforme o tipo de dados."""
+        excel_data = pd.read_excel(io.BytesIO(content), sheet_name=None)
+        
+        # Processar baseado no tipo de dados
+        if data_type == 'country_risk':
+            return self._process_country_risk_data(excel_data)
+        elif data_type == 'industry_betas':
+            return self._process_industry_betas_data(excel_data)
+        elif data_type == 'market_risk_premium':
+            return self._process_market_risk_premium_data(excel_data)
+        elif data_type == 'cost_of_capital':
+            return self._process_cost_of_capital_data(excel_data)
+        elif data_type == 'size_premium':
+            return self._process_size_premium_data(excel_data)
+        else:
+            return self._process_generic_excel_data(excel_data, data_type)
+    
     def _process_country_risk_data(self, excel_data: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
         """Processa dados de risco país."""
         # Assumindo que os dados estão na primeira sheet
@@ -259,33 +263,36 @@ class DamodaranExtractor(BaseExtractor):
         url = self.data_urls[data_type]
         
         try:
-            response = self._retry_request(url)
-            
-            # Tentar extrair tabelas HTML
-            tables = pd.read_html(response.text)
-            
-            processed_tables = []
-            for i, table in enumerate(tables):
-                processed_tables.append({
-                    'table_index': i,
-                    'shape': table.shape,
-                    'columns': table.columns.tolist(),
-                    'sample_data': table.head(5).to_dict('records')
-                })
-            
-            return {
-                'data_type': data_type,
-                'tables': processed_tables,
-                'total_tables': len(tables),
-                'extracted_at': datetime.now().isoformat(),
-                'source': f'Damodaran {data_type} HTML',
-                'url': url
-            }
+            response = self._retry_request(url, data_type='damodaran_html')
+            return self._parse_cached(response, f"{data_type}_html",
+                                      lambda r: self._parse_html(data_type, url, r.text))
             
         except Exception as e:
             self.logger.error(f"Erro ao processar HTML {data_type}: {e}")
             raise
     
+    def _parse_html(self, data_type: str, url: str, html: str) -> Dict[str, Any]:
+        """Extrai as tabelas de uma página HTML do Damodaran."""
+        tables = pd.read_html(io.StringIO(html))
+        
+        processed_tables = []
+        for i, table in enumerate(tables):
+            processed_tables.append({
+                'table_index': i,
+                'shape': table.shape,
+                'columns': table.columns.tolist(),
+                'sample_data': table.head(5).to_dict('records')
+            })
+        
+        return {
+            'data_type': data_type,
+            'tables': processed_tables,
+            'total_tables': len(tables),
+            'extracted_at': datetime.now().isoformat(),
+            'source': f'Damodaran {data_type} HTML',
+            'url': url
+        }
+    
     def get_brazil_country_risk(self) -> Dict[str, Any]:
         """Obtém o risco país do Brasil."""
         data = self.extract_data('country_risk')
@@ -17,6 +17,7 @@ import os
 import csv
 import io
 import json
+import tempfile
 import zipfile
 import warnings
 from datetime import datetime
@@ -43,6 +44,7 @@ warnings.filterwarnings("ignore", category=FutureWarning, module="yfinance")
 warnings.filterwarnings("ignore", message=".*Timestamp.utcnow.*")
 
 from .base_extractor import BaseExtractor
+from .etf_index import get_etf_index, refresh_etf_index
 
 log = logging.getLogger("etf_extractor")
 
@@ -191,6 +193,93 @@ _BR_TICKER_TO_CNPJ = {
 }
 
 
+def _cvm_float(s: Optional[str]) -> float:
+    try:
+        return float(s.replace(",", ".")) if s else 0
+    except ValueError:
+        return 0
+
+
+def _iter_cvm_rows(z: zipfile.ZipFile, fname: str, cnpj_cols: tuple, wanted: set):
+    """Lê um CSV do ZIP linha a linha (decodificação incremental latin-1).
+
+    Só monta o dict (como o csv.DictReader) das linhas cujo CNPJ está em
+    `wanted`; as demais são descartadas sem alocação extra.
+    """
+    with z.open(fname) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding="latin-1", newline=""), delimiter=";")
+        header = next(reader, None)
+        if not header:
+            return
+        idx = [header.index(c) for c in cnpj_cols if c in header]
+        n = len(header)
+        for row in reader:
+            cnpj = None
+            for i in idx:
+                if i < len(row) and row[i]:
+                    cnpj = row[i]
+                    break
+            if cnpj not in wanted:
+                continue
+            rec = dict(zip(header, row))
+            if len(row) < n:
+                rec.update(dict.fromkeys(header[len(row):]))
+            yield cnpj, rec
+
+
+def _parse_cvm_zip(path: str, wanted: set) -> Dict[str, List[Dict]]:
+    """Extrai do ZIP `cda_fi_YYYYMM` as holdings dos CNPJs em `wanted`."""
+    result: Dict[str, List[Dict]] = {}
+    with zipfile.ZipFile(path) as z:
+        names = z.namelist()
+
+        # 1. Arquivos BLC (blocos de ativos – fundos regulares)
+        for fname in names:
+            if "BLC" not in fname:
+                continue
+            # Determinar asset class pelo bloco
+            blc = "Equity" if "BLC_1" in fname else \
+                  "Fixed Income" if "BLC_2" in fname else \
+                  "Swap" if "BLC_3" in fname else \
+                  "FX" if "BLC_5" in fname else \
+                  "Fund" if "BLC_7" in fname else "Other"
+            for cnpj, row in _iter_cvm_rows(z, fname, ("CNPJ_FUNDO_CLASSE", "CNPJ_FUNDO"), wanted):
+                qty = _cvm_float(row.get("QT_POS_FINAL", "0"))
+                val = _cvm_float(row.get("VL_MERC_POS_FINAL", "0"))
+                result.setdefault(cnpj, []).append({
+                    "holding_ticker": row.get("CD_ISIN", "") or None,
+                    "holding_name": row.get("DENOM_SOCIAL", row.get("TP_ATIVO", "")),
+                    "weight": None,
+                    "shares": int(qty) if qty else None,
+                    "market_value": val if val else None,
+                    "sector": None,
+                    "asset_class": blc,
+                })
+
+        # 2. cda_fie (Fundos Estruturados – inclui ETFs/FIIM)
+        for fname in names:
+            if "cda_fie" not in fname or "CONFID" in fname:
+                continue
+            for cnpj, row in _iter_cvm_rows(z, fname, ("CNPJ_FUNDO_CLASSE",), wanted):
+                tp_ativo = (row.get("TP_ATIVO") or "").upper()
+                asset_class = "Equity" if tp_ativo in ("Ações", "AÇÕES", "ACOES") else \
+                              "Fixed Income" if "RENDA FIXA" in tp_ativo else \
+                              "Fund" if "COTAS" in tp_ativo or "FUNDO" in tp_ativo else \
+                              tp_ativo or "Other"
+                qty = _cvm_float(row.get("QT_POS_FINAL", "0"))
+                val = _cvm_float(row.get("VL_MERC_POS_FINAL", "0"))
+                result.setdefault(cnpj, []).append({
+                    "holding_ticker": row.get("CD_ATIVO", "") or None,
+                    "holding_name": row.get("DS_ATIVO", "") or row.get("EMISSOR", ""),
+                    "weight": None,
+                    "shares": int(qty) if qty else None,
+                    "market_value": val if val else None,
+                    "sector": row.get("CD_PAIS"),
+                    "asset_class": asset_class,
+                })
+    return result
+
+
 # ────────────────────────────────────────────────────────────────────
 # Rate Limiter (thread-safe)
 # ────────────────────────────────────────────────────────────────────
@@ -728,9 +817,39 @@ class ETFExtractor(BaseExtractor):
             return []
 
     # ── CVM – Holdings de ETFs brasileiros ───────────────────────
+    def _cvm_cache_path(self, year_month: str) -> Path:
+        return Path(self.db_path).parent / "cvm_cache" / f"cda_fi_{year_month}.json"
+
+    def _load_cvm_month_cache(self, year_month: str, wanted: set) -> Optional[Dict[str, List[Dict]]]:
+        """Lê o recorte filtrado do mês em disco (se cobre todos os CNPJs pedidos)."""
+        try:
+            with open(self._cvm_cache_path(year_month), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not wanted.issubset(cached.get("cnpjs", [])):
+            return None
+        return cached.get("funds", {})
+
+    def _save_cvm_month_cache(self, year_month: str, wanted: set, funds: Dict[str, List[Dict]]):
+        path = self._cvm_cache_path(year_month)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"year_month": year_month, "cnpjs": sorted(wanted), "funds": funds}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning(f"Erro ao salvar cache CVM {year_month}: {e}")
+
     def _load_cvm_data(self, year_month: Optional[str] = None) -> Dict[str, List[Dict]]:
         """Carrega composição de carteira da CVM (lazy, cached).
 
+        O ZIP mensal (centenas de MB) é baixado em streaming para um arquivo
+        temporário e cada CSV é lido linha a linha; só ficam as linhas dos
+        CNPJs de `_BR_TICKER_TO_CNPJ`. O recorte filtrado é salvo por mês em
+        `cvm_cache/` ao lado do banco, então o download ocorre uma vez por mês.
+
         Args:
             year_month: formato YYYYMM (padrão: mês anterior)
 
@@ -748,104 +867,28 @@ class ETFExtractor(BaseExtractor):
             else:
                 year_month = f"{now.year}{now.month - 1:02d}"
 
+        wanted = set(_BR_TICKER_TO_CNPJ.values())
+        cached = self._load_cvm_month_cache(year_month, wanted)
+        if cached is not None:
+            self._cvm_cache = cached
+            log.info(f"CVM (cache em disco): {len(cached)} fundos, mês {year_month}")
+            return self._cvm_cache
+
         self._cvm_cache = {}
         url = f"http://dados.cvm.gov.br/dados/FI/DOC/CDA/DADOS/cda_fi_{year_month}.zip"
         log.info(f"Baixando composição CVM: {url}")
 
+        tmp_path = None
         try:
-            r = requests.get(url, headers={"User-Agent": "WACC-Research"}, timeout=120)
-            r.raise_for_status()
-
-            z = zipfile.ZipFile(io.BytesIO(r.content))
-
-            # 1. Processar arquivos BLC (blocos de ativos – fundos regulares)
-            for fname in z.namelist():
-                if "BLC" not in fname:
-                    continue
-                with z.open(fname) as f:
-                    content = f.read().decode("latin-1")
-                    reader = csv.DictReader(io.StringIO(content), delimiter=";")
-                    for row in reader:
-                        cnpj = row.get("CNPJ_FUNDO_CLASSE") or row.get("CNPJ_FUNDO", "")
-                        if not cnpj:
-                            continue
-                        if cnpj not in self._cvm_cache:
-                            self._cvm_cache[cnpj] = []
-
-                        # Determinar asset class pelo bloco
-                        blc = "Equity" if "BLC_1" in fname else \
-                              "Fixed Income" if "BLC_2" in fname else \
-                              "Swap" if "BLC_3" in fname else \
-                              "FX" if "BLC_5" in fname else \
-                              "Fund" if "BLC_7" in fname else "Other"
-
-                        isin = row.get("CD_ISIN", "")
-                        qty_str = row.get("QT_POS_FINAL", "0")
-                        val_str = row.get("VL_MERC_POS_FINAL", "0")
-
-                        try:
-                            qty = float(qty_str.replace(",", ".")) if qty_str else 0
-                        except ValueError:
-                            qty = 0
-                        try:
-                            val = float(val_str.replace(",", ".")) if val_str else 0
-                        except ValueError:
-                            val = 0
-
-                        self._cvm_cache[cnpj].append({
-                            "holding_ticker": isin or None,
-                            "holding_name": row.get("DENOM_SOCIAL", row.get("TP_ATIVO", "")),
-                            "weight": None,
-                            "shares": int(qty) if qty else None,
-                            "market_value": val if val else None,
-                            "sector": None,
-                            "asset_class": blc,
-                        })
-
-            # 2. Processar cda_fie (Fundos Estruturados – inclui ETFs/FIIM)
-            for fname in z.namelist():
-                if "cda_fie" not in fname or "CONFID" in fname:
-                    continue
-                with z.open(fname) as f:
-                    content = f.read().decode("latin-1")
-                    reader = csv.DictReader(io.StringIO(content), delimiter=";")
-                    for row in reader:
-                        cnpj = row.get("CNPJ_FUNDO_CLASSE") or ""
-                        if not cnpj:
-                            continue
-                        if cnpj not in self._cvm_cache:
-                            self._cvm_cache[cnpj] = []
-
-                        tp_ativo = (row.get("TP_ATIVO") or "").upper()
-                        asset_class = "Equity" if tp_ativo in ("Ações", "AÇÕES", "ACOES") else \
-                                      "Fixed Income" if "RENDA FIXA" in tp_ativo else \
-                                      "Fund" if "COTAS" in tp_ativo or "FUNDO" in tp_ativo else \
-                                      tp_ativo or "Other"
-
-                        cd_ativo = row.get("CD_ATIVO", "")
-                        ds_ativo = row.get("DS_ATIVO", "")
-                        qty_str = row.get("QT_POS_FINAL", "0")
-                        val_str = row.get("VL_MERC_POS_FINAL", "0")
-
-                        try:
-                            qty = float(qty_str.replace(",", ".")) if qty_str else 0
-                        except ValueError:
-                            qty = 0
-                        try:
-                            val = float(val_str.replace(",", ".")) if val_str else 0
-                        except ValueError:
-                            val = 0
-
-                        self._cvm_cache[cnpj].append({
-                            "holding_ticker": cd_ativo or None,
-                            "holding_name": ds_ativo or row.get("EMISSOR", ""),
-                            "weight": None,
-                            "shares": int(qty) if qty else None,
-                            "market_value": val if val else None,
-                            "sector": row.get("CD_PAIS"),
-                            "asset_class": asset_class,
-                        })
+            with requests.get(url, headers={"User-Agent": "WACC-Research"}, timeout=120, stream=True) as r:
+                r.raise_for_status()
+                with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+                    tmp_path = tmp.name
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        tmp.write(chunk)
 
+            self._cvm_cache = _parse_cvm_zip(tmp_path, wanted)
+            self._save_cvm_month_cache(year_month, wanted, self._cvm_cache)
             log.info(f"CVM carregada: {len(self._cvm_cache)} fundos, mês {year_month}")
 
         except requests.exceptions.HTTPError:
@@ -862,6 +905,12 @@ class ETFExtractor(BaseExtractor):
                 return self._load_cvm_data(prev)
         except Exception as e:
             log.error(f"Erro ao carregar CVM: {e}")
+        finally:
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
 
         return self._cvm_cache or {}
 
@@ -1099,6 +1148,7 @@ class ETFExtractor(BaseExtractor):
             "errors": errors,
         }
         log.info(f"Concluído: {success}/{total} ETFs, {total_holdings} holdings, {failed} falhas")
+        refresh_etf_index(self.db_path)
         return summary
 
     # ── Consultas ────────────────────────────────────────────────
@@ -1201,28 +1251,25 @@ class ETFExtractor(BaseExtractor):
         return self.bulk_process(tickers=stale, **kwargs)
 
     def get_overlap(self, ticker1: str, ticker2: str) -> Dict[str, Any]:
-        """Calcula sobreposição entre dois ETFs."""
-        h1 = self.get_holdings_for(ticker1)
-        h2 = self.get_holdings_for(ticker2)
-
-        tickers1 = {h["holding_ticker"] for h in h1 if h.get("holding_ticker")}
-        tickers2 = {h["holding_ticker"] for h in h2 if h.get("holding_ticker")}
-
-        common = tickers1 & tickers2
-        union = tickers1 | tickers2
-
-        overlap_pct = (len(common) / len(union) * 100) if union else 0
+        """Calcula sobreposição entre dois ETFs (via índice invertido)."""
+        idx = get_etf_index(self.db_path)
+        ov = idx.overlap([ticker1, ticker2])
 
         return {
             "etf1": ticker1,
             "etf2": ticker2,
-            "holdings_etf1": len(tickers1),
-            "holdings_etf2": len(tickers2),
-            "common": len(common),
-            "overlap_pct": round(overlap_pct, 2),
-            "common_tickers": sorted(common),
+            "holdings_etf1": len(idx.holdings_of(ticker1)),
+            "holdings_etf2": len(idx.holdings_of(ticker2)),
+            "common": ov["common"],
+            "overlap_pct": ov["pct"],
+            "weighted_overlap": ov["weighted_overlap"],
+            "common_tickers": sorted(ov["common_tickers"]),
         }
 
+    def get_top_overlapping(self, ticker: str, k: int = 10, by: str = "weighted") -> List[Dict[str, Any]]:
+        """Top K ETFs mais sobrepostos a `ticker`."""
+        return get_etf_index(self.db_path).top_overlapping(ticker, k=k, by=by)
+
     # ── Auto-tagging ───────────────────────────────────────────
     # Tag types: asset_class, geography, cap_size, style, sector, strategy, theme, index
 
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Índice invertido em memória das holdings de ETFs.
+
+Em vez de carregar as listas completas de `etf_holdings` e cruzar sets em
+Python a cada chamada, o índice é montado uma vez (no primeiro uso, após
+`ETFExtractor.bulk_process` ou quando o banco muda) e responde:
+
+  - overlap ponderado entre N ETFs (contagem, Jaccard e soma dos pesos
+    mínimos das holdings em comum);
+  - "top K ETFs que mais se sobrepõem a este ETF" percorrendo só as
+    postings das holdings do ETF (sem O(#ETFs) consultas);
+  - busca reversa (em quais ETFs um ticker/nome aparece).
+
+Estruturas:
+  - postings[holding_id]   → [(etf_pos, peso), ...]
+  - membership[holding_id] → bitset (int) das posições de ETF que a contêm
+  - etf_bits[etf_pos]      → bitset (int) das holdings do ETF
+    (contagens de interseção/união via `(a & b).bit_count()`)
+
+Quando um ETF lista o mesmo ticker mais de uma vez, vale a última linha
+(ordem de inserção), como no cruzamento por dict usado antes.
+"""
+
+import heapq
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ETFHoldingIndex:
+    """Índice invertido holding → (ETF, peso) com pertencimento em bitsets."""
+
+    def __init__(self):
+        self.stamp = None
+        self.etf_tickers: List[str] = []
+        self.etf_pos: Dict[str, int] = {}
+        self.etf_meta: Dict[str, Dict[str, Any]] = {}
+        self.holdings: List[Dict[str, Dict[str, Any]]] = []   # por ETF: ticker → campos
+        self.holding_ids: Dict[str, int] = {}
+        self.holding_tickers: List[str] = []
+        self.postings: List[List[tuple]] = []
+        self.membership: List[int] = []
+        self.etf_bits: List[int] = []
+        # Busca reversa: (TICKER, NOME) distintos → linhas (etf_pos, ticker, nome, peso)
+        self._search_keys: List[tuple] = []
+
+    # ── Construção ───────────────────────────────────────────────
+    @classmethod
+    def build(cls, conn: sqlite3.Connection, stamp=None) -> "ETFHoldingIndex":
+        idx = cls()
+        idx.stamp = stamp if stamp is not None else index_stamp(conn)
+
+        for row in conn.execute(
+            "SELECT ticker, name, category, aum, total_holdings, data_source FROM etfs"
+        ):
+            idx.etf_meta[row[0]] = {
+                "ticker": row[0], "name": row[1], "category": row[2], "aum": row[3],
+                "total_holdings": row[4], "data_source": row[5],
+            }
+
+        search: Dict[tuple, list] = {}
+        for etf, tk, name, weight, sector, asset_class, country in conn.execute("""
+            SELECT etf_ticker, holding_ticker, holding_name, weight, sector, asset_class, country
+            FROM etf_holdings
+            ORDER BY id
+        """):
+            pos = idx._etf_position(etf)
+            search.setdefault((tk or "", name or ""), []).append((pos, tk, name, weight))
+            if not tk:
+                continue
+            hid = idx.holding_ids.get(tk)
+            if hid is None:
+                hid = idx.holding_ids[tk] = len(idx.holding_tickers)
+                idx.holding_tickers.append(tk)
+                idx.postings.append([])
+                idx.membership.append(0)
+            idx.holdings[pos][tk] = {
+                "holding_ticker": tk, "holding_name": name, "weight": weight,
+                "sector": sector, "asset_class": asset_class, "country": country,
+            }
+
+        # Postings/bitsets a partir do dict já deduplicado (última linha vence)
+        n_bytes = (len(idx.holding_tickers) + 7) // 8
+        for pos, by_ticker in enumerate(idx.holdings):
+            bit = 1 << pos
+            buf = bytearray(n_bytes)  # evita OR repetido em ints grandes
+            for tk, h in by_ticker.items():
+                hid = idx.holding_ids[tk]
+                idx.postings[hid].append((pos, h["weight"]))
+                idx.membership[hid] |= bit
+                buf[hid >> 3] |= 1 << (hid & 7)
+            idx.etf_bits[pos] = int.from_bytes(buf, "little")
+
+        idx._search_keys = [(k[0].upper(), k[1].upper(), rows) for k, rows in search.items()]
+        return idx
+
+    def _etf_position(self, etf: str) -> int:
+        pos = self.etf_pos.get(etf)
+        if pos is None:
+            pos = self.etf_pos[etf] = len(self.etf_tickers)
+            self.etf_tickers.append(etf)
+            self.holdings.append({})
+            self.etf_bits.append(0)
+        return pos
+
+    # ── Consultas ────────────────────────────────────────────────
+    def holdings_of(self, etf: str) -> Dict[str, Dict[str, Any]]:
+        pos = self.etf_pos.get(etf)
+        return self.holdings[pos] if pos is not None else {}
+
+    def size(self, etf: str) -> int:
+        pos = self.etf_pos.get(etf)
+        return self.etf_bits[pos].bit_count() if pos is not None else 0
+
+    def common_tickers(self, etfs: List[str]) -> List[str]:
+        """Holdings presentes em todos os ETFs (varre o menor e testa o bitset)."""
+        positions = [self.etf_pos.get(e) for e in etfs]
+        if not etfs or any(p is None for p in positions):
+            return []
+        mask = 0
+        for p in positions:
+            mask |= 1 << p
+        smallest = min(positions, key=lambda p: len(self.holdings[p]))
+        return [tk for tk in self.holdings[smallest]
+                if self.membership[self.holding_ids[tk]] & mask == mask]
+
+    def overlap(self, etfs: List[str]) -> Dict[str, Any]:
+        """Overlap entre N ETFs: contagens, Jaccard (%) e overlap ponderado.
+
+        O overlap ponderado é a soma, sobre as holdings em comum, do menor
+        peso entre os ETFs (a fração da carteira que todos compartilham).
+        """
+        positions = [self.etf_pos.get(e) for e in etfs]
+        inter = union = 0
+        if positions and all(p is not None for p in positions):
+            inter = ~0
+            for p in positions:
+                inter &= self.etf_bits[p]
+                union |= self.etf_bits[p]
+        elif positions:
+            for p in positions:
+                if p is not None:
+                    union |= self.etf_bits[p]
+        common = self.common_tickers(etfs) if inter else []
+        weighted = 0.0
+        for tk in common:
+            weighted += min((self.holdings[p][tk]["weight"] or 0) for p in positions)
+        n_union = union.bit_count()
+        n_common = len(common)
+        return {
+            "common": n_common,
+            "union": n_union,
+            "pct": round(n_common / n_union * 100, 2) if n_union else 0,
+            "weighted_overlap": round(weighted, 4),
+            "common_tickers": common,
+        }
+
+    def top_overlapping(self, etf: str, k: int = 10, by: str = "weighted") -> List[Dict[str, Any]]:
+        """Top K ETFs mais sobrepostos a `etf`, percorrendo só as postings dele.
+
+        by: "weighted" (soma dos pesos mínimos), "pct" (Jaccard) ou "common".
+        """
+        pos = self.etf_pos.get(etf)
+        if pos is None:
+            return []
+        counts: Dict[int, int] = {}
+        weighted: Dict[int, float] = {}
+        for tk, h in self.holdings[pos].items():
+            w_self = h["weight"] or 0
+            for other, w in self.postings[self.holding_ids[tk]]:
+                if other == pos:
+                    continue
+                counts[other] = counts.get(other, 0) + 1
+                weighted[other] = weighted.get(other, 0.0) + min(w_self, w or 0)
+
+        n_self = len(self.holdings[pos])
+
+        def jaccard(o):
+            union = n_self + len(self.holdings[o]) - counts[o]
+            return counts[o] / union * 100 if union else 0
+
+        key = {
+            "weighted": lambda o: (weighted[o], counts[o]),
+            "pct": lambda o: (jaccard(o), counts[o]),
+            "common": lambda o: (counts[o], weighted[o]),
+        }.get(by)
+        if key is None:
+            raise ValueError(f"Critério inválido: {by}")
+        best = heapq.nlargest(k, counts, key=key)
+        result = []
+        for o in best:
+            tk = self.etf_tickers[o]
+            meta = self.etf_meta.get(tk, {})
+            result.append({
+                "ticker": tk,
+                "name": meta.get("name", tk),
+                "category": meta.get("category"),
+                "aum": meta.get("aum"),
+                "holdings": len(self.holdings[o]),
+                "common": counts[o],
+                "overlap_pct": round(jaccard(o), 2),
+                "weighted_overlap": round(weighted[o], 4),
+            })
+        return result
+
+    def search(self, q: str) -> List[Dict[str, Any]]:
+        """Busca reversa por substring no ticker ou no nome (como o LIKE '%q%')."""
+        q = (q or "").upper()
+        rows = []
+        for tk_u, name_u, entries in self._search_keys:
+            if q in tk_u or q in name_u:
+                for pos, tk, name, weight in entries:
+                    meta = self.etf_meta.get(self.etf_tickers[pos])
+                    if meta is None:  # JOIN com etfs
+                        continue
+                    rows.append({
+                        "etf_ticker": meta["ticker"], "etf_name": meta["name"],
+                        "category": meta["category"], "aum": meta["aum"],
+                        "weight": weight, "holding_name": name, "holding_ticker": tk,
+                        "data_source": meta["data_source"], "total_holdings": meta["total_holdings"],
+                    })
+        # ORDER BY weight DESC (NULLs por último, como no SQLite)
+        rows.sort(key=lambda r: (r["weight"] is not None, r["weight"] or 0), reverse=True)
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "etfs": len(self.etf_tickers),
+            "unique_holdings": len(self.holding_tickers),
+            "postings": sum(len(p) for p in self.postings),
+        }
+
+
+# ── Cache por banco ──────────────────────────────────────────────────
+_indexes: Dict[str, ETFHoldingIndex] = {}
+_lock = threading.Lock()
+
+
+def index_stamp(conn: sqlite3.Connection) -> tuple:
+    """Assinatura barata do conteúdo (save_holdings apaga e reinsere → MAX(id) muda)."""
+    h = conn.execute("SELECT MAX(id) FROM etf_holdings").fetchone()
+    e = conn.execute("SELECT COUNT(*), MAX(last_updated), SUM(total_holdings) FROM etfs").fetchone()
+    return (h[0],) + tuple(e)
+
+
+def get_etf_index(db_path: str, connect: Optional[Callable[[], sqlite3.Connection]] = None,
+                  force: bool = False) -> ETFHoldingIndex:
+    """Retorna o índice do banco, (re)construindo se o conteúdo mudou."""
+    connect = connect or (lambda: sqlite3.connect(db_path))
+    conn = connect()
+    try:
+        stamp = index_stamp(conn)
+        idx = _indexes.get(db_path)
+        if idx is not None and idx.stamp == stamp and not force:
+            return idx
+        with _lock:
+            idx = _indexes.get(db_path)
+            if idx is None or idx.stamp != stamp or force:
+                idx = _indexes[db_path] = ETFHoldingIndex.build(conn, stamp)
+        return idx
+    finally:
+        conn.close()
+
+
+def refresh_etf_index(db_path: str) -> Optional[ETFHoldingIndex]:
+    """Reconstrói o índice (chamado ao fim do bulk_process)."""
+    try:
+        return get_etf_index(db_path, force=True)
+    except sqlite3.Error:
+        return None
@@ -41,6 +41,9 @@ class FREDExtractor(BaseExtractor):
     def extract_data(self, series_id: str, **kwargs) -> Dict[str, Any]:
         """Extrai dados de uma série específica do FRED."""
         cache_key = f"fred_{series_id}"
+        for option in ('start_date', 'end_date', 'limit'):
+            if option in kwargs:
+                cache_key += f"_{option}={kwargs[option]}"
         
         # Verificar cache primeiro
         cached_data = self._get_from_cache(cache_key)
@@ -81,13 +84,13 @@ class FREDExtractor(BaseExtractor):
         
         # Obter informações da série
         series_url = f"{self.base_url}/series"
-        series_response = self._retry_request(series_url, params)
+        series_response = self._retry_request(series_url, params, data_type='fred')
         series_info = series_response.json()
         
         # Obter observações da série
         obs_params = params.copy()
         obs_url = f"{self.base_url}/series/observations"
-        obs_response = self._retry_request(obs_url, obs_params)
+        obs_response = self._retry_request(obs_url, obs_params, data_type='fred')
         observations = obs_response.json()
         
         if 'observations' not in observations:
@@ -113,7 +116,7 @@ class FREDExtractor(BaseExtractor):
         url = f"{self.web_base_url}/series/{series_id}"
         
         try:
-            response = self._retry_request(url)
+            response = self._retry_request(url, data_type='fred')
             
             # Aqui implementaríamos o parsing do HTML
             # Por simplicidade, vamos retornar dados mock
@@ -30,6 +30,8 @@ from typing import Dict, List, Optional, Tuple
 
 import requests
 
+from .http_cache import CachedResponse, get_http_cache
+
 log = logging.getLogger("holdings_providers")
 
 _HEADERS = {
@@ -41,6 +43,12 @@ _HEADERS = {
     "Accept": "*/*",
 }
 
+
+def _get(url: str, timeout: int) -> CachedResponse:
+    """GET pelo cache HTTP compartilhado (TTL de holdings + revalidação condicional)."""
+    return get_http_cache().get(url, headers=_HEADERS, timeout=timeout,
+                                data_type="holdings", namespace="holdings")
+
 # ────────────────────────────────────────────────────────────────
 # iShares / BlackRock  CSV
 # ────────────────────────────────────────────────────────────────
@@ -95,7 +103,7 @@ def fetch_ishares(ticker: str, timeout: int = 20) -> List[Dict]:
     )
 
     try:
-        resp = requests.get(url, headers=_HEADERS, timeout=timeout)
+        resp = _get(url, timeout)
         if resp.status_code != 200 or len(resp.text) < 100:
             return []
     except requests.RequestException:
@@ -163,7 +171,7 @@ def fetch_vanguard(ticker: str, timeout: int = 20) -> List[Dict]:
             f"?offset=0&limit=500&sortField=marketValue&sortOrder=desc"
         )
         try:
-            resp = requests.get(url, headers=_HEADERS, timeout=timeout)
+            resp = _get(url, timeout)
             if resp.status_code != 200:
                 continue
             data = resp.json()
@@ -236,7 +244,7 @@ def fetch_spdr(ticker: str, timeout: int = 20) -> List[Dict]:
     )
 
     try:
-        resp = requests.get(url, headers=_HEADERS, timeout=timeout)
+        resp = _get(url, timeout)
         if resp.status_code != 200 or len(resp.content) < 1000:
             return []
     except requests.RequestException:
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Cache HTTP persistente e compartilhado dos extratores de dados.
+
+Cada BaseExtractor guardava as respostas num dict da instância
+(`self.cache`): perdido a cada restart/cold start e duplicado entre o
+`WACCCalculator.data_manager` e o `data_manager` do app. A validade usava
+`timedelta.seconds`, que volta a zero a cada dia. Aqui, um SQLite em disco
+(cache/http_cache.db; /tmp/cache no GAE), aberto uma vez por processo e
+compartilhado por todos os extratores e pelos holdings_providers, guarda:
+
+- respostas HTTP (`http_responses`) com TTL por tipo de dado (`TTLS`).
+  Vencido o TTL, a requisição sai condicional (If-None-Match /
+  If-Modified-Since); um 304 renova a entrada sem baixar o corpo de novo.
+  Se a rede falhar, uma entrada vencida ainda é servida;
+- resultados dos extratores (`extractor_results`): os dados processados de
+  `_get_from_cache/_save_to_cache` e o parse de um corpo (`memo`), indexado
+  pelo sha256 do corpo — planilha do Damodaran ou série do BCB que não mudou
+  (304 ou conteúdo idêntico) não é parseada de novo.
+
+O arquivo é separado do banco principal de propósito: escrever nele não
+muda a `data_version()` do cache de respostas do app.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlencode
+
+import requests
+
+log = logging.getLogger("http_cache")
+
+HTTP_CACHE_ENV = "HTTP_CACHE_DB"
+HTTP_CACHE_FILE = "http_cache.db"
+
+# TTL (segundos) por tipo de dado; passado o TTL a resposta é revalidada
+TTLS: Dict[str, int] = {
+    "bcb_sgs": 30 * 60,             # séries SGS: no máximo uma atualização por dia útil
+    "bcb_focus": 60 * 60,           # Focus: semanal
+    "fred": 60 * 60,
+    "damodaran_excel": 24 * 3600,   # planilhas do Damodaran: atualizadas poucas vezes por ano
+    "damodaran_html": 24 * 3600,
+    "web": 60 * 60,
+    "holdings": 12 * 3600,          # holdings dos emissores: diárias
+}
+DEFAULT_TTL = 3600
+MAX_BODY_BYTES = 100 * 1024 * 1024  # corpos maiores não são guardados
+PRUNE_AFTER = 30 * 86400            # entradas não renovadas há 30 dias são removidas
+
+
+def default_cache_path() -> str:
+    """Caminho do cache: $HTTP_CACHE_DB, ou cache/ (/tmp/cache no GAE)."""
+    path = os.environ.get(HTTP_CACHE_ENV)
+    if path:
+        return path
+    cache_dir = "/tmp/cache" if os.environ.get("GAE_ENV", "").startswith("standard") else "cache"
+    return os.path.join(cache_dir, HTTP_CACHE_FILE)
+
+
+def request_key(url: str, params: Optional[Dict] = None) -> str:
+    """Chave da requisição: sha256 da URL com os parâmetros ordenados."""
+    full = url
+    if params:
+        full += ("&" if "?" in url else "?") + urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+    return hashlib.sha256(full.encode("utf-8")).hexdigest()
+
+
+def _json_default(obj):
+    """Tipos NumPy/pandas/datas nos resultados dos extratores."""
+    if isinstance(obj, (datetime, date)) or hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if hasattr(obj, "tolist"):  # arrays e escalares NumPy, Series
+        return obj.tolist()
+    if hasattr(obj, "item") and callable(obj.item):
+        return obj.item()
+    return str(obj)
+
+
+def _json_key(key):
+    """Chave de dict aceita pelo JSON (Timestamp, tupla, np.int64 → texto)."""
+    if key is None or isinstance(key, (str, int, float, bool)):
+        return key
+    key = _json_default(key)
+    return key if isinstance(key, (str, int, float, bool)) else str(key)
+
+
+def _jsonable(obj):
+    """Cópia de `obj` com as chaves de todos os dicts convertidas por `_json_key`."""
+    if isinstance(obj, dict):
+        return {_json_key(k): _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    return obj
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(_jsonable(data), default=_json_default)
+
+
+# ─── Resposta ────────────────────────────────────────────────────────────────
+
+class CachedResponse:
+    """Resposta HTTP com a interface que os extratores usam de `requests.Response`.
+
+    `from_cache` indica que o corpo veio do disco (fresco, revalidado por 304
+    ou — `stale` — servido porque a rede falhou); `digest` é o sha256 do corpo.
+    """
+
+    def __init__(self, url: str, status_code: int, content: bytes, headers: Dict[str, str],
+                 encoding: Optional[str] = None, from_cache: bool = False,
+                 revalidated: bool = False, stale: bool = False, key: Optional[str] = None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content or b""
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.encoding = encoding
+        self.from_cache = from_cache
+        self.revalidated = revalidated
+        self.stale = stale
+        self.key = key
+        self._digest = None
+        self._text = None
+
+    @classmethod
+    def from_requests(cls, response: requests.Response, key: Optional[str] = None) -> "CachedResponse":
+        cached = cls(response.url, response.status_code, response.content, dict(response.headers),
+                     encoding=response.encoding, key=key)
+        cached._source = response
+        return cached
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.content).hexdigest()
+        return self._digest
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            source = getattr(self, "_source", None)
+            if source is not None:
+                self._text = source.text  # mesma detecção de encoding do requests
+            else:
+                self._text = self.content.decode(self.encoding or "utf-8", errors="replace")
+        return self._text
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+# ─── Cache ───────────────────────────────────────────────────────────────────
+
+class HTTPCache:
+    """Respostas HTTP + resultados dos extratores num SQLite compartilhado."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_cache_path()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        except OSError:  # filesystem somente leitura (GAE): /tmp é gravável
+            self.path = os.path.join("/tmp/cache", os.path.basename(self.path))
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "stale": 0}
+        self._init_db()
+        self.prune()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS http_responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                namespace TEXT,
+                status INTEGER NOT NULL,
+                headers TEXT,
+                encoding TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                body BLOB,
+                digest TEXT,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS extractor_results (
+                key TEXT PRIMARY KEY,
+                namespace TEXT,
+                data TEXT NOT NULL,
+                digest TEXT,
+                saved_at REAL NOT NULL
+            );
+        """)
+
+    # -- HTTP --------------------------------------------------------------
+    def get(self, url: str, params: Optional[Dict] = None, *, data_type: Optional[str] = None,
+            ttl: Optional[int] = None, session=None, headers: Optional[Dict] = None,
+            timeout: int = 30, namespace: str = "") -> CachedResponse:
+        """GET com cache: fresco → disco; vencido → condicional; rede fora → vencido.
+
+        Só respostas 200 são guardadas. Erros HTTP voltam como resposta (o
+        chamador decide com `raise_for_status`); erros de rede propagam se
+        não houver nada em cache.
+        """
+        key = request_key(url, params)
+        ttl = ttl if ttl is not None else TTLS.get(data_type, DEFAULT_TTL)
+        row = self._conn().execute(
+            "SELECT url, status, headers, encoding, etag, last_modified, body, digest, fetched_at "
+            "FROM http_responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+
+        if row is not None and now - row[8] < ttl:
+            self.stats["hits"] += 1
+            return self._cached(key, row, from_cache=True)
+
+        request_headers = dict(headers or {})
+        if row is not None:
+            if row[4]:
+                request_headers["If-None-Match"] = row[4]
+            if row[5]:
+                request_headers["If-Modified-Since"] = row[5]
+        try:
+            response = (session or requests).get(url, params=params, headers=request_headers, timeout=timeout)
+        except requests.RequestException as e:
+            if row is None:
+                raise
+            log.warning(f"Rede indisponível para {url} ({e}); usando resposta em cache")
+            self.stats["stale"] += 1
+            return self._cached(key, row, from_cache=True, stale=True)
+
+        if response.status_code == 304 and row is not None:
+            self._conn().execute("UPDATE http_responses SET fetched_at = ? WHERE key = ?", (now, key))
+            self.stats["revalidated"] += 1
+            return self._cached(key, row, from_cache=True, revalidated=True)
+
+        self.stats["misses"] += 1
+        cached = CachedResponse.from_requests(response, key=key)
+        if (response.status_code == 200 and len(response.content) <= MAX_BODY_BYTES
+                and "no-store" not in response.headers.get("Cache-Control", "")):
+            self._conn().execute("""
+                INSERT OR REPLACE INTO http_responses
+                (key, url, namespace, status, headers, encoding, etag, last_modified, body, digest, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, url, namespace, response.status_code, json.dumps(dict(response.headers)),
+                  response.encoding, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                  sqlite3.Binary(response.content), cached.digest, now))
+        return cached
+
+    @staticmethod
+    def _cached(key: str, row, **flags) -> CachedResponse:
+        url, status, headers, encoding, _, _, body, digest, _ = row
+        cached = CachedResponse(url, status, bytes(body or b""), json.loads(headers or "{}"),
+                                encoding=encoding, key=key, **flags)
+        cached._digest = digest
+        return cached
+
+    # -- Resultados --------------------------------------------------------
+    def get_result(self, key: str, max_age: Optional[float] = None) -> Optional[Any]:
+        """Resultado salvo em `key` (None se ausente ou mais velho que `max_age` s)."""
+        row = self._conn().execute(
+            "SELECT data, saved_at FROM extractor_results WHERE key = ?", (key,)).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] >= max_age):
+            return None
+        return json.loads(row[0])
+
+    def put_result(self, key: str, data: Any, namespace: str = "", digest: Optional[str] = None) -> Any:
+        """Salva `data` e devolve a forma normalizada (o que `get_result` vai ler).
+
+        Falha de serialização ou do SQLite não propaga: o cache é opcional, então
+        registra o aviso e devolve `data` como veio.
+        """
+        try:
+            encoded = _dumps(data)
+            self._conn().execute(
+                "INSERT OR REPLACE INTO extractor_results (key, namespace, data, digest, saved_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, namespace, encoded, digest, time.time()))
+        except (TypeError, ValueError, sqlite3.Error) as e:
+            log.warning(f"Resultado {key} não foi salvo no cache: {e}")
+            return data
+        return json.loads(encoded)
+
+    def memo(self, key: str, digest: str, compute: Callable[[], Any], namespace: str = "") -> Any:
+        """`compute()`, reaproveitado enquanto o corpo de origem (`digest`) não mudar.
+
+        A primeira chamada devolve o mesmo valor normalizado (ida e volta pelo
+        JSON) que as seguintes leem do disco.
+        """
+        try:
+            row = self._conn().execute(
+                "SELECT data FROM extractor_results WHERE key = ? AND digest = ?", (key, digest)).fetchone()
+        except sqlite3.Error as e:
+            log.warning(f"Cache de resultados indisponível para {key}: {e}")
+            row = None
+        if row is not None:
+            return json.loads(row[0])
+        return self.put_result(key, compute(), namespace=namespace, digest=digest)
+
+    # -- Manutenção --------------------------------------------------------
+    def clear(self, namespace: Optional[str] = None):
+        conn = self._conn()
+        if namespace is None:
+            conn.execute("DELETE FROM http_responses")
+            conn.execute("DELETE FROM extractor_results")
+        else:
+            conn.execute("DELETE FROM http_responses WHERE namespace = ?", (namespace,))
+            conn.execute("DELETE FROM extractor_results WHERE namespace = ?", (namespace,))
+
+    def prune(self, max_age: float = PRUNE_AFTER):
+        cutoff = time.time() - max_age
+        conn = self._conn()
+        conn.execute("DELETE FROM http_responses WHERE fetched_at < ?", (cutoff,))
+        conn.execute("DELETE FROM extractor_results WHERE saved_at < ?", (cutoff,))
+
+    def info(self, namespace: Optional[str] = None) -> Dict[str, Any]:
+        where, args = ("WHERE namespace = ?", (namespace,)) if namespace is not None else ("", ())
+        conn = self._conn()
+        responses, body_bytes = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM http_responses {where}", args).fetchone()
+        results = [r[0] for r in conn.execute(f"SELECT key FROM extractor_results {where} ORDER BY key", args)]
+        return {"path": self.path, "responses": responses, "body_bytes": body_bytes,
+                "results": results, "stats": dict(self.stats)}
+
+
+_caches: Dict[str, HTTPCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_http_cache(path: Optional[str] = None) -> HTTPCache:
+    """Cache do processo para `path` (padrão: `default_cache_path()`)."""
+    path = path or default_cache_path()
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = HTTPCache(path)
+        return cache
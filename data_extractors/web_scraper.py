@@ -6,6 +6,7 @@ Extrator genérico para web scraping de dados financeiros.
 import pandas as pd
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List, Union
+import hashlib
 import json
 import re
 from bs4 import BeautifulSoup
@@ -55,7 +56,8 @@ class WebScraper(BaseExtractor):
     
     def extract_data(self, url: str, **kwargs) -> Dict[str, Any]:
         """Extrai dados de uma URL específica."""
-        cache_key = f"webscraper_{hash(url)}"
+        # sha1 (e não hash()): a chave precisa ser a mesma entre processos
+        cache_key = f"webscraper_{hashlib.sha1(url.encode('utf-8')).hexdigest()}"
         
         # Verificar cache primeiro
         cached_data = self._get_from_cache(cache_key)
@@ -68,7 +70,7 @@ class WebScraper(BaseExtractor):
             
             # Fazer requisição
             headers = site_config.get('headers', {})
-            response = self._retry_request(url, headers=headers)
+            response = self._retry_request(url, headers=headers, data_type='web')
             
             # Processar baseado no tipo de extração
             extraction_type = kwargs.get('type', 'html')
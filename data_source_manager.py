@@ -17,6 +17,8 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Generator
 from pathlib import Path
 
+from result_cache import bump_data_version
+
 logger = logging.getLogger(__name__)
 
 _IS_GAE = os.environ.get('GAE_ENV', '').startswith('standard')
@@ -346,6 +348,7 @@ class DataSourceManager:
                 duration=duration,
                 details=json.dumps(result.get("details", {}), ensure_ascii=False),
             )
+            bump_data_version(f"data_source:{source_id}")
 
             return {
                 "success": True,
@@ -490,10 +493,10 @@ class DataSourceManager:
         """).fetchone()[0]
 
         avg_beta = conn.execute("""
-            SELECT AVG(CAST(beta AS REAL))
+            SELECT AVG(beta)
             FROM damodaran_global
             WHERE beta IS NOT NULL AND beta != '' AND beta != 'None'
-              AND CAST(beta AS REAL) > 0 AND CAST(beta AS REAL) < 10
+              AND beta > 0 AND beta < 10
         """).fetchone()[0]
 
         # Distribuição por região
@@ -535,11 +538,11 @@ class DataSourceManager:
         """).fetchone()[0]
 
         avg_beta = conn.execute(f"""
-            SELECT AVG(CAST(beta AS REAL))
+            SELECT AVG(beta)
             FROM damodaran_global
             WHERE {emkt_filter}
               AND beta IS NOT NULL AND beta != '' AND beta != 'None'
-              AND CAST(beta AS REAL) > 0 AND CAST(beta AS REAL) < 10
+              AND beta > 0 AND beta < 10
         """).fetchone()[0]
 
         countries = conn.execute(f"""
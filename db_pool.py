@@ -0,0 +1,159 @@
+"""
+db_pool.py — Pool de conexões SQLite local por thread/greenlet.
+
+Substitui o padrão "abrir + fechar a cada request" do app:
+- Cada thread (ou greenlet, quando o gunicorn roda com gevent e o
+  threading.local é monkeypatched) mantém sua própria lista de conexões
+  livres — nada é compartilhado entre threads, então check_same_thread
+  continua valendo.
+- `conn.close()` devolve a conexão ao pool em vez de fechá-la; as rotas
+  existentes não precisam mudar.
+- Pools somente leitura recebem PRAGMAs ajustados (mmap, cache de páginas,
+  temp_store em memória e query_only).
+- Toda conexão nova recebe as agregações de sqlite_aggregates (MEDIAN,
+  PERCENTILE_CONT, STDEV, ...).
+- O alvo da conexão (URI `?immutable=1` no GAE) é montado uma única vez.
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+
+from sqlite_aggregates import register_aggregates
+
+# PRAGMAs aplicados às conexões de leitura (uma vez, na criação)
+READ_PRAGMAS = (
+    ("mmap_size", 268435456),    # 256 MB mapeados em memória
+    ("cache_size", -65536),      # 64 MB de page cache por conexão
+    ("temp_store", "MEMORY"),
+    ("query_only", "ON"),
+)
+
+# PRAGMAs aplicados às conexões graváveis (cache de relatórios)
+WRITE_PRAGMAS = (
+    ("cache_size", -16384),
+    ("temp_store", "MEMORY"),
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Conexão cujo close() devolve ao pool de origem."""
+
+    _pool: "SQLitePool | None" = None
+    _generation: int = 0
+
+    def close(self):
+        pool = self._pool
+        if pool is None:
+            super().close()
+            return
+        pool._release(self)
+
+    def discard(self):
+        """Fecha a conexão de fato (sem devolver ao pool)."""
+        self._pool = None
+        super().close()
+
+
+class SQLitePool:
+    """Pool de conexões SQLite com listas livres locais por thread."""
+
+    def __init__(self, path: str, readonly: bool = True, immutable: bool = False,
+                 max_idle: int = 4, pragmas: tuple | None = None):
+        self.path = path
+        self.readonly = readonly
+        self.max_idle = max_idle
+        self.pragmas = pragmas if pragmas is not None else (READ_PRAGMAS if readonly else WRITE_PRAGMAS)
+        if immutable:
+            self._target = 'file:' + os.path.abspath(path) + '?immutable=1'
+            self._uri = True
+        else:
+            self._target = path
+            self._uri = False
+        self._local = threading.local()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {"created": 0, "reused": 0, "discarded": 0}
+
+    def _idle(self) -> list:
+        idle = getattr(self._local, "idle", None)
+        if idle is None:
+            idle = self._local.idle = []
+        return idle
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(self._target, uri=self._uri, factory=PooledConnection)
+        for name, value in self.pragmas:
+            conn.execute(f"PRAGMA {name} = {value}")
+        register_aggregates(conn)
+        conn._pool = self
+        conn._generation = self._generation
+        with self._lock:
+            self._stats["created"] += 1
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        """Retorna uma conexão livre da thread atual (ou cria uma nova)."""
+        idle = self._idle()
+        while idle:
+            conn = idle.pop()
+            if conn._generation == self._generation:
+                with self._lock:
+                    self._stats["reused"] += 1
+                return conn
+            conn.discard()
+        return self._connect()
+
+    def _release(self, conn: PooledConnection):
+        """Restaura o estado da conexão e a devolve à lista livre."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+            conn.text_factory = str
+        except sqlite3.Error:
+            conn.discard()
+            return
+        idle = self._idle()
+        if conn._generation != self._generation or len(idle) >= self.max_idle:
+            conn.discard()
+            with self._lock:
+                self._stats["discarded"] += 1
+            return
+        idle.append(conn)
+
+    def invalidate(self):
+        """Descarta (de forma preguiçosa) todas as conexões existentes.
+
+        Útil quando o arquivo do banco é substituído: cada thread fecha suas
+        conexões antigas no próximo acquire/release.
+        """
+        with self._lock:
+            self._generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, path=self.path, readonly=self.readonly,
+                        generation=self._generation)
+
+
+_pools: dict = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str, readonly: bool = True, immutable: bool = False) -> SQLitePool:
+    """Retorna (criando se necessário) o pool para o par caminho/modo."""
+    key = (os.path.abspath(path), readonly, immutable)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SQLitePool(path, readonly=readonly, immutable=immutable)
+    return pool
+
+
+def pool_stats() -> list[dict]:
+    """Estatísticas de todos os pools (para /api/health)."""
+    return [p.stats() for p in list(_pools.values())]
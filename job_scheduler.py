@@ -0,0 +1,487 @@
+"""
+job_scheduler.py — Scheduler dos jobs de atualização com grafo de dependências.
+
+O company_update_manager rodava um subprocesso por vez: `start_job` recusava
+qualquer job enquanto `_active_job` estivesse rodando e o `full_pipeline`
+encadeava anual → trimestral → TTM → ratios → FX → snapshot, cada etapa
+esperando a anterior inteira. Aqui cada job vira um conjunto de tarefas
+(subprocessos) com dependências:
+
+- a fila é persistente: o job pedido é uma linha de `update_jobs` e cada
+  tarefa é outra linha com `parent_id`, `depends_on` (ids das tarefas das
+  quais depende), `command` e `resource`. Se o processo do app reiniciar,
+  `resume()` devolve à fila as tarefas que estavam rodando e o job continua;
+- uma tarefa roda quando todas as dependências terminaram com sucesso; se
+  alguma falhar (ou for cancelada), as dependentes são puladas ('skipped');
+- a concorrência é limitada por recurso: tarefas 'network' (buscas no Yahoo,
+  shards por setor/país) rodam em paralelo até `limits['network']`; tarefas
+  'db' (TTM, ratios, FX, snapshot — só SQLite) rodam uma por vez, já que o
+  SQLite tem um escritor só;
+- o progresso vem do canal estruturado de scripts/job_progress.py (arquivo
+  JSON por tarefa, caminho na variável UPDATE_JOB_PROGRESS); o stdout vai
+  para um log por tarefa, usado só como rastro de erro e como fase dos
+  scripts que ainda não reportam progresso.
+
+O laço de despacho roda numa thread daemon e consulta a fila no banco a cada
+`poll_interval`; quando nada está na fila ele dorme até o próximo `submit`.
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from scripts.job_progress import PROGRESS_ENV, read_progress
+
+NETWORK = "network"
+DB = "db"
+DEFAULT_LIMITS = {NETWORK: 3, DB: 1}
+
+FINISHED = ("completed", "error", "skipped", "cancelled")
+LOG_TAIL_LINES = 50
+KILL_GRACE_SECONDS = 10
+
+
+@dataclass
+class TaskSpec:
+    """Tarefa a enfileirar; `deps` referencia `key`s do mesmo job."""
+    key: str
+    job_type: str
+    cmd: list
+    deps: tuple = ()
+    resource: str = NETWORK
+    label: str = ""
+
+
+@dataclass
+class _Running:
+    task_id: int
+    parent_id: int
+    resource: str
+    process: subprocess.Popen
+    progress_path: Path
+    log_path: Path
+    started: float
+    terminate_at: float | None = None
+    log_file: object = field(default=None, repr=False)
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(worker: str | None) -> bool:
+    """True se `worker` (host:pid) é um processo vivo nesta máquina."""
+    if not worker or ":" not in worker:
+        return False
+    host, pid = worker.rsplit(":", 1)
+    if host != socket.gethostname():
+        return True  # outra máquina: não dá para saber, não mexe
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _tail(path: Path, lines: int = LOG_TAIL_LINES) -> str:
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64 * 1024))
+            text = f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return ""
+    return "\n".join([ln for ln in text.splitlines() if ln.strip()][-lines:])
+
+
+class JobScheduler:
+    """Fila persistente em `update_jobs` + despacho de subprocessos por recurso."""
+
+    def __init__(self, db_path: str, *, limits: dict | None = None, workdir: str | Path | None = None,
+                 state_dir: str | Path = "cache/_jobs", poll_interval: float = 0.5,
+                 on_job_done: Callable[[int, str, str], None] | None = None):
+        self.db_path = str(db_path)
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.workdir = str(workdir or Path(__file__).parent)
+        self.state_dir = Path(state_dir)
+        self.poll_interval = poll_interval
+        self.on_job_done = on_job_done
+        self.worker = _worker_id()
+        self._running: dict[int, _Running] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # ─── API ──────────────────────────────────────────────────────────────────
+
+    def submit(self, job_type: str, filters: dict, specs: list[TaskSpec]) -> int:
+        """Grava o job e suas tarefas na fila; devolve o id do job."""
+        keys = [s.key for s in specs]
+        if len(set(keys)) != len(keys):
+            raise ValueError("Chaves de tarefa duplicadas")
+        for s in specs:
+            missing = set(s.deps) - set(keys)
+            if missing:
+                raise ValueError(f"Tarefa {s.key} depende de tarefas inexistentes: {sorted(missing)}")
+
+        now = _now()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "INSERT INTO update_jobs (job_type, status, filters, started_at, total_items) "
+                "VALUES (?, 'running', ?, ?, 0)",
+                (job_type, json.dumps(filters, ensure_ascii=False), now))
+            job_id = cur.lastrowid
+            ids = {}
+            for s in specs:  # as specs chegam em ordem topológica ou não: ids primeiro
+                ids[s.key] = conn.execute(
+                    "INSERT INTO update_jobs (job_type, status, parent_id, task_key, label, command, resource) "
+                    "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                    (s.job_type, job_id, s.key, s.label or s.key,
+                     json.dumps(s.cmd, ensure_ascii=False), s.resource)).lastrowid
+            for s in specs:
+                conn.execute("UPDATE update_jobs SET depends_on = ? WHERE id = ?",
+                             (json.dumps([ids[d] for d in s.deps]), ids[s.key]))
+            conn.commit()
+        finally:
+            conn.close()
+        self._ensure_thread()
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id: int | None = None) -> list[int]:
+        """Cancela o job (ou todos os ativos): mata os processos e esvazia a fila."""
+        conn = self._connect()
+        try:
+            if job_id is None:
+                jobs = [r[0] for r in conn.execute(
+                    "SELECT id FROM update_jobs WHERE parent_id IS NULL AND status = 'running'")]
+            else:
+                jobs = [job_id]
+            for jid in jobs:
+                conn.execute("UPDATE update_jobs SET status = 'cancelled' WHERE id = ? AND status = 'running'", (jid,))
+                conn.execute("UPDATE update_jobs SET status = 'cancelled', completed_at = ? "
+                             "WHERE parent_id = ? AND status = 'queued'", (_now(), jid))
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            for run in self._running.values():
+                if run.parent_id in jobs and run.terminate_at is None:
+                    run.process.terminate()
+                    run.terminate_at = time.monotonic() + KILL_GRACE_SECONDS
+        self._wake.set()
+        return jobs
+
+    def active_jobs(self) -> list[int]:
+        conn = self._connect()
+        try:
+            return [r[0] for r in conn.execute(
+                "SELECT id FROM update_jobs WHERE parent_id IS NULL AND completed_at IS NULL "
+                "AND status IN ('running', 'cancelled') ORDER BY id")]
+        finally:
+            conn.close()
+
+    def resume(self):
+        """Trata tarefas 'running' órfãs (app reiniciado) e retoma o despacho.
+
+        Órfãs de jobs ativos voltam para a fila; as de jobs cancelados (o
+        processo caiu antes de o cancelamento terminar) são fechadas como
+        'cancelled', para que `_finalize` consiga encerrar o job.
+        """
+        conn = self._connect()
+        try:
+            stranded = [r for r in conn.execute("""
+                SELECT t.id, t.worker, p.status AS parent_status FROM update_jobs t
+                JOIN update_jobs p ON p.id = t.parent_id
+                WHERE t.status = 'running' AND p.status IN ('running', 'cancelled')
+            """) if r["worker"] != self.worker and not _pid_alive(r["worker"])]
+            orphans = [r["id"] for r in stranded if r["parent_status"] == "running"]
+            abandoned = [r["id"] for r in stranded if r["parent_status"] == "cancelled"]
+            if orphans:
+                conn.executemany("UPDATE update_jobs SET status = 'queued', worker = NULL WHERE id = ?",
+                                 [(i,) for i in orphans])
+            if abandoned:
+                conn.executemany("UPDATE update_jobs SET status = 'cancelled', completed_at = ? WHERE id = ?",
+                                 [(_now(), i) for i in abandoned])
+            if stranded:
+                conn.commit()
+            pending = conn.execute(
+                "SELECT 1 FROM update_jobs WHERE parent_id IS NULL AND completed_at IS NULL "
+                "AND status IN ('running', 'cancelled') LIMIT 1").fetchone()
+        finally:
+            conn.close()
+        if pending:
+            self._ensure_thread()
+            self._wake.set()
+        return orphans
+
+    def progress(self, job_id: int) -> dict | None:
+        """Progresso agregado do job (formato do antigo arquivo de progresso) + tarefas."""
+        conn = self._connect()
+        try:
+            job = conn.execute("SELECT * FROM update_jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            tasks = conn.execute("SELECT * FROM update_jobs WHERE parent_id = ? ORDER BY id", (job_id,)).fetchall()
+        finally:
+            conn.close()
+
+        rows, fractions = [], []
+        current = total = success = errors = 0
+        running_labels, phases = [], []
+        for t in tasks:
+            state = read_progress(self._progress_path(t["id"])) or {}
+            t_current = int(state.get("current") or t["processed_items"] or 0)
+            t_total = int(state.get("total") or t["total_items"] or 0)
+            t_success = int(state.get("success") or t["success_items"] or 0)
+            t_errors = int(state.get("errors") or t["error_items"] or 0)
+            if t["status"] in FINISHED:
+                fractions.append(1.0)
+            elif t["status"] == "running":
+                fractions.append(min(1.0, t_current / t_total) if t_total else 0.0)
+                running_labels.append(t["label"])
+                phases.append(state.get("phase") or _tail(self._log_path(t["id"]), 1)[:120])
+            else:
+                fractions.append(0.0)
+            current += t_current
+            total += t_total
+            success += t_success
+            errors += t_errors
+            rows.append({"id": t["id"], "key": t["task_key"], "label": t["label"], "job_type": t["job_type"],
+                         "status": t["status"], "current": t_current, "total": t_total,
+                         "success": t_success, "errors": t_errors})
+
+        finished = job["completed_at"] is not None
+        status = job["status"]
+        done = sum(1 for t in tasks if t["status"] in FINISHED)
+        if finished:
+            phase = {"completed": "Concluído!", "cancelled": "Cancelado pelo usuário"}.get(status, "Erro")
+            pct = 100 if status == "completed" else int(100 * sum(fractions) / max(len(fractions), 1))
+        else:
+            if status == "cancelled":
+                status = "running"  # aguardando os processos encerrarem
+            pct = min(99, int(100 * sum(fractions) / max(len(fractions), 1)))
+            if len(running_labels) == 1:
+                phase = f"{running_labels[0]}: {phases[0]}" if phases[0] else running_labels[0]
+            elif running_labels:
+                phase = f"{done}/{len(tasks)} tarefas • em execução: {', '.join(running_labels)}"
+            else:
+                phase = f"{done}/{len(tasks)} tarefas • aguardando"
+        result = {
+            "job_id": job_id,
+            "job_type": job["job_type"],
+            "status": status,
+            "phase": phase,
+            "pct": pct,
+            "current": current,
+            "total": total,
+            "success": success,
+            "errors": errors,
+            "tasks": rows,
+        }
+        if finished and job["duration_seconds"] is not None:
+            result["duration"] = round(job["duration_seconds"], 1)
+        return result
+
+    # ─── Despacho ─────────────────────────────────────────────────────────────
+
+    def _progress_path(self, task_id: int) -> Path:
+        return self.state_dir / f"task_{task_id}.json"
+
+    def _log_path(self, task_id: int) -> Path:
+        return self.state_dir / f"task_{task_id}.log"
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="job-scheduler", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                busy = self._tick()
+            except sqlite3.Error:
+                busy = True  # banco ocupado: tenta no próximo ciclo
+            if busy:
+                self._wake.wait(self.poll_interval)
+            else:
+                self._wake.wait()
+            self._wake.clear()
+
+    def _tick(self) -> bool:
+        """Um ciclo: colhe processos, pula/inicia tarefas, fecha jobs. True se há trabalho."""
+        self._reap()
+        conn = self._connect()
+        try:
+            self._dispatch(conn)
+            open_jobs = self._finalize(conn)
+        finally:
+            conn.close()
+        with self._lock:
+            return bool(self._running) or open_jobs
+
+    def _reap(self):
+        with self._lock:
+            runs = list(self._running.values())
+        for run in runs:
+            code = run.process.poll()
+            if code is None:
+                if run.terminate_at is not None and time.monotonic() > run.terminate_at:
+                    run.process.kill()
+                continue
+            run.log_file.close()
+            state = read_progress(run.progress_path) or {}
+            if run.terminate_at is not None:
+                status = "cancelled"
+            else:
+                status = "completed" if code == 0 else "error"
+            conn = self._connect()
+            try:
+                conn.execute("""
+                    UPDATE update_jobs SET status = ?, completed_at = ?, duration_seconds = ?,
+                        total_items = ?, processed_items = ?, success_items = ?, error_items = ?,
+                        error_log = ?
+                    WHERE id = ?
+                """, (status, _now(), time.monotonic() - run.started,
+                      state.get("total", 0), state.get("current", 0), state.get("success", 0),
+                      state.get("errors", 0), _tail(run.log_path) or None, run.task_id))
+                conn.commit()
+            finally:
+                conn.close()
+            with self._lock:
+                self._running.pop(run.task_id, None)
+
+    def _dispatch(self, conn: sqlite3.Connection):
+        queued = conn.execute("""
+            SELECT t.id, t.parent_id, t.depends_on, t.command, t.resource
+            FROM update_jobs t JOIN update_jobs p ON p.id = t.parent_id
+            WHERE t.status = 'queued' AND p.status = 'running'
+            ORDER BY t.id
+        """).fetchall()
+        if not queued:
+            return
+        dep_ids = {d for t in queued for d in json.loads(t["depends_on"] or "[]")}
+        dep_status = {}
+        if dep_ids:
+            marks = ",".join("?" * len(dep_ids))
+            dep_status = dict(conn.execute(f"SELECT id, status FROM update_jobs WHERE id IN ({marks})",
+                                           list(dep_ids)).fetchall())
+
+        with self._lock:
+            in_use = {}
+            for run in self._running.values():
+                in_use[run.resource] = in_use.get(run.resource, 0) + 1
+
+        skipped = []
+        for t in queued:
+            deps = json.loads(t["depends_on"] or "[]")
+            states = [dep_status.get(d) for d in deps]
+            if any(s in ("error", "skipped", "cancelled") for s in states):
+                skipped.append(t["id"])
+                continue
+            if any(s != "completed" for s in states):
+                continue
+            resource = t["resource"] or NETWORK
+            if in_use.get(resource, 0) >= self.limits.get(resource, 1):
+                continue
+            if self._start(conn, t["id"], t["parent_id"], resource, json.loads(t["command"])):
+                in_use[resource] = in_use.get(resource, 0) + 1
+
+        if skipped:
+            # Dependentes das puladas caem no próximo ciclo (cascata)
+            conn.executemany("UPDATE update_jobs SET status = 'skipped', completed_at = ? WHERE id = ?",
+                             [(_now(), i) for i in skipped])
+            conn.commit()
+            self._wake.set()
+
+    def _start(self, conn, task_id: int, parent_id: int, resource: str, cmd: list) -> bool:
+        # Reivindica a tarefa (outro processo do app pode ter pego antes)
+        claimed = conn.execute(
+            "UPDATE update_jobs SET status = 'running', started_at = ?, worker = ? WHERE id = ? AND status = 'queued'",
+            (_now(), self.worker, task_id)).rowcount
+        conn.commit()
+        if not claimed:
+            return False
+
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        progress_path = self._progress_path(task_id)
+        progress_path.unlink(missing_ok=True)
+        log_path = self._log_path(task_id)
+        env = dict(os.environ, **{PROGRESS_ENV: str(progress_path.resolve()), "PYTHONUNBUFFERED": "1"})
+        log_file = open(log_path, "w", encoding="utf-8", errors="replace")
+        try:
+            process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT,
+                                       cwd=self.workdir, env=env)
+        except OSError as e:
+            log_file.close()
+            conn.execute("UPDATE update_jobs SET status = 'error', completed_at = ?, error_log = ? WHERE id = ?",
+                         (_now(), str(e), task_id))
+            conn.commit()
+            return False
+        with self._lock:
+            self._running[task_id] = _Running(task_id, parent_id, resource, process, progress_path,
+                                              log_path, time.monotonic(), log_file=log_file)
+        return True
+
+    def _finalize(self, conn: sqlite3.Connection) -> bool:
+        """Fecha jobs sem tarefas pendentes; True se ainda há jobs abertos."""
+        jobs = conn.execute("""
+            SELECT id, job_type, status, started_at FROM update_jobs
+            WHERE parent_id IS NULL AND completed_at IS NULL AND status IN ('running', 'cancelled')
+        """).fetchall()
+        still_open = False
+        for job in jobs:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM update_jobs WHERE parent_id = ? AND status IN ('queued', 'running')",
+                (job["id"],)).fetchone()[0]
+            if pending:
+                still_open = True
+                continue
+            agg = conn.execute("""
+                SELECT COALESCE(SUM(total_items), 0), COALESCE(SUM(processed_items), 0),
+                       COALESCE(SUM(success_items), 0), COALESCE(SUM(error_items), 0),
+                       SUM(status != 'completed'), COUNT(*)
+                FROM update_jobs WHERE parent_id = ?
+            """, (job["id"],)).fetchone()
+            failed_logs = conn.execute(
+                "SELECT label, error_log FROM update_jobs WHERE parent_id = ? AND status = 'error' ORDER BY id",
+                (job["id"],)).fetchall()
+            if job["status"] == "cancelled":
+                status = "cancelled"
+            else:
+                status = "completed" if not agg[4] else "error"
+            error_log = "\n".join(f"--- {r['label']} ---\n{r['error_log'] or ''}" for r in failed_logs) or None
+            try:
+                duration = (datetime.now() - datetime.fromisoformat(job["started_at"])).total_seconds()
+            except (TypeError, ValueError):
+                duration = None
+            conn.execute("""
+                UPDATE update_jobs SET status = ?, completed_at = ?, duration_seconds = ?,
+                    total_items = ?, processed_items = ?, success_items = ?, error_items = ?, error_log = ?
+                WHERE id = ?
+            """, (status, _now(), duration, agg[0], agg[1], agg[2], agg[3], error_log, job["id"]))
+            conn.commit()
+            if self.on_job_done is not None:
+                threading.Thread(target=self.on_job_done, args=(job["id"], job["job_type"], self.db_path),
+                                 daemon=True).start()
+        return still_open
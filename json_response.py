@@ -0,0 +1,180 @@
+"""
+json_response.py — Serialização JSON rápida (DataFrames/NumPy) e compressão.
+
+Muitas rotas faziam `df.replace({np.nan: None, np.inf: None, -np.inf: None})`
+→ `to_dict('records')` → `jsonify`, criando um dict Python por linha (e
+algumas ainda varriam os floats com `v != v`). Aqui:
+
+- `json_response(payload)` aceita DataFrames, Series e arrays NumPy em
+  qualquer ponto do payload; eles são serializados direto pelo encoder C do
+  pandas (`to_json`), com NaN/inf → null, e o resto pelo `json` normal;
+- `?orient=columns` (opt-in) troca as listas de registros por
+  `{"columns": [...], "data": [[coluna 1], [coluna 2], ...]}` — bem menor
+  em listas grandes;
+- `NumpyJSONProvider` (instalado em `app.json`) faz o `jsonify` aceitar
+  escalares/arrays NumPy, Timestamps e trocar NaN/inf por null, em vez de
+  emitir `NaN` (JSON inválido para o navegador);
+- `compress_response()` (after_request) comprime respostas grandes com br
+  (se o pacote brotli estiver instalado) ou gzip, conforme Accept-Encoding.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import math
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import brotli
+except ImportError:  # brotli é opcional
+    brotli = None
+
+DOUBLE_PRECISION = 15
+COMPRESS_MIN_BYTES = 8 * 1024
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/html", "text/csv", "text/plain", "application/javascript")
+
+
+# ─── Escalares e sanitização ─────────────────────────────────────────────────
+
+def _default(obj):
+    """Tipos que o `json` não conhece (NumPy, pandas, datas)."""
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        value = float(obj)
+        return value if math.isfinite(value) else None
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return _clean(obj.tolist())
+    if isinstance(obj, (pd.Timestamp, datetime, date)):
+        return obj.isoformat()
+    if obj is pd.NaT or obj is pd.NA:
+        return None
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return json.loads(_frame_json(obj, "records"))
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _clean(obj):
+    """Cópia do payload com NaN/inf → None (só usada quando há não finitos)."""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _clean(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_clean(v) for v in obj]
+    return obj
+
+
+def dumps(obj, **kwargs) -> str:
+    """`json.dumps` com NaN/inf → null e suporte a NumPy/pandas.
+
+    Caminho rápido: `allow_nan=False` só falha se houver não finitos; nesse
+    caso o payload é limpo e serializado de novo.
+    """
+    kwargs.setdefault("default", _default)
+    kwargs["allow_nan"] = False
+    try:
+        return json.dumps(obj, **kwargs)
+    except ValueError:
+        return json.dumps(_clean(obj), **kwargs)
+
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """Provider do Flask que usa `dumps()` (jsonify com NumPy e sem NaN)."""
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        return dumps(obj, **kwargs)
+
+
+# ─── DataFrames / arrays ─────────────────────────────────────────────────────
+
+def _frame_json(obj, orient: str) -> str:
+    if isinstance(obj, np.ndarray):  # arrays viram listas (aninhadas se 2-D)
+        obj = pd.Series(obj) if obj.ndim == 1 else pd.DataFrame(obj)
+        return obj.to_json(orient="values", double_precision=DOUBLE_PRECISION, date_format="iso")
+    if isinstance(obj, pd.Series):
+        return obj.to_json(orient="values", double_precision=DOUBLE_PRECISION, date_format="iso")
+    if orient == "columns":
+        columns = [str(c) for c in obj.columns]
+        arrays = ",".join(obj.iloc[:, i].to_json(orient="values", double_precision=DOUBLE_PRECISION,
+                                                 date_format="iso")
+                          for i in range(obj.shape[1]))
+        return f'{{"columns":{json.dumps(columns)},"data":[{arrays}]}}'
+    return obj.to_json(orient="records", double_precision=DOUBLE_PRECISION, date_format="iso")
+
+
+_FRAME_TYPES = (pd.DataFrame, pd.Series, np.ndarray)
+
+
+def _has_frames(obj) -> bool:
+    """DataFrames/arrays em dicts (recursivo) ou direto numa lista.
+
+    Listas de registros não são percorridas registro a registro; um DataFrame
+    dentro delas ainda funciona, pelo caminho lento do `_default`.
+    """
+    if isinstance(obj, _FRAME_TYPES):
+        return True
+    if isinstance(obj, dict):
+        return any(_has_frames(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(isinstance(v, _FRAME_TYPES) for v in obj)
+    return False
+
+
+def encode(obj, orient: str = "records") -> str:
+    """JSON de `obj`; DataFrames/arrays vão direto pelo `to_json` do pandas."""
+    if isinstance(obj, _FRAME_TYPES):
+        return _frame_json(obj, orient)
+    if not _has_frames(obj):
+        return dumps(obj)
+    if isinstance(obj, dict):
+        return "{" + ",".join(f"{json.dumps(str(k))}:{encode(v, orient)}" for k, v in obj.items()) + "}"
+    return "[" + ",".join(encode(v, orient) for v in obj) + "]"
+
+
+def requested_orient() -> str:
+    """'columns' se o cliente pediu `?orient=columns`, senão 'records'."""
+    return "columns" if request.args.get("orient") == "columns" else "records"
+
+
+def json_response(payload, status: int = 200, orient: str | None = None) -> Response:
+    """Response JSON de um payload que pode conter DataFrames/arrays."""
+    body = encode(payload, orient or requested_orient())
+    return Response(body, status=status, mimetype="application/json")
+
+
+# ─── Compressão ──────────────────────────────────────────────────────────────
+
+def _accepts(encoding: str) -> bool:
+    return encoding in request.accept_encodings
+
+
+def compress_response(response: Response) -> Response:
+    """after_request: br/gzip para respostas grandes e comprimíveis."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code == 204
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    if brotli is not None and _accepts("br"):
+        compressed, encoding = brotli.compress(data, quality=5), "br"
+    elif _accepts("gzip"):
+        compressed, encoding = gzip.compress(data, compresslevel=6), "gzip"
+    else:
+        return response
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,124 @@
+"""
+keyset_pagination.py — Paginação por cursor (keyset) das listagens de drill-down.
+
+`/api/yahoo_drill/companies` e `/api/historico_drill/companies` paginavam com
+`LIMIT ? OFFSET ?` e, a cada página, refaziam o COUNT(*) do join inteiro; a
+listagem Yahoo ainda rodava um `EXISTS (... company_financials_historical ...)`
+por linha para o flag `has_historico`. Aqui:
+
+- a ordenação ganha um desempate único (`ORDER BY col, id`) e a próxima
+  página é pedida "depois de (valor, id)" — o SQLite não precisa mais pular
+  OFFSET linhas. O cursor é opaco (JSON em base64) e volta em `next_cursor`;
+- quando a UI pede a página N+1 logo depois da N, o cursor do fim da página N
+  (guardado em cache por assinatura do filtro) é reaproveitado, então a
+  navegação sequencial por números de página também vira keyset;
+- totais ficam em cache por assinatura do filtro (SQL + parâmetros);
+- o conjunto de yahoo_codes com histórico é calculado uma vez por versão dos
+  dados e o flag `has_historico` vira um teste de pertinência.
+
+Os caches usam o `ResultCache`/`data_version()` de result_cache.py, então
+jobs de atualização (bump_data_version) e escritas no banco os invalidam.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import threading
+
+from result_cache import ResultCache, data_version
+
+count_cache = ResultCache(max_entries=2048, max_bytes=1024 * 1024)
+anchor_cache = ResultCache(max_entries=4096, max_bytes=4 * 1024 * 1024)
+
+
+# ─── Cursor ──────────────────────────────────────────────────────────────────
+
+def encode_cursor(sort_value, tie_value) -> str:
+    if hasattr(sort_value, "item"):  # escalares NumPy (linhas vindas do pandas)
+        sort_value = sort_value.item()
+    if isinstance(sort_value, float) and sort_value != sort_value:
+        sort_value = None
+    raw = json.dumps([sort_value, tie_value], separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple:
+    """(valor de ordenação, desempate); ValueError se o cursor for inválido."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        sort_value, tie_value = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Cursor inválido: {token}") from e
+    if not all(v is None or isinstance(v, (str, int, float)) for v in (sort_value, tie_value)):
+        raise ValueError(f"Cursor inválido: {token}")
+    return sort_value, tie_value
+
+
+def order_by(sort_expr: str, tie_expr: str, sort_dir: str) -> str:
+    return f"{sort_expr} {sort_dir}, {tie_expr} {sort_dir}"
+
+
+def keyset_condition(sort_expr: str, tie_expr: str, sort_dir: str, cursor: tuple) -> tuple[str, list]:
+    """Predicado "linhas depois do cursor" para `order_by(...)`.
+
+    Segue a ordem do SQLite: NULLs primeiro em ASC e por último em DESC.
+    """
+    value, tie = cursor
+    if sort_dir == "ASC":
+        if value is None:
+            return f"(({sort_expr} IS NULL AND {tie_expr} > ?) OR {sort_expr} IS NOT NULL)", [tie]
+        return f"({sort_expr} > ? OR ({sort_expr} = ? AND {tie_expr} > ?))", [value, value, tie]
+    if value is None:
+        return f"({sort_expr} IS NULL AND {tie_expr} < ?)", [tie]
+    return (f"({sort_expr} < ? OR ({sort_expr} = ? AND {tie_expr} < ?) OR {sort_expr} IS NULL)",
+            [value, value, tie])
+
+
+# ─── Caches por assinatura do filtro ─────────────────────────────────────────
+
+def signature(*parts) -> str:
+    canon = json.dumps(parts, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def cached_count(conn, route: str, count_sql: str, params: list) -> int:
+    """COUNT do filtro, reaproveitado enquanto a versão dos dados não muda."""
+    key = f"{route}:{signature(count_sql, params)}"
+    version = data_version()
+    payload = count_cache.get(route, key, version)
+    if payload is not None:
+        return int(payload)
+    total = conn.execute(count_sql, params).fetchone()[0] or 0
+    count_cache.put(key, version, str(total).encode())
+    return total
+
+
+def get_anchor(route: str, sig: str, page: int) -> str | None:
+    """Cursor do fim da página `page - 1` (se já foi servida)."""
+    payload = anchor_cache.get(route, f"{route}:{sig}:{page}", data_version())
+    return payload.decode("ascii") if payload is not None else None
+
+
+def put_anchor(route: str, sig: str, page: int, cursor: str):
+    """Guarda o cursor que abre a página `page`."""
+    anchor_cache.put(f"{route}:{sig}:{page}", data_version(), cursor.encode("ascii"))
+
+
+# ─── Flag has_historico ──────────────────────────────────────────────────────
+
+_historico_codes = {"version": None, "codes": frozenset()}
+_historico_lock = threading.Lock()
+
+
+def historico_codes(conn) -> frozenset:
+    """yahoo_codes com ao menos uma linha em company_financials_historical."""
+    version = data_version()
+    if _historico_codes["version"] == version:
+        return _historico_codes["codes"]
+    with _historico_lock:
+        if _historico_codes["version"] != version:
+            rows = conn.execute("SELECT DISTINCT yahoo_code FROM company_financials_historical")
+            _historico_codes["codes"] = frozenset(r[0] for r in rows if r[0] is not None)
+            _historico_codes["version"] = version
+    return _historico_codes["codes"]
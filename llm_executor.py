@@ -0,0 +1,255 @@
+"""
+llm_executor.py — Execução concorrente e cache das chamadas de LLM do relatório.
+
+`api_estudoanloc_generate_report` gerava as narrativas e os comentários dos
+gráficos um depois do outro, cada um bloqueando num
+`anthropic.Anthropic(...).messages.create`, e toda regeneração pagava a
+latência inteira de novo mesmo com o contexto estatístico inalterado. Aqui:
+
+- `LLMExecutor.submit()` roda os prompts num pool limitado de threads
+  (`max_workers`) e devolve um Future — prompts independentes correm em
+  paralelo;
+- prompts idênticos em andamento (duplo clique, dois usuários gerando o
+  mesmo relatório) compartilham o mesmo Future em vez de chamar a API duas
+  vezes;
+- as respostas ficam na tabela `llm_completion_cache` do DB de cache dos
+  relatórios, com chave = sha256 de (provedor, modelo, max_tokens, system,
+  mensagens). O prompt carrega o contexto estatístico, então qualquer mudança
+  nos dados gera outra chave. Falhas não são gravadas, nem respostas
+  recusadas pelo `validate` do chamador (ex.: JSON truncado) — e uma entrada
+  em cache que o `validate` recuse é removida e o prompt é reenviado.
+
+O provedor é qualquer função com a assinatura de `_call_llm_chat`:
+
+    call(provider, api_key, messages, system_prompt, model=None, max_tokens=4096) -> str
+
+`FakeProvider` implementa essa interface localmente (respostas fixas,
+latência simulada e registro das chamadas) para testar sem rede.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODELS = {
+    "gemini": "gemini-2.0-flash",
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-sonnet-4-20250514",
+}
+DEFAULT_MAX_TOKENS = 4096
+MAX_WORKERS = 4
+
+CACHE_TABLE = "llm_completion_cache"
+
+
+def resolve_model(provider: str, model: str | None = None) -> str:
+    if model:
+        return model
+    if provider not in DEFAULT_MODELS:
+        raise ValueError(f"Provedor LLM não suportado: {provider}")
+    return DEFAULT_MODELS[provider]
+
+
+def prompt_key(provider: str, model: str, messages: list, system_prompt: str, max_tokens: int) -> str:
+    """sha256 canônico do prompt completo (o contexto vai dentro das mensagens)."""
+    canon = json.dumps([provider, model, max_tokens, system_prompt or "",
+                        [[m["role"], m["content"]] for m in messages]],
+                       separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+# ─── Cache persistente ───────────────────────────────────────────────────────
+
+def ensure_cache_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+            prompt_hash TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            elapsed_ms INTEGER,
+            created_at TEXT DEFAULT (datetime('now', 'localtime'))
+        )
+    """)
+    conn.commit()
+
+
+class CompletionCache:
+    """Respostas por prompt_hash numa tabela do DB de cache.
+
+    `connect` devolve uma conexão gravável (ex.: `get_cache_db` do app); ela
+    é fechada (devolvida ao pool) após cada operação. Leituras não escrevem
+    nada: fora do GAE o DB de cache é o banco principal, e uma escrita mudaria
+    a `data_version()` e invalidaria o cache de respostas.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        conn = self._connect()
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    ensure_cache_table(conn)
+                    self._ready = True
+        return conn
+
+    def get(self, key: str) -> str | None:
+        conn = self._conn()
+        try:
+            row = conn.execute(f"SELECT response FROM {CACHE_TABLE} WHERE prompt_hash = ?", (key,)).fetchone()
+            return row[0] if row is not None else None
+        finally:
+            conn.close()
+
+    def put(self, key: str, provider: str, model: str, response: str, elapsed_ms: int):
+        conn = self._conn()
+        try:
+            conn.execute(f"""
+                INSERT OR REPLACE INTO {CACHE_TABLE} (prompt_hash, provider, model, response, elapsed_ms)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, provider, model, response, elapsed_ms))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, key: str):
+        conn = self._conn()
+        try:
+            conn.execute(f"DELETE FROM {CACHE_TABLE} WHERE prompt_hash = ?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def _accepts(validate, text: str) -> bool:
+    """Resposta passa no `validate` do chamador (exceção conta como recusa)."""
+    if validate is None:
+        return True
+    try:
+        return bool(validate(text))
+    except Exception:
+        return False
+
+
+# ─── Executor ────────────────────────────────────────────────────────────────
+
+class LLMExecutor:
+    """Pool limitado + dedup em andamento + cache persistente de completions."""
+
+    def __init__(self, call, cache: CompletionCache | None = None, max_workers: int = MAX_WORKERS):
+        self.call = call
+        self.cache = cache
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, provider: str, api_key: str, messages: list, system_prompt: str = "",
+               model: str | None = None, max_tokens: int = DEFAULT_MAX_TOKENS,
+               use_cache: bool = True, validate=None) -> Future:
+        """Future com o texto da resposta.
+
+        Com use_cache=False a resposta não é lida do cache (é regravada nele);
+        um prompt idêntico já em andamento ainda é compartilhado. `validate(text)`
+        decide se a resposta pode ir para o cache: só respostas aceitas são
+        gravadas, e uma entrada em cache recusada é apagada e o prompt reenviado.
+        """
+        model = resolve_model(provider, model)
+        key = prompt_key(provider, model, messages, system_prompt, max_tokens)
+
+        if use_cache and self.cache is not None:
+            try:
+                cached = self.cache.get(key)
+            except Exception as e:  # cache indisponível não impede a chamada
+                logger.warning(f"Falha ao ler cache de LLM: {e}")
+                cached = None
+            if cached is not None and not _accepts(validate, cached):
+                logger.warning("Resposta de LLM em cache recusada pela validação; descartando")
+                self.evict(key)
+                cached = None
+            if cached is not None:
+                done = Future()
+                done.set_result(cached)
+                return done
+
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = self._pool.submit(self._run, key, provider, api_key, messages,
+                                       system_prompt, model, max_tokens, validate)
+            self._inflight[key] = future
+        future.add_done_callback(lambda _f: self._forget(key))
+        return future
+
+    def complete(self, *args, **kwargs) -> str:
+        """`submit(...).result()`."""
+        return self.submit(*args, **kwargs).result()
+
+    def evict(self, key: str):
+        """Remove uma resposta do cache persistente (falhas só são logadas)."""
+        if self.cache is None:
+            return
+        try:
+            self.cache.delete(key)
+        except Exception as e:
+            logger.warning(f"Falha ao remover do cache de LLM: {e}")
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def _run(self, key, provider, api_key, messages, system_prompt, model, max_tokens, validate=None) -> str:
+        start = time.perf_counter()
+        text = self.call(provider, api_key, messages, system_prompt, model=model, max_tokens=max_tokens)
+        elapsed_ms = int((time.perf_counter() - start) * 1000)
+        if self.cache is not None and text:
+            if not _accepts(validate, text):
+                logger.warning("Resposta de LLM recusada pela validação; não será gravada no cache")
+                return text
+            try:
+                self.cache.put(key, provider, model, text, elapsed_ms)
+            except Exception as e:
+                logger.warning(f"Falha ao gravar cache de LLM: {e}")
+        return text
+
+
+# ─── Provedor falso (testes locais) ──────────────────────────────────────────
+
+class FakeProvider:
+    """Provedor local com a interface de `_call_llm_chat`.
+
+    `responses` mapeia um trecho do prompt → resposta (a primeira que
+    aparecer na última mensagem vence); sem correspondência, devolve
+    `default`. `delay` simula a latência da API. As chamadas recebidas ficam
+    em `calls`.
+    """
+
+    def __init__(self, responses: dict | None = None, default: str = "{}", delay: float = 0.0):
+        self.responses = responses or {}
+        self.default = default
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, provider, api_key, messages, system_prompt, model=None, max_tokens=DEFAULT_MAX_TOKENS):
+        with self._lock:
+            self.calls.append({"provider": provider, "model": model, "max_tokens": max_tokens,
+                               "system_prompt": system_prompt, "messages": messages,
+                               "thread": threading.current_thread().name})
+        if self.delay:
+            time.sleep(self.delay)
+        prompt = messages[-1]["content"] if messages else ""
+        for needle, response in self.responses.items():
+            if needle in prompt:
+                return response
+        return self.default
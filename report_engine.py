@@ -0,0 +1,354 @@
+"""
+report_engine.py — Motor do Relatório Periódico (Estudo Anloc) para todos os setores.
+
+Substitui o laço setor a setor de /api/estudoanloc/generate_report (uma query +
+filtros + percentis por setor e por ano de evolução) por:
+- uma única query com as linhas anuais de todos os setores/anos necessários;
+- filtros de exclusão vetorizados (indústria, manual, EV mínimo, EBITDA ≤ 0,
+  teto EV/EBITDA), preservando a ordem e o texto da lista de excluídos;
+- estatísticas (mediana, p25, p75, média) em um único groupby sobre
+  setor × recorte (Global/LATAM/Brasil) × ano, e setor × indústria.
+
+O formato de saída é o mesmo das antigas _report_calc_sector_stats e
+_report_evolution_sector.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+LATAM_COUNTRIES = [
+    'Brazil', 'Mexico', 'Argentina', 'Chile', 'Colombia', 'Peru', 'Uruguay',
+    'Paraguay', 'Bolivia', 'Ecuador', 'Venezuela', 'Costa Rica', 'Panama',
+    'Guatemala', 'Honduras', 'El Salvador', 'Nicaragua', 'Dominican Republic',
+    'Puerto Rico', 'Cuba'
+]
+
+METRICS = ['ev_ebitda', 'ev_revenue']
+
+_EXCLUSION_COLS = ['ticker', 'company_name', 'sector', 'industry', 'country', 'motivo', 'detalhe']
+
+
+# ─── Carga ─────────────────────────────────────────────────────────────────────
+
+def _load_rows(conn, sectors, fiscal_year, is_current, year_start, year_end) -> pd.DataFrame:
+    """Carrega as linhas anuais de todos os setores em uma única query."""
+    placeholders = ','.join('?' * len(sectors))
+    query = f"""
+        SELECT cbd.id as company_id, cbd.ticker, cbd.company_name,
+               cbd.yahoo_sector, cbd.yahoo_industry, cbd.yahoo_country as country,
+               COALESCE(dg.sub_group, 'Other') as region,
+               cfh.enterprise_value_estimated as ev,
+               cfh.total_revenue as revenue, cfh.normalized_ebitda as ebitda,
+               cfh.free_cash_flow as fcf, cfh.fiscal_year
+        FROM company_basic_data cbd
+        JOIN company_financials_historical cfh ON cfh.yahoo_code = cbd.yahoo_code
+        LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
+        WHERE cbd.yahoo_sector IN ({placeholders})
+          AND cfh.period_type = 'annual'
+          AND cfh.enterprise_value_estimated IS NOT NULL AND cfh.enterprise_value_estimated > 0
+          AND cfh.total_revenue IS NOT NULL AND cfh.total_revenue > 0
+    """
+    params = list(sectors)
+    if not is_current:
+        # Modo múltiplos atuais usa anuais de qualquer ano; histórico só o ano + janela de evolução
+        query += " AND (cfh.fiscal_year = ? OR cfh.fiscal_year BETWEEN ? AND ?)"
+        params.extend([fiscal_year, year_start, year_end])
+    query += " ORDER BY cbd.id, cfh.id"
+    return pd.read_sql_query(query, conn, params=params)
+
+
+def _add_multiples(df: pd.DataFrame) -> pd.DataFrame:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['ev_ebitda'] = np.where((df['ebitda'] > 0) & (df['ev'] > 0), df['ev'] / df['ebitda'], np.nan)
+        df['ev_revenue'] = np.where(df['revenue'] > 0, df['ev'] / df['revenue'], np.nan)
+    return df
+
+
+# ─── Estatísticas agrupadas ────────────────────────────────────────────────────
+
+def _segments(df: pd.DataFrame) -> pd.DataFrame:
+    """Empilha os recortes Global / LATAM / Brasil numa coluna 'segment'."""
+    parts = [
+        df.assign(segment='global'),
+        df[df['country'].isin(LATAM_COUNTRIES)].assign(segment='latam'),
+        df[df['country'] == 'Brazil'].assign(segment='brazil'),
+    ]
+    return pd.concat(parts, ignore_index=True)
+
+
+def _group_stats(df: pd.DataFrame, keys: list, with_spread_stats: bool = True) -> pd.DataFrame:
+    """n, e por métrica: contagem, mediana, média, p25 e p75 — um groupby só."""
+    g = df.groupby(keys, sort=False)
+    out = {'n': g.size()}
+    for m in METRICS:
+        col = g[m]
+        out[f'{m}_n'] = col.count()
+        out[f'{m}_median'] = col.median()
+        if with_spread_stats:
+            out[f'{m}_mean'] = col.mean()
+            out[f'{m}_p25'] = col.quantile(0.25)
+            out[f'{m}_p75'] = col.quantile(0.75)
+    return pd.DataFrame(out)
+
+
+def _stats_dict(row) -> dict:
+    result = {'n': int(row['n'])}
+    for m in METRICS:
+        if row[f'{m}_n'] >= 1:
+            result[m] = {
+                'median': round(float(row[f'{m}_median']), 2),
+                'mean': round(float(row[f'{m}_mean']), 2),
+                'p25': round(float(row[f'{m}_p25']), 2),
+                'p75': round(float(row[f'{m}_p75']), 2),
+                'n': int(row[f'{m}_n'])
+            }
+        else:
+            result[m] = None
+    return result
+
+
+def _lookup(stats: pd.DataFrame, key):
+    try:
+        return stats.loc[key]
+    except KeyError:
+        return None
+
+
+def _spread(local, ref, metric):
+    lv = local.get(metric, {})
+    rv = ref.get(metric, {})
+    if lv and rv and lv.get('median') and rv.get('median') and rv['median'] != 0:
+        diff = lv['median'] - rv['median']
+        pct = round((diff / abs(rv['median'])) * 100, 1)
+        return {'diff': round(diff, 2), 'pct': pct, 'direction': 'premium' if pct > 0 else 'discount'}
+    return None
+
+
+# ─── Exclusões ─────────────────────────────────────────────────────────────────
+
+def _exclusion_frame(df, mask, stage, motivo, detalhe) -> pd.DataFrame:
+    sub = df[mask]
+    return pd.DataFrame({
+        '_sector_order': sub['_sector_order'],
+        '_stage': stage,
+        '_row': sub['_row'],
+        'ticker': sub['ticker'],
+        'company_name': sub['company_name'],
+        'sector': sub['yahoo_sector'],
+        'industry': sub['yahoo_industry'],
+        'country': sub['country'],
+        'motivo': motivo if isinstance(motivo, str) else motivo(sub),
+        'detalhe': detalhe if isinstance(detalhe, str) else detalhe(sub),
+    })
+
+
+def _apply_filters(df, min_ev, max_ev_ebitda, require_positive_ebitda,
+                   selected_industries, manual_excluded_tickers):
+    """Aplica os filtros do relatório; retorna (df filtrado, frame de excluídos)."""
+    excluded = []
+
+    if selected_industries:
+        mask = ~df['yahoo_industry'].isin(selected_industries)
+        excluded.append(_exclusion_frame(
+            df, mask, 0, 'Indústria não selecionada',
+            lambda s: [f"Indústria: {v}" for v in s['yahoo_industry']]))
+        df = df[~mask]
+
+    if manual_excluded_tickers:
+        manual_set = set(t.upper().strip() for t in manual_excluded_tickers)
+        # Aceita ticker completo (NasdaqGS:AAPL) ou só o código após o prefixo (AAPL)
+        tick = df['ticker'].str.upper().str.strip()
+        short = tick.str.split(':', n=1).str[1]
+        mask = tick.isin(manual_set) | short.isin(manual_set)
+        excluded.append(_exclusion_frame(
+            df, mask, 1, 'Exclusão manual', 'Removido manualmente pelo usuário'))
+        df = df[~mask]
+
+    if min_ev:
+        mask = df['ev'] < min_ev
+        excluded.append(_exclusion_frame(
+            df, mask, 2, f'EV < USD {min_ev/1e6:.0f}M',
+            lambda s: [f"EV: USD {v/1e6:.1f}M < mínimo USD {min_ev/1e6:.0f}M" for v in s['ev']]))
+        df = df[~mask]
+
+    df = _add_multiples(df.copy())
+
+    if require_positive_ebitda:
+        mask = (df['ebitda'] <= 0) | df['ebitda'].isna()
+        excluded.append(_exclusion_frame(
+            df, mask, 3, 'EBITDA ≤ 0',
+            lambda s: [f"EBITDA: {v:.0f}" if pd.notna(v) else 'EBITDA: N/D' for v in s['ebitda']]))
+        df = df[~mask]
+
+    if max_ev_ebitda:
+        mask = df['ev_ebitda'] > max_ev_ebitda
+        excluded.append(_exclusion_frame(
+            df, mask, 4, f'EV/EBITDA > {max_ev_ebitda}x',
+            lambda s: [f"EV/EBITDA: {v:.1f}x > teto {max_ev_ebitda}x" for v in s['ev_ebitda']]))
+        df.loc[mask, 'ev_ebitda'] = np.nan
+
+    excluded = [e for e in excluded if not e.empty]
+    if excluded:
+        excl = pd.concat(excluded, ignore_index=True).sort_values(
+            ['_sector_order', '_stage', '_row'], kind='stable')
+    else:
+        excl = pd.DataFrame(columns=['_sector_order', '_stage', '_row'] + _EXCLUSION_COLS)
+    return df, excl
+
+
+# ─── Seções do relatório ───────────────────────────────────────────────────────
+
+def _sector_sections(df, sectors) -> dict:
+    """Estatísticas por setor (Global/LATAM/Brasil, spreads, indústrias, top BR)."""
+    seg_stats = _group_stats(_segments(df), ['yahoo_sector', 'segment'])
+    ind_stats = _group_stats(df.dropna(subset=['yahoo_industry']), ['yahoo_sector', 'yahoo_industry'])
+    df_br = df[df['country'] == 'Brazil']
+    ind_br_stats = _group_stats(df_br.dropna(subset=['yahoo_industry']), ['yahoo_sector', 'yahoo_industry'])
+    top_br = (df_br.dropna(subset=['ev_ebitda'])
+              .sort_values('ev_ebitda', ascending=False, kind='stable')
+              .groupby('yahoo_sector', sort=False).head(10))
+    sizes = df.groupby('yahoo_sector', sort=False).size()
+
+    sections = {}
+    for sector in sectors:
+        if sector not in sizes.index:
+            continue
+
+        global_stats = _stats_dict(seg_stats.loc[(sector, 'global')])
+        global_stats['label'] = 'Global'
+
+        regional = {}
+        for seg, label in (('latam', 'LATAM'), ('brazil', 'Brasil')):
+            row = _lookup(seg_stats, (sector, seg))
+            n = int(row['n']) if row is not None else 0
+            stats = _stats_dict(row) if n >= 2 else {'n': n, 'ev_ebitda': None, 'ev_revenue': None}
+            stats['label'] = label
+            regional[seg] = stats
+        latam_stats, br_stats = regional['latam'], regional['brazil']
+
+        spreads = {
+            'latam_vs_global': {m: _spread(latam_stats, global_stats, m) for m in METRICS},
+            'br_vs_global': {m: _spread(br_stats, global_stats, m) for m in METRICS},
+            'br_vs_latam': {m: _spread(br_stats, latam_stats, m) for m in METRICS},
+        }
+
+        by_industry = []
+        if sector in ind_stats.index.get_level_values(0):
+            sec_ind = ind_stats.xs(sector, level=0).sort_index()
+            for ind, row in sec_ind.iterrows():
+                if row['n'] < 2:
+                    continue
+                s = _stats_dict(row)
+                s['label'] = ind
+                br_row = _lookup(ind_br_stats, (sector, ind))
+                if br_row is not None:
+                    br_s = _stats_dict(br_row)
+                    s['brazil_ev_ebitda'] = br_s.get('ev_ebitda')
+                    s['brazil_ev_revenue'] = br_s.get('ev_revenue')
+                    s['brazil_n'] = br_s['n']
+                else:
+                    s['brazil_ev_ebitda'] = None
+                    s['brazil_ev_revenue'] = None
+                    s['brazil_n'] = 0
+                by_industry.append(s)
+        by_industry.sort(key=lambda x: x['n'], reverse=True)
+
+        top = top_br[top_br['yahoo_sector'] == sector]
+        sections[sector] = {
+            'sector': sector,
+            'global': global_stats,
+            'latam': latam_stats,
+            'brazil': br_stats,
+            'spreads': spreads,
+            'by_industry': by_industry,
+            'top_brazil_companies': top[['ticker', 'company_name', 'yahoo_industry', 'ev_ebitda', 'ev_revenue', 'ev']].to_dict('records'),
+            'total_companies': int(sizes[sector]),
+        }
+    return sections
+
+
+def _evolution_sections(df, sectors, year_start, year_end, min_ev, max_ev_ebitda) -> dict:
+    """Evolução anual de medianas (Global/LATAM/Brasil + indústrias) por setor."""
+    df = df[(df['fiscal_year'] >= year_start) & (df['fiscal_year'] <= year_end)]
+    if min_ev:
+        df = df[df['ev'] >= min_ev]
+    df = _add_multiples(df.copy())
+    if max_ev_ebitda:
+        df.loc[df['ev_ebitda'] > max_ev_ebitda, 'ev_ebitda'] = np.nan
+
+    seg_stats = _group_stats(_segments(df), ['yahoo_sector', 'fiscal_year', 'segment'], with_spread_stats=False)
+    ind_stats = _group_stats(df.dropna(subset=['yahoo_industry']),
+                             ['yahoo_sector', 'fiscal_year', 'yahoo_industry'], with_spread_stats=False)
+
+    def _med(row, metric):
+        if row is None or row[f'{metric}_n'] < 2:
+            return None
+        return round(float(row[f'{metric}_median']), 2)
+
+    # Indústrias na ordem de primeira aparição (como df['industry'].unique())
+    industries = {}
+    for (sector, yr, ind), row in ind_stats.iterrows():
+        if row['n'] >= 2:
+            industries.setdefault((sector, yr), {})[ind] = {
+                'ev_ebitda': _med(row, 'ev_ebitda'),
+                'ev_revenue': _med(row, 'ev_revenue'),
+                'n': int(row['n'])
+            }
+
+    sections = {}
+    for sector in sectors:
+        results = []
+        for yr in range(year_start, year_end + 1):
+            yr_data = {'year': yr}
+            for seg in ('global', 'latam', 'brazil'):
+                row = _lookup(seg_stats, (sector, yr, seg))
+                yr_data[seg] = {'ev_ebitda': _med(row, 'ev_ebitda'), 'ev_revenue': _med(row, 'ev_revenue'),
+                                'n': int(row['n']) if row is not None else 0}
+            yr_data['by_industry'] = industries.get((sector, yr), {})
+            results.append(yr_data)
+        sections[sector] = results
+    return sections
+
+
+def build_report_sectors(conn, sectors, fiscal_year, current_year, min_ev=100_000_000, max_ev_ebitda=60,
+                         require_positive_ebitda=True, selected_industries=None,
+                         manual_excluded_tickers=None, year_start=2021, year_end=2025):
+    """Calcula as seções de todos os setores do relatório.
+
+    Retorna (sectors_data, excluded_tickers) — sectors_data na ordem de `sectors`,
+    omitindo setores sem dados após os filtros (cujas exclusões também são omitidas).
+    """
+    sectors = list(dict.fromkeys(sectors))
+    if not sectors:
+        return [], []
+    is_current = (fiscal_year >= current_year)
+
+    rows = _load_rows(conn, sectors, fiscal_year, is_current, year_start, year_end)
+    order = {s: i for i, s in enumerate(sectors)}
+    rows['_sector_order'] = rows['yahoo_sector'].map(order)
+
+    if is_current:
+        df = rows.drop_duplicates(subset=['company_id'], keep='first')
+    else:
+        df = rows[rows['fiscal_year'] == fiscal_year]
+    df = df.assign(_row=np.arange(len(df)))
+
+    df, excl = _apply_filters(df, min_ev, max_ev_ebitda, require_positive_ebitda,
+                              selected_industries, manual_excluded_tickers)
+
+    sections = _sector_sections(df, sectors)
+    kept = [s for s in sectors if s in sections]
+    evolution = _evolution_sections(rows[rows['yahoo_sector'].isin(kept)], kept,
+                                    year_start, year_end, min_ev, max_ev_ebitda)
+
+    sectors_data = []
+    for sector in kept:
+        sd = sections[sector]
+        sd['evolution'] = evolution[sector]
+        sectors_data.append(sd)
+
+    kept_order = {order[s] for s in kept}
+    excl = excl[excl['_sector_order'].isin(kept_order)]
+    excluded = excl[_EXCLUSION_COLS].to_dict('records')
+    return sectors_data, excluded
@@ -0,0 +1,214 @@
+"""
+result_cache.py — Cache de resultados das rotas analíticas (estudoanloc).
+
+As rotas de cálculo (calculate, evolution, cross_sector, insights,
+companies_full) são funções puras do corpo JSON + conteúdo do banco.
+Este módulo memoriza a resposta serializada, chaveada por:
+- nome da rota;
+- corpo JSON canonicalizado (chaves ordenadas, sem espaços);
+- carimbo de versão dos dados (`data_version()`);
+- data corrente (as rotas usam o ano corrente para decidir modo TTM/atual).
+
+O carimbo fica em um arquivo em disco para que jobs de atualização rodando
+em outras threads/processos possam invalidá-lo com `bump_data_version()`.
+O mtime do arquivo do banco entra no carimbo como rede de segurança para
+escritas feitas fora do app (scripts de pipeline rodados manualmente).
+
+A eviction é LRU, limitada por número de entradas e por bytes totais.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from pathlib import Path
+
+# Arquivo do carimbo de versão (mesmo diretório de cache dos jobs)
+VERSION_FILE = Path(os.getenv("DATA_VERSION_FILE",
+                              "/tmp/cache/_data_version.txt" if os.getenv("GAE_ENV", "").startswith("standard")
+                              else "cache/_data_version.txt"))
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # 64 MB de respostas serializadas
+
+
+# ─── Carimbo de versão dos dados ─────────────────────────────────────────────
+
+_version_lock = threading.Lock()
+_version_cache = {"mtime_ns": None, "token": "0"}
+_watched_paths: list[str] = []
+
+
+def watch_path(path: str):
+    """Inclui o mtime de `path` (e do -wal, se existir) no carimbo de versão."""
+    path = os.path.abspath(path)
+    if path not in _watched_paths:
+        _watched_paths.append(path)
+
+
+def _mtime_ns(path) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def bump_data_version(reason: str = "") -> str:
+    """Gera um novo carimbo de versão (invalida todos os resultados em cache)."""
+    token = f"{time.time_ns()}"
+    try:
+        VERSION_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = VERSION_FILE.with_suffix(".tmp")
+        tmp.write_text(f"{token}\n{reason}\n", encoding="utf-8")
+        os.replace(tmp, VERSION_FILE)
+    except OSError:
+        pass
+    with _version_lock:
+        _version_cache["mtime_ns"] = None
+        _version_cache["token"] = token
+    return token
+
+
+def _read_token() -> str:
+    mtime = _mtime_ns(VERSION_FILE)
+    with _version_lock:
+        if mtime and mtime == _version_cache["mtime_ns"]:
+            return _version_cache["token"]
+    try:
+        token = VERSION_FILE.read_text(encoding="utf-8").split("\n", 1)[0].strip() or "0"
+    except OSError:
+        return _version_cache["token"]
+    with _version_lock:
+        _version_cache["mtime_ns"] = mtime
+        _version_cache["token"] = token
+    return token
+
+
+def data_version() -> str:
+    """Carimbo atual: token do arquivo + mtimes dos bancos observados."""
+    parts = [_read_token()]
+    for path in _watched_paths:
+        parts.append(str(_mtime_ns(path)))
+        parts.append(str(_mtime_ns(path + "-wal")))
+    return ":".join(parts)
+
+
+# ─── Cache LRU ───────────────────────────────────────────────────────────────
+
+class ResultCache:
+    """LRU de respostas serializadas com limite de entradas e de bytes."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "stale": 0}
+        self._by_route: dict = {}
+
+    def _count(self, route: str, field: str):
+        self._stats[field] += 1
+        per = self._by_route.setdefault(route, {"hits": 0, "misses": 0})
+        if field in per:
+            per[field] += 1
+
+    def get(self, route: str, key: str, version: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._count(route, "misses")
+                return None
+            if entry[0] != version:
+                self._drop(key)
+                self._stats["stale"] += 1
+                self._count(route, "misses")
+                return None
+            self._data.move_to_end(key)
+            self._count(route, "hits")
+            return entry[1]
+
+    def put(self, key: str, version: str, payload: bytes):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (version, payload)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+                self._stats["evictions"] += 1
+
+    def _drop(self, key: str):
+        _, payload = self._data.pop(key)
+        self._bytes -= len(payload)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return dict(
+                self._stats,
+                entries=len(self._data),
+                bytes=self._bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                hit_rate=round(self._stats["hits"] / total, 4) if total else None,
+                by_route={k: dict(v) for k, v in self._by_route.items()},
+            )
+
+
+result_cache = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", DEFAULT_MAX_BYTES // (1024 * 1024))) * 1024 * 1024,
+)
+
+
+def _canonical_key(route: str, body) -> str:
+    canon = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    digest = hashlib.sha256(canon.encode("utf-8")).hexdigest()
+    return f"{route}:{date.today().isoformat()}:{digest}"
+
+
+def cached_json_route(route: str):
+    """Decorator para rotas Flask POST que retornam JSON puro do corpo.
+
+    Só respostas 200 são guardadas; erros (400/500) sempre recalculam.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from flask import Response, request
+
+            body = request.get_json(silent=True)
+            if body is None:
+                return view(*args, **kwargs)
+            key = _canonical_key(route, body)
+            version = data_version()
+            payload = result_cache.get(route, key, version)
+            if payload is not None:
+                resp = Response(payload, status=200, mimetype="application/json")
+                resp.headers["X-Result-Cache"] = "HIT"
+                return resp
+
+            rv = view(*args, **kwargs)
+            resp = rv[0] if isinstance(rv, tuple) else rv
+            status = rv[1] if isinstance(rv, tuple) and len(rv) > 1 else getattr(resp, "status_code", 200)
+            if status == 200 and getattr(resp, "mimetype", None) == "application/json":
+                result_cache.put(key, version, resp.get_data())
+                resp.headers["X-Result-Cache"] = "MISS"
+            return rv
+        return wrapper
+    return decorator
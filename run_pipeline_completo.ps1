@@ -1,5 +1,5 @@
 # ==========================================================================
-# Pipeline completo: Quarterly fetch → TTM → Ratios → FX
+# Pipeline completo: Quarterly fetch → TTM → Ratios → FX → Snapshot múltiplos
 # Executa em sequência (cada passo depende do anterior)
 # ==========================================================================
 
@@ -7,7 +7,7 @@ $ErrorActionPreference = "Continue"
 $startTime = Get-Date
 
 Write-Host "`n============================================" -ForegroundColor Cyan
-Write-Host "PASSO 1/4: FETCH HISTORICOS TRIMESTRAIS" -ForegroundColor Cyan
+Write-Host "PASSO 1/5: FETCH HISTORICOS TRIMESTRAIS" -ForegroundColor Cyan
 Write-Host "============================================" -ForegroundColor Cyan
 
 python scripts/fetch_historical_financials.py --quarterly --workers 5 --max-rps 4
@@ -19,10 +19,10 @@ Write-Host "PASSO 1 CONCLUIDO (exit: $step1Exit) em $([math]::Round(($step1Time
 Write-Host "============================================" -ForegroundColor Green
 
 Write-Host "`n============================================" -ForegroundColor Cyan
-Write-Host "PASSO 2/4: CALCULO TTM" -ForegroundColor Cyan
+Write-Host "PASSO 2/5: CALCULO TTM" -ForegroundColor Cyan
 Write-Host "============================================" -ForegroundColor Cyan
 
-python scripts/calculate_ttm.py
+python scripts/calculate_ttm.py --incremental
 $step2Exit = $LASTEXITCODE
 $step2Time = Get-Date
 
@@ -31,7 +31,7 @@ Write-Host "PASSO 2 CONCLUIDO (exit: $step2Exit) em $([math]::Round(($step2Time
 Write-Host "============================================" -ForegroundColor Green
 
 Write-Host "`n============================================" -ForegroundColor Cyan
-Write-Host "PASSO 3/4: RECALCULAR RATIOS" -ForegroundColor Cyan
+Write-Host "PASSO 3/5: RECALCULAR RATIOS" -ForegroundColor Cyan
 Write-Host "============================================" -ForegroundColor Cyan
 
 python scripts/recalculate_ratios.py
@@ -43,7 +43,7 @@ Write-Host "PASSO 3 CONCLUIDO (exit: $step3Exit) em $([math]::Round(($step3Time
 Write-Host "============================================" -ForegroundColor Green
 
 Write-Host "`n============================================" -ForegroundColor Cyan
-Write-Host "PASSO 4/4: RECALCULAR FX RATES" -ForegroundColor Cyan
+Write-Host "PASSO 4/5: RECALCULAR FX RATES" -ForegroundColor Cyan
 Write-Host "============================================" -ForegroundColor Cyan
 
 python scripts/recalculate_fx_rates.py
@@ -54,11 +54,24 @@ Write-Host "`n============================================" -ForegroundColor Gre
 Write-Host "PASSO 4 CONCLUIDO (exit: $step4Exit) em $([math]::Round(($step4Time - $step3Time).TotalMinutes, 1)) min" -ForegroundColor Green
 Write-Host "============================================" -ForegroundColor Green
 
-$totalMin = [math]::Round(($step4Time - $startTime).TotalMinutes, 1)
+Write-Host "`n============================================" -ForegroundColor Cyan
+Write-Host "PASSO 5/5: SNAPSHOT DE MULTIPLOS SETORIAIS" -ForegroundColor Cyan
+Write-Host "============================================" -ForegroundColor Cyan
+
+python scripts/build_sector_multiples.py
+$step5Exit = $LASTEXITCODE
+$step5Time = Get-Date
+
+Write-Host "`n============================================" -ForegroundColor Green
+Write-Host "PASSO 5 CONCLUIDO (exit: $step5Exit) em $([math]::Round(($step5Time - $step4Time).TotalMinutes, 1)) min" -ForegroundColor Green
+Write-Host "============================================" -ForegroundColor Green
+
+$totalMin = [math]::Round(($step5Time - $startTime).TotalMinutes, 1)
 Write-Host "`n============================================" -ForegroundColor Yellow
 Write-Host "PIPELINE COMPLETO em $totalMin minutos" -ForegroundColor Yellow
 Write-Host "  Passo 1 (Quarterly): exit $step1Exit" -ForegroundColor White
 Write-Host "  Passo 2 (TTM):       exit $step2Exit" -ForegroundColor White
 Write-Host "  Passo 3 (Ratios):    exit $step3Exit" -ForegroundColor White
 Write-Host "  Passo 4 (FX):        exit $step4Exit" -ForegroundColor White
+Write-Host "  Passo 5 (Snapshot):  exit $step5Exit" -ForegroundColor White
 Write-Host "============================================" -ForegroundColor Yellow
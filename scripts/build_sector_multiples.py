@@ -0,0 +1,380 @@
+"""
+build_sector_multiples.py
+=========================
+Materializa a tabela sector_multiples_snapshot usada pelo Estudo Anloc
+(/api/estudoanloc/calculate e /api/estudoanloc/evolution).
+
+Os endpoints resolviam a cada request, via CTE `latest_q` (GROUP BY
+MAX(period_date) por empresa), qual registro de company_financials_historical
+representa cada empresa. Esta etapa faz essa resolução uma única vez por
+atualização de dados, gravando uma linha por empresa × ano fiscal × fonte:
+
+  - Annual       : registro anual (period_type='annual') do ano fiscal
+  - TTM          : último trimestre do ano fiscal com TTM calculado
+  - Current+TTM  : último trimestre (qualquer ano) com receita e EBITDA TTM
+  - Current+FY   : servido pelas linhas Annual do ano anterior (sem duplicar)
+
+As fontes TTM dependem do mínimo de trimestres pedido pelo usuário
+(ttm_quarters_count >= N); por isso são gravadas uma vez para cada
+N em 1..MAX_TTM_QUARTERS (coluna min_quarters). Linhas Annual usam min_quarters=0.
+
+Uso:
+  python scripts/build_sector_multiples.py
+  python scripts/build_sector_multiples.py --db data/outro.db
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+log = logging.getLogger("sector_multiples")
+
+DB_PATH = Path(__file__).resolve().parent.parent / "data" / "damodaran_data_new.db"
+
+SNAPSHOT_TABLE = "sector_multiples_snapshot"
+MAX_TTM_QUARTERS = 4
+
+SNAPSHOT_COLUMNS = [
+    "cid", "yahoo_code", "ticker", "sector", "industry", "country", "region",
+    "fiscal_year", "source", "min_quarters", "period_date",
+    "revenue", "ebitda", "fcf", "ev",
+    "ev_usd", "revenue_usd", "ebitda_usd", "fcf_usd",
+]
+
+# Colunas retornadas aos endpoints (mesmo formato das queries originais)
+RESULT_COLUMNS = [
+    "cid", "ticker", "industry", "country", "region",
+    "revenue", "ebitda", "fcf", "ev",
+    "ev_usd", "revenue_usd", "ebitda_usd", "fcf_usd", "data_source",
+]
+
+_CBD_JOIN = """
+    JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
+    LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
+"""
+
+_ANNUAL_SELECT = f"""
+    SELECT q.company_basic_data_id, q.yahoo_code, cbd.ticker, cbd.yahoo_sector,
+           cbd.yahoo_industry, cbd.yahoo_country, dg.sub_group,
+           q.fiscal_year, 'Annual', 0, q.period_date,
+           q.total_revenue, q.normalized_ebitda, q.free_cash_flow,
+           q.enterprise_value_estimated,
+           q.enterprise_value_usd, q.total_revenue_usd, q.ebitda_usd, q.free_cash_flow_usd
+    FROM company_financials_historical q
+    {_CBD_JOIN}
+    WHERE q.period_type = 'annual'
+"""
+
+# Último trimestre por empresa (e por ano fiscal, no caso 'TTM').
+# RANK() preserva empates de period_date como o JOIN original com MAX().
+_TTM_SELECT = f"""
+    SELECT q.company_basic_data_id, q.yahoo_code, cbd.ticker, cbd.yahoo_sector,
+           cbd.yahoo_industry, cbd.yahoo_country, dg.sub_group,
+           q.fiscal_year, :source, :k, q.period_date,
+           q.total_revenue_ttm, q.ebitda_ttm, q.free_cash_flow_ttm,
+           q.enterprise_value_estimated,
+           q.enterprise_value_usd, q.total_revenue_usd, q.ebitda_usd, q.free_cash_flow_usd
+    FROM (
+        SELECT f.*, RANK() OVER (
+                   PARTITION BY f.company_basic_data_id {{partition_extra}}
+                   ORDER BY f.period_date DESC) AS rk
+        FROM company_financials_historical f
+        WHERE f.period_type = 'quarterly'
+          AND f.ttm_quarters_count >= :k
+          AND f.total_revenue_ttm IS NOT NULL
+          {{extra_filter}}
+    ) q
+    {_CBD_JOIN}
+    WHERE q.rk = 1
+"""
+
+
+def _create_table(conn, name: str):
+    conn.execute(f"DROP TABLE IF EXISTS {name}")
+    conn.execute(f"""
+        CREATE TABLE {name} (
+            cid INTEGER NOT NULL,
+            yahoo_code TEXT,
+            ticker TEXT,
+            sector TEXT,
+            industry TEXT,
+            country TEXT,
+            region TEXT,
+            fiscal_year INTEGER,
+            source TEXT NOT NULL,
+            min_quarters INTEGER NOT NULL DEFAULT 0,
+            period_date TEXT,
+            revenue REAL,
+            ebitda REAL,
+            fcf REAL,
+            ev REAL,
+            ev_usd REAL,
+            revenue_usd REAL,
+            ebitda_usd REAL,
+            fcf_usd REAL
+        )
+    """)
+
+
+def refresh_snapshot(conn: sqlite3.Connection) -> int:
+    """Reconstrói sector_multiples_snapshot (staging + swap). Retorna nº de linhas."""
+    staging = f"{SNAPSHOT_TABLE}_staging"
+    cols = ", ".join(SNAPSHOT_COLUMNS)
+    _create_table(conn, staging)
+
+    conn.execute(f"INSERT INTO {staging} ({cols}) {_ANNUAL_SELECT}")
+    for k in range(1, MAX_TTM_QUARTERS + 1):
+        # TTM por ano fiscal (modo histórico)
+        sql = _TTM_SELECT.format(partition_extra=", f.fiscal_year", extra_filter="")
+        conn.execute(f"INSERT INTO {staging} ({cols}) {sql}", {"source": "TTM", "k": k})
+        # Último TTM completo de qualquer ano (modo múltiplos atuais)
+        sql = _TTM_SELECT.format(partition_extra="", extra_filter="AND f.ebitda_ttm IS NOT NULL")
+        conn.execute(f"INSERT INTO {staging} ({cols}) {sql}", {"source": "Current+TTM", "k": k})
+
+    conn.execute(f"DROP TABLE IF EXISTS {SNAPSHOT_TABLE}")
+    conn.execute(f"ALTER TABLE {staging} RENAME TO {SNAPSHOT_TABLE}")
+    conn.execute(f"""CREATE INDEX IF NOT EXISTS idx_sms_lookup
+                     ON {SNAPSHOT_TABLE}(sector, source, min_quarters, fiscal_year)""")
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE}_meta (
+                         id INTEGER PRIMARY KEY CHECK (id = 1),
+                         refreshed_at TEXT, n_rows INTEGER)""")
+    n_rows = conn.execute(f"SELECT COUNT(*) FROM {SNAPSHOT_TABLE}").fetchone()[0]
+    conn.execute(f"INSERT OR REPLACE INTO {SNAPSHOT_TABLE}_meta (id, refreshed_at, n_rows) VALUES (1, ?, ?)",
+                 (datetime.now().isoformat(), n_rows))
+    conn.commit()
+    return n_rows
+
+
+def invalidate_snapshot(conn: sqlite3.Connection) -> None:
+    """Descarta o snapshot (os endpoints voltam às queries diretas).
+
+    Para quando company_financials_historical mudou e a reconstrução não
+    rodou até o fim: servir o snapshot antigo seria pior que a query lenta.
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {SNAPSHOT_TABLE}")
+    conn.execute(f"DROP TABLE IF EXISTS {SNAPSHOT_TABLE}_meta")
+    conn.commit()
+
+
+def snapshot_exists(conn: sqlite3.Connection) -> bool:
+    """Indica se o snapshot já foi materializado neste banco."""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SNAPSHOT_TABLE,)
+    ).fetchone()
+    return row is not None
+
+
+# ─── Leitura (usada pelos endpoints) ──────────────────────────────────────────
+
+def _query_snapshot(conn, sector, source, industries, min_quarters=0, fiscal_year=None,
+                    require_ev=False, label=None) -> pd.DataFrame:
+    sql = f"""
+        SELECT cid, ticker, industry, country, region,
+               revenue, ebitda, fcf, ev, ev_usd, revenue_usd, ebitda_usd, fcf_usd,
+               ? AS data_source
+        FROM {SNAPSHOT_TABLE}
+        WHERE sector = ? AND source = ? AND min_quarters = ?
+    """
+    params = [label or source, sector, source, min_quarters]
+    if fiscal_year is not None:
+        sql += " AND fiscal_year = ?"
+        params.append(fiscal_year)
+    if require_ev:
+        sql += " AND ev IS NOT NULL"
+    if industries:
+        sql += f" AND industry IN ({','.join('?' * len(industries))})"
+        params.extend(industries)
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+def _clamp_quarters(min_ttm_quarters: int) -> int:
+    # ttm_quarters_count >= 0 equivale a >= 1 (registros com TTM têm ao menos 1 trimestre)
+    return max(1, int(min_ttm_quarters))
+
+
+def load_sector_multiples(conn, sector: str, fiscal_year: int, current_year: int,
+                          use_ttm_fallback: bool = True, min_ttm_quarters: int = 4,
+                          industries: list | None = None) -> pd.DataFrame:
+    """Carrega as linhas (annual + TTM) de um setor/ano, já resolvidas.
+
+    Usa sector_multiples_snapshot quando disponível; caso contrário cai nas
+    queries diretas sobre company_financials_historical. O resultado tem as
+    colunas de RESULT_COLUMNS, com as linhas anuais antes das TTM.
+    """
+    if not snapshot_exists(conn):
+        return _load_from_history(conn, sector, fiscal_year, current_year,
+                                  use_ttm_fallback, min_ttm_quarters, industries)
+
+    k = _clamp_quarters(min_ttm_quarters)
+    ttm_available = k <= MAX_TTM_QUARTERS
+
+    if fiscal_year >= current_year:
+        # Múltiplos atuais: último TTM completo || anual do ano anterior
+        prev_year = fiscal_year - 1
+        if ttm_available:
+            df_ttm = _query_snapshot(conn, sector, "Current+TTM", industries, k, require_ev=True)
+        else:
+            df_ttm = pd.DataFrame(columns=RESULT_COLUMNS)
+        df_annual = _query_snapshot(conn, sector, "Annual", industries, 0, prev_year,
+                                    require_ev=True, label=f"Current+FY{prev_year}")
+        if not df_annual.empty and not df_ttm.empty:
+            df_annual = df_annual[~df_annual["cid"].isin(set(df_ttm["cid"]))]
+    else:
+        df_annual = _query_snapshot(conn, sector, "Annual", industries, 0, fiscal_year)
+        df_ttm = pd.DataFrame()
+        if use_ttm_fallback and ttm_available:
+            df_ttm = _query_snapshot(conn, sector, "TTM", industries, k, fiscal_year)
+            if not df_ttm.empty and not df_annual.empty:
+                df_ttm = df_ttm[~df_ttm["cid"].isin(set(df_annual["cid"]))]
+
+    frames = [df_annual]
+    if not df_ttm.empty:
+        frames.append(df_ttm)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _load_from_history(conn, sector, fiscal_year, current_year, use_ttm_fallback,
+                       min_ttm_quarters, industries) -> pd.DataFrame:
+    """Caminho sem snapshot: resolve latest_q diretamente no histórico."""
+    industry_filter = ""
+    if industries:
+        industry_filter = f"AND cbd.yahoo_industry IN ({','.join('?' * len(industries))})"
+    ind_params = list(industries or [])
+
+    def _annual(year, require_ev, label):
+        sql = f"""
+            SELECT cfh.company_basic_data_id AS cid,
+                   cbd.ticker, cbd.yahoo_industry AS industry,
+                   cbd.yahoo_country AS country,
+                   dg.sub_group AS region,
+                   cfh.total_revenue AS revenue,
+                   cfh.normalized_ebitda AS ebitda,
+                   cfh.free_cash_flow AS fcf,
+                   cfh.enterprise_value_estimated AS ev,
+                   cfh.enterprise_value_usd AS ev_usd,
+                   cfh.total_revenue_usd AS revenue_usd,
+                   cfh.ebitda_usd AS ebitda_usd,
+                   cfh.free_cash_flow_usd AS fcf_usd,
+                   '{label}' AS data_source
+            FROM company_financials_historical cfh
+            JOIN company_basic_data cbd ON cfh.yahoo_code = cbd.yahoo_code
+            LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
+            WHERE cfh.period_type = 'annual'
+              AND cfh.fiscal_year = ?
+              AND cbd.yahoo_sector = ?
+              {'AND cfh.enterprise_value_estimated IS NOT NULL' if require_ev else ''}
+              {industry_filter}
+        """
+        return pd.read_sql_query(sql, conn, params=[year, sector] + ind_params)
+
+    _ttm_cols = """
+        SELECT q.company_basic_data_id AS cid,
+               cbd.ticker, cbd.yahoo_industry AS industry,
+               cbd.yahoo_country AS country,
+               dg.sub_group AS region,
+               q.total_revenue_ttm AS revenue,
+               q.ebitda_ttm AS ebitda,
+               q.free_cash_flow_ttm AS fcf,
+               q.enterprise_value_estimated AS ev,
+               q.enterprise_value_usd AS ev_usd,
+               q.total_revenue_usd AS revenue_usd,
+               q.ebitda_usd AS ebitda_usd,
+               q.free_cash_flow_usd AS fcf_usd,
+    """
+
+    if fiscal_year >= current_year:
+        ttm_sql = f"""
+            WITH latest_q AS (
+                SELECT q.company_basic_data_id AS cid,
+                       MAX(q.period_date) AS max_date
+                FROM company_financials_historical q
+                JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
+                WHERE q.period_type = 'quarterly'
+                  AND q.ttm_quarters_count >= ?
+                  AND q.total_revenue_ttm IS NOT NULL
+                  AND q.ebitda_ttm IS NOT NULL
+                  AND cbd2.yahoo_sector = ?
+                GROUP BY q.company_basic_data_id
+            )
+            {_ttm_cols}
+                   'Current+TTM' AS data_source
+            FROM company_financials_historical q
+            JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
+            JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
+            LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
+            WHERE q.period_type = 'quarterly'
+              AND q.enterprise_value_estimated IS NOT NULL
+              {industry_filter}
+        """
+        df_ttm = pd.read_sql_query(ttm_sql, conn, params=[min_ttm_quarters, sector] + ind_params)
+        prev_year = fiscal_year - 1
+        df_annual = _annual(prev_year, True, f"Current+FY{prev_year}")
+        if not df_annual.empty and not df_ttm.empty:
+            df_annual = df_annual[~df_annual["cid"].isin(set(df_ttm["cid"]))]
+    else:
+        df_annual = _annual(fiscal_year, False, "Annual")
+        df_ttm = pd.DataFrame()
+        if use_ttm_fallback:
+            ttm_sql = f"""
+                WITH latest_q AS (
+                    SELECT q.company_basic_data_id AS cid,
+                           MAX(q.period_date) AS max_date
+                    FROM company_financials_historical q
+                    JOIN company_basic_data cbd2 ON q.company_basic_data_id = cbd2.id
+                    WHERE q.period_type = 'quarterly'
+                      AND q.fiscal_year = ?
+                      AND q.ttm_quarters_count >= ?
+                      AND q.total_revenue_ttm IS NOT NULL
+                      AND cbd2.yahoo_sector = ?
+                    GROUP BY q.company_basic_data_id
+                )
+                {_ttm_cols}
+                       'TTM' AS data_source
+                FROM company_financials_historical q
+                JOIN latest_q lq ON q.company_basic_data_id = lq.cid AND q.period_date = lq.max_date
+                JOIN company_basic_data cbd ON q.yahoo_code = cbd.yahoo_code
+                LEFT JOIN damodaran_global dg ON cbd.damodaran_company_id = dg.id
+                WHERE q.period_type = 'quarterly'
+                  AND q.fiscal_year = ?
+                  AND q.ttm_quarters_count >= ?
+                  {industry_filter}
+            """
+            params = [fiscal_year, min_ttm_quarters, sector, fiscal_year, min_ttm_quarters] + ind_params
+            df_ttm = pd.read_sql_query(ttm_sql, conn, params=params)
+            if not df_ttm.empty and not df_annual.empty:
+                df_ttm = df_ttm[~df_ttm["cid"].isin(set(df_annual["cid"]))]
+
+    frames = [df_annual]
+    if not df_ttm.empty:
+        frames.append(df_ttm)
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%H:%M:%S",
+    )
+    parser = argparse.ArgumentParser(description="Materializa sector_multiples_snapshot")
+    parser.add_argument("--db", type=str, default=None, help="Caminho do banco")
+    args = parser.parse_args()
+
+    db_path = Path(args.db) if args.db else DB_PATH
+    log.info(f"DB: {db_path}")
+
+    start = time.time()
+    conn = sqlite3.connect(str(db_path), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    n_rows = refresh_snapshot(conn)
+    conn.close()
+    log.info(f"{SNAPSHOT_TABLE}: {n_rows} linhas em {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,17 +8,32 @@ Para cada registro (annual ou quarterly), o TTM é calculado como a soma
 dos 4 últimos trimestres disponíveis até aquela data-base.
 Para anuais, o TTM = próprio valor anual (já representa 12 meses).
 
+O cálculo é vetorizado por lote de empresas (janela móvel agrupada) e a
+gravação é um único executemany por lote. Com --incremental, apenas
+empresas/registros cuja janela de 4 trimestres mudou desde a última execução
+são recalculados (rastreado por fetched_at vs. ttm_computed_at).
+
 Uso:
   python scripts/calculate_ttm.py --sector "Utilities"
   python scripts/calculate_ttm.py --company POSI3.SA
+  python scripts/calculate_ttm.py --incremental  # só janelas alteradas
   python scripts/calculate_ttm.py  # processa tudo
 """
 
 import argparse
+import os
 import sqlite3
+import sys
 import logging
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.job_progress import reporter
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -37,6 +52,9 @@ TTM_FIELDS = [
     ("net_income", "net_income_ttm"),
 ]
 
+# Empresas por lote (uma leitura + um executemany por lote)
+BATCH_COMPANIES = 500
+
 
 def ensure_ttm_columns(conn):
     """Adiciona colunas TTM se não existirem."""
@@ -52,6 +70,12 @@ def ensure_ttm_columns(conn):
         log.info("Coluna 'ttm_quarters_count' adicionada.")
     except sqlite3.OperationalError:
         pass
+    # Marca de quando o TTM do registro foi calculado (modo incremental)
+    try:
+        conn.execute("ALTER TABLE company_financials_historical ADD COLUMN ttm_computed_at TIMESTAMP")
+        log.info("Coluna 'ttm_computed_at' adicionada.")
+    except sqlite3.OperationalError:
+        pass
     # Também garantir close_price
     try:
         conn.execute("ALTER TABLE company_financials_historical ADD COLUMN close_price REAL")
@@ -76,158 +100,182 @@ def get_companies(conn, args) -> list[dict]:
     if args.company:
         query += " AND (cfh.yahoo_code = ? OR cbd.ticker LIKE ?)"
         params.extend([args.company, f"%{args.company}%"])
+    if getattr(args, "incremental", False):
+        query += " AND (cfh.ttm_computed_at IS NULL OR cfh.fetched_at >= cfh.ttm_computed_at)"
     query += " ORDER BY cfh.yahoo_code"
     
     rows = conn.execute(query, params).fetchall()
     return [{"company_basic_data_id": r[0], "yahoo_code": r[1], "sector": r[2]} for r in rows]
 
 
-def calculate_ttm_for_company(conn, company_id: int, yahoo_code: str) -> int:
+def _load_history(conn, company_ids: list[int]) -> pd.DataFrame:
+    """Carrega os registros (annual + quarterly) das empresas informadas."""
+    placeholders = ",".join("?" * len(company_ids))
+    return pd.read_sql_query(f"""
+        SELECT id, company_basic_data_id, period_type, period_date,
+               fetched_at, ttm_computed_at,
+               total_revenue, ebitda, ebit, free_cash_flow, net_income,
+               enterprise_value_estimated, fx_rate_to_usd
+        FROM company_financials_historical
+        WHERE company_basic_data_id IN ({placeholders})
+        ORDER BY company_basic_data_id, period_date, id
+    """, conn, params=company_ids, coerce_float=True)
+
+
+def compute_ttm_frame(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Calcula TTM para todos os registros (annual e quarterly) de uma empresa.
-    
-    Lógica:
-    - Para ANNUAL: TTM = valor do próprio período (já é 12 meses)
-    - Para QUARTERLY: TTM = soma dos 4 últimos trimestres <= period_date
-      (incluindo o trimestre atual)
-    
+    Calcula TTM e múltiplos para todos os registros de `df` de uma vez.
+
+    Lógica (idêntica à versão registro-a-registro):
+    - ANNUAL: TTM = valor do próprio período (já é 12 meses), quarters_count = 4
+    - QUARTERLY: TTM = soma dos valores não-nulos dos 4 últimos trimestres
+      <= period_date (incluindo o atual), exigindo ao menos 2 com dado;
+      quarters_count = nº de trimestres da janela com receita.
+
+    A janela móvel é feita com shift() agrupado por empresa (soma do mais
+    antigo para o mais recente, na mesma ordem do sum() em Python).
+    """
+    df = df.reset_index(drop=True)
+    is_q = (df["period_type"] == "quarterly").to_numpy()
+    out = pd.DataFrame({"id": df["id"]})
+
+    q = df[is_q]
+    q_grp = q.groupby("company_basic_data_id", sort=False)
+    lags = range(3, -1, -1)  # 3 = trimestre mais antigo da janela
+
+    for src_field, ttm_field in TTM_FIELDS:
+        col = pd.Series(np.nan, index=df.index)
+        col[~is_q] = df.loc[~is_q, src_field].astype(float)
+        if len(q):
+            shifted = [q_grp[src_field].shift(k).astype(float) if k else q[src_field].astype(float)
+                       for k in lags]
+            total = shifted[0].fillna(0.0)
+            n_vals = shifted[0].notna().astype(int)
+            for s in shifted[1:]:
+                total = total + s.fillna(0.0)
+                n_vals = n_vals + s.notna().astype(int)
+            col[is_q] = total.where(n_vals >= 2)
+        out[ttm_field] = col
+
+    quarters = pd.Series(4, index=df.index, dtype="int64")
+    if len(q):
+        has_rev = q["total_revenue"].notna().astype(int)
+        rev_grp = has_rev.groupby(q["company_basic_data_id"], sort=False)
+        count = has_rev.copy()
+        for k in (1, 2, 3):
+            count = count + rev_grp.shift(k).fillna(0).astype(int)
+        quarters[is_q] = count
+    out["ttm_quarters_count"] = quarters
+
+    # ── Múltiplos com TTM (só quando TTM é confiável: 4 trimestres) ──
+    ev = df["enterprise_value_estimated"].astype(float).to_numpy()
+    fx = df["fx_rate_to_usd"].astype(float).fillna(0.0).to_numpy()
+    fx = np.where(fx == 0, 1.0, fx)
+    rev = out["total_revenue_ttm"].to_numpy()
+    ebitda = out["ebitda_ttm"].to_numpy()
+    ebit = out["ebit_ttm"].to_numpy()
+
+    reliable = quarters.to_numpy() >= 4
+    ev_ok = ~np.isnan(ev) & (ev != 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Materialidade: receita TTM mínima de $100K USD para evitar distorções
+        rev_ok = reliable & ev_ok & ~np.isnan(rev) & (rev != 0) & (np.abs(rev * fx) >= 100_000)
+        ratio = ev / rev
+        out["ev_revenue"] = np.where(rev_ok & (np.abs(ratio) <= 500), ratio, np.nan)
+
+        ebitda_ok = reliable & ev_ok & ~np.isnan(ebitda) & (ebitda != 0)
+        ratio = ev / ebitda
+        out["ev_ebitda"] = np.where(ebitda_ok & (np.abs(ebitda * fx) >= 100) & (np.abs(ratio) <= 500),
+                                    ratio, np.nan)
+
+        ebit_ok = reliable & ev_ok & ~np.isnan(ebit) & (ebit > 0)
+        ratio = ev / ebit
+        out["ev_ebit"] = np.where(ebit_ok & (np.abs(ratio) <= 500), ratio, np.nan)
+
+    return out
+
+
+def _stale_mask(df: pd.DataFrame) -> np.ndarray:
+    """
+    Registros cuja janela TTM mudou desde a última execução.
+
+    Um registro está "sujo" se nunca teve TTM calculado ou se foi (re)gravado
+    depois (fetched_at >= ttm_computed_at; INSERT OR REPLACE do fetch renova
+    o fetched_at). Trimestrais também ficam sujos quando qualquer um dos 3
+    trimestres anteriores da janela está sujo.
+    """
+    dirty = df["ttm_computed_at"].isna() | (
+        df["fetched_at"].notna() & (df["fetched_at"] >= df["ttm_computed_at"].fillna(""))
+    )
+    is_q = df["period_type"] == "quarterly"
+    q_dirty = dirty[is_q].astype(int)
+    grp = q_dirty.groupby(df.loc[is_q, "company_basic_data_id"], sort=False)
+    window = q_dirty.copy()
+    for k in (1, 2, 3):
+        window = window + grp.shift(k).fillna(0).astype(int)
+    dirty = dirty.copy()
+    dirty[is_q] = window > 0
+    return dirty.to_numpy()
+
+
+_UPDATE_SQL = """
+    UPDATE company_financials_historical
+    SET total_revenue_ttm = ?,
+        ebitda_ttm = ?,
+        ebit_ttm = ?,
+        free_cash_flow_ttm = ?,
+        net_income_ttm = ?,
+        ev_revenue = ?,
+        ev_ebitda = ?,
+        ev_ebit = ?,
+        ttm_quarters_count = ?,
+        ttm_computed_at = ?
+    WHERE id = ?
+"""
+
+_OUT_COLUMNS = [ttm for _, ttm in TTM_FIELDS] + ["ev_revenue", "ev_ebitda", "ev_ebit"]
+
+
+def _nullable(v):
+    return None if v != v else v  # NaN -> NULL
+
+
+def calculate_ttm_batch(conn, company_ids: list[int], incremental: bool = False,
+                        computed_at: str | None = None) -> int:
+    """
+    Calcula TTM para todas as empresas do lote com uma única leitura e um
+    único executemany. Em modo incremental só regrava os registros cuja
+    janela mudou (ver `_stale_mask`).
+
     Retorna: número de registros atualizados.
     """
-    # Buscar todos os registros da empresa, ordenados por data
-    rows = conn.execute("""
-        SELECT id, period_type, period_date, fiscal_year, fiscal_quarter,
-               total_revenue, ebitda, ebit, free_cash_flow, net_income
-        FROM company_financials_historical
-        WHERE company_basic_data_id = ?
-        ORDER BY period_date
-    """, (company_id,)).fetchall()
-    
-    if not rows:
+    if not company_ids:
+        return 0
+    df = _load_history(conn, company_ids)
+    if df.empty:
+        return 0
+    if computed_at is None:
+        computed_at = conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
+
+    res = compute_ttm_frame(df)
+    if incremental:
+        res = res[_stale_mask(df)]
+    if res.empty:
         return 0
-    
-    # Separar trimestrais e anuais
-    quarterly_records = []
-    annual_records = []
-    for r in rows:
-        rec = {
-            "id": r[0], "period_type": r[1], "period_date": r[2],
-            "fiscal_year": r[3], "fiscal_quarter": r[4],
-            "total_revenue": r[5], "ebitda": r[6], "ebit": r[7],
-            "free_cash_flow": r[8], "net_income": r[9],
-        }
-        if rec["period_type"] == "quarterly":
-            quarterly_records.append(rec)
-        else:
-            annual_records.append(rec)
-    
-    updated = 0
-    
-    # --- Para ANUAIS: TTM = próprio valor, quarters_count = 4 ---
-    for rec in annual_records:
-        ttm_values = {}
-        for src_field, ttm_field in TTM_FIELDS:
-            ttm_values[ttm_field] = rec[src_field]
-        
-        # Recalcular múltiplos usando TTM (que para anuais são os mesmos valores)
-        _update_record_ttm(conn, rec["id"], ttm_values, quarters_count=4)
-        updated += 1
-    
-    # --- Para TRIMESTRAIS: TTM = soma 4 últimos Q ---
-    # Ordenar trimestrais por data
-    quarterly_records.sort(key=lambda x: x["period_date"])
-    
-    for i, rec in enumerate(quarterly_records):
-        # Pegar os 4 últimos trimestres (incluindo o atual)
-        # Buscar os 3 anteriores + atual
-        start_idx = max(0, i - 3)
-        window = quarterly_records[start_idx:i + 1]
-        
-        ttm_values = {}
-        # Usar revenue como referência para contagem de trimestres
-        rev_vals = [w["total_revenue"] for w in window if w["total_revenue"] is not None]
-        quarters_count = len(rev_vals)
-        
-        for src_field, ttm_field in TTM_FIELDS:
-            # Somar os valores não-nulos dos 4 trimestres
-            vals = [w[src_field] for w in window if w[src_field] is not None]
-            if len(vals) >= 2:  # mínimo 2 trimestres com dados para ser razoável
-                ttm_values[ttm_field] = sum(vals)
-            else:
-                ttm_values[ttm_field] = None
-        
-        _update_record_ttm(conn, rec["id"], ttm_values, quarters_count=quarters_count)
-        updated += 1
-    
-    return updated
 
+    values = zip(*(res[c].tolist() for c in _OUT_COLUMNS))
+    batch = [
+        tuple(_nullable(v) for v in vals) + (int(qc), computed_at, int(rid))
+        for vals, qc, rid in zip(values, res["ttm_quarters_count"].tolist(), res["id"].tolist())
+    ]
+    conn.executemany(_UPDATE_SQL, batch)
+    return len(batch)
 
-def _update_record_ttm(conn, record_id: int, ttm_values: dict, quarters_count: int = 4):
-    """Atualiza um registro com os valores TTM e recalcula múltiplos."""
-    # Buscar dados necessários para recalcular múltiplos
-    row = conn.execute("""
-        SELECT enterprise_value_estimated, market_cap_estimated, fx_rate_to_usd
-        FROM company_financials_historical
-        WHERE id = ?
-    """, (record_id,)).fetchone()
-    
-    if not row:
-        return
-    
-    ev = row[0]
-    mcap = row[1]
-    fx_rate = row[2] or 1.0
-    
-    rev_ttm = ttm_values.get("total_revenue_ttm")
-    ebitda_ttm = ttm_values.get("ebitda_ttm")
-    ebit_ttm = ttm_values.get("ebit_ttm")
-    fcf_ttm = ttm_values.get("free_cash_flow_ttm")
-    net_income_ttm = ttm_values.get("net_income_ttm")
-    
-    # Recalcular múltiplos com TTM
-    # Só calcular múltiplos EV quando TTM é confiável (4 trimestres completos)
-    ev_revenue = None
-    ev_ebitda = None
-    ev_ebit = None
-    
-    ttm_reliable = quarters_count >= 4
-    
-    # Materialidade: receita TTM mínima de $100K USD para evitar distorções
-    rev_usd = abs(rev_ttm * fx_rate) if rev_ttm else 0
-    rev_material = ttm_reliable and rev_ttm and rev_ttm != 0 and rev_usd >= 100_000
-    
-    if rev_material and ev:
-        ratio = ev / rev_ttm
-        ev_revenue = ratio if abs(ratio) <= 500 else None
-    
-    if ttm_reliable and ev and ebitda_ttm and ebitda_ttm != 0:
-        ratio = ev / ebitda_ttm
-        ebitda_usd = abs(ebitda_ttm * fx_rate)
-        if ebitda_usd >= 100 and abs(ratio) <= 500:
-            ev_ebitda = ratio
-    
-    if ttm_reliable and ev and ebit_ttm and ebit_ttm > 0:
-        ratio = ev / ebit_ttm
-        ev_ebit = ratio if abs(ratio) <= 500 else None
-    
-    # Update
-    conn.execute("""
-        UPDATE company_financials_historical
-        SET total_revenue_ttm = ?,
-            ebitda_ttm = ?,
-            ebit_ttm = ?,
-            free_cash_flow_ttm = ?,
-            net_income_ttm = ?,
-            ev_revenue = ?,
-            ev_ebitda = ?,
-            ev_ebit = ?,
-            ttm_quarters_count = ?
-        WHERE id = ?
-    """, (
-        rev_ttm, ebitda_ttm, ebit_ttm, fcf_ttm, net_income_ttm,
-        ev_revenue, ev_ebitda, ev_ebit,
-        quarters_count,
-        record_id,
-    ))
+
+def calculate_ttm_for_company(conn, company_id: int, yahoo_code: str) -> int:
+    """Calcula TTM para todos os registros de uma empresa (ver `calculate_ttm_batch`)."""
+    return calculate_ttm_batch(conn, [company_id])
 
 
 def main():
@@ -235,39 +283,55 @@ def main():
     parser.add_argument("--sector", type=str, help="Filtrar por Yahoo sector")
     parser.add_argument("--company", type=str, help="Yahoo code específico")
     parser.add_argument("--db", type=str, default=None, help="Caminho do banco")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Recalcula só registros cuja janela TTM mudou desde a última execução")
+    parser.add_argument("--batch-size", type=int, default=BATCH_COMPANIES,
+                        help=f"Empresas por lote (default: {BATCH_COMPANIES})")
     args = parser.parse_args()
 
     db_path = Path(args.db) if args.db else DB_PATH
     log.info(f"DB: {db_path}")
 
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     conn.execute("PRAGMA journal_mode=WAL")
     
     # Garantir colunas TTM existem
     ensure_ttm_columns(conn)
     
     # Buscar empresas
+    progress = reporter()
     companies = get_companies(conn, args)
     if not companies:
         log.info("Nenhuma empresa encontrada com os filtros.")
+        progress.done(phase="Nenhuma empresa pendente")
         conn.close()
         return
     
-    log.info(f"Empresas para processar: {len(companies)}")
+    # Uma empresa pode aparecer com mais de um yahoo_code
+    company_ids = list(dict.fromkeys(c["company_basic_data_id"] for c in companies))
+    mode = "incremental" if args.incremental else "completo"
+    log.info(f"Empresas para processar ({mode}): {len(company_ids)}")
+    progress.done(total=len(company_ids), phase=f"Calculando TTM ({mode})...")
+    
+    # Mesmo carimbo para a execução inteira: registros gravados pelo fetch
+    # durante o cálculo continuam "sujos" para a próxima execução
+    computed_at = conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()[0]
     
     total_updated = 0
-    for i, comp in enumerate(companies):
-        n = calculate_ttm_for_company(conn, comp["company_basic_data_id"], comp["yahoo_code"])
+    batch_size = max(1, args.batch_size)
+    for start in range(0, len(company_ids), batch_size):
+        batch = company_ids[start:start + batch_size]
+        n = calculate_ttm_batch(conn, batch, incremental=args.incremental, computed_at=computed_at)
+        conn.commit()
         total_updated += n
-        
-        if (i + 1) % 100 == 0 or (i + 1) == len(companies):
-            conn.commit()
-            log.info(f"[{i+1}/{len(companies)}] {comp['yahoo_code']} - {n} registros | Total: {total_updated}")
+        done = start + len(batch)
+        log.info(f"[{done}/{len(company_ids)}] lote de {len(batch)} empresas - {n} registros | Total: {total_updated}")
+        progress.update(current=done, success=done)
     
-    conn.commit()
     conn.close()
+    progress.done(current=len(company_ids), success=len(company_ids), phase="Concluído")
     
-    log.info(f"Concluído: {total_updated} registros atualizados em {len(companies)} empresas.")
+    log.info(f"Concluído: {total_updated} registros atualizados em {len(company_ids)} empresas.")
 
 
 if __name__ == "__main__":
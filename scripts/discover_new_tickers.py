@@ -39,7 +39,7 @@ CACHE_DIR = Path("cache")
 
 def discover_from_damodaran(db_path: Path, year: int | None = None) -> dict:
     """Compara Excel do Damodaran com a base atual. Retorna novos tickers."""
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
 
     # Determinar ano do arquivo
     if year is None:
@@ -125,7 +125,7 @@ def discover_from_damodaran(db_path: Path, year: int | None = None) -> dict:
 
 def discover_from_etf_holdings(db_path: Path) -> dict:
     """Descobre tickers que aparecem em holdings de ETFs mas não estão na base."""
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     
     # Verificar se tabela de holdings existe
     tables = [r[0] for r in conn.execute(
@@ -216,7 +216,7 @@ def discover_from_screener(db_path: Path, market: str = "us_market") -> dict:
     except ImportError:
         return {"error": "yfinance não instalado"}
     
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     db_yahoo_codes = set(r[0] for r in conn.execute(
         "SELECT yahoo_code FROM company_basic_data WHERE yahoo_code IS NOT NULL"
     ).fetchall())
@@ -266,7 +266,7 @@ def discover_from_screener(db_path: Path, market: str = "us_market") -> dict:
 
 def coverage_report(db_path: Path) -> None:
     """Gera relatório de cobertura atual da base."""
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     
     total_cbd = conn.execute("SELECT COUNT(*) FROM company_basic_data").fetchone()[0]
     with_yahoo = conn.execute("SELECT COUNT(*) FROM company_basic_data WHERE yahoo_code IS NOT NULL AND yahoo_code != ''").fetchone()[0]
@@ -1,12 +1,34 @@
+"""
+Importa os arquivos globalcompfirms{ano}.xlsx do Damodaran para damodaran_global.
+
+Ingestão em streaming: o Excel é lido em modo read-only pelo openpyxl (linha a
+linha, sem carregar a planilha inteira num DataFrame), o cabeçalho é resolvido
+uma vez (colunas essenciais → colunas da tabela) e cada chunk de CHUNK_SIZE
+linhas é projetado e convertido coluna a coluna em tuplas tipadas, gravadas
+por executemany numa staging table. Só depois de todos os anos carregados a
+staging substitui damodaran_global (falha no meio não deixa a tabela vazia).
+"""
 import sqlite3
 import requests
 import pandas as pd
+import numpy as np
 import os
 import io
+import json
 from datetime import datetime
+from itertools import islice
+from operator import itemgetter
 import re
+import sys
 import time
 
+from openpyxl import load_workbook
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.migrate_typed_damodaran_global import create_covering_indexes
+from search_index import build_search_index
+
 # URL base para os arquivos do Damodaran
 base_url = "https://pages.stern.nyu.edu/~adamodar/pc/datasets/"
 
@@ -14,8 +36,10 @@ base_url = "https://pages.stern.nyu.edu/~adamodar/pc/datasets/"
 db_name = "data/damodaran_data_new.db"
 
 # Configurações de otimização
-CHUNK_SIZE = 1000  # Processar 1000 linhas por vez
-BATCH_SIZE = 100   # Inserir 100 registros por transação
+CHUNK_SIZE = 5000  # Linhas lidas/convertidas/inseridas por vez (memória limitada)
+
+TABLE = "damodaran_global"
+STAGING_TABLE = "damodaran_global_stg"
 
 def get_available_years():
     """
@@ -64,18 +88,19 @@ def download_file_with_progress(year):
         # Obter tamanho do arquivo se disponível
         total_size = int(response.headers.get('content-length', 0))
         
-        # Baixar em chunks
-        content = b''
+        # Baixar em chunks (BytesIO: concatenar bytes copiaria o arquivo a cada chunk)
+        buffer = io.BytesIO()
         downloaded = 0
         
-        for chunk in response.iter_content(chunk_size=8192):
+        for chunk in response.iter_content(chunk_size=65536):
             if chunk:
-                content += chunk
+                buffer.write(chunk)
                 downloaded += len(chunk)
                 if total_size > 0:
                     progress = (downloaded / total_size) * 100
                     print(f"\rProgresso: {progress:.1f}%", end='', flush=True)
         
+        content = buffer.getvalue()
         print(f"\n{filename} baixado com sucesso ({len(content)} bytes)")
         return content
     
@@ -83,40 +108,6 @@ def download_file_with_progress(year):
         print(f"Erro ao baixar {filename}: {e}")
         return None
 
-def process_excel_in_chunks(excel_content, year):
-    """
-    Processa o arquivo Excel em chunks para otimizar memória
-    """
-    print(f"Processando arquivo do ano {year} em chunks...")
-    
-    try:
-        # Ler apenas o cabeçalho primeiro para entender a estrutura
-        df_header = pd.read_excel(io.BytesIO(excel_content), nrows=0)
-        total_columns = len(df_header.columns)
-        print(f"Arquivo tem {total_columns} colunas")
-        
-        # Ler o arquivo completo para saber quantas linhas tem
-        df_full = pd.read_excel(io.BytesIO(excel_content))
-        total_rows = len(df_full)
-        print(f"Arquivo tem {total_rows} linhas")
-        
-        # Selecionar apenas colunas essenciais para reduzir uso de memória
-        essential_columns = select_essential_columns(df_full.columns)
-        print(f"Selecionadas {len(essential_columns)} colunas essenciais")
-        
-        # Filtrar apenas as colunas essenciais
-        df_filtered = df_full[essential_columns].copy()
-        df_filtered['year'] = year
-        
-        # Limpar memória
-        del df_full
-        
-        return df_filtered
-    
-    except Exception as e:
-        print(f"Erro ao processar Excel: {e}")
-        return None
-
 def select_essential_columns(all_columns):
     """
     Seleciona apenas as colunas essenciais para reduzir uso de memória
@@ -210,49 +201,17 @@ def select_essential_columns(all_columns):
     # Aumentar limite para incluir campos de subdivisões (de 30 para 50)
     return selected_columns[:50]
 
-def clean_and_standardize_data(df):
+def clean_column_name(col):
     """
-    Limpa e padroniza os dados do DataFrame de forma otimizada
+    Padroniza o nome de uma coluna: minúsculas, não alfanuméricos → '_'
     """
-    if df is None or df.empty:
-        return None
-    
-    print(f"Limpando dados ({len(df)} linhas)...")
-    
-    # Remover linhas completamente vazias
-    df = df.dropna(how='all')
-    
-    # Padronizar nomes das colunas
-    new_columns = []
-    for col in df.columns:
-        # Converter para string, minúsculas, remover espaços e caracteres especiais
-        clean_col = str(col).strip().lower()
-        clean_col = re.sub(r'[^a-zA-Z0-9_]', '_', clean_col)
-        clean_col = re.sub(r'_+', '_', clean_col)  # Remover underscores múltiplos
-        clean_col = clean_col.strip('_')  # Remover underscores no início/fim
-        new_columns.append(clean_col)
-    
-    df.columns = new_columns
-    
-    print(f"Dados limpos: {len(df)} linhas, {len(df.columns)} colunas")
-    return df
+    clean_col = str(col).strip().lower()
+    clean_col = re.sub(r'[^a-zA-Z0-9_]', '_', clean_col)
+    clean_col = re.sub(r'_+', '_', clean_col)  # Remover underscores múltiplos
+    return clean_col.strip('_')  # Remover underscores no início/fim
 
-def create_optimized_table(conn):
-    """
-    Cria uma tabela otimizada para os dados globais
-    """
-    cursor = conn.cursor()
-    
-    # Verificar se a tabela já existe
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='damodaran_global';")
-    if cursor.fetchone():
-        print("Tabela damodaran_global já existe. Será recriada.")
-        cursor.execute("DROP TABLE damodaran_global;")
-    
-    # Criar tabela com estrutura mais simples e otimizada
-    # Incluindo campos específicos para subdivisões geográficas e setoriais
-    cursor.execute('''
-    CREATE TABLE damodaran_global (
+TABLE_DDL = '''
+    CREATE TABLE {table} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         year INTEGER NOT NULL,
         company_name TEXT,
@@ -291,19 +250,65 @@ def create_optimized_table(conn):
         raw_data TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
-    ''')
-    
-    # Criar índices para melhor performance
-    cursor.execute("CREATE INDEX idx_year ON damodaran_global(year);")
-    cursor.execute("CREATE INDEX idx_company ON damodaran_global(company_name);")
-    cursor.execute("CREATE INDEX idx_country ON damodaran_global(country);")
-    
+'''
+
+# Colunas da tabela preenchidas pela ingestão (na ordem do INSERT)
+TEXT_COLUMNS = [
+    'company_name', 'ticker', 'exchange', 'industry', 'country', 'broad_group',
+    'industry_group', 'primary_sector', 'sub_group', 'sic_code',
+]
+REAL_COLUMNS = [
+    'erp_for_country', 'bottom_up_beta_sector', 'market_cap', 'enterprise_value',
+    'revenue', 'net_income', 'ebitda', 'pe_ratio', 'beta', 'debt_equity', 'roe',
+    'roa', 'dividend_yield', 'revenue_growth', 'operating_margin',
+]
+INSERT_COLUMNS = ['year'] + TEXT_COLUMNS + REAL_COLUMNS + ['raw_data']
+
+def create_staging_table(conn):
+    """
+    Cria a staging table vazia (mesmo schema de damodaran_global)
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+    conn.execute(TABLE_DDL.format(table=STAGING_TABLE))
     conn.commit()
-    print("Tabela damodaran_global criada com índices otimizados.")
 
-def map_columns_optimized(df):
+def swap_staging_table(conn):
     """
-    Mapeia colunas de forma otimizada, incluindo campos de subdivisões
+    Substitui damodaran_global pela staging table numa única transação,
+    recriando junto tudo o que depende da tabela: índices básicos, índices de
+    cobertura (migrate_typed_damodaran_global) e os triggers + conteúdo do
+    damodaran_fts (search_index). Sem isso cada ingestão anual derrubava os
+    índices quentes e deixava a busca desatualizada.
+    """
+    if conn.in_transaction:
+        conn.commit()  # staging já carregada
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (TABLE,))
+        if cursor.fetchone():
+            print(f"Tabela {TABLE} já existe. Será substituída.")
+            cursor.execute(f"DROP TABLE {TABLE};")
+        cursor.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO {TABLE};")
+        # Índices criados após o rename (os nomes são globais no banco)
+        cursor.execute(f"CREATE INDEX idx_year ON {TABLE}(year);")
+        cursor.execute(f"CREATE INDEX idx_company ON {TABLE}(company_name);")
+        cursor.execute(f"CREATE INDEX idx_country ON {TABLE}(country);")
+        covering = create_covering_indexes(conn, commit=False)
+        # Triggers do FTS caíram com o DROP: recria e repopula (faz o commit)
+        search_counts = build_search_index(conn, rebuild=False)
+    except Exception:
+        conn.rollback()
+        raise
+    print(f"Tabela {TABLE} recriada com índices otimizados "
+          f"({len(covering)} de cobertura; damodaran_fts: {search_counts.get('damodaran_fts', 0)} linhas).")
+
+def map_columns(clean_columns):
+    """
+    Resolve, uma vez por arquivo, qual coluna (já padronizada) alimenta cada
+    coluna da tabela, incluindo campos de subdivisões.
+
+    Retorna {coluna_da_tabela: índice em clean_columns}.
     """
     # Mapeamento simplificado para colunas mais comuns
     column_mapping = {
@@ -341,87 +346,102 @@ def map_columns_optimized(df):
         'operating_margin': ['Operating Margin', 'operating_margin', 'op_margin']
     }
     
-    mapped_data = {'year': df['year'] if 'year' in df.columns else None}
-    
-    # Mapear colunas disponíveis
+    mapping = {}
     for target_col, possible_names in column_mapping.items():
-        found = False
+        # Primeiro nome possível contido numa coluna vence (ordem das colunas)
         for possible_name in possible_names:
-            # Buscar por nome exato ou similar
-            for df_col in df.columns:
-                if possible_name in str(df_col).lower():
-                    mapped_data[target_col] = df[df_col]
-                    found = True
-                    break
-            if found:
+            matches = [i for i, col in enumerate(clean_columns) if possible_name in col]
+            if matches:
+                mapping[target_col] = matches[0]
                 break
-    
-    # Criar DataFrame mapeado
-    result_df = pd.DataFrame(mapped_data)
-    
-    # Adicionar dados brutos como JSON (apenas uma amostra para economizar espaço)
-    if len(df) > 0:
-        sample_data = df.head(1).to_dict('records')[0] if len(df) > 0 else {}
-        import json
-        result_df['raw_data'] = json.dumps(sample_data)
-    
-    return result_df
+    return mapping
 
-def insert_data_in_batches(conn, df, year):
+def _text_values(values):
     """
-    Insere dados em lotes para melhor performance
+    Coluna → lista de str/None (números viram texto, vazios viram None)
     """
-    if df is None or df.empty:
-        print(f"Nenhum dado para inserir do ano {year}")
-        return 0
-    
-    cursor = conn.cursor()
-    
-    # Obter colunas da tabela
-    cursor.execute("PRAGMA table_info(damodaran_global);")
-    table_columns = [col[1] for col in cursor.fetchall() if col[1] not in ['id', 'created_at']]
-    
-    inserted_count = 0
-    total_rows = len(df)
-    
-    print(f"Inserindo {total_rows} registros em lotes de {BATCH_SIZE}...")
-    
-    # Processar em lotes
-    for i in range(0, total_rows, BATCH_SIZE):
-        batch_df = df.iloc[i:i+BATCH_SIZE]
-        
-        try:
-            # Preparar dados do lote
-            batch_data = []
-            
-            for _, row in batch_df.iterrows():
-                row_data = []
-                for col in table_columns:
-                    if col in batch_df.columns:
-                        value = row[col]
-                        # Converter valores não numéricos para None se necessário
-                        if pd.isna(value):
-                            row_data.append(None)
-                        else:
-                            row_data.append(value)
-                    else:
-                        row_data.append(None)
-                batch_data.append(row_data)
-            
-            # Inserir lote
-            placeholders = ', '.join(['?' for _ in table_columns])
-            query = f"INSERT INTO damodaran_global ({', '.join(table_columns)}) VALUES ({placeholders})"
-            
-            cursor.executemany(query, batch_data)
-            conn.commit()
+    series = pd.Series(values, dtype=object)
+    return series.astype(str).astype(object).where(series.notna(), None).tolist()
+
+def _real_values(values):
+    """
+    Coluna → lista de float/None (textos não numéricos e NaN viram None)
+    """
+    numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').astype(float)
+    return numbers.astype(object).where(numbers.notna(), None).tolist()
+
+def iter_excel_chunks(excel_content, year, chunk_size=CHUNK_SIZE):
+    """
+    Lê a primeira planilha em streaming e gera chunks de tuplas prontas para
+    o INSERT (na ordem de INSERT_COLUMNS).
+
+    Só as colunas de select_essential_columns são projetadas; a conversão
+    de tipos é feita por coluna (pandas), sem laço Python por linha/célula.
+    """
+    workbook = load_workbook(io.BytesIO(excel_content), read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        header = next(sheet.iter_rows(max_row=1, values_only=True), None)
+        if not header:
+            print("Arquivo sem cabeçalho")
+            return
+        all_columns = [col if col is not None else f"Unnamed: {i}" for i, col in enumerate(header)]
+        print(f"Arquivo tem {len(all_columns)} colunas")
+        
+        essential_columns = select_essential_columns(all_columns)
+        print(f"Selecionadas {len(essential_columns)} colunas essenciais")
+        positions = [all_columns.index(col) for col in essential_columns]
+        clean_columns = [clean_column_name(col) for col in essential_columns]
+        mapping = map_columns(clean_columns)
+        
+        # Projeção: o openpyxl não lê além da última coluna essencial e o
+        # itemgetter (em C) extrai só as colunas essenciais de cada linha
+        rows = sheet.iter_rows(min_row=2, max_col=max(positions) + 1, values_only=True)
+        project = itemgetter(*positions) if len(positions) > 1 else (lambda row: (row[positions[0]],))
+        raw_data = None
+        
+        while True:
+            block = list(map(project, islice(rows, chunk_size)))
+            if not block:
+                break
+            matrix = np.array(block, dtype=object)
+            # Remover linhas completamente vazias
+            matrix = matrix[(matrix != None).any(axis=1)]  # noqa: E711 — comparação elemento a elemento
+            if not len(matrix):
+                continue
             
-            inserted_count += len(batch_data)
-            progress = (i + BATCH_SIZE) / total_rows * 100
-            print(f"\rProgresso inserção: {progress:.1f}% ({inserted_count}/{total_rows})", end='', flush=True)
+            if raw_data is None:
+                # Dados brutos: amostra da primeira linha (mesma para todas, economiza espaço)
+                sample = dict(zip(clean_columns, matrix[0].tolist()))
+                sample['year'] = year
+                raw_data = json.dumps(sample, default=str)
             
-        except Exception as e:
-            print(f"\nErro ao inserir lote {i//BATCH_SIZE + 1}: {e}")
-            continue
+            n = len(matrix)
+            columns = [[year] * n]
+            for target_col in TEXT_COLUMNS:
+                i = mapping.get(target_col)
+                columns.append(_text_values(matrix[:, i]) if i is not None else [None] * n)
+            for target_col in REAL_COLUMNS:
+                i = mapping.get(target_col)
+                columns.append(_real_values(matrix[:, i]) if i is not None else [None] * n)
+            columns.append([raw_data] * n)
+            yield list(zip(*columns))
+    finally:
+        workbook.close()
+
+def load_year(conn, excel_content, year):
+    """
+    Carrega um ano na staging table, em chunks, numa única transação
+    """
+    print(f"Processando arquivo do ano {year} em streaming (chunks de {CHUNK_SIZE})...")
+    query = (f"INSERT INTO {STAGING_TABLE} ({', '.join(INSERT_COLUMNS)}) "
+             f"VALUES ({', '.join('?' for _ in INSERT_COLUMNS)})")
+    inserted_count = 0
+    with conn:
+        for batch in iter_excel_chunks(excel_content, year):
+            conn.executemany(query, batch)
+            inserted_count += len(batch)
+            print(f"\rInseridos: {inserted_count}", end='', flush=True)
     
     print(f"\nInseridos {inserted_count} registros do ano {year}")
     return inserted_count
@@ -470,7 +490,7 @@ def main():
     """
     print("=== Extrator Otimizado de Dados Globais do Damodaran ===")
     print(f"Banco de dados: {db_name}")
-    print(f"Configurações: Chunk size = {CHUNK_SIZE}, Batch size = {BATCH_SIZE}")
+    print(f"Configurações: Chunk size = {CHUNK_SIZE}")
     
     # Buscar anos disponíveis
     available_years = get_available_years()
@@ -499,8 +519,8 @@ def main():
     cursor.execute("PRAGMA temp_store = MEMORY;")
     
     try:
-        # Criar tabela otimizada
-        create_optimized_table(conn)
+        # Carregar tudo na staging; damodaran_global só é trocada no final
+        create_staging_table(conn)
         
         total_inserted = 0
         start_time = time.time()
@@ -514,30 +534,21 @@ def main():
             excel_content = download_file_with_progress(year)
             
             if excel_content is not None:
-                # Processar em chunks
-                processed_data = process_excel_in_chunks(excel_content, year)
-                
-                if processed_data is not None:
-                    # Limpar dados
-                    cleaned_data = clean_and_standardize_data(processed_data)
-                    
-                    if cleaned_data is not None:
-                        # Mapear colunas
-                        mapped_data = map_columns_optimized(cleaned_data)
-                        
-                        # Inserir no banco em lotes
-                        inserted = insert_data_in_batches(conn, mapped_data, year)
-                        total_inserted += inserted
-                        
-                        year_time = time.time() - year_start_time
-                        print(f"Ano {year} processado em {year_time:.1f}s")
-                    else:
-                        print(f"Erro ao limpar dados do ano {year}")
-                else:
-                    print(f"Erro ao processar dados do ano {year}")
+                try:
+                    total_inserted += load_year(conn, excel_content, year)
+                    year_time = time.time() - year_start_time
+                    print(f"Ano {year} processado em {year_time:.1f}s")
+                except Exception as e:
+                    print(f"Erro ao processar dados do ano {year}: {e}")
             else:
                 print(f"Erro ao baixar dados do ano {year}")
         
+        if total_inserted == 0:
+            print(f"\nNenhum registro carregado; {TABLE} mantida como estava.")
+            conn.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+            return
+        swap_staging_table(conn)
+        
         total_time = time.time() - start_time
         
         print(f"\n=== Processo Concluído em {total_time:.1f}s ===")
@@ -18,21 +18,29 @@ Uso:
   python scripts/fetch_historical_financials.py --company AAPL
   python scripts/fetch_historical_financials.py --sector "Technology" --quarterly
   python scripts/fetch_historical_financials.py --force  # re-busca mesmo se existir
+  python scripts/fetch_historical_financials.py --processes 4  # 4 shards em processos
+
+Escrita: só o processo principal grava (HistoricalWriter, uma conexão WAL).
+Com --processes N as empresas são divididas em N shards; cada processo busca
+e parseia (pandas, preso ao GIL) localmente e envia as linhas prontas por uma
+fila ao processo principal.
 """
 
 import argparse
+import multiprocessing as mp
 import os
+import queue
 import sys
 import time
-import random
 import sqlite3
 import threading
 import logging
 import warnings
 from datetime import datetime, date
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
 # Garante import do yfinance com SSL ok
 os.environ.setdefault("CURL_CA_BUNDLE", r"C:\cacerts\cacert.pem")
 
@@ -42,6 +50,10 @@ from yfinance.data import YfData
 import numpy as np
 import pandas as pd
 
+from scripts.fx_daily import download_fx_series, load_fx_series, rates_for_dates, refresh_fx_daily
+from scripts.job_progress import reporter
+from scripts.yahoo_fetch_engine import YahooFetchEngine, TIMEOUT
+
 # Silenciar warnings de depreciação do Pandas (Timestamp.utcnow) no yfinance
 warnings.filterwarnings("ignore", category=FutureWarning, module="yfinance")
 warnings.filterwarnings("ignore", message=".*Timestamp.utcnow.*")
@@ -57,28 +69,8 @@ logging.basicConfig(
 log = logging.getLogger("hist_fin")
 
 # --------------------------------------------------------------------------
-# Rate Limiter
+# Controle de sessão (taxa/concorrência ficam no YahooFetchEngine)
 # --------------------------------------------------------------------------
-class RateLimiter:
-    def __init__(self, max_per_second: float):
-        self._min_interval = 1.0 / max_per_second
-        self._lock = threading.Lock()
-        self._last = 0.0
-
-    def acquire(self):
-        with self._lock:
-            now = time.monotonic()
-            # Jitter aleatório: 0.8x a 1.2x do intervalo mínimo (menos variância = throughput mais previsível)
-            jitter = self._min_interval * random.uniform(0.8, 1.2)
-            wait = jitter - (now - self._last)
-            if wait > 0:
-                time.sleep(wait)
-            self._last = time.monotonic()
-
-
-_rate_limiter: RateLimiter | None = None
-_rate_limited = threading.Event()
-_RATE_LIMIT_PAUSE = 60  # 1 minuto (com cookies limpos + curl_cffi é suficiente)
 _reset_lock = threading.Lock()
 _request_counter = 0
 _counter_lock = threading.Lock()
@@ -154,54 +146,88 @@ def _reset_yf_session():
 
 
 # --------------------------------------------------------------------------
-# Conversão de moeda (cache com série histórica)
+# Conversão de moeda (tabela fx_daily + cache em memória por processo)
+#
+# fx_daily é atualizada uma vez, no processo principal, antes dos workers e
+# shards começarem (`prepare_fx`); eles só leem (conexão mode=ro). Uma moeda
+# ausente da tabela é baixada em memória sem gravar — o único escritor
+# continua sendo o HistoricalWriter.
 # --------------------------------------------------------------------------
 _fx_cache: dict[str, pd.DataFrame] = {}
 _fx_lock = threading.Lock()
+_fx_currency_locks: dict[str, threading.Lock] = {}
+_FX_ID_CHUNK = 900  # limite de parâmetros por IN (...)
+
+
+def _fx_currencies(db_path: Path, companies: list[dict]) -> list[str]:
+    """Moedas das empresas alvo: negociação (resolvida) + moedas de balanço já vistas."""
+    currencies = {SUBUNIT_CURRENCY_MAP.get(c.get("currency"), c.get("currency")) for c in companies}
+    ids = [c["id"] for c in companies]
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    try:
+        for i in range(0, len(ids), _FX_ID_CHUNK):
+            chunk = ids[i:i + _FX_ID_CHUNK]
+            currencies.update(r[0] for r in conn.execute(
+                f"SELECT DISTINCT original_currency FROM company_financials_historical "
+                f"WHERE company_basic_data_id IN ({','.join('?' * len(chunk))})", chunk))
+    finally:
+        conn.close()
+    return sorted(c for c in currencies if c and c != "USD")
+
+
+def prepare_fx(db_path: Path, companies: list[dict]):
+    """Atualiza fx_daily das moedas das empresas alvo (só no processo principal)."""
+    currencies = _fx_currencies(db_path, companies)
+    if not currencies:
+        return
+    log.info(f"Atualizando câmbio de {len(currencies)} moedas...")
+    conn = sqlite3.connect(str(db_path), timeout=60)
+    try:
+        refresh_fx_daily(conn, currencies)
+    except sqlite3.Error as e:
+        log.warning(f"Erro atualizando fx_daily: {e}")
+    finally:
+        conn.close()
 
 
 def _get_fx_series(currency: str) -> pd.DataFrame:
-    """Retorna série histórica FX para USD. Usa cache thread-safe."""
+    """Retorna série histórica FX para USD (leitura de fx_daily; erros não ficam em cache)."""
     if not currency or currency == "USD":
         return pd.DataFrame()
     with _fx_lock:
         if currency in _fx_cache:
             return _fx_cache[currency]
-    # Busca via yfinance
-    try:
-        pair = f"{currency}USD=X"
-        ticker = yf.Ticker(pair)
-        hist = ticker.history(period="10y", interval="1d")
-        if hist.empty:
-            log.warning(f"Sem cotação histórica para {pair}")
-            hist = pd.DataFrame()
-    except Exception as e:
-        log.warning(f"Erro buscando FX {currency}: {e}")
-        hist = pd.DataFrame()
-    with _fx_lock:
-        _fx_cache[currency] = hist
-    return hist
+        currency_lock = _fx_currency_locks.setdefault(currency, threading.Lock())
+    # Uma thread por moeda carrega; as demais esperam e reutilizam
+    with currency_lock:
+        if currency in _fx_cache:
+            return _fx_cache[currency]
+        try:
+            conn = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+            try:
+                conn.execute("PRAGMA query_only = ON")
+                series = load_fx_series(conn, currency)
+            finally:
+                conn.close()
+            if series.empty:
+                log.info(f"{currency} ausente de fx_daily; baixando série em memória")
+                series = download_fx_series(currency)
+        except Exception as e:
+            # Falha transitória (DB ocupado, rede): tenta de novo na próxima empresa
+            log.warning(f"Erro lendo câmbio de {currency}: {e}")
+            return pd.DataFrame()
+        with _fx_lock:
+            _fx_cache[currency] = series
+        return series
 
 
 def _get_historical_fx_rates(currency: str, period_dates: list[str]) -> dict[str, float]:
     """Retorna taxa FX para USD mais próxima de cada data de período."""
     if not currency or currency == "USD":
         return {d: 1.0 for d in period_dates}
-    fx_hist = _get_fx_series(currency)
-    if fx_hist.empty:
-        return {d: 1.0 for d in period_dates}
-    tz = fx_hist.index.tz
-    result = {}
-    for date_str in period_dates:
-        pd_date = pd.Timestamp(date_str)
-        if tz is not None:
-            pd_date = pd_date.tz_localize(tz)
-        closest_idx = fx_hist.index.get_indexer([pd_date], method="nearest")[0]
-        if 0 <= closest_idx < len(fx_hist):
-            result[date_str] = float(fx_hist.iloc[closest_idx]["Close"])
-        else:
-            result[date_str] = 1.0
-    return result
+    fx_series = _get_fx_series(currency)
+    rates = rates_for_dates(fx_series, period_dates)
+    return dict(zip(period_dates, (float(r) for r in rates)))
 
 
 # --------------------------------------------------------------------------
@@ -212,7 +238,7 @@ DB_PATH = Path(__file__).resolve().parent.parent / "data" / "damodaran_data_new.
 
 def ensure_table(db_path: Path):
     """Cria tabela company_financials_historical se não existir."""
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("""
     CREATE TABLE IF NOT EXISTS company_financials_historical (
@@ -328,7 +354,7 @@ def ensure_table(db_path: Path):
 # --------------------------------------------------------------------------
 def get_target_companies(db_path: Path, args) -> list[dict]:
     """Retorna lista de empresas para buscar, com base nos filtros."""
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     conn.row_factory = sqlite3.Row
 
     base_query = """
@@ -353,6 +379,9 @@ def get_target_companies(db_path: Path, args) -> list[dict]:
         if args.country:
             base_query += " AND cbd.yahoo_country = ?"
             params.append(args.country)
+        if args.unclassified:
+            column = {"sector": "yahoo_sector", "country": "yahoo_country"}[args.unclassified]
+            base_query += f" AND COALESCE(cbd.{column}, '') = ''"
 
     if not args.force:
         period_type = "quarterly" if args.quarterly else "annual"
@@ -423,11 +452,6 @@ def _get_historical_prices(ticker_obj, periods: list[str]) -> dict[str, float |
 
 def fetch_company_financials(company: dict, quarterly: bool = False) -> dict | str | None:
     """Busca dados financeiros históricos de uma empresa via yfinance."""
-    if _rate_limited.is_set():
-        _rate_limited.wait()
-    if _rate_limiter:
-        _rate_limiter.acquire()
-
     # Reset proativo de sessão a cada N requests
     global _request_counter
     with _counter_lock:
@@ -703,8 +727,6 @@ def fetch_company_financials(company: dict, quarterly: bool = False) -> dict | s
 # --------------------------------------------------------------------------
 # Salvar no banco
 # --------------------------------------------------------------------------
-_db_lock = threading.Lock()
-
 FIELDS = [
     "period_date", "fiscal_year", "fiscal_quarter",
     "total_revenue", "cost_of_revenue", "gross_profit", "operating_income",
@@ -726,83 +748,224 @@ FIELDS = [
     "capex_revenue", "ev_revenue", "ev_ebitda", "ev_ebit",
 ]
 
-
-_write_buffer: list[list] = []
-_WRITE_BUFFER_SIZE = 50  # flush a cada N períodos acumulados
+_WRITE_BATCH_SIZE = 500     # linhas por transação
+_WRITE_MAX_DELAY = 2.0      # segundos máximos com linhas pendentes sem commit
 
 _FIELD_NAMES_SQL = "company_basic_data_id, yahoo_code, company_name, period_type, " + ", ".join(FIELDS)
 _PLACEHOLDERS_SQL = ", ".join(["?"] * (4 + len(FIELDS)))
 
 
-def _flush_buffer(db_path: Path, _max_retries: int = 5):
-    """Grava o buffer acumulado no banco em uma única transação."""
-    with _db_lock:
-        if not _write_buffer:
+def financial_rows(company: dict, data: dict, period_type: str) -> list[list]:
+    """Linhas prontas para company_financials_historical (uma por período)."""
+    return [
+        [company["id"], company["yahoo_code"], company.get("company_name"), period_type]
+        + [rec.get(f) for f in FIELDS]
+        for rec in data["periods"]
+    ]
+
+
+class HistoricalWriter:
+    """Único escritor do script: uma conexão WAL aberta durante toda a execução.
+
+    Antes, cada thread empilhava linhas num buffer global sob lock e quem
+    enchia o buffer abria uma conexão nova, com retries e sleeps em
+    "database is locked". Agora só o processo principal grava: as linhas
+    chegam pelo laço de resultados (threads) ou pela fila dos shards
+    (processos) e são gravadas em lotes de `batch_size`, ou depois de
+    `max_delay` segundos, em uma transação cada.
+    """
+
+    def __init__(self, db_path: Path, batch_size: int = _WRITE_BATCH_SIZE,
+                 max_delay: float = _WRITE_MAX_DELAY):
+        self.conn = sqlite3.connect(str(db_path), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending: list[list] = []
+        self.written = 0
+        self._oldest = None
+
+    def add(self, rows: list[list]):
+        if not rows:
             return
-        batch = list(_write_buffer)
-        _write_buffer.clear()
-    for attempt in range(_max_retries):
-        try:
-            conn = sqlite3.connect(str(db_path), timeout=30)
-            conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA synchronous=NORMAL")
-            cursor = conn.cursor()
-            cursor.executemany(f"""
+        if not self.pending:
+            self._oldest = time.monotonic()
+        self.pending.extend(rows)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def tick(self):
+        """Grava o pendente se ele já espera há mais de `max_delay`."""
+        if self.pending and time.monotonic() - self._oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany(f"""
                 INSERT OR REPLACE INTO company_financials_historical
                 ({_FIELD_NAMES_SQL})
                 VALUES ({_PLACEHOLDERS_SQL})
-            """, batch)
-            conn.commit()
-            conn.close()
-            return
-        except sqlite3.OperationalError as e:
-            if "locked" in str(e) and attempt < _max_retries - 1:
-                logger.warning(f"DB locked, retry {attempt+1}/{_max_retries}...")
-                time.sleep(2 * (attempt + 1))
-            else:
-                raise
-
+            """, self.pending)
+        self.written += len(self.pending)
+        self.pending = []
 
-def save_financials(db_path: Path, company: dict, data: dict, period_type: str):
-    """Acumula dados no buffer e grava em batch quando cheio. Thread-safe."""
-    rows = []
-    for rec in data["periods"]:
-        rows.append([
-            company["id"],
-            company["yahoo_code"],
-            company.get("company_name"),
-            period_type,
-        ] + [rec.get(f) for f in FIELDS])
-
-    with _db_lock:
-        _write_buffer.extend(rows)
-        should_flush = len(_write_buffer) >= _WRITE_BUFFER_SIZE
-    if should_flush:
-        _flush_buffer(db_path)
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
 
 
 # --------------------------------------------------------------------------
 # Worker
 # --------------------------------------------------------------------------
-def process_company(company: dict, quarterly: bool) -> tuple[int, str, str]:
-    """Processa uma empresa. Retorna (id, status, yahoo_code)."""
+def process_company(company: dict, quarterly: bool) -> tuple[int, str, str, list[list]]:
+    """Processa uma empresa. Retorna (id, status, yahoo_code, linhas a gravar).
+
+    Não grava nada: as linhas voltam para o escritor único (HistoricalWriter).
+    """
     yahoo_code = company["yahoo_code"]
     try:
         result = fetch_company_financials(company, quarterly=quarterly)
         if result == "RATE_LIMITED":
-            return company["id"], "rate_limited", yahoo_code
+            return company["id"], "rate_limited", yahoo_code, []
         if result is None:
-            return company["id"], "no_data", yahoo_code
+            return company["id"], "no_data", yahoo_code, []
         if not result.get("periods"):
-            return company["id"], "empty", yahoo_code
+            return company["id"], "empty", yahoo_code, []
 
         period_type = "quarterly" if quarterly else "annual"
-        save_financials(DB_PATH, company, result, period_type)
-        n = len(result["periods"])
-        return company["id"], f"ok:{n}", yahoo_code
+        rows = financial_rows(company, result, period_type)
+        return company["id"], f"ok:{len(rows)}", yahoo_code, rows
     except Exception as e:
         log.debug(f"Erro {yahoo_code}: {e}")
-        return company["id"], "error", yahoo_code
+        return company["id"], "error", yahoo_code, []
+
+
+def _outcome(comp: dict, result) -> tuple[str, list[list]]:
+    """(status, linhas) de um resultado do engine (TIMEOUT e exceções viram 'error')."""
+    if result is TIMEOUT:
+        log.warning(f"Timeout para {comp['yahoo_code']} — pulando")
+        return "error", []
+    if isinstance(result, Exception):
+        log.error(f"Exceção não tratada para {comp['yahoo_code']}: {result}")
+        return "error", []
+    _, status, _, rows = result
+    return status, rows
+
+
+def _tally(stats: dict, status: str):
+    if status.startswith("ok:"):
+        stats["ok"] += 1
+        stats["periods_total"] += int(status.split(":")[1])
+    elif status in ("no_data", "empty"):
+        stats[status] += 1
+    elif status == "rate_limited":
+        stats["rate_limited"] += 1  # tentativas esgotadas
+    else:
+        stats["error"] += 1
+
+
+def _make_engine(quarterly: bool, workers: int, max_rps: float) -> YahooFetchEngine:
+    # Motor adaptativo: concorrência AIMD, token bucket e circuit breaker.
+    # Empresas com rate-limit voltam ao início da fila automaticamente.
+    return YahooFetchEngine(
+        lambda comp: process_company(comp, quarterly),
+        max_concurrency=workers,
+        max_rps=max_rps,
+        is_rate_limited=lambda r: r[1] == "rate_limited",
+        is_success=lambda r: r[1].startswith("ok:"),  # no_data/empty/error são neutros
+        on_open=_on_circuit_open,
+        request_timeout=120,
+    )
+
+
+# --------------------------------------------------------------------------
+# Shards em processos (--processes N)
+# --------------------------------------------------------------------------
+_SHARD_QUEUE_SIZE = 256  # mensagens em trânsito; shards esperam se o escritor atrasar
+
+
+def split_shards(companies: list[dict], n: int) -> list[list[dict]]:
+    """Divide as empresas em até `n` shards intercalados (tamanhos equilibrados)."""
+    n = max(1, min(n, len(companies)))
+    return [companies[i::n] for i in range(n)]
+
+
+def _run_shard(shard: int, companies: list[dict], db_path: str, quarterly: bool,
+               workers: int, max_rps: float, out):
+    """Processo de shard: busca e parseia localmente, envia (status, linhas) pela fila.
+
+    Nada é gravado aqui; o único escritor é o processo principal.
+    """
+    global DB_PATH
+    DB_PATH = Path(db_path)  # leitura de fx_daily (somente leitura)
+    engine = _make_engine(quarterly, workers, max_rps)
+    try:
+        for comp, result in engine.run(companies):
+            status, rows = _outcome(comp, result)
+            out.put(("result", shard, status, rows))
+    finally:
+        out.put(("done", shard, engine.stats(), None))
+
+
+def _run_sharded(companies: list[dict], args, writer: HistoricalWriter, stats: dict, on_result):
+    """Roda os shards em processos e grava o que chega pela fila.
+
+    Taxa e concorrência são divididas entre os shards, de modo que o teto
+    global de requisições continua sendo `--max-rps`.
+    """
+    shards = split_shards(companies, args.processes)
+    n = len(shards)
+    workers = max(1, -(-args.workers // n))
+    max_rps = args.max_rps / n
+    log.info(f"{n} shards em processos | por shard: workers={workers} max_rps={max_rps:.2f}")
+
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue(maxsize=_SHARD_QUEUE_SIZE)
+    procs = [ctx.Process(target=_run_shard, name=f"hist-shard-{i}",
+                         args=(i, shard, str(DB_PATH), args.quarterly, workers, max_rps, out))
+             for i, shard in enumerate(shards)]
+    for p in procs:
+        p.start()
+
+    seen = [0] * n
+    finished = set()
+    engine_stats = []
+    try:
+        while len(finished) < n:
+            try:
+                kind, shard, payload, rows = out.get(timeout=1.0)
+            except queue.Empty:
+                writer.tick()
+                for i, p in enumerate(procs):
+                    if i not in finished and p.exitcode is not None:
+                        # Shard morreu sem avisar: o que faltou conta como erro
+                        missing = len(shards[i]) - seen[i]
+                        log.error(f"Shard {i} terminou com código {p.exitcode}; {missing} empresas sem resultado")
+                        finished.add(i)
+                        for _ in range(missing):
+                            _tally(stats, "error")
+                            on_result()
+                continue
+            if kind == "done":
+                finished.add(shard)
+                engine_stats.append(payload)
+                continue
+            seen[shard] += 1
+            writer.add(rows)
+            _tally(stats, payload)
+            on_result()
+            writer.tick()
+    finally:
+        for p in procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+    return engine_stats
 
 
 # --------------------------------------------------------------------------
@@ -828,18 +991,26 @@ def _clear_yf_cookies():
 # --------------------------------------------------------------------------
 # Main
 # --------------------------------------------------------------------------
-def main():
-    global _rate_limiter
+def _on_circuit_open():
+    """Circuito aberto por rate-limit: descarta sessão e cookies do yfinance."""
+    _clear_yf_cookies()
+    _reset_yf_session()
+
 
+def main():
     parser = argparse.ArgumentParser(description="Busca dados financeiros históricos via Yahoo Finance")
     parser.add_argument("--sector", type=str, help="Filtrar por Yahoo sector")
     parser.add_argument("--industry", type=str, help="Filtrar por Yahoo industry")
     parser.add_argument("--country", type=str, help="Filtrar por country")
     parser.add_argument("--company", type=str, help="Yahoo code ou ticker específico")
+    parser.add_argument("--unclassified", choices=("sector", "country"),
+                        help="Só empresas sem yahoo_sector/yahoo_country (shard do scheduler)")
     parser.add_argument("--quarterly", action="store_true", help="Buscar dados trimestrais (default: anual)")
     parser.add_argument("--limit", type=int, default=None, help="Limite de empresas")
-    parser.add_argument("--workers", type=int, default=5, help="Threads paralelas (default: 5)")
-    parser.add_argument("--max-rps", type=float, default=4.0, help="Requests/segundo (default: 4)")
+    parser.add_argument("--workers", type=int, default=5, help="Concorrência máxima (default: 5)")
+    parser.add_argument("--max-rps", type=float, default=4.0, help="Teto de requests/segundo (default: 4)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Shards em processos (parse em paralelo; taxa/workers divididos; default: 1)")
     parser.add_argument("--force", action="store_true", help="Re-busca mesmo se já existir")
     parser.add_argument("--db", type=str, default=None, help="Caminho do banco (opcional)")
     args = parser.parse_args()
@@ -857,126 +1028,77 @@ def main():
 
     # Setup
     ensure_table(DB_PATH)
-    _rate_limiter = RateLimiter(args.max_rps)
 
     # Buscar empresas alvo
+    progress = reporter()
     companies = get_target_companies(DB_PATH, args)
     if not companies:
         log.info("Nenhuma empresa encontrada com os filtros especificados (ou todas já têm dados).")
+        progress.done(phase="Nenhuma empresa pendente")
         return
 
     total = len(companies)
     log.info(f"Empresas para processar: {total}")
+    progress.done(total=total, phase="Atualizando câmbio...")
+
+    # Câmbio atualizado antes dos workers/shards, que só leem fx_daily
+    prepare_fx(DB_PATH, companies)
+    progress.done(phase=f"Buscando {'trimestrais' if args.quarterly else 'anuais'}...")
 
     # Estatísticas
     stats = {"ok": 0, "no_data": 0, "empty": 0, "error": 0, "rate_limited": 0, "periods_total": 0}
     start_time = time.time()
-    rate_pauses = 0
-
-    # Batch processing — processa em lotes pequenos, re-enfileira rate-limited
-    batch_size = args.workers * 5
-    idx = 0
-    while idx < total:
-        batch = companies[idx : idx + batch_size]
-        retry_companies = []
-        hit_rate_limit = False
-
-        with ThreadPoolExecutor(max_workers=args.workers) as executor:
-            futures = {
-                executor.submit(process_company, comp, args.quarterly): comp
-                for comp in batch
-            }
-
-            try:
-                for future in as_completed(futures, timeout=120):
-                    comp = futures[future]
-                    try:
-                        cid, status, ycode = future.result(timeout=60)
-                    except TimeoutError:
-                        log.warning(f"Timeout para {comp['yahoo_code']} — pulando")
-                        stats["error"] += 1
-                        continue
-                    except Exception as e:
-                        log.error(f"Exceção não tratada para {comp['yahoo_code']}: {e}")
-                        stats["error"] += 1
-                        continue
-
-                    if status == "rate_limited":
-                        stats["rate_limited"] += 1
-                        hit_rate_limit = True
-                        retry_companies.append(comp)
-                        continue
-
-                    if status.startswith("ok:"):
-                        n_periods = int(status.split(":")[1])
-                        stats["ok"] += 1
-                        stats["periods_total"] += n_periods
-                    elif status == "no_data":
-                        stats["no_data"] += 1
-                    elif status == "empty":
-                        stats["empty"] += 1
-                    else:
-                        stats["error"] += 1
-            except TimeoutError:
-                n_stuck = sum(1 for f in futures if not f.done())
-                stuck_codes = [futures[f]['yahoo_code'] for f in futures if not f.done()]
-                log.warning(f"Batch timeout! {n_stuck} empresas travadas: {stuck_codes[:5]}...")
-                stats["error"] += n_stuck
-                for f in futures:
-                    f.cancel()
-
-        if hit_rate_limit:
-            rate_pauses += 1
-            pause = _RATE_LIMIT_PAUSE * min(rate_pauses, 3)  # max 15min
-            log.warning(f"Rate limit! Pausa de {pause//60}min (pausa #{rate_pauses})...")
-            _clear_yf_cookies()
-            _reset_yf_session()
-            time.sleep(pause)
-            log.info("Sessão resetada, retomando...")
-            # Re-inserir rate-limited no início da fila restante
-            remaining = retry_companies + companies[idx + batch_size:]
-            companies = companies[:idx + batch_size] + remaining[len(retry_companies):]
-            # Re-inserir retry no próximo batch (não avançar idx por completo)
-            companies[idx + batch_size - len(retry_companies):idx + batch_size] = retry_companies
-            total = len(companies)
-            # Avançar apenas pelas empresas que NÃO falharam
-            idx += batch_size - len(retry_companies)
-            continue
-        else:
-            if rate_pauses > 0:
-                rate_pauses = 0
-
-        idx += len(batch)
-
-        # Flush buffer de escritas pendentes ao final de cada batch
-        _flush_buffer(DB_PATH)
-
-        # Progress
+    writer = HistoricalWriter(DB_PATH)
+    report_every = args.workers * 5
+    done = 0
+    engine = None
+
+    def on_result():
+        nonlocal done
+        done += 1
+        progress.update(current=done, success=stats["ok"], errors=stats["error"])
+        if done % report_every and done != total:
+            return
         elapsed = time.time() - start_time
-        processed = stats["ok"] + stats["no_data"] + stats["empty"] + stats["error"]
-        rps = processed / elapsed if elapsed > 0 else 0
-        remaining_time = (total - idx) / rps if rps > 0 else 0
-        pct = idx / total * 100
+        rps = done / elapsed if elapsed > 0 else 0
+        remaining_time = (total - done) / rps if rps > 0 else 0
+        pct = done / total * 100
         log.info(
-            f"[{idx}/{total}] {pct:.0f}% | "
+            f"[{done}/{total}] {pct:.0f}% | "
             f"OK:{stats['ok']} Sem dados:{stats['no_data']} Erros:{stats['error']} "
             f"Periodos:{stats['periods_total']} | {rps:.1f} emp/s | "
-            f"ETA {remaining_time/60:.0f}min"
+            f"ETA {remaining_time/60:.0f}min" + (f" | {engine.describe()}" if engine else "")
         )
 
-    # Flush final do buffer de escritas pendentes
-    _flush_buffer(DB_PATH)
+    try:
+        if args.processes > 1 and total > 1:
+            engine_stats = _run_sharded(companies, args, writer, stats, on_result)
+        else:
+            engine = _make_engine(args.quarterly, args.workers, args.max_rps)
+            for comp, result in engine.run(companies):
+                status, rows = _outcome(comp, result)
+                writer.add(rows)
+                _tally(stats, status)
+                on_result()
+                writer.tick()
+            engine_stats = [engine.stats()]
+    finally:
+        writer.close()
+    progress.done(current=done, success=stats["ok"], errors=stats["error"], phase="Concluído")
 
     # Resumo final
     elapsed = time.time() - start_time
+    throttled = sum(e["throttled"] for e in engine_stats)
+    circuit_opens = sum(e["circuit_opens"] for e in engine_stats)
     log.info("=" * 60)
     log.info(f"CONCLUÍDO em {elapsed:.0f}s ({elapsed/60:.1f} min)")
     log.info(f"  OK (com dados): {stats['ok']}")
     log.info(f"  Sem dados financeiros: {stats['no_data']}")
     log.info(f"  Vazios: {stats['empty']}")
     log.info(f"  Erros: {stats['error']}")
-    log.info(f"  Rate limits: {stats['rate_limited']}")
-    log.info(f"  Total períodos gravados: {stats['periods_total']}")
+    log.info(f"  Rate limits: {throttled} (desistências: {stats['rate_limited']}, "
+             f"aberturas do circuito: {circuit_opens})")
+    log.info(f"  Total períodos gravados: {writer.written}")
     log.info("=" * 60)
 
 
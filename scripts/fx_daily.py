@@ -0,0 +1,184 @@
+"""
+fx_daily.py
+===========
+Tabela persistida de câmbio diário (moeda → USD) e conversão vetorizada.
+
+Antes, cada processo baixava a série `{MOEDA}USD=X` de 10 anos do Yahoo e
+procurava a cotação de cada data com `get_indexer(..., method="nearest")`,
+uma data por vez. Agora:
+
+- `fx_daily(currency, date, close)` guarda as séries no próprio banco;
+  `refresh_currency()` só baixa o trecho novo desde a última data gravada.
+- `rates_for_dates()` resolve a cotação mais próxima de muitas datas de uma
+  vez, com um único `merge_asof` por moeda (mesma regra do `nearest` antigo,
+  inclusive o desempate para a data mais recente).
+
+Uso:
+  python scripts/fx_daily.py                 # atualiza moedas do histórico
+  python scripts/fx_daily.py --currency BRL  # uma moeda específica
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sqlite3
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+log = logging.getLogger("fx_daily")
+
+DB_PATH = Path(__file__).resolve().parent.parent / "data" / "damodaran_data_new.db"
+
+FX_TABLE = "fx_daily"
+INITIAL_PERIOD = "10y"
+# Re-baixa alguns dias antes da última data (fechamentos revisados)
+OVERLAP_DAYS = 7
+
+
+def ensure_fx_table(conn):
+    """Cria a tabela fx_daily se não existir."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {FX_TABLE} (
+            currency TEXT NOT NULL,
+            date TEXT NOT NULL,
+            close REAL NOT NULL,
+            PRIMARY KEY (currency, date)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+
+def _last_date(conn, currency: str) -> str | None:
+    row = conn.execute(f"SELECT MAX(date) FROM {FX_TABLE} WHERE currency = ?", (currency,)).fetchone()
+    return row[0] if row else None
+
+
+def _download(currency: str, start: str | None) -> pd.DataFrame:
+    """Baixa a série `{currency}USD=X` do Yahoo (inteira ou a partir de `start`)."""
+    import yfinance as yf
+
+    pair = f"{currency}USD=X"
+    ticker = yf.Ticker(pair)
+    if start:
+        return ticker.history(start=start, interval="1d")
+    return ticker.history(period=INITIAL_PERIOD, interval="1d")
+
+
+def refresh_currency(conn, currency: str, today: date | None = None) -> int:
+    """
+    Atualiza incrementalmente a série de uma moeda. Retorna linhas gravadas.
+
+    Datas são gravadas no fuso da própria série (dia local da cotação), que
+    é o mesmo referencial usado antes ao localizar a data do período.
+    """
+    if not currency or currency == "USD":
+        return 0
+    today = today or date.today()
+    last = _last_date(conn, currency)
+    if last and last >= (today - timedelta(days=1)).isoformat():
+        return 0
+    start = (date.fromisoformat(last) - timedelta(days=OVERLAP_DAYS)).isoformat() if last else None
+    try:
+        hist = _download(currency, start)
+    except Exception as e:
+        log.warning(f"Erro buscando FX {currency}: {e}")
+        return 0
+    if hist is None or hist.empty or "Close" not in hist:
+        if not last:
+            log.warning(f"Sem cotação histórica para {currency}USD=X")
+        return 0
+    closes = hist["Close"].dropna()
+    rows = [(currency, ts.strftime("%Y-%m-%d"), float(v)) for ts, v in closes.items()]
+    conn.executemany(f"INSERT OR REPLACE INTO {FX_TABLE} (currency, date, close) VALUES (?, ?, ?)", rows)
+    conn.commit()
+    return len(rows)
+
+
+def refresh_fx_daily(conn, currencies, pause: float = 0.5) -> int:
+    """Atualiza várias moedas (pausa curta entre downloads)."""
+    ensure_fx_table(conn)
+    total = 0
+    for currency in currencies:
+        n = refresh_currency(conn, currency)
+        if n:
+            log.info(f"FX {currency}: {n} cotações gravadas")
+            time.sleep(pause)
+        total += n
+    return total
+
+
+def load_fx_series(conn, currency: str) -> pd.DataFrame:
+    """Série da moeda como DataFrame (date datetime64, close), ordenada."""
+    df = pd.read_sql_query(
+        f"SELECT date, close FROM {FX_TABLE} WHERE currency = ? ORDER BY date",
+        conn, params=(currency,),
+    )
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+def download_fx_series(currency: str) -> pd.DataFrame:
+    """Série completa direto do Yahoo, no formato de load_fx_series, sem gravar.
+
+    Para leitores que não podem escrever em fx_daily (workers do histórico)
+    quando a moeda ainda não está na tabela.
+    """
+    hist = _download(currency, None)
+    if hist is None or hist.empty or "Close" not in hist:
+        return pd.DataFrame({"date": pd.to_datetime([]), "close": []})
+    closes = hist["Close"].dropna()
+    return pd.DataFrame({
+        "date": pd.to_datetime([ts.strftime("%Y-%m-%d") for ts in closes.index]),
+        "close": closes.to_numpy(dtype=float),
+    })
+
+
+def rates_for_dates(series: pd.DataFrame, dates) -> pd.Series:
+    """
+    Cotação mais próxima de cada data (vetorizado). Sem série → 1.0.
+
+    O merge é feito sobre o tempo negado para que, em empate de distância,
+    vença a data mais recente (mesmo comportamento do get_indexer nearest).
+    """
+    dates = pd.to_datetime(pd.Series(list(dates), dtype="object"))
+    if series is None or series.empty or dates.empty:
+        return pd.Series(1.0, index=dates.index)
+    left = pd.DataFrame({"key": -dates.to_numpy().astype("datetime64[ns]").astype("int64"),
+                         "pos": dates.index})
+    right = pd.DataFrame({"key": -series["date"].to_numpy().astype("datetime64[ns]").astype("int64"),
+                          "close": series["close"].to_numpy()})
+    merged = pd.merge_asof(
+        left.sort_values("key"), right.sort_values("key"),
+        on="key", direction="nearest",
+    )
+    return merged.set_index("pos")["close"].reindex(dates.index).fillna(1.0)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        datefmt="%H:%M:%S")
+    parser = argparse.ArgumentParser(description="Atualiza a tabela fx_daily (câmbio diário → USD)")
+    parser.add_argument("--currency", type=str, help="Moeda específica (ex: BRL)")
+    parser.add_argument("--db", type=str, default=None, help="Caminho do banco")
+    args = parser.parse_args()
+
+    db_path = Path(args.db) if args.db else DB_PATH
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    ensure_fx_table(conn)
+    if args.currency:
+        currencies = [args.currency]
+    else:
+        currencies = [r[0] for r in conn.execute("""
+            SELECT DISTINCT original_currency FROM company_financials_historical
+            WHERE original_currency IS NOT NULL AND original_currency != 'USD'
+        """)]
+    n = refresh_fx_daily(conn, currencies)
+    log.info(f"Concluído: {n} cotações gravadas para {len(currencies)} moedas.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+job_progress.py — Canal estruturado de progresso dos scripts de atualização.
+
+O company_update_manager adivinhava o progresso dos subprocessos lendo o
+stdout com regex ("Processando", "OK", "N empresas"...), o que contava linhas
+de log em vez de empresas. Agora o scheduler (job_scheduler.py) passa a cada
+tarefa, na variável de ambiente UPDATE_JOB_PROGRESS, o caminho de um arquivo
+JSON; o script grava ali {current, total, success, errors, phase} via
+`ProgressReporter.update()` e o scheduler só lê o arquivo.
+
+Sem a variável (execução manual pelo terminal) o reporter não faz nada.
+
+Uso nos scripts:
+    progress = reporter()
+    progress.update(total=len(items), phase="Buscando...")
+    progress.update(current=done, success=ok, errors=fail)   # com throttle
+    progress.done(current=done)                              # grava sempre
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+from pathlib import Path
+
+PROGRESS_ENV = "UPDATE_JOB_PROGRESS"
+MIN_INTERVAL = 0.5  # segundos entre gravações (update sem force)
+
+FIELDS = ("current", "total", "success", "errors", "phase")
+
+
+class ProgressReporter:
+    """Grava o estado de progresso atomicamente (tmp + os.replace)."""
+
+    def __init__(self, path: str | Path | None = None):
+        self.path = Path(path) if path else None
+        self.state = {"current": 0, "total": 0, "success": 0, "errors": 0, "phase": ""}
+        self._last_write = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def update(self, force: bool = False, **fields):
+        if self.path is None:
+            return
+        for key, value in fields.items():
+            if key in FIELDS and value is not None:
+                self.state[key] = value
+        now = time.monotonic()
+        if not force and now - self._last_write < MIN_INTERVAL:
+            return
+        self._last_write = now
+        self.state["updated_at"] = time.time()
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            tmp.write_text(json.dumps(self.state, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # progresso é informativo; nunca derruba o script
+
+    def done(self, **fields):
+        self.update(force=True, **fields)
+
+
+def reporter() -> ProgressReporter:
+    """Reporter ligado ao arquivo de UPDATE_JOB_PROGRESS (no-op se ausente)."""
+    return ProgressReporter(os.environ.get(PROGRESS_ENV) or None)
+
+
+def read_progress(path: str | Path) -> dict | None:
+    """Último estado gravado (None se o script ainda não reportou)."""
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,451 @@
+"""
+Migração: tipagem numérica da tabela damodaran_global + índices de cobertura.
+
+As métricas da damodaran_global foram gravadas por importadores diferentes
+e parte delas ficou como texto ('1.23', '', 'None'). Por isso o app usava
+`CAST(dg.x AS REAL)` em quase toda consulta — o que custa uma conversão por
+linha e impede o uso de índices.
+
+Esta migração reescreve a tabela com afinidade REAL/INTEGER nas colunas
+numéricas, no mesmo esquema de staging + swap do migrate_full_globalcomp.py:
+
+1. Inspeciona o schema e classifica as colunas (texto × numérica)
+2. Cria a staging table tipada (preserva ids, PK e UNIQUEs)
+3. Copia as linhas normalizando '' / 'None' / 'nan' → NULL
+4. Valida (contagem, ids, fração de valores não numéricos descartados)
+5. Swap atômico com backup + índices de cobertura + ANALYZE + triggers e
+   conteúdo do damodaran_fts (search_index), tudo na mesma transação
+
+Uso:
+  # Dry-run (padrão) - sem alterações no banco
+  python scripts/migrate_typed_damodaran_global.py
+
+  # Executar de fato
+  python scripts/migrate_typed_damodaran_global.py --execute
+
+  # Só (re)criar os índices de cobertura
+  python scripts/migrate_typed_damodaran_global.py --indexes-only
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sqlite3
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from search_index import build_search_index  # noqa: E402
+
+TABLE = "damodaran_global"
+STAGING_TABLE = "damodaran_global_typed_stg"
+
+# Colunas que são texto mesmo quando o conteúdo parece número
+TEXT_COLUMNS = {
+    "company_name", "ticker", "exchange", "exchange_ticker", "industry",
+    "industry_group", "primary_sector", "broad_group", "sub_group", "country",
+    "sic_code", "sic_desc", "sic_round", "atividade_anloc", "raw_data",
+    "created_at", "updated_at",
+}
+
+# Marcadores de "vazio" gravados como texto pelos importadores
+NULL_TOKENS = {"", "none", "null"}
+NUMERIC_NULL_TOKENS = NULL_TOKENS | {"nan", "n/a", "na", "-", "inf", "-inf"}
+
+# Índices de cobertura para os filtros quentes do app
+# (filtro principal primeiro; depois colunas lidas pelas consultas do dashboard/WACC)
+COVERING_INDEXES = {
+    "idx_dg_industry_cov": ("industry", "broad_group", "country", "market_cap", "beta", "debt_equity"),
+    "idx_dg_broad_group_cov": ("broad_group", "sub_group", "country", "industry"),
+    "idx_dg_sub_group_cov": ("sub_group", "country", "industry"),
+    "idx_dg_country_cov": ("country", "industry", "market_cap"),
+    "idx_dg_atividade_cov": ("atividade_anloc", "industry", "market_cap"),
+    "idx_dg_ticker_cov": ("ticker", "company_name", "market_cap"),
+}
+
+
+@dataclass
+class ValidationResult:
+    name: str
+    passed: bool
+    details: str
+
+
+@dataclass
+class ColumnPlan:
+    name: str
+    old_type: str
+    new_type: str
+    notnull: bool
+    default: str | None
+    pk: int
+
+
+def _affinity(decl: str) -> str:
+    """Afinidade SQLite de um tipo declarado (regras da seção 3.1 da doc)."""
+    d = (decl or "").upper()
+    if "INT" in d:
+        return "INTEGER"
+    if "CHAR" in d or "CLOB" in d or "TEXT" in d:
+        return "TEXT"
+    if "BLOB" in d or not d:
+        return "BLOB"
+    if "REAL" in d or "FLOA" in d or "DOUB" in d:
+        return "REAL"
+    return "NUMERIC"
+
+
+def parse_number(value):
+    """Número ou None (texto vazio/marcador/não numérico → None)."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return None if isinstance(value, float) and math.isnan(value) else value
+    text = str(value).strip()
+    if text.lower() in NUMERIC_NULL_TOKENS:
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return None if math.isnan(number) or math.isinf(number) else number
+
+
+def _is_null_token(value) -> bool:
+    return isinstance(value, str) and value.strip().lower() in NULL_TOKENS
+
+
+def plan_columns(conn: sqlite3.Connection, min_numeric_ratio: float) -> tuple[list[ColumnPlan], dict]:
+    """Decide o tipo final de cada coluna a partir do schema e do conteúdo."""
+    info = conn.execute(f"PRAGMA table_info({TABLE})").fetchall()
+    stats: dict[str, dict] = {}
+    plans: list[ColumnPlan] = []
+    for _cid, name, decl, notnull, default, pk in info:
+        affinity = _affinity(decl)
+        new_type = decl or ""
+        if pk or name in TEXT_COLUMNS:
+            plans.append(ColumnPlan(name, decl, new_type, bool(notnull), default, pk))
+            continue
+
+        total = valid = integral = 0
+        for (value,) in conn.execute(f'SELECT "{name}" FROM {TABLE} WHERE "{name}" IS NOT NULL'):
+            if _is_null_token(value):
+                continue
+            total += 1
+            number = parse_number(value)
+            if number is not None:
+                valid += 1
+                if float(number).is_integer():
+                    integral += 1
+        ratio = valid / total if total else 0.0
+        stats[name] = {"non_null": total, "numeric": valid, "discarded": total - valid,
+                       "numeric_ratio": round(ratio, 6)}
+
+        if affinity in ("REAL", "NUMERIC", "INTEGER") or (total and ratio >= min_numeric_ratio):
+            new_type = "INTEGER" if affinity == "INTEGER" and valid == integral else "REAL"
+        plans.append(ColumnPlan(name, decl, new_type, bool(notnull), default, pk))
+    return plans, stats
+
+
+def _unique_constraints(conn: sqlite3.Connection) -> list[list[str]]:
+    """Colunas de cada UNIQUE declarado na tabela (índices automáticos)."""
+    uniques = []
+    for _seq, idx_name, unique, origin, _partial in conn.execute(f"PRAGMA index_list({TABLE})"):
+        if unique and origin == "u":
+            cols = [r[2] for r in conn.execute(f'PRAGMA index_info("{idx_name}")')]
+            uniques.append(cols)
+    return uniques
+
+
+def create_staging_table(conn: sqlite3.Connection, plans: list[ColumnPlan]) -> None:
+    table_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (TABLE,)
+    ).fetchone()[0]
+    autoincrement = "AUTOINCREMENT" in table_sql.upper()
+
+    defs = []
+    pk_cols = [p.name for p in sorted((p for p in plans if p.pk), key=lambda p: p.pk)]
+    for p in plans:
+        col = f'"{p.name}" {p.new_type}'.rstrip()
+        if len(pk_cols) == 1 and p.pk:
+            col += " PRIMARY KEY" + (" AUTOINCREMENT" if autoincrement else "")
+        if p.notnull and not p.pk:
+            col += " NOT NULL"
+        if p.default is not None:
+            col += f" DEFAULT {p.default}"
+        defs.append(col)
+    if len(pk_cols) > 1:
+        defs.append("PRIMARY KEY (" + ", ".join(f'"{c}"' for c in pk_cols) + ")")
+    for cols in _unique_constraints(conn):
+        defs.append("UNIQUE (" + ", ".join(f'"{c}"' for c in cols) + ")")
+
+    conn.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+    conn.execute(f"CREATE TABLE {STAGING_TABLE} (\n    " + ",\n    ".join(defs) + "\n)")
+    conn.commit()
+
+
+def copy_rows(conn: sqlite3.Connection, plans: list[ColumnPlan], batch_size: int = 5000) -> int:
+    """Copia as linhas convertendo as colunas numéricas e normalizando vazios."""
+    names = [p.name for p in plans]
+    numeric = [p.new_type in ("REAL", "INTEGER") and not p.pk for p in plans]
+    integer = [p.new_type == "INTEGER" for p in plans]
+    col_list = ", ".join(f'"{n}"' for n in names)
+    insert_sql = f"INSERT INTO {STAGING_TABLE} ({col_list}) VALUES ({', '.join('?' * len(names))})"
+
+    def convert(row):
+        out = []
+        for value, is_num, is_int in zip(row, numeric, integer):
+            if is_num:
+                value = parse_number(value)
+                if is_int and value is not None:
+                    value = int(value)
+            elif _is_null_token(value):
+                value = None
+            out.append(value)
+        return out
+
+    read = conn.cursor()
+    read.execute(f"SELECT {col_list} FROM {TABLE}")
+    copied = 0
+    while True:
+        rows = read.fetchmany(batch_size)
+        if not rows:
+            break
+        conn.executemany(insert_sql, [convert(r) for r in rows])
+        copied += len(rows)
+    conn.commit()
+    return copied
+
+
+def run_validations(conn: sqlite3.Connection, plans: list[ColumnPlan], stats: dict,
+                    max_discard_ratio: float) -> list[ValidationResult]:
+    results: list[ValidationResult] = []
+    prod = conn.execute(f"SELECT COUNT(*), TOTAL(id) FROM {TABLE}").fetchone()
+    stg = conn.execute(f"SELECT COUNT(*), TOTAL(id) FROM {STAGING_TABLE}").fetchone()
+    results.append(ValidationResult(
+        name="row_count",
+        passed=prod[0] == stg[0],
+        details=f"producao={prod[0]}, staging={stg[0]}",
+    ))
+    results.append(ValidationResult(
+        name="ids_preservados",
+        passed=prod[1] == stg[1],
+        details=f"soma_ids_producao={prod[1]:.0f}, soma_ids_staging={stg[1]:.0f}",
+    ))
+
+    converted = [p.name for p in plans if p.new_type in ("REAL", "INTEGER") and not p.pk]
+    worst = []
+    for name in converted:
+        s = stats.get(name)
+        if s and s["non_null"]:
+            ratio = s["discarded"] / s["non_null"]
+            if ratio > max_discard_ratio:
+                worst.append(f"{name}={ratio:.2%}")
+    results.append(ValidationResult(
+        name="valores_descartados",
+        passed=not worst,
+        details=("colunas acima do limite: " + ", ".join(worst)) if worst
+        else f"{len(converted)} colunas numéricas, descarte <= {max_discard_ratio:.2%}",
+    ))
+    return results
+
+
+def backup_database(db_path: Path, backup_dir: Path) -> Path:
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_file = backup_dir / f"damodaran_data_new_backup_{ts}.db"
+    shutil.copy2(db_path, backup_file)
+    return backup_file
+
+
+def create_covering_indexes(conn: sqlite3.Connection, commit: bool = True) -> list[str]:
+    """Cria os índices de cobertura cujas colunas existem na tabela.
+
+    Com commit=False roda dentro da transação do chamador (ex.: troca da
+    tabela em extract_global_damodaran).
+    """
+    existing = {r[1] for r in conn.execute(f"PRAGMA table_info({TABLE})")}
+    created = []
+    for idx_name, cols in COVERING_INDEXES.items():
+        if cols[0] not in existing:
+            continue
+        cols = [c for c in cols if c in existing]
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON {TABLE}(" + ", ".join(cols) + ")")
+        created.append(idx_name)
+    conn.execute(f"ANALYZE {TABLE}")
+    if commit:
+        conn.commit()
+    return created
+
+
+def swap_tables(conn: sqlite3.Connection, drop_backup_table: bool) -> tuple[str, list[str]]:
+    """Troca a tabela pela staging numa transação; devolve (backup, índices de cobertura).
+
+    Índices e triggers acompanham a tabela renomeada para o backup. Os índices
+    são recriados na nova; os triggers do backup (damodaran_fts_*) são
+    removidos — senão editar o backup mexeria no índice de busca — e o
+    `build_search_index` os recria na nova tabela e repopula o FTS.
+    """
+    backup_table = f"damodaran_global_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    index_sql = [
+        (name, sql) for name, sql in conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (TABLE,),
+        )
+    ]
+    # Não reescrever referências de views/triggers/FKs para a tabela de backup
+    if conn.in_transaction:
+        conn.commit()  # staging já carregada
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(f"ALTER TABLE {TABLE} RENAME TO {backup_table}")
+        triggers = [r[0] for r in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (backup_table,))]
+        for name in triggers:
+            cur.execute(f'DROP TRIGGER "{name}"')
+        # Os índices acompanham a tabela renomeada; recriá-los na nova
+        for name, _ in index_sql:
+            cur.execute(f'DROP INDEX IF EXISTS "{name}"')
+        cur.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO {TABLE}")
+        for _, sql in index_sql:
+            cur.execute(sql)
+        covering = create_covering_indexes(conn, commit=False)
+        if drop_backup_table:
+            cur.execute(f"DROP TABLE {backup_table}")
+        # Triggers do FTS ausentes: recria e repopula (faz o commit)
+        build_search_index(conn, rebuild=False)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+    return backup_table, covering
+
+
+def is_typed(conn: sqlite3.Connection) -> bool:
+    """True se market_cap/beta já têm afinidade numérica."""
+    types = {r[1]: _affinity(r[2]) for r in conn.execute(f"PRAGMA table_info({TABLE})")}
+    return all(types.get(c) in ("REAL", "INTEGER", "NUMERIC") for c in ("market_cap", "beta") if c in types)
+
+
+def write_report(report_path: Path, payload: dict) -> None:
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Migração: colunas numéricas tipadas + índices de cobertura na damodaran_global"
+    )
+    parser.add_argument("--db-path", default="data/damodaran_data_new.db")
+    parser.add_argument("--execute", action="store_true", help="Executa swap final (sem isso roda como dry-run)")
+    parser.add_argument("--force", action="store_true", help="Ignora validações e força swap")
+    parser.add_argument("--indexes-only", action="store_true", help="Só cria os índices de cobertura")
+    parser.add_argument("--drop-backup-table", action="store_true",
+                        help="Remove a tabela de backup lógico após o swap (o backup físico é mantido)")
+    parser.add_argument("--min-numeric-ratio", type=float, default=0.99,
+                        help="Fração mínima de valores numéricos para converter uma coluna TEXT")
+    parser.add_argument("--max-discard-ratio", type=float, default=0.01,
+                        help="Fração máxima de valores não numéricos descartados por coluna")
+    parser.add_argument("--backup-dir", default="backups")
+    parser.add_argument("--report-path", default="cache/migration_typed_damodaran_global_report.json")
+    args = parser.parse_args()
+
+    db_path = Path(args.db_path)
+    if not db_path.exists():
+        raise FileNotFoundError(f"Banco não encontrado: {db_path}")
+
+    conn = sqlite3.connect(db_path)
+    try:
+        if args.indexes_only:
+            created = create_covering_indexes(conn)
+            print(f"✅ Índices de cobertura: {', '.join(created)}")
+            return
+
+        print("=" * 70)
+        print("  MIGRAÇÃO: damodaran_global tipada (REAL/INTEGER)")
+        print("=" * 70)
+        print(f"  Banco: {db_path}")
+        print(f"  Modo:  {'EXECUÇÃO' if args.execute else 'DRY-RUN (seguro)'}")
+        print("=" * 70)
+
+        print("\n🔎 Classificando colunas...")
+        plans, stats = plan_columns(conn, args.min_numeric_ratio)
+        changed = [p for p in plans if (p.old_type or "").upper() != (p.new_type or "").upper()]
+        for p in changed:
+            s = stats.get(p.name, {})
+            print(f"   {p.name}: {p.old_type or '(sem tipo)'} → {p.new_type}"
+                  f"  (descartados: {s.get('discarded', 0)})")
+        kept_text = [n for n, s in stats.items()
+                     if s["non_null"] and not any(p.name == n and p.new_type in ("REAL", "INTEGER") for p in plans)]
+        if kept_text:
+            print(f"   Mantidas como texto (conteúdo não numérico): {', '.join(kept_text)}")
+
+        print("\n🧪 Criando staging e copiando dados...")
+        create_staging_table(conn, plans)
+        copied = copy_rows(conn, plans)
+        print(f"   Staging pronta: {copied:,} linhas")
+
+        validations = run_validations(conn, plans, stats, args.max_discard_ratio)
+        all_passed = all(v.passed for v in validations)
+        print("\n✅ Validações:")
+        for item in validations:
+            status = "PASS" if item.passed else "FAIL"
+            print(f"   [{status}] {item.name}: {item.details}")
+
+        report_payload = {
+            "timestamp": datetime.now().isoformat(),
+            "db_path": str(db_path),
+            "dry_run": not args.execute,
+            "columns": [
+                {"name": p.name, "old_type": p.old_type, "new_type": p.new_type, **stats.get(p.name, {})}
+                for p in plans
+            ],
+            "validations": [
+                {"name": v.name, "passed": v.passed, "details": v.details}
+                for v in validations
+            ],
+            "all_passed": all_passed,
+        }
+
+        if not args.execute or (not all_passed and not args.force):
+            if args.execute:
+                print("\n❌ Validações falharam. Swap abortado (use --force se quiser assumir o risco).")
+            else:
+                print("\n🛡️ Dry-run concluído. Nenhuma troca de tabela foi executada.")
+                print("   Para executar de fato, use: --execute")
+            conn.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+            conn.commit()
+            write_report(Path(args.report_path), report_payload)
+            print(f"📝 Relatório salvo em: {args.report_path}")
+            return
+
+        print("\n💾 Gerando backup físico do banco...")
+        backup_file = backup_database(db_path, Path(args.backup_dir))
+        print(f"   Backup criado: {backup_file}")
+
+        print("🔁 Executando swap atômico de tabelas (+ índices de cobertura, ANALYZE e FTS)...")
+        backup_table, created = swap_tables(conn, args.drop_backup_table)
+        print(f"   Swap concluído. Backup lógico: {backup_table}"
+              + (" (removido)" if args.drop_backup_table else ""))
+        print(f"   Índices de cobertura: {', '.join(created)}")
+
+        report_payload["backup_file"] = str(backup_file)
+        report_payload["backup_table"] = backup_table
+        report_payload["indexes"] = created
+        write_report(Path(args.report_path), report_payload)
+        print(f"\n✅ Migração concluída. 📝 Relatório salvo em: {args.report_path}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
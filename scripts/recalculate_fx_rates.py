@@ -4,70 +4,56 @@ Recalcula taxas de câmbio históricas e campos USD no banco de dados.
 Não precisa buscar dados do Yahoo Finance novamente — apenas atualiza
 fx_rate_to_usd e os campos *_usd usando taxas históricas por período.
 
+As séries de câmbio vêm da tabela fx_daily (atualizada incrementalmente,
+ver scripts/fx_daily.py) e a taxa de cada registro é resolvida com um único
+merge as-of por moeda, em vez de uma busca por linha.
+
 Uso:
-    python scripts/recalculate_fx_rates.py [--dry-run] [--sector "Energy"]
+    python scripts/recalculate_fx_rates.py [--dry-run] [--sector "Energy"] [--no-refresh]
 """
 
+import os
+import sys
 import sqlite3
 import logging
 import argparse
-import time
 from pathlib import Path
 
-import yfinance as yf
 import pandas as pd
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.fx_daily import ensure_fx_table, load_fx_series, rates_for_dates, refresh_fx_daily
+from scripts.job_progress import reporter
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
                     datefmt="%H:%M:%S")
 log = logging.getLogger(__name__)
 
 DB_PATH = Path(__file__).resolve().parent.parent / "data" / "damodaran_data_new.db"
 
-# Cache de séries FX
-_fx_cache: dict[str, pd.DataFrame] = {}
-
-
-def _get_fx_series(currency: str) -> pd.DataFrame:
-    """Busca série histórica FX para USD via yfinance."""
-    if currency in _fx_cache:
-        return _fx_cache[currency]
-    try:
-        pair = f"{currency}USD=X"
-        log.info(f"Buscando série FX: {pair}")
-        ticker = yf.Ticker(pair)
-        hist = ticker.history(period="10y", interval="1d")
-        if hist.empty:
-            log.warning(f"Sem cotação histórica para {pair}")
-            hist = pd.DataFrame()
-    except Exception as e:
-        log.warning(f"Erro buscando FX {currency}: {e}")
-        hist = pd.DataFrame()
-    _fx_cache[currency] = hist
-    return hist
-
-
-def _get_fx_rate_for_date(fx_hist: pd.DataFrame, date_str: str) -> float:
-    """Retorna taxa FX mais próxima da data informada."""
-    if fx_hist.empty:
-        return 1.0
-    tz = fx_hist.index.tz
-    pd_date = pd.Timestamp(date_str)
-    if tz is not None:
-        pd_date = pd_date.tz_localize(tz)
-    closest_idx = fx_hist.index.get_indexer([pd_date], method="nearest")[0]
-    if 0 <= closest_idx < len(fx_hist):
-        return float(fx_hist.iloc[closest_idx]["Close"])
-    return 1.0
+
+def compute_new_rates(conn, rows: pd.DataFrame) -> pd.Series:
+    """Taxa FX de cada registro (um merge as-of por moeda)."""
+    new_rates = pd.Series(1.0, index=rows.index)
+    for currency, grp in rows.groupby("original_currency", sort=False):
+        series = load_fx_series(conn, currency)
+        new_rates[grp.index] = rates_for_dates(series, grp["period_date"]).to_numpy()
+    return new_rates
 
 
 def main():
     parser = argparse.ArgumentParser(description="Recalcula FX rates históricas")
     parser.add_argument("--dry-run", action="store_true", help="Apenas mostra o que seria feito")
     parser.add_argument("--sector", type=str, help="Filtrar por setor")
+    parser.add_argument("--no-refresh", action="store_true",
+                        help="Não baixa cotações novas (usa só o que já está em fx_daily)")
+    parser.add_argument("--db", type=str, default=None, help="Caminho do banco")
     args = parser.parse_args()
 
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row
+    db_path = Path(args.db) if args.db else DB_PATH
+    conn = sqlite3.connect(str(db_path), timeout=60)
+    ensure_fx_table(conn)
 
     # Buscar moedas únicas que precisam de conversão
     sector_filter = ""
@@ -80,53 +66,49 @@ def main():
         """
         params.append(args.sector)
 
-    cur = conn.execute(f"""
-        SELECT DISTINCT original_currency
+    # Buscar registros que precisam de atualização
+    rows = pd.read_sql_query(f"""
+        SELECT id, original_currency, period_date, fx_rate_to_usd
         FROM company_financials_historical h
         WHERE original_currency IS NOT NULL
           AND original_currency != 'USD'
           {sector_filter}
-    """, params)
+    """, conn, params=params)
 
-    currencies = [r[0] for r in cur.fetchall()]
+    currencies = rows["original_currency"].unique().tolist()
     log.info(f"Moedas a processar: {len(currencies)} ({', '.join(currencies[:10])}{'...' if len(currencies) > 10 else ''})")
 
-    # Pré-carregar séries FX para todas as moedas
-    for currency in currencies:
-        _get_fx_series(currency)
-        time.sleep(0.5)  # Respeitar rate limit
-
-    # Buscar registros que precisam de atualização
-    cur = conn.execute(f"""
-        SELECT id, original_currency, period_date,
-               total_revenue, ebit, ebitda, net_income,
-               free_cash_flow, enterprise_value_estimated,
-               fx_rate_to_usd
-        FROM company_financials_historical h
-        WHERE original_currency IS NOT NULL
-          AND original_currency != 'USD'
-          {sector_filter}
-    """, params)
+    # Atualizar séries FX (só o trecho novo de cada moeda)
+    if not args.no_refresh:
+        refresh_fx_daily(conn, currencies)
 
-    rows = cur.fetchall()
     total = len(rows)
     log.info(f"Registros para atualizar: {total}")
+    progress = reporter()
+    progress.done(total=total, phase="Recalculando taxas FX...")
+    if not total:
+        conn.close()
+        return
+
+    new_rate = compute_new_rates(conn, rows)
+    old_rate = rows["fx_rate_to_usd"].astype(float).fillna(0.0)
+    old_rate = old_rate.where(old_rate != 0, 1.0)
+
+    # Só atualiza se a taxa mudou significativamente (>0.01%)
+    changed = ((new_rate - old_rate).abs() / old_rate.clip(lower=0.0001)) >= 0.0001
 
     if args.dry_run:
         # Mostrar amostra
-        sample = rows[:5]
-        for r in sample:
-            fx_hist = _fx_cache.get(r["original_currency"], pd.DataFrame())
-            new_rate = _get_fx_rate_for_date(fx_hist, r["period_date"])
-            old_rate = r["fx_rate_to_usd"] or 1.0
-            log.info(f"  {r['original_currency']} {r['period_date']}: "
-                     f"taxa antiga={old_rate:.4f} -> nova={new_rate:.4f} "
-                     f"(delta={((new_rate/old_rate)-1)*100:+.1f}%)")
+        for i in rows.index[:5]:
+            log.info(f"  {rows.at[i, 'original_currency']} {rows.at[i, 'period_date']}: "
+                     f"taxa antiga={old_rate[i]:.4f} -> nova={new_rate[i]:.4f} "
+                     f"(delta={((new_rate[i]/old_rate[i])-1)*100:+.1f}%)")
+        log.info(f"Seriam atualizados: {int(changed.sum())} | Sem mudança: {int((~changed).sum())}")
         log.info("Dry run - nenhuma alteração feita.")
         conn.close()
         return
 
-    # Atualizar em batch
+    # Atualizar em um único passe
     update_sql = """
         UPDATE company_financials_historical
         SET fx_rate_to_usd = ?,
@@ -138,44 +120,18 @@ def main():
             enterprise_value_usd = enterprise_value_estimated * ?
         WHERE id = ?
     """
+    ids = rows.loc[changed, "id"].tolist()
+    rates = new_rate[changed].tolist()
+    conn.executemany(update_sql, ((r, r, r, r, r, r, r, int(i)) for r, i in zip(rates, ids)))
+    conn.commit()
 
-    updated = 0
-    unchanged = 0
-    batch = []
-    batch_size = 1000
-
-    for i, r in enumerate(rows):
-        fx_hist = _fx_cache.get(r["original_currency"], pd.DataFrame())
-        new_rate = _get_fx_rate_for_date(fx_hist, r["period_date"])
-        old_rate = r["fx_rate_to_usd"] or 1.0
-
-        # Só atualiza se a taxa mudou significativamente (>0.01%)
-        if abs(new_rate - old_rate) / max(old_rate, 0.0001) < 0.0001:
-            unchanged += 1
-            continue
-
-        batch.append((new_rate, new_rate, new_rate, new_rate, new_rate, new_rate, new_rate, r["id"]))
-        updated += 1
-
-        if len(batch) >= batch_size:
-            conn.executemany(update_sql, batch)
-            conn.commit()
-            batch = []
-
-        if (i + 1) % 10000 == 0:
-            log.info(f"  Progresso: {i+1}/{total} ({(i+1)*100//total}%) | "
-                     f"Atualizados: {updated} | Sem mudança: {unchanged}")
-
-    # Flush batch restante
-    if batch:
-        conn.executemany(update_sql, batch)
-        conn.commit()
-
+    updated = len(ids)
+    progress.done(current=total, success=updated, phase="Concluído")
     log.info("=" * 60)
     log.info(f"CONCLUÍDO")
     log.info(f"  Total registros: {total}")
     log.info(f"  Atualizados: {updated}")
-    log.info(f"  Sem mudança: {unchanged}")
+    log.info(f"  Sem mudança: {total - updated}")
     log.info("=" * 60)
 
     conn.close()
@@ -25,7 +25,7 @@ def _clamp(numerator, denominator, limit=100):
 
 
 def recalculate(db_path=DB):
-    conn = sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(str(db_path), timeout=60)
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
 
@@ -137,12 +137,12 @@ def recalculate(db_path=DB):
     print("\nRe-executando validação de consistência...")
     try:
         from scripts.validate_data_consistency import run_validation, update_data_quality
-        conn = sqlite3.connect(str(db_path))
+        conn = sqlite3.connect(str(db_path), timeout=60)
         conn.row_factory = sqlite3.Row
         results = run_validation(conn)
         conn.close()
-        conn2 = sqlite3.connect(str(db_path))
-        update_data_quality(conn2, results)
+        conn2 = sqlite3.connect(str(db_path), timeout=60)
+        update_data_quality(conn2)
         conn2.close()
         crit = sum(1 for r in results["issues"] if r["severity"] == "critical")
         warn = sum(1 for r in results["issues"] if r["severity"] == "warning")
@@ -1,10 +1,12 @@
 """
 Versão MULTITHREADED do update_company_data_from_yahoo.py
 
-Usa ThreadPoolExecutor para fazer chamadas Yahoo em paralelo (I/O bound),
-enquanto um único thread principal escreve no banco SQLite (sem conflito de locks).
+Usa o YahooFetchEngine (scripts/yahoo_fetch_engine.py) para fazer chamadas
+Yahoo em paralelo (I/O bound), enquanto um único thread principal escreve no
+banco SQLite (sem conflito de locks).
 
-Detecta rate-limit do Yahoo e pausa automaticamente para esperar o desbloqueio.
+Rate-limit do Yahoo é tratado pelo motor: concorrência e taxa se ajustam
+sozinhas e o circuit breaker segura as requisições até o desbloqueio.
 
 Uso:
     python scripts/update_company_data_from_yahoo_fast.py --workers 4 --limit 50000
@@ -18,10 +20,11 @@ import sqlite3
 import sys
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
 from pathlib import Path
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
 # Fix SSL para caminhos com espaços (OneDrive)
 _cacert = Path(r"C:\cacerts\cacert.pem")
 if _cacert.exists() and "CURL_CA_BUNDLE" not in os.environ:
@@ -31,32 +34,13 @@ import yfinance as yf
 from yfinance.exceptions import YFRateLimitError
 from yfinance.data import YfData
 
+from scripts.job_progress import reporter
+from scripts.yahoo_fetch_engine import RATE_LIMITED, TIMEOUT, YahooFetchEngine
+
 # ---------------------------------------------------------------------------
-# Rate limiter thread-safe
+# Sessão yfinance (taxa/concorrência ficam no YahooFetchEngine)
 # ---------------------------------------------------------------------------
 
-class RateLimiter:
-    """Limita número máximo de chamadas por segundo entre múltiplas threads."""
-
-    def __init__(self, max_per_second: float):
-        self._min_interval = 1.0 / max_per_second
-        self._lock = threading.Lock()
-        self._last_call = 0.0
-
-    def acquire(self) -> None:
-        with self._lock:
-            now = time.monotonic()
-            wait = self._min_interval - (now - self._last_call)
-            if wait > 0:
-                time.sleep(wait)
-            self._last_call = time.monotonic()
-
-
-_rate_limiter: RateLimiter | None = None
-
-# Flag global para sinalizar rate-limit a todas as threads
-_rate_limited = threading.Event()
-_RATE_LIMIT_PAUSE = 300  # 5 minutos
 _reset_lock = threading.Lock()
 
 
@@ -71,25 +55,13 @@ def _reset_yf_session() -> None:
 # Funções de busca Yahoo (thread-safe, sem acesso ao banco)
 # ---------------------------------------------------------------------------
 
-def _wait_if_rate_limited() -> None:
-    """Se rate-limit foi detectado, espera todas as threads pausarem."""
-    if _rate_limited.is_set():
-        _rate_limited.wait()  # bloqueia até o event ser cleared
-
-# ---------------------------------------------------------------------------
-# Funções de busca Yahoo (thread-safe, sem acesso ao banco)
-# ---------------------------------------------------------------------------
-
 def fetch_data_from_yahoo(yahoo_code: str) -> dict | None:
     """Busca dados de uma empresa no Yahoo Finance."""
-    _wait_if_rate_limited()
-    if _rate_limiter:
-        _rate_limiter.acquire()
     try:
         ticker = yf.Ticker(yahoo_code)
         info = ticker.get_info()
     except YFRateLimitError:
-        return "RATE_LIMITED"  # type: ignore[return-value]
+        return RATE_LIMITED  # type: ignore[return-value]
     except Exception:
         return None
 
@@ -243,9 +215,9 @@ def main() -> None:
     parser.add_argument("--db-path", default="data/damodaran_data_new.db")
     parser.add_argument("--limit", type=int, default=50000)
     parser.add_argument("--workers", type=int, default=8,
-                        help="Número de threads paralelas para chamadas Yahoo (padrão: 8)")
+                        help="Concorrência máxima de chamadas Yahoo (padrão: 8)")
     parser.add_argument("--max-rps", type=float, default=5.0,
-                        help="Máximo de requisições por segundo (padrão: 5)")
+                        help="Teto de requisições por segundo (padrão: 5)")
     parser.add_argument("--exchanges", type=str, default="")
     parser.add_argument("--sector", type=str, default="", help="Filtrar por Yahoo sector")
     parser.add_argument("--industry", type=str, default="", help="Filtrar por Yahoo industry")
@@ -263,9 +235,6 @@ def main() -> None:
     conn = sqlite3.connect(db_path, timeout=60)
     conn.execute("PRAGMA journal_mode=WAL")
 
-    global _rate_limiter
-    _rate_limiter = RateLimiter(args.max_rps)
-
     exchanges = [x.strip() for x in args.exchanges.split(",") if x.strip()] if args.exchanges else None
     extra_filters = {}
     if args.sector:
@@ -276,11 +245,14 @@ def main() -> None:
         extra_filters["country"] = args.country
     rows = fetch_candidates(conn, args.limit, exchanges, args.force, extra_filters)
 
+    progress = reporter()
     if not rows:
         print("Nenhum registro elegível.")
+        progress.done(phase="Nenhum registro elegível")
         return
 
     total = len(rows)
+    progress.done(total=total, phase="Atualizando dados do Yahoo...")
     print(f"Registros a processar: {total}")
     print(f"Workers: {args.workers}")
     print(f"Data de referência: {dta_ref}")
@@ -291,75 +263,64 @@ def main() -> None:
     cursor = conn.cursor()
     updated = 0
     failed = 0
-    rate_pauses = 0
     t0 = time.time()
 
-    # Processar em batches para dar feedback e commitar
-    batch_size = args.workers * 5
-    idx = 0
-    while idx < total:
-        batch = rows[idx : idx + batch_size]
-        retry_rows: list[tuple[int, str | None, str | None, str | None]] = []
-        hit_rate_limit = False
-
-        with ThreadPoolExecutor(max_workers=args.workers) as pool:
-            futures = {pool.submit(fetch_one, row): row for row in batch}
-
-            for future in as_completed(futures):
-                row_id, data = future.result()
-                if data == "RATE_LIMITED":
-                    hit_rate_limit = True
-                    retry_rows.append(futures[future])
-                elif data and isinstance(data, dict):
-                    apply_update(cursor, row_id, data, dta_ref)
-                    updated += 1
-                else:
-                    failed += 1
-
-        conn.commit()
+    # Motor adaptativo: concorrência AIMD + token bucket + circuit breaker.
+    # Linhas com rate-limit voltam ao início da fila; ao abrir o circuito a
+    # sessão do yfinance é resetada.
+    engine = YahooFetchEngine(
+        fetch_one,
+        max_concurrency=args.workers,
+        max_rps=args.max_rps,
+        is_rate_limited=lambda r: r[1] == RATE_LIMITED,
+        is_success=lambda r: isinstance(r[1], dict) and bool(r[1]),  # None = sem dados/erro
+        on_open=_reset_yf_session,
+        request_timeout=120,
+    )
 
-        if hit_rate_limit:
-            rate_pauses += 1
-            pause = _RATE_LIMIT_PAUSE * min(rate_pauses, 3)  # max 15min
-            print(
-                f"\n  ⚠ RATE LIMITED! Pausa de {pause//60}min... "
-                f"(pausa #{rate_pauses}) — progresso salvo.",
-                flush=True,
-            )
-            time.sleep(pause)
-            _reset_yf_session()
-            print("  ↻ Sessão resetada, retomando...", flush=True)
-            # Re-inserir rows que falharam por rate-limit no início da fila
-            remaining_rows = retry_rows + rows[idx + batch_size:]
-            rows = rows[:idx] + remaining_rows  # manter processados + retry + restante  
-            total = len(rows)
-            # Não avançar idx - retry do batch
-            continue
+    # Commit + feedback a cada bloco de resultados
+    batch_size = args.workers * 5
+    done = 0
+    for row, result in engine.run(rows):
+        done += 1
+        if result is TIMEOUT or isinstance(result, Exception):
+            failed += 1
         else:
-            # Reset rate_pauses counter após batch sem bloqueio
-            if rate_pauses > 0:
-                rate_pauses = 0
+            row_id, data = result
+            if data and isinstance(data, dict):
+                apply_update(cursor, row_id, data, dta_ref)
+                updated += 1
+            else:
+                failed += 1
+
+        progress.update(current=done, success=updated, errors=failed)
+        if done % batch_size and done != total:
+            continue
 
-        idx += len(batch)
+        conn.commit()
         elapsed = time.time() - t0
-        rate = idx / elapsed if elapsed > 0 else 0
-        remaining = (total - idx) / rate if rate > 0 else 0
+        rate = done / elapsed if elapsed > 0 else 0
+        remaining = (total - done) / rate if rate > 0 else 0
         print(
-            f"  [{idx:,}/{total:,}] "
+            f"  [{done:,}/{total:,}] "
             f"ok={updated:,} fail={failed:,} | "
             f"{rate:.1f}/s | "
-            f"ETA {remaining/60:.0f}min",
+            f"ETA {remaining/60:.0f}min | "
+            f"{engine.describe()}",
             flush=True,
         )
 
     conn.commit()
     elapsed = time.time() - t0
+    progress.done(current=done, success=updated, errors=failed, phase="Concluído")
 
     print()
     print(f"=== CONCLUÍDO em {elapsed/60:.1f} minutos ===")
     print(f"Atualizados: {updated:,}")
     print(f"Sem dados: {failed:,}")
     print(f"Taxa média: {total/elapsed:.1f}/s")
+    engine_stats = engine.stats()
+    print(f"Rate limits: {engine_stats['throttled']:,} | aberturas do circuito: {engine_stats['circuit_opens']}")
 
     # Resumo
     stats = conn.execute("""
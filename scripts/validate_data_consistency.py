@@ -10,6 +10,7 @@ Uso:
 
 Opções:
     --fix     : Atualiza o campo data_quality no banco com os problemas encontrados
+    --changed-only : com --fix, reavalia só os registros alterados desde a última execução
     --report  : Exibe relatório resumido no console
     --csv     : Gera CSV com todos os registros problemáticos em cache/
 """
@@ -18,6 +19,7 @@ import argparse
 import csv
 import json
 import os
+import re
 import sqlite3
 import sys
 from datetime import datetime
@@ -418,38 +420,178 @@ def run_validation(conn):
     return results
 
 
-def update_data_quality(conn, results):
-    """Atualiza o campo data_quality no banco com base nos problemas encontrados."""
-    cur = conn.cursor()
-
-    # Primeiro, resetar todos para 'ok'
-    cur.execute("UPDATE company_financials_historical SET data_quality = 'ok'")
-
-    # Agrupar issues por record_id, priorizando por severidade
-    severity_order = {'critical': 0, 'warning': 1, 'info': 2}
-    record_issues = {}
-    for issue in results['issues']:
-        rid = issue['record_id']
-        if rid not in record_issues:
-            record_issues[rid] = []
-        record_issues[rid].append(issue)
-
-    # Atualizar cada registro com o problema mais grave
-    for rid, issues in record_issues.items():
-        issues.sort(key=lambda x: severity_order.get(x['severity'], 9))
-        worst = issues[0]
-        # Formato: "severity:RULE_ID[,RULE_ID2,...]"
-        rule_ids = ','.join(sorted(set(i['rule_id'] for i in issues)))
-        quality = f"{worst['severity']}:{rule_ids}"
-        cur.execute(
-            "UPDATE company_financials_historical SET data_quality = ? WHERE id = ?",
-            (quality, rid)
+# ─────────────────────────────────────────────────────────────────────────────
+# Motor set-based do data_quality
+# ─────────────────────────────────────────────────────────────────────────────
+#
+# update_data_quality() não materializa issues: cada regra vira uma coluna
+# 0/1 de um único SELECT por period_type, o data_quality
+# ("severidade:REGRA[,REGRA2...]" ou 'ok') é montado em SQL numa tabela
+# temporária e aplicado com um UPDATE ... FROM. Só linhas cujo valor muda
+# são escritas.
+#
+# Modo incremental (changed_only=True): triggers mantêm
+# company_financials_historical.row_version (maior versão + 1 a cada INSERT
+# ou UPDATE de dados) e data_quality_state guarda a versão já validada —
+# só as linhas novas/alteradas desde a última execução são reavaliadas.
+
+SEVERITY_ORDER = ('critical', 'warning', 'info')
+STATE_TABLE = 'data_quality_state'
+_ROW_VERSION_TRIGGERS = {
+    'cfh_row_version_ai': """
+        CREATE TRIGGER cfh_row_version_ai AFTER INSERT ON company_financials_historical
+        BEGIN
+            UPDATE company_financials_historical
+            SET row_version = (SELECT COALESCE(MAX(row_version), 0) + 1 FROM company_financials_historical)
+            WHERE id = new.id;
+        END
+    """,
+    # Não dispara para a escrita do próprio data_quality nem para o ajuste de row_version
+    'cfh_row_version_au': """
+        CREATE TRIGGER cfh_row_version_au AFTER UPDATE ON company_financials_historical
+        WHEN new.row_version IS old.row_version AND new.data_quality IS old.data_quality
+        BEGIN
+            UPDATE company_financials_historical
+            SET row_version = (SELECT COALESCE(MAX(row_version), 0) + 1 FROM company_financials_historical)
+            WHERE id = new.id;
+        END
+    """,
+}
+_RULE_WHERE = re.compile(r"WHERE\s+period_type\s*=\s*'(\w+)'\s+AND\s+(.*)$", re.S | re.I)
+
+
+def _rule_predicates():
+    """{period_type: [(rule, predicado SQL), ...]} a partir do SQL de RULES."""
+    grouped = {}
+    for rule in RULES:
+        m = _RULE_WHERE.search(rule['sql'])
+        if not m:
+            raise ValueError(f"Regra {rule['id']}: SQL sem 'WHERE period_type = ... AND'")
+        grouped.setdefault(m.group(1), []).append((rule, ' '.join(m.group(2).split())))
+    return grouped
+
+
+def _quality_expr(rules):
+    """Expressão SQL do data_quality sobre as colunas r0..rN (0/1) das regras."""
+    severity = ' '.join(
+        f"WHEN {' OR '.join(f'r{i}' for i, (rule, _) in enumerate(rules) if rule['severity'] == sev)} THEN '{sev}'"
+        for sev in SEVERITY_ORDER if any(rule['severity'] == sev for rule, _ in rules)
+    )
+    ids = ' || '.join(f"CASE WHEN r{i} THEN '{rule['id']},' ELSE '' END"
+                      for i, (rule, _) in sorted(enumerate(rules), key=lambda x: x[1][0]['id']))
+    return f"CASE {severity} ELSE NULL END || ':' || RTRIM({ids}, ',')"
+
+
+def ensure_row_versioning(conn):
+    """Cria row_version, índice e triggers se faltarem. True se algo foi criado."""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(company_financials_historical)")}
+    triggers = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    created = False
+    if 'row_version' not in cols:
+        conn.execute("ALTER TABLE company_financials_historical ADD COLUMN row_version INTEGER")
+        created = True
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cfh_row_version ON company_financials_historical(row_version)")
+    for name, ddl in _ROW_VERSION_TRIGGERS.items():
+        if name not in triggers:
+            conn.execute(ddl)
+            created = True
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            scope TEXT PRIMARY KEY,
+            last_version INTEGER NOT NULL,
+            validated_at TEXT NOT NULL
         )
-
-    conn.commit()
-    updated = len(record_issues)
-    print(f"  ✅ Atualizados {updated} registros no campo data_quality")
-    return updated
+    """)
+    return created
+
+
+def apply_data_quality(conn, changed_only=False):
+    """Recalcula data_quality com o motor set-based. Retorna estatísticas.
+
+    Com changed_only=True só reavalia linhas com row_version maior que a da
+    última execução; cai para a varredura completa se o versionamento acabou
+    de ser criado (ou a tabela foi recriada e perdeu os triggers).
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        full = ensure_row_versioning(conn) or not changed_only
+        last = None
+        if not full:
+            row = conn.execute(f"SELECT last_version FROM {STATE_TABLE} WHERE scope = 'cfh'").fetchone()
+            last = row[0] if row else None
+            full = last is None
+        current = conn.execute(
+            "SELECT COALESCE(MAX(row_version), 0) FROM company_financials_historical").fetchone()[0]
+        scope_sql, scope_params = ("", []) if full else (" AND row_version > ?", [last])
+
+        conn.execute("DROP TABLE IF EXISTS temp._dq")
+        conn.execute("CREATE TEMP TABLE _dq (id INTEGER PRIMARY KEY, quality TEXT NOT NULL)")
+        skipped = []
+        grouped = _rule_predicates()
+        for period_type, rules in grouped.items():
+            usable = []
+            for rule, pred in rules:
+                try:  # regra quebrada (coluna ausente) não derruba as demais
+                    conn.execute(f"SELECT 1 FROM company_financials_historical WHERE {pred} LIMIT 0")
+                    usable.append((rule, pred))
+                except sqlite3.Error as e:
+                    print(f"  ERRO na regra {rule['id']}: {e}")
+                    skipped.append(rule['id'])
+            flags = ', '.join(f"CASE WHEN {pred} THEN 1 ELSE 0 END AS r{i}" for i, (_, pred) in enumerate(usable))
+            quality = f"COALESCE({_quality_expr(usable)}, 'ok')" if usable else "'ok'"
+            conn.execute(f"""
+                INSERT INTO _dq (id, quality)
+                SELECT id, {quality}
+                FROM (SELECT id{', ' + flags if flags else ''}
+                      FROM company_financials_historical
+                      WHERE period_type = ?{scope_sql})
+            """, [period_type] + scope_params)
+
+        # Períodos sem regras (ex.: quarterly) ficam 'ok'
+        placeholders = ','.join('?' * len(grouped))
+        conn.execute(f"""
+            INSERT INTO _dq (id, quality)
+            SELECT id, 'ok' FROM company_financials_historical
+            WHERE (period_type IS NULL OR period_type NOT IN ({placeholders})){scope_sql}
+        """, list(grouped) + scope_params)
+
+        written = conn.execute("""
+            UPDATE company_financials_historical SET data_quality = d.quality
+            FROM _dq AS d
+            WHERE company_financials_historical.id = d.id
+              AND company_financials_historical.data_quality IS NOT d.quality
+        """).rowcount
+        scanned, flagged = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(quality != 'ok'), 0) FROM _dq").fetchone()
+        conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE} (scope, last_version, validated_at) VALUES ('cfh', ?, ?)",
+                     (current, datetime.now().isoformat()))
+        conn.execute("DROP TABLE temp._dq")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return {'full': full, 'scanned': scanned, 'flagged': flagged, 'written': written,
+            'row_version': current, 'skipped_rules': skipped}
+
+
+def update_data_quality(conn, changed_only=False):
+    """Atualiza o campo data_quality no banco; retorna registros com problema no escopo."""
+    stats = apply_data_quality(conn, changed_only=changed_only)
+    scope = 'completa' if stats['full'] else 'incremental'
+    print(f"  ✅ Validação {scope}: {stats['scanned']} registros avaliados, "
+          f"{stats['flagged']} com problemas, {stats['written']} alterados no campo data_quality")
+    return stats['flagged']
+
+
+def refresh_data_quality(db_path, changed_only=True):
+    """Validação incremental após jobs de atualização (abre a própria conexão)."""
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    try:
+        return apply_data_quality(conn, changed_only=changed_only)
+    finally:
+        conn.close()
 
 
 def export_csv(results, output_dir='cache'):
@@ -563,6 +705,8 @@ def main():
     )
     parser.add_argument('--fix', action='store_true',
                         help='Atualizar campo data_quality no banco')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='Com --fix: reavaliar só registros alterados desde a última validação')
     parser.add_argument('--report', action='store_true',
                         help='Exibir relatório resumido')
     parser.add_argument('--csv', action='store_true',
@@ -575,18 +719,19 @@ def main():
     print(f"📊 Conectando ao banco: {DB_PATH}")
     conn = sqlite3.connect(DB_PATH)
 
-    print("🔍 Executando validações...")
-    results = run_validation(conn)
+    if args.report or args.csv:
+        print("🔍 Executando validações...")
+        results = run_validation(conn)
 
-    if args.report:
-        print_report(results)
+        if args.report:
+            print_report(results)
 
-    if args.csv:
-        export_csv(results)
+        if args.csv:
+            export_csv(results)
 
     if args.fix:
         print("💾 Atualizando data_quality no banco...")
-        update_data_quality(conn, results)
+        update_data_quality(conn, changed_only=args.changed_only)
 
     conn.close()
     print("✅ Concluído.")
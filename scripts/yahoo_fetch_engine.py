@@ -0,0 +1,368 @@
+"""
+yahoo_fetch_engine.py
+=====================
+Motor de busca compartilhado para chamadas ao Yahoo Finance com controle de
+taxa adaptativo. Usado por fetch_historical_financials.py e
+update_company_data_from_yahoo_fast.py.
+
+Em vez de RateLimiter fixo + lotes com pausas fixas (time.sleep) quando o
+Yahoo devolve 429, o motor ajusta-se ao que observa:
+
+- TokenBucket: limita requisições/segundo; a taxa sobe aos poucos a cada
+  sucesso e cai pela metade a cada rate-limit (AIMD na taxa).
+- AIMDLimiter: limite de concorrência (requisições em voo). Aumento aditivo
+  (+1 por "janela" de sucessos) e redução multiplicativa em rate-limit ou
+  quando a latência média passa de `latency_tolerance` × a menor latência
+  das últimas `baseline_window` respostas bem-sucedidas.
+- CircuitBreaker: após N rate-limits seguidos, abre o circuito (nenhuma
+  requisição sai) por um cooldown que dobra a cada reabertura; depois deixa
+  passar uma requisição de prova (half-open). Ao abrir, chama `on_open`
+  (reset de sessão/cookies do yfinance).
+
+Só respostas bem-sucedidas (`is_success`) alimentam os controles. Exceções e
+resultados vazios (ticker sem dados, erro rápido) são neutros: não contam
+como sinal de latência, não sobem a taxa e não fecham o circuito — uma falha
+rápida não pode virar a "latência normal" contra a qual as demais são medidas.
+
+Os itens são despachados continuamente (sem barreira de lote): o laço de
+controle roda na thread de quem itera `engine.run(items)` e os resultados
+são entregues na ordem de conclusão. Itens com rate-limit voltam ao início
+da fila até `max_retries`.
+
+O yfinance é bloqueante, então as requisições rodam em um pool de threads;
+o "assíncrono" aqui é o despacho desacoplado da conclusão.
+
+Uso:
+    engine = YahooFetchEngine(fetch_fn, max_concurrency=5, max_rps=4.0,
+                              is_rate_limited=lambda r: r == RATE_LIMITED,
+                              is_success=lambda r: r is not None)
+    for item, result in engine.run(items):
+        ...
+"""
+from __future__ import annotations
+
+import logging
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+log = logging.getLogger("yahoo_engine")
+
+# Sentinelas de resultado
+RATE_LIMITED = "RATE_LIMITED"
+TIMEOUT = "TIMEOUT"
+
+
+# --------------------------------------------------------------------------
+# Token bucket com taxa ajustável
+# --------------------------------------------------------------------------
+class TokenBucket:
+    """Token bucket não bloqueante: `try_acquire()` diz quanto esperar."""
+
+    def __init__(self, rate: float, capacity: float | None = None,
+                 min_rate: float = 0.1, max_rate: float | None = None,
+                 increase_step: float | None = None, decrease_factor: float = 0.5):
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.min_rate = min(min_rate, self.max_rate)
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        # Sem passo explícito: volta ao teto em ~50 sucessos seguidos
+        self.increase_step = increase_step if increase_step is not None else self.max_rate / 50
+        self.decrease_factor = decrease_factor
+        self._tokens = 1.0
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self) -> float:
+        """Consome um token e retorna 0, ou retorna os segundos até haver um."""
+        self._refill()
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self._tokens = min(self._tokens, 0.0)  # descarta rajada acumulada
+
+
+# --------------------------------------------------------------------------
+# Limite de concorrência AIMD (com sinal de latência)
+# --------------------------------------------------------------------------
+class AIMDLimiter:
+    """Limite de requisições em voo: aumento aditivo, redução multiplicativa."""
+
+    def __init__(self, initial: float, min_limit: float = 1.0, max_limit: float = 16.0,
+                 backoff: float = 0.5, latency_backoff: float = 0.9,
+                 latency_tolerance: float = 2.5, ewma_alpha: float = 0.2,
+                 baseline_window: int = 50):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = max(min_limit, min(initial, self.max_limit))
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.latency_tolerance = latency_tolerance
+        self.ewma_alpha = ewma_alpha
+        self.ewma_latency: float | None = None
+        # Linha de base = mínimo das últimas N latências (não o mínimo de sempre)
+        self._recent: deque = deque(maxlen=max(1, baseline_window))
+
+    @property
+    def slots(self) -> int:
+        return int(self.limit)
+
+    @property
+    def min_latency(self) -> float | None:
+        return min(self._recent) if self._recent else None
+
+    def on_success(self, latency: float):
+        """Resposta útil: atualiza a latência e ajusta o limite."""
+        self._recent.append(latency)
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency += self.ewma_alpha * (latency - self.ewma_latency)
+        if self.ewma_latency > self.latency_tolerance * max(self.min_latency, 0.05):
+            # Latência subindo = fila do lado do servidor: recua de leve
+            self.limit = max(self.min_limit, self.limit * self.latency_backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+
+# --------------------------------------------------------------------------
+# Circuit breaker
+# --------------------------------------------------------------------------
+class CircuitBreaker:
+    """closed → open (cooldown) → half_open (1 prova) → closed/open."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, base_cooldown: float = 30.0,
+                 max_cooldown: float = 900.0, on_open: Callable[[], None] | None = None):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.on_open = on_open
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.cooldown = base_cooldown
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe_in_flight = False
+
+    def wait_time(self) -> float:
+        """Segundos até poder despachar (0 = pode agora)."""
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            log.info("Circuito half-open: enviando requisição de prova")
+        if self.state == self.HALF_OPEN and self._probe_in_flight:
+            return 0.5
+        return 0.0
+
+    def on_dispatch(self):
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = True
+
+    def on_neutral(self):
+        """Resposta sem rate-limit mas sem dados: não fecha nem reabre o circuito.
+
+        Em half-open libera outra prova (senão o despacho esperaria para sempre).
+        """
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def on_success(self):
+        self.consecutive_failures = 0
+        if self.state == self.HALF_OPEN:
+            log.info("Circuito fechado: Yahoo respondendo normalmente")
+            self.cooldown = self.base_cooldown
+            self.state = self.CLOSED
+        # Em OPEN, respostas tardias de requisições antigas não fecham o circuito
+
+    def on_throttle(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self._open()
+        elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.opens += 1
+        self._probe_in_flight = False
+        log.warning(f"Rate limit! Circuito aberto por {self.cooldown:.0f}s (abertura #{self.opens})")
+        if self.on_open:
+            try:
+                self.on_open()
+            except Exception as e:
+                log.debug(f"on_open falhou: {e}")
+
+
+# --------------------------------------------------------------------------
+# Motor
+# --------------------------------------------------------------------------
+class YahooFetchEngine:
+    """Despacha `fetch_fn(item)` com concorrência/taxa adaptativas."""
+
+    def __init__(self, fetch_fn: Callable[[Any], Any], *,
+                 max_concurrency: int = 5,
+                 max_rps: float = 4.0,
+                 min_rps: float = 0.2,
+                 initial_concurrency: float | None = None,
+                 is_rate_limited: Callable[[Any], bool] | None = None,
+                 is_success: Callable[[Any], bool] | None = None,
+                 rate_limit_exceptions: tuple = (),
+                 on_open: Callable[[], None] | None = None,
+                 max_retries: int = 10,
+                 request_timeout: float | None = 120.0,
+                 failure_threshold: int = 3,
+                 base_cooldown: float = 30.0,
+                 max_cooldown: float = 900.0):
+        self.fetch_fn = fetch_fn
+        self.is_rate_limited = is_rate_limited or (lambda r: r == RATE_LIMITED)
+        self.is_success = is_success or (lambda r: r is not None)
+        self.rate_limit_exceptions = rate_limit_exceptions
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self.bucket = TokenBucket(max_rps, min_rate=min_rps, max_rate=max_rps)
+        self.limiter = AIMDLimiter(
+            initial_concurrency if initial_concurrency is not None else max(1.0, self.max_concurrency / 2),
+            max_limit=self.max_concurrency,
+        )
+        self.breaker = CircuitBreaker(failure_threshold, base_cooldown, max_cooldown, on_open=on_open)
+        self._stats = {"dispatched": 0, "completed": 0, "throttled": 0, "retried": 0,
+                       "gave_up": 0, "timeouts": 0, "failed": 0}
+
+    # -- worker ------------------------------------------------------------
+    def _call(self, seq: int, item, done: queue.Queue):
+        t0 = time.monotonic()
+        try:
+            result = self.fetch_fn(item)
+        except self.rate_limit_exceptions:
+            result = RATE_LIMITED
+        except Exception as e:  # erro do próprio fetch: entrega ao chamador
+            result = e
+        done.put((seq, item, result, time.monotonic() - t0))
+
+    # -- laço de controle --------------------------------------------------
+    def run(self, items: Iterable) -> Iterator[tuple[Any, Any]]:
+        """Gera (item, resultado) na ordem de conclusão.
+
+        `resultado` é o retorno de fetch_fn, a exceção levantada por ele,
+        TIMEOUT (requisição abandonada) ou o último resultado rate-limited
+        quando as tentativas se esgotam.
+        """
+        pending = deque((item, 0) for item in items)
+        done: queue.Queue = queue.Queue()
+        in_flight: dict[int, tuple[Any, int, float]] = {}
+        seq = 0
+        # Threads extras absorvem requisições abandonadas por timeout
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency * 2,
+                                  thread_name_prefix="yahoo")
+        try:
+            while pending or in_flight:
+                wait = 0.5
+                # 1) Despachar o quanto os controles permitirem
+                while pending and len(in_flight) < self.limiter.slots:
+                    wait_breaker = self.breaker.wait_time()
+                    if wait_breaker > 0:
+                        wait = min(wait, wait_breaker)
+                        break
+                    wait_bucket = self.bucket.try_acquire()
+                    if wait_bucket > 0:
+                        wait = min(wait, wait_bucket)
+                        break
+                    item, attempts = pending.popleft()
+                    seq += 1
+                    in_flight[seq] = (item, attempts, time.monotonic())
+                    self.breaker.on_dispatch()
+                    self._stats["dispatched"] += 1
+                    pool.submit(self._call, seq, item, done)
+                    if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                        break
+
+                # 2) Abandonar requisições travadas
+                if self.request_timeout:
+                    now = time.monotonic()
+                    for s, (item, _, started) in list(in_flight.items()):
+                        if now - started > self.request_timeout:
+                            del in_flight[s]
+                            self._stats["timeouts"] += 1
+                            yield item, TIMEOUT
+
+                if not in_flight:
+                    if pending:
+                        time.sleep(wait)
+                    continue
+
+                # 3) Coletar uma conclusão (ou acordar para despachar)
+                try:
+                    s, item, result, latency = done.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                entry = in_flight.pop(s, None)
+                if entry is None:
+                    continue  # resposta tardia de requisição abandonada
+                _, attempts, _ = entry
+                self._stats["completed"] += 1
+
+                if not isinstance(result, Exception) and self.is_rate_limited(result):
+                    self._stats["throttled"] += 1
+                    self.limiter.on_throttle()
+                    self.bucket.on_throttle()
+                    self.breaker.on_throttle()
+                    if attempts < self.max_retries:
+                        self._stats["retried"] += 1
+                        pending.appendleft((item, attempts + 1))
+                        continue
+                    self._stats["gave_up"] += 1
+                    yield item, result
+                    continue
+
+                if isinstance(result, Exception) or not self.is_success(result):
+                    # Falha sem rate-limit: neutra para os controles
+                    self._stats["failed"] += 1
+                    self.breaker.on_neutral()
+                    yield item, result
+                    continue
+
+                self.limiter.on_success(latency)
+                self.bucket.on_success()
+                self.breaker.on_success()
+                yield item, result
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return dict(
+            self._stats,
+            concurrency=round(self.limiter.limit, 2),
+            rps=round(self.bucket.rate, 2),
+            circuit=self.breaker.state,
+            circuit_opens=self.breaker.opens,
+            ewma_latency=round(self.limiter.ewma_latency, 3) if self.limiter.ewma_latency else None,
+        )
+
+    def describe(self) -> str:
+        s = self.stats()
+        return (f"conc={s['concurrency']:.1f} rps={s['rps']:.2f} "
+                f"429s={s['throttled']} circuito={s['circuit']}")
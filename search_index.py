@@ -0,0 +1,219 @@
+"""
+search_index.py — Índice FTS5 (tokenizer trigram) das buscas por texto.
+
+As buscas do app (autocomplete de empresas, drill-downs, histórico, lista de
+ETFs) usavam `col LIKE '%q%'`, que varre a tabela inteira a cada tecla. O
+tokenizer trigram do FTS5 indexa todas as sequências de 3 caracteres, então
+`MATCH '"q"'` encontra as mesmas substrings (sem diferenciar maiúsculas) pelo
+índice — e ainda fornece `bm25()` para ordenar por relevância.
+
+Tabelas (rowid = rowid da tabela de origem):
+  company_fts    ← company_basic_data (yahoo_code, ticker, company_name, about)
+  damodaran_fts  ← damodaran_global   (ticker, company_name)
+  etf_fts        ← etfs + etf_tags    (ticker, name, tags)
+
+São tabelas FTS5 com conteúdo próprio (não "external content"): os scripts
+do pipeline usam INSERT OR REPLACE e troca de tabelas, e um rowid órfão aqui
+só deixa de casar no JOIN em vez de corromper o índice. Triggers mantêm as
+tabelas em sincronia; quando um script recria a tabela de origem (os
+triggers somem junto), `search_index_ready()` passa a ser falso e as rotas
+voltam ao LIKE até o índice ser recriado:
+
+  python search_index.py [--db caminho]
+
+Termos com menos de 3 caracteres não formam trigramas: `fts_query()` devolve
+None e as rotas usam o LIKE antigo.
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import threading
+
+from result_cache import data_version
+
+MIN_QUERY_LENGTH = 3
+
+# (tabela FTS, tabela de origem, colunas indexadas)
+SOURCES = (
+    ("company_fts", "company_basic_data", ("yahoo_code", "ticker", "company_name", "about")),
+    ("damodaran_fts", "damodaran_global", ("ticker", "company_name")),
+)
+ETF_FTS = "etf_fts"
+ETF_COLUMNS = ("ticker", "name", "tags")
+FTS_TABLES = tuple(fts for fts, _, _ in SOURCES) + (ETF_FTS,)
+
+_ETF_TAGS_EXPR = "(SELECT group_concat(tag_value, ' | ') FROM etf_tags WHERE etf_ticker = {ticker})"
+
+
+def _source_triggers(fts: str, table: str, columns: tuple) -> dict[str, str]:
+    cols = ", ".join(columns)
+    new_vals = ", ".join(f"new.{c}" for c in columns)
+    upsert = f"INSERT OR REPLACE INTO {fts}(rowid, {cols}) VALUES (new.rowid, {new_vals});"
+    return {
+        f"{fts}_ai": f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN {upsert} END",
+        f"{fts}_ad": f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+                     f"DELETE FROM {fts} WHERE rowid = old.rowid; END",
+        f"{fts}_au": f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN "
+                     f"DELETE FROM {fts} WHERE rowid = old.rowid; {upsert} END",
+    }
+
+
+def _etf_triggers() -> dict[str, str]:
+    def upsert(ticker):
+        # Recalcula o documento do ETF (nome + tags concatenadas)
+        tags = _ETF_TAGS_EXPR.format(ticker="e.ticker")
+        return (f"INSERT OR REPLACE INTO {ETF_FTS}(rowid, ticker, name, tags) "
+                f"SELECT e.rowid, e.ticker, e.name, {tags} FROM etfs e WHERE e.ticker = {ticker};")
+
+    delete = f"DELETE FROM {ETF_FTS} WHERE rowid = old.rowid;"
+    return {
+        f"{ETF_FTS}_ai": f"CREATE TRIGGER {ETF_FTS}_ai AFTER INSERT ON etfs BEGIN {upsert('new.ticker')} END",
+        f"{ETF_FTS}_ad": f"CREATE TRIGGER {ETF_FTS}_ad AFTER DELETE ON etfs BEGIN {delete} END",
+        f"{ETF_FTS}_au": (f"CREATE TRIGGER {ETF_FTS}_au AFTER UPDATE OF ticker, name ON etfs BEGIN "
+                          f"{delete} {upsert('new.ticker')} END"),
+        f"{ETF_FTS}_tag_ai": (f"CREATE TRIGGER {ETF_FTS}_tag_ai AFTER INSERT ON etf_tags BEGIN "
+                              f"{upsert('new.etf_ticker')} END"),
+        f"{ETF_FTS}_tag_ad": (f"CREATE TRIGGER {ETF_FTS}_tag_ad AFTER DELETE ON etf_tags BEGIN "
+                              f"{upsert('old.etf_ticker')} END"),
+        f"{ETF_FTS}_tag_au": (f"CREATE TRIGGER {ETF_FTS}_tag_au AFTER UPDATE OF tag_value, etf_ticker ON etf_tags "
+                              f"BEGIN {upsert('old.etf_ticker')} {upsert('new.etf_ticker')} END"),
+    }
+
+
+def _existing(conn: sqlite3.Connection, kind: str) -> set:
+    return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = ?", (kind,))}
+
+
+def _all_triggers(tables: set) -> dict[str, str]:
+    triggers = {}
+    for fts, table, columns in SOURCES:
+        if table in tables:
+            triggers.update(_source_triggers(fts, table, columns))
+    if {"etfs", "etf_tags"} <= tables:
+        triggers.update(_etf_triggers())
+    return triggers
+
+
+# ─── Criação / reconstrução ──────────────────────────────────────────────────
+
+def build_search_index(conn: sqlite3.Connection, rebuild: bool = True) -> dict:
+    """Cria tabelas FTS e triggers ausentes e (re)popula o índice.
+
+    Com rebuild=False só repopula as tabelas FTS recém-criadas ou cujos
+    triggers estavam faltando (a origem pode ter sido recriada).
+    """
+    tables = _existing(conn, "table")
+    triggers = _existing(conn, "trigger")
+    counts = {}
+
+    for fts, table, columns in SOURCES:
+        if table not in tables:
+            continue
+        wanted = _source_triggers(fts, table, columns)
+        stale = rebuild or fts not in tables or not set(wanted) <= triggers
+        if fts not in tables:
+            conn.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({', '.join(columns)}, tokenize='trigram')")
+        for name, ddl in wanted.items():
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            conn.execute(ddl)
+        if stale:
+            cols = ", ".join(columns)
+            conn.execute(f"DELETE FROM {fts}")
+            conn.execute(f"INSERT INTO {fts}(rowid, {cols}) SELECT rowid, {cols} FROM {table}")
+            conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('optimize')")
+        counts[fts] = conn.execute(f"SELECT COUNT(*) FROM {fts}").fetchone()[0]
+
+    if {"etfs", "etf_tags"} <= tables:
+        wanted = _etf_triggers()
+        stale = rebuild or ETF_FTS not in tables or not set(wanted) <= triggers
+        if ETF_FTS not in tables:
+            conn.execute(f"CREATE VIRTUAL TABLE {ETF_FTS} USING fts5({', '.join(ETF_COLUMNS)}, tokenize='trigram')")
+        for name, ddl in wanted.items():
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            conn.execute(ddl)
+        if stale:
+            conn.execute(f"DELETE FROM {ETF_FTS}")
+            conn.execute(f"""
+                INSERT INTO {ETF_FTS}(rowid, ticker, name, tags)
+                SELECT e.rowid, e.ticker, e.name, {_ETF_TAGS_EXPR.format(ticker='e.ticker')}
+                FROM etfs e
+            """)
+            conn.execute(f"INSERT INTO {ETF_FTS}({ETF_FTS}) VALUES ('optimize')")
+        counts[ETF_FTS] = conn.execute(f"SELECT COUNT(*) FROM {ETF_FTS}").fetchone()[0]
+
+    conn.commit()
+    return counts
+
+
+def ensure_search_index(db_path: str) -> dict:
+    """Recria o que estiver faltando (chamado ao fim dos jobs de atualização)."""
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    try:
+        return build_search_index(conn, rebuild=False)
+    finally:
+        conn.close()
+
+
+# ─── Uso nas rotas ───────────────────────────────────────────────────────────
+
+_ready = {"version": None, "tables": frozenset()}
+_ready_lock = threading.Lock()
+
+
+def search_index_ready(conn: sqlite3.Connection, fts: str) -> bool:
+    """True se `fts` existe e os triggers que o mantêm estão no lugar."""
+    version = data_version()
+    if _ready["version"] != version:
+        with _ready_lock:
+            if _ready["version"] != version:
+                tables = _existing(conn, "table")
+                triggers = _existing(conn, "trigger")
+                expected = _all_triggers(tables)
+                ready = set()
+                for name in FTS_TABLES:
+                    own = {t for t in expected if t.startswith(name + "_")}
+                    if name in tables and own and own <= triggers:
+                        ready.add(name)
+                _ready["tables"] = frozenset(ready)
+                _ready["version"] = version
+    return fts in _ready["tables"]
+
+
+def fts_query(q: str, columns: tuple | None = None) -> str | None:
+    """Expressão MATCH de substring para `q` (None se curto demais)."""
+    q = (q or "").strip()
+    if len(q) < MIN_QUERY_LENGTH:
+        return None
+    phrase = '"' + q.replace('"', '""') + '"'
+    if columns:
+        return "{" + " ".join(columns) + "} : " + phrase
+    return phrase
+
+
+def match_condition(conn: sqlite3.Connection, fts: str, rowid_expr: str, q: str,
+                    columns: tuple | None = None) -> tuple[str, list] | None:
+    """`rowid_expr IN (... MATCH ?)` para o WHERE; None → a rota usa o LIKE."""
+    expr = fts_query(q, columns)
+    if expr is None or not search_index_ready(conn, fts):
+        return None
+    return f"{rowid_expr} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)", [expr]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cria/reconstrói o índice FTS5 das buscas")
+    parser.add_argument("--db", type=str, default="data/damodaran_data_new.db", help="Caminho do banco")
+    parser.add_argument("--missing-only", action="store_true",
+                        help="Só cria/repopula tabelas e triggers ausentes")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        counts = build_search_index(conn, rebuild=not args.missing_only)
+    finally:
+        conn.close()
+    for name, n in counts.items():
+        print(f"{name}: {n} documentos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+sqlite_aggregates.py — Funções de agregação estatísticas para o SQLite.
+
+O SQLite não tem mediana/percentis, então várias rotas puxavam o conjunto
+inteiro para o pandas só para calcular p25/mediana/p75 (ou devolviam 0 no
+lugar da mediana). Estas agregações rodam dentro do GROUP BY:
+
+  median(x)                      mediana
+  percentile_cont(x, p)          percentil contínuo, p em [0, 1] (interpolação linear)
+  trimmed_mean(x, frac)          média descartando `frac` de cada ponta
+  stdev(x)                       desvio-padrão amostral (ddof=1)
+  weighted_avg(x, w)             Σ(x·w) / Σw (ignora linhas com x ou w nulo)
+  histogram(x, bins, trim)       JSON [{bin_start, bin_end, count}, ...]
+
+Os valores de cada grupo ficam em `array('d')` (8 bytes por valor, sem
+objetos Python) e os quantis usam o NumPy no fechamento do grupo — mesmos
+resultados de `Series.median()/quantile()` do pandas. NULLs e textos não
+numéricos são ignorados, como nas agregações nativas.
+
+`register_aggregates(conn)` é chamado pelo db_pool em toda conexão nova.
+"""
+from __future__ import annotations
+
+import json
+import math
+from array import array
+
+import numpy as np
+
+
+def _as_float(value):
+    if value is None or isinstance(value, bytes):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Buffered:
+    """Base: acumula os valores não nulos do grupo num array compacto."""
+
+    def __init__(self):
+        self.values = array("d")
+        self.param = None
+
+    def step(self, value, param=None):
+        v = _as_float(value)
+        if v is not None and not math.isnan(v):
+            self.values.append(v)
+        if self.param is None:
+            self.param = param
+
+    def _array(self) -> np.ndarray:
+        return np.frombuffer(self.values, dtype=float) if self.values else np.empty(0)
+
+
+class Median(_Buffered):
+    def finalize(self):
+        arr = self._array()
+        return float(np.median(arr)) if arr.size else None
+
+
+class PercentileCont(_Buffered):
+    def finalize(self):
+        arr = self._array()
+        p = _as_float(self.param)
+        if not arr.size or p is None or not 0 <= p <= 1:
+            return None
+        return float(np.quantile(arr, p))
+
+
+class TrimmedMean(_Buffered):
+    def finalize(self):
+        arr = self._array()
+        frac = _as_float(self.param) or 0.0
+        if not arr.size or not 0 <= frac < 0.5:
+            return None
+        cut = int(frac * arr.size)
+        arr = np.sort(arr)[cut:arr.size - cut]
+        return float(arr.mean()) if arr.size else None
+
+
+class Stdev(_Buffered):
+    def finalize(self):
+        arr = self._array()
+        return float(arr.std(ddof=1)) if arr.size > 1 else None
+
+
+class WeightedAvg:
+    def __init__(self):
+        self.sum_xw = 0.0
+        self.sum_w = 0.0
+
+    def step(self, value, weight):
+        x = _as_float(value)
+        w = _as_float(weight)
+        if x is None or w is None or math.isnan(x) or math.isnan(w):
+            return
+        self.sum_xw += x * w
+        self.sum_w += w
+
+    def finalize(self):
+        return self.sum_xw / self.sum_w if self.sum_w else None
+
+
+class Histogram(_Buffered):
+    """histogram(x, bins, trim).
+
+    - trim: fração descartada em cada ponta pelos quantis (0.01 → p1..p99);
+    - bins: número de faixas; 0 = automático, n/10 limitado a [5, 15].
+    As faixas vão do menor ao maior valor mantido (como o np.histogram).
+    """
+
+    def step(self, value, bins=0, trim=0.0):
+        super().step(value, (bins, trim))
+
+    def finalize(self):
+        arr = self._array()
+        if not arr.size:
+            return json.dumps([])
+        bins, trim = self.param or (0, 0.0)
+        bins = int(_as_float(bins) or 0)
+        trim = _as_float(trim) or 0.0
+        if trim > 0:
+            lo, hi = np.quantile(arr, [trim, 1 - trim])
+            arr = arr[(arr >= lo) & (arr <= hi)]
+        if not arr.size:
+            return json.dumps([])
+        if bins <= 0:
+            bins = min(15, max(5, arr.size // 10))
+        counts, edges = np.histogram(arr, bins=bins)
+        return json.dumps([
+            {"bin_start": round(float(edges[i]), 2), "bin_end": round(float(edges[i + 1]), 2),
+             "count": int(counts[i])}
+            for i in range(len(counts))
+        ])
+
+
+AGGREGATES = (
+    ("median", 1, Median),
+    ("percentile_cont", 2, PercentileCont),
+    ("trimmed_mean", 2, TrimmedMean),
+    ("stdev", 1, Stdev),
+    ("weighted_avg", 2, WeightedAvg),
+    ("histogram", 1, Histogram),
+    ("histogram", 2, Histogram),
+    ("histogram", 3, Histogram),
+)
+
+
+def register_aggregates(conn):
+    """Registra as agregações na conexão (idempotente)."""
+    for name, n_args, cls in AGGREGATES:
+        conn.create_aggregate(name, n_args, cls)
+    return conn
@@ -0,0 +1,195 @@
+"""
+streaming_export.py — Exportações (XLSX/CSV/Parquet) em streaming e memória constante.
+
+`/api/export_excel` carregava o resultado inteiro num DataFrame, gerava o
+.xlsx num BytesIO via `pd.ExcelWriter` e ainda calculava a largura de cada
+coluna com `df[col].astype(str).str.len().max()`. Num export do universo
+inteiro com 100+ campos isso estoura a memória das instâncias. Aqui:
+
+- o cursor SQL é lido em blocos de `CHUNK_SIZE` linhas (`iter_chunks`);
+- CSV: cada bloco vira bytes e segue direto para o cliente;
+- XLSX: workbook `write_only` do openpyxl (as linhas vão para o XML do
+  arquivo temporário à medida que chegam, sem manter células em memória).
+  O .xlsx é um zip cujo índice só é escrito no fim, então os bytes são
+  enviados depois do `save()`, lidos do arquivo temporário em blocos. As
+  larguras vêm de um `MAX(LENGTH(...))` no próprio SQL (`column_widths`);
+- Parquet: um row group por bloco via `pyarrow.parquet.ParquetWriter`
+  (dependência opcional — sem pyarrow o formato não é oferecido).
+
+As rotas devolvem `Response(stream_with_context(...))`; a conexão do pool é
+devolvida no `finally` do gerador, inclusive se o cliente desconectar.
+"""
+from __future__ import annotations
+
+import csv
+import io
+import tempfile
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow é opcional
+    pa = pq = None
+
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+PARQUET_AVAILABLE = pa is not None
+
+CHUNK_SIZE = 5000
+READ_BLOCK = 256 * 1024
+MAX_COLUMN_WIDTH = 50
+
+FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def available_formats() -> tuple:
+    return tuple(f for f in FORMATS if f != "parquet" or PARQUET_AVAILABLE)
+
+
+# ─── Leitura do cursor ───────────────────────────────────────────────────────
+
+def iter_chunks(conn, query: str, params=(), size: int = CHUNK_SIZE):
+    """Gera listas de até `size` linhas; fecha `conn` ao terminar."""
+    try:
+        cursor = conn.execute(query, list(params))
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def peek(chunks):
+    """(primeiro bloco, iterador completo) — permite responder 404 se vazio."""
+    first = next(chunks, None)
+    if first is None:
+        return None, iter(())
+
+    def chained():
+        yield first
+        yield from chunks
+    return first, chained()
+
+
+def column_widths(conn, from_where: str, exprs: list, labels: list, params=()) -> list:
+    """Larguras (em caracteres) das colunas com uma agregação no SQL.
+
+    Mesma regra do export antigo: maior texto entre o rótulo e os valores,
+    +2, limitado a MAX_COLUMN_WIDTH.
+    """
+    select = ", ".join(f"MAX(LENGTH(CAST({e} AS TEXT)))" for e in exprs)
+    row = conn.execute(f"SELECT {select} {from_where}", list(params)).fetchone()
+    return [min(max(row[i] or 0, len(str(labels[i]))) + 2, MAX_COLUMN_WIDTH)
+            for i in range(len(exprs))]
+
+
+# ─── Formatos ────────────────────────────────────────────────────────────────
+
+def csv_stream(header: list, chunks, delimiter: str = ",", bom: bool = False):
+    """CSV em bytes UTF-8, um bloco de saída por bloco do cursor."""
+    buffer = io.StringIO()
+    if bom:  # Excel em pt-BR só reconhece UTF-8 com BOM
+        buffer.write("\ufeff")
+    writer = csv.writer(buffer, delimiter=delimiter)
+    writer.writerow(header)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def xlsx_stream(header: list, chunks, sheet_name: str = "Dados", widths: list | None = None):
+    """XLSX via workbook write-only gravado num arquivo temporário."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    for idx, width in enumerate(widths or [], start=1):
+        ws.column_dimensions[get_column_letter(idx)].width = width
+    ws.append(header)
+    for rows in chunks:
+        for row in rows:
+            ws.append(row)
+
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            block = tmp.read(READ_BLOCK)
+            if not block:
+                break
+            yield block
+
+
+_ARROW_TYPES = (("INT", "int64"), ("REAL", "float64"), ("FLOA", "float64"),
+                ("DOUB", "float64"), ("NUM", "float64"), ("DEC", "float64"))
+
+
+def _arrow_type(declared: str | None):
+    declared = (declared or "").upper()
+    for token, name in _ARROW_TYPES:
+        if token in declared:
+            return getattr(pa, name)()
+    return pa.string()
+
+
+def _coerce(value, arrow_type):
+    """Ajusta o valor ao tipo declarado da coluna (fora do tipo → nulo)."""
+    if value is None:
+        return None
+    if pa.types.is_string(arrow_type):
+        return value if isinstance(value, str) else str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number:
+        return None
+    if pa.types.is_integer(arrow_type):
+        return int(number) if number.is_integer() else None
+    return number
+
+
+def parquet_stream(header: list, chunks, declared_types: list):
+    """Parquet com um row group por bloco; tipos a partir do schema SQLite."""
+    if not PARQUET_AVAILABLE:
+        raise RuntimeError("Exportação Parquet requer o pacote pyarrow")
+    types = [_arrow_type(t) for t in declared_types]
+    schema = pa.schema([pa.field(str(name), t) for name, t in zip(header, types)])
+
+    with tempfile.TemporaryFile() as tmp:
+        with pq.ParquetWriter(tmp, schema) as writer:
+            for rows in chunks:
+                arrays = [pa.array([_coerce(r[i], t) for r in rows], type=t)
+                          for i, t in enumerate(types)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        tmp.seek(0)
+        while True:
+            block = tmp.read(READ_BLOCK)
+            if not block:
+                break
+            yield block
+
+
+def declared_types(conn, table: str) -> dict:
+    """{coluna: tipo declarado} de PRAGMA table_info."""
+    return {r[1]: r[2] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def export_stream(fmt: str, header: list, chunks, *, sheet_name: str = "Dados",
+                  widths: list | None = None, types: list | None = None,
+                  csv_delimiter: str = ",", csv_bom: bool = False):
+    """Gerador de bytes no formato pedido."""
+    if fmt == "csv":
+        return csv_stream(header, chunks, delimiter=csv_delimiter, bom=csv_bom)
+    if fmt == "parquet":
+        return parquet_stream(header, chunks, types or [None] * len(header))
+    return xlsx_stream(header, chunks, sheet_name=sheet_name, widths=widths)
@@ -0,0 +1,57 @@
+"""Testes do motor de busca adaptativo (scripts/yahoo_fetch_engine.py).
+
+Rodar: python -m pytest -q tests/test_yahoo_fetch_engine.py
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scripts.yahoo_fetch_engine import AIMDLimiter, YahooFetchEngine  # noqa: E402
+
+
+def test_falhas_rapidas_nao_derrubam_o_limite():
+    """Erros instantâneos seguidos de respostas normais não levam o limite a 1."""
+    n_fail, n_ok = 40, 60
+
+    def fetch(i):
+        if i < n_fail:
+            raise RuntimeError("ticker inexistente")  # falha rápida
+        time.sleep(0.02)
+        return {"ok": i}
+
+    engine = YahooFetchEngine(fetch, max_concurrency=4, max_rps=500.0,
+                              initial_concurrency=4, base_cooldown=0.1)
+    results = list(engine.run(range(n_fail + n_ok)))
+
+    assert len(results) == n_fail + n_ok
+    assert engine.stats()["failed"] == n_fail
+    assert engine.limiter.limit > 1.5
+    # Falhas não viram linha de base: a referência vem só das respostas úteis
+    assert engine.limiter.min_latency >= 0.015
+
+
+def test_resultado_vazio_e_neutro():
+    """`is_success` falso não conta como sucesso nem como sinal de latência."""
+    engine = YahooFetchEngine(lambda i: None, max_concurrency=2, max_rps=500.0)
+    results = list(engine.run(range(10)))
+
+    assert [r for _, r in results] == [None] * 10
+    assert engine.stats()["failed"] == 10
+    assert engine.limiter.ewma_latency is None
+    assert engine.limiter.min_latency is None
+
+
+def test_linha_de_base_em_janela():
+    """A linha de base acompanha as últimas respostas, não o mínimo histórico."""
+    limiter = AIMDLimiter(4.0, max_limit=8.0, baseline_window=10)
+    for _ in range(10):
+        limiter.on_success(0.001)
+    for _ in range(30):
+        limiter.on_success(0.2)
+
+    assert limiter.min_latency == 0.2
+    assert limiter.limit > 1.0
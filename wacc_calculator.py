@@ -52,6 +52,37 @@ class WACCComponents:
             self.data_sources = {}
 
 
+def derive_wacc(risk_free_rate, market_risk_premium, country_risk_premium, beta,
+                size_premium, cost_of_debt, tax_rate, debt_to_equity):
+    """Calcula Ke, pesos e WACC a partir dos componentes.
+    
+    Usa só aritmética elementar, então aceita tanto floats quanto arrays NumPy
+    (com broadcasting) — é a mesma fórmula do cálculo pontual e do motor de
+    sensibilidade/Monte Carlo (wacc_sensitivity.py).
+    
+    Returns:
+        Tupla (cost_of_equity, weight_equity, weight_debt, wacc)
+    """
+    # Custo do patrimônio líquido (CAPM + Size Premium)
+    cost_of_equity = (
+        risk_free_rate +
+        beta * (market_risk_premium + country_risk_premium) +
+        size_premium
+    )
+    
+    # Pesos da dívida e patrimônio líquido
+    total_value = 1 + debt_to_equity
+    weight_equity = 1 / total_value
+    weight_debt = debt_to_equity / total_value
+    
+    # WACC final
+    wacc = (
+        weight_equity * cost_of_equity +
+        weight_debt * cost_of_debt * (1 - tax_rate)
+    )
+    return cost_of_equity, weight_equity, weight_debt, wacc
+
+
 class WACCCalculator:
     """Calculador automatizado do WACC."""
     
@@ -289,22 +320,16 @@ class WACCCalculator:
         Args:
             components: Objeto WACCComponents para atualizar
         """
-        # Custo do patrimônio líquido (CAPM + Size Premium)
-        components.cost_of_equity = (
-            components.risk_free_rate + 
-            components.beta * (components.market_risk_premium + components.country_risk_premium) +
-            components.size_premium
-        )
-        
-        # Pesos da dívida e patrimônio líquido
-        total_value = 1 + components.debt_to_equity
-        components.weight_equity = 1 / total_value
-        components.weight_debt = components.debt_to_equity / total_value
-        
-        # WACC final
-        components.wacc = (
-            components.weight_equity * components.cost_of_equity +
-            components.weight_debt * components.cost_of_debt * (1 - components.tax_rate)
+        (components.cost_of_equity, components.weight_equity,
+         components.weight_debt, components.wacc) = derive_wacc(
+            risk_free_rate=components.risk_free_rate,
+            market_risk_premium=components.market_risk_premium,
+            country_risk_premium=components.country_risk_premium,
+            beta=components.beta,
+            size_premium=components.size_premium,
+            cost_of_debt=components.cost_of_debt,
+            tax_rate=components.tax_rate,
+            debt_to_equity=components.debt_to_equity,
         )
     
     def _get_data_sources(self, extracted_data: Dict[str, Any]) -> Dict[str, str]:
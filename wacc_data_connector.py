@@ -298,11 +298,11 @@ class WACCDataConnector:
                 industry,
                 COUNT(*) as company_count,
                 AVG(CASE WHEN beta IS NOT NULL AND beta != '' AND beta != 'None' 
-                    THEN CAST(beta as REAL) ELSE NULL END) as avg_beta,
+                    THEN beta ELSE NULL END) as avg_beta,
                 SUM(CASE WHEN debt_equity IS NOT NULL AND market_cap IS NOT NULL AND market_cap > 0
-                    THEN CAST(debt_equity as REAL) * CAST(market_cap as REAL) ELSE 0 END) /
+                    THEN debt_equity * market_cap ELSE 0 END) /
                 NULLIF(SUM(CASE WHEN debt_equity IS NOT NULL AND market_cap IS NOT NULL AND market_cap > 0
-                    THEN CAST(market_cap as REAL) ELSE 0 END), 0) as avg_debt_equity,
+                    THEN market_cap ELSE 0 END), 0) as avg_debt_equity,
                 AVG(bottom_up_beta_for_sector) as unlevered_beta_damodaran
             FROM damodaran_global 
             WHERE industry IS NOT NULL
@@ -311,7 +311,7 @@ class WACCDataConnector:
             GROUP BY industry
             HAVING COUNT(*) >= 3
                 AND AVG(CASE WHEN beta IS NOT NULL AND beta != '' AND beta != 'None' 
-                    THEN CAST(beta as REAL) ELSE NULL END) IS NOT NULL
+                    THEN beta ELSE NULL END) IS NOT NULL
             ORDER BY company_count DESC
             """
             
@@ -374,11 +374,11 @@ class WACCDataConnector:
             # Query: pegar TODAS as empresas do setor (inclui betas negativos)
             base_query = """
             SELECT 
-                CAST(beta as REAL) as beta,
-                CAST(debt_equity as REAL) as debt_equity,
-                CAST(market_cap as REAL) as market_cap,
-                CAST(effective_tax_rate as REAL) as effective_tax_rate,
-                CAST(cash_firm_value as REAL) as cash_firm_value,
+                beta,
+                debt_equity,
+                market_cap,
+                effective_tax_rate,
+                cash_firm_value,
                 bottom_up_beta_for_sector,
                 country,
                 broad_group
@@ -0,0 +1,461 @@
+"""
+wacc_sensitivity.py — Sensibilidade e Monte Carlo do WACC, vetorizados.
+
+`WACCCalculator.calculate_wacc` monta um `WACCComponents` por vez em Python
+escalar; quem queria uma tabela de sensibilidade chamava `/api/calculate_wacc`
+em laço, uma requisição (e uma extração de dados) por célula. Aqui, a partir
+de um conjunto-base de componentes:
+
+- `tornado()` avalia cada parâmetro no mínimo e no máximo da sua faixa com os
+  demais na base — uma única avaliação sobre vetores de 2×P pontos;
+- `heatmap()` cruza dois parâmetros por broadcasting (`y[:, None]` × `x[None, :]`);
+- `full_grid()` avalia o produto cartesiano de todas as faixas como um array
+  N-dimensional (cada parâmetro num eixo) e resume a distribuição do WACC;
+  acima de MAX_GRID_POINTS, `run()` troca a grade por `sampled_grid()`, um
+  resumo sobre pontos sorteados uniformemente da mesma grade;
+- `monte_carlo()` sorteia 100k (padrão) cenários de todas as distribuições de
+  uma vez e devolve percentis, histograma e correlação de Spearman de cada
+  entrada com o WACC.
+
+Todas as avaliações passam por `wacc_calculator.derive_wacc`, a mesma fórmula
+(CAPM + size premium, pesos por D/E) do cálculo pontual. Taxas em decimal
+(0.045 = 4,5%), como no resto da API.
+"""
+from __future__ import annotations
+
+import math
+
+import numpy as np
+
+from wacc_calculator import derive_wacc
+
+PARAMS = (
+    "risk_free_rate",
+    "market_risk_premium",
+    "country_risk_premium",
+    "beta",
+    "size_premium",
+    "cost_of_debt",
+    "tax_rate",
+    "debt_to_equity",
+)
+
+# Limites aplicados aos sorteios (sobrescrevíveis com "clip" na distribuição)
+BOUNDS = {
+    "tax_rate": (0.0, 1.0),
+    "debt_to_equity": (0.0, None),
+    "cost_of_debt": (0.0, None),
+}
+
+DEFAULT_STEPS = 11
+MAX_STEPS = 201
+MAX_GRID_POINTS = 2_000_000
+GRID_SAMPLE_POINTS = 200_000
+DEFAULT_SIMULATIONS = 100_000
+MAX_SIMULATIONS = 1_000_000
+HISTOGRAM_BINS = 50
+PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+# ─── Entradas ────────────────────────────────────────────────────────────────
+
+def _check_param(name: str) -> str:
+    if name not in PARAMS:
+        raise ValueError(f"Parâmetro desconhecido: {name!r} (válidos: {', '.join(PARAMS)})")
+    return name
+
+
+def _number(value, label: str) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{label}: valor numérico inválido ({value!r})")
+    if not math.isfinite(number):
+        raise ValueError(f"{label}: valor não finito")
+    return number
+
+
+def _integer(value, label: str) -> int:
+    """Inteiro vindo do JSON (aceita 10.0; recusa bool, 10.5 e texto)."""
+    if isinstance(value, bool):
+        raise ValueError(f"{label}: inteiro inválido ({value!r})")
+    number = _number(value, label)
+    if not number.is_integer():
+        raise ValueError(f"{label}: inteiro inválido ({value!r})")
+    return int(number)
+
+
+def _seed(value) -> int | None:
+    if value is None:
+        return None
+    seed = _integer(value, "seed")
+    if seed < 0:
+        raise ValueError("seed deve ser >= 0")
+    return seed
+
+
+def _mapping(value, label: str) -> dict:
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError(f"{label} deve ser um objeto JSON")
+    return value
+
+
+def _check_domain(name: str, values) -> None:
+    """D/E <= -1 zera (ou inverte) o valor total 1 + D/E nos pesos."""
+    if name == "debt_to_equity" and np.any(np.asarray(values) <= -1):
+        raise ValueError("debt_to_equity deve ser maior que -1")
+
+
+def base_values(base: dict) -> dict:
+    """Componentes-base como {parâmetro: float}; exige os 8 parâmetros."""
+    base = _mapping(base, "base")
+    missing = [p for p in PARAMS if base.get(p) is None]
+    if missing:
+        raise ValueError(f"Componentes-base ausentes: {', '.join(missing)}")
+    values = {p: _number(base[p], p) for p in PARAMS}
+    for name, value in values.items():
+        _check_domain(name, value)
+    return values
+
+
+def grid_values(name: str, spec) -> np.ndarray:
+    """Pontos da faixa de um parâmetro.
+
+    Aceita `{"min", "max", "steps"}` (linspace, `steps` padrão 11) ou
+    `{"values": [...]}` / lista explícita. Devolve array ordenado sem repetições.
+    """
+    if isinstance(spec, dict) and "values" in spec:
+        spec = spec["values"]
+    if isinstance(spec, (list, tuple)):
+        values = np.unique([_number(v, name) for v in spec])
+        if not 1 <= values.size <= MAX_STEPS:
+            raise ValueError(f"{name}: entre 1 e {MAX_STEPS} valores")
+        _check_domain(name, values)
+        return values
+    if not isinstance(spec, dict) or "min" not in spec or "max" not in spec:
+        raise ValueError(f"{name}: faixa deve ter 'min' e 'max' ou 'values'")
+    low, high = _number(spec["min"], f"{name}.min"), _number(spec["max"], f"{name}.max")
+    if low > high:
+        raise ValueError(f"{name}: min maior que max")
+    steps = spec.get("steps")
+    steps = DEFAULT_STEPS if steps is None else _integer(steps, f"{name}.steps")
+    if not 2 <= steps <= MAX_STEPS:
+        raise ValueError(f"{name}: steps deve estar entre 2 e {MAX_STEPS}")
+    _check_domain(name, low)
+    return np.linspace(low, high, steps)
+
+
+def parse_ranges(ranges: dict | None) -> dict:
+    """{parâmetro: array de pontos}, na ordem de PARAMS."""
+    ranges = _mapping(ranges, "ranges")
+    for name in ranges:
+        _check_param(name)
+    return {p: grid_values(p, ranges[p]) for p in PARAMS if p in ranges}
+
+
+def evaluate(values: dict) -> np.ndarray:
+    """WACC para cada combinação (broadcasting entre arrays e escalares)."""
+    return np.asarray(derive_wacc(**values)[3], dtype=float)
+
+
+# ─── Sensibilidade determinística ────────────────────────────────────────────
+
+def tornado(base: dict, ranges: dict) -> list:
+    """Variação do WACC com cada parâmetro em min/max, maior amplitude primeiro."""
+    names = list(ranges)
+    if not names:
+        return []
+    n = 2 * len(names)
+    columns = {p: np.full(n, base[p]) for p in PARAMS}
+    for i, name in enumerate(names):
+        columns[name][2 * i] = ranges[name][0]
+        columns[name][2 * i + 1] = ranges[name][-1]
+    wacc = evaluate(columns)
+    base_wacc = float(evaluate(base))
+
+    bars = []
+    for i, name in enumerate(names):
+        at_low, at_high = float(wacc[2 * i]), float(wacc[2 * i + 1])
+        bars.append({
+            "parameter": name,
+            "base_value": base[name],
+            "low_value": float(ranges[name][0]),
+            "high_value": float(ranges[name][-1]),
+            "wacc_at_low": at_low,
+            "wacc_at_high": at_high,
+            "downside": min(at_low, at_high) - base_wacc,
+            "upside": max(at_low, at_high) - base_wacc,
+            "swing": abs(at_high - at_low),
+        })
+    bars.sort(key=lambda b: b["swing"], reverse=True)
+    return bars
+
+
+def heatmap(base: dict, x: str, x_values: np.ndarray, y: str, y_values: np.ndarray) -> dict:
+    """Matriz WACC[y][x] cruzando dois parâmetros, demais na base."""
+    if x == y:
+        raise ValueError("heatmap: eixos x e y devem ser parâmetros diferentes")
+    values = dict(base)
+    values[x] = np.asarray(x_values)[None, :]
+    values[y] = np.asarray(y_values)[:, None]
+    wacc = np.broadcast_to(evaluate(values), (len(y_values), len(x_values)))
+    return {
+        "x": x,
+        "y": y,
+        "x_values": np.asarray(x_values).tolist(),
+        "y_values": np.asarray(y_values).tolist(),
+        "wacc": wacc.tolist(),
+        "min": float(wacc.min()),
+        "max": float(wacc.max()),
+    }
+
+
+def full_grid(base: dict, ranges: dict) -> dict:
+    """Resumo do WACC sobre o produto cartesiano de todas as faixas.
+
+    Cada parâmetro com faixa ocupa um eixo do array; o resultado é avaliado de
+    uma vez por broadcasting. Recusa grades acima de MAX_GRID_POINTS.
+    """
+    names = list(ranges)
+    shape = tuple(len(ranges[p]) for p in names)
+    points = grid_points(ranges)
+    if points > MAX_GRID_POINTS:
+        raise ValueError(f"Grade com {points:,} pontos excede o limite de {MAX_GRID_POINTS:,}; "
+                         "reduza 'steps'")
+    values = dict(base)
+    for axis, name in enumerate(names):
+        view = [1] * len(names)
+        view[axis] = shape[axis]
+        values[name] = ranges[name].reshape(view)
+    wacc = np.broadcast_to(evaluate(values), shape)
+
+    def at(index) -> dict:
+        coords = np.unravel_index(index, shape)
+        return {name: float(ranges[name][i]) for name, i in zip(names, coords)}
+
+    summary = summarize(wacc.ravel())
+    summary["points"] = points
+    summary["axes"] = {name: len(ranges[name]) for name in names}
+    summary["argmin"] = at(int(np.argmin(wacc)))
+    summary["argmax"] = at(int(np.argmax(wacc)))
+    return summary
+
+
+def grid_points(ranges: dict) -> int:
+    """Número de pontos do produto cartesiano das faixas."""
+    return math.prod(len(values) for values in ranges.values())
+
+
+def sampled_grid(base: dict, ranges: dict, n: int = GRID_SAMPLE_POINTS,
+                 seed: int | None = None) -> dict:
+    """Resumo do WACC sobre `n` pontos sorteados da grade cartesiana.
+
+    Sortear um índice uniforme por eixo equivale a sortear um ponto uniforme da
+    grade, então as estatísticas estimam as de `full_grid()` sem materializá-la.
+    `argmin`/`argmax` são os extremos da amostra.
+    """
+    rng = np.random.default_rng(_seed(seed))
+    names = list(ranges)
+    picks = {name: ranges[name][rng.integers(len(ranges[name]), size=n)] for name in names}
+    wacc = np.broadcast_to(evaluate({**base, **picks}), (n,))
+
+    def at(index) -> dict:
+        return {name: float(picks[name][index]) for name in names}
+
+    summary = summarize(wacc)
+    summary["points"] = grid_points(ranges)
+    summary["sampled"] = n
+    summary["axes"] = {name: len(ranges[name]) for name in names}
+    summary["argmin"] = at(int(np.argmin(wacc)))
+    summary["argmax"] = at(int(np.argmax(wacc)))
+    return summary
+
+
+# ─── Monte Carlo ─────────────────────────────────────────────────────────────
+
+def draw(name: str, spec, n: int, rng: np.random.Generator) -> np.ndarray:
+    """Amostra `n` valores de um parâmetro.
+
+    Distribuições (`"dist"`): normal (mean, std), lognormal (mean, std do próprio
+    valor), uniform (min, max), triangular (min, mode, max) e empirical
+    (values — reamostragem com reposição). Um número é tratado como fixo.
+    Os sorteios são limitados por BOUNDS ou por `"clip": [lo, hi]`.
+    """
+    if not isinstance(spec, dict):
+        value = _number(spec, name)
+        _check_domain(name, value)
+        return np.full(n, value)
+    kind = str(spec.get("dist", "normal")).lower()
+    get = lambda key: _number(spec.get(key), f"{name}.{key}")  # noqa: E731
+
+    if kind == "normal":
+        std = get("std")
+        if std < 0:
+            raise ValueError(f"{name}: std negativo")
+        sample = rng.normal(get("mean"), std, n)
+    elif kind == "lognormal":
+        mean, std = get("mean"), get("std")
+        if mean <= 0 or std < 0:
+            raise ValueError(f"{name}: lognormal exige mean > 0 e std >= 0")
+        sigma2 = math.log1p((std / mean) ** 2)
+        sample = rng.lognormal(math.log(mean) - sigma2 / 2, math.sqrt(sigma2), n)
+    elif kind == "uniform":
+        low, high = get("min"), get("max")
+        if low > high:
+            raise ValueError(f"{name}: min maior que max")
+        sample = rng.uniform(low, high, n)
+    elif kind == "triangular":
+        low, mode, high = get("min"), get("mode"), get("max")
+        if not low <= mode <= high or low == high:
+            raise ValueError(f"{name}: triangular exige min <= mode <= max e min < max")
+        sample = rng.triangular(low, mode, high, n)
+    elif kind == "empirical":
+        values = [_number(v, name) for v in spec.get("values") or []]
+        if not values:
+            raise ValueError(f"{name}: empirical exige 'values'")
+        sample = rng.choice(np.asarray(values), n)
+    else:
+        raise ValueError(f"{name}: distribuição desconhecida {kind!r}")
+
+    low, high = _clip_bounds(name, spec.get("clip"))
+    if low is not None or high is not None:
+        sample = np.clip(sample, low, high)
+    _check_domain(name, sample)
+    return sample
+
+
+def _clip_bounds(name: str, clip) -> tuple:
+    """`"clip": [lo, hi]` (None = sem limite daquele lado); padrão BOUNDS."""
+    if clip is None:
+        return BOUNDS.get(name, (None, None))
+    if not isinstance(clip, (list, tuple)) or len(clip) != 2:
+        raise ValueError(f"{name}.clip deve ser [min, max]")
+    low, high = (None if v is None else _number(v, f"{name}.clip") for v in clip)
+    if low is not None and high is not None and low > high:
+        raise ValueError(f"{name}.clip: min maior que max")
+    return low, high
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    """Postos médios: empates recebem a média das posições (como rankdata)."""
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    ends = np.cumsum(counts)
+    return (ends - (counts - 1) / 2)[inverse.ravel()]
+
+
+def monte_carlo(base: dict, distributions: dict, simulations: int = DEFAULT_SIMULATIONS,
+                seed: int | None = None) -> dict:
+    """Sorteia `simulations` cenários e resume a distribuição do WACC.
+
+    Parâmetros sem distribuição ficam fixos na base. `seed` torna o resultado
+    reproduzível (os parâmetros são sorteados sempre na ordem de PARAMS).
+    """
+    distributions = _mapping(distributions, "distributions")
+    for name in distributions:
+        _check_param(name)
+    if not distributions:
+        raise ValueError("Monte Carlo: informe ao menos uma distribuição")
+    n = _integer(simulations, "simulations")
+    if not 1 <= n <= MAX_SIMULATIONS:
+        raise ValueError(f"simulations deve estar entre 1 e {MAX_SIMULATIONS:,}")
+    rng = np.random.default_rng(_seed(seed))
+    samples = {p: draw(p, distributions[p], n, rng) for p in PARAMS if p in distributions}
+    wacc = np.broadcast_to(evaluate({**base, **samples}), (n,))
+    finite = np.isfinite(wacc)
+    wacc_ok = wacc[finite]
+    if not wacc_ok.size:
+        raise ValueError("Monte Carlo: nenhum cenário com WACC finito")
+
+    summary = summarize(wacc_ok)
+    summary["simulations"] = n
+    summary["valid"] = int(wacc_ok.size)
+    summary["base_wacc"] = float(evaluate(base))
+    summary["prob_above_base"] = float(np.mean(wacc_ok > summary["base_wacc"]))
+    counts, edges = np.histogram(wacc_ok, bins=HISTOGRAM_BINS)
+    summary["histogram"] = {"edges": edges.tolist(), "counts": counts.tolist()}
+
+    # Spearman de cada entrada com o WACC + participação na variância (ρ² normalizado)
+    wacc_ranks = _ranks(wacc_ok)
+    rho = {}
+    for name, sample in samples.items():
+        sample = sample[finite]
+        if np.ptp(sample) == 0:
+            continue
+        rho[name] = float(np.corrcoef(_ranks(sample), wacc_ranks)[0, 1])
+    total = sum(r * r for r in rho.values()) or 1.0
+    summary["sensitivity"] = sorted(
+        ({"parameter": name, "spearman": r, "contribution_to_variance": r * r / total}
+         for name, r in rho.items()),
+        key=lambda item: abs(item["spearman"]), reverse=True,
+    )
+    return summary
+
+
+# ─── Resumo / orquestração ───────────────────────────────────────────────────
+
+def summarize(values: np.ndarray) -> dict:
+    """Média, desvio, extremos e percentis de um vetor de WACCs."""
+    percentiles = np.percentile(values, PERCENTILES)
+    return {
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "percentiles": {f"p{q}": float(v) for q, v in zip(PERCENTILES, percentiles)},
+    }
+
+
+def run(base: dict, ranges: dict | None = None, distributions: dict | None = None,
+        heatmap_axes: dict | None = None, simulations: int = DEFAULT_SIMULATIONS,
+        seed: int | None = None, include_grid: bool = True) -> dict:
+    """Executa as análises pedidas e devolve um dict pronto para JSON.
+
+    `ranges` alimenta tornado, heatmap e grade completa; `distributions`, o
+    Monte Carlo. Sem `heatmap_axes` ({"x", "y"}), o heatmap usa os dois
+    parâmetros de maior amplitude no tornado. Uma grade acima de
+    MAX_GRID_POINTS não derruba a chamada: vira um resumo amostrado
+    (`sampled_grid`) e `grid_skipped` traz o motivo.
+    """
+    base = base_values(base)
+    parsed = parse_ranges(ranges)
+    cost_of_equity, weight_equity, weight_debt, wacc = derive_wacc(**base)
+    result = {
+        "base": base,
+        "base_result": {
+            "cost_of_equity": cost_of_equity,
+            "weight_equity": weight_equity,
+            "weight_debt": weight_debt,
+            "wacc": wacc,
+        },
+    }
+
+    if parsed:
+        result["tornado"] = tornado(base, parsed)
+        axes = _mapping(heatmap_axes, "heatmap")
+        x, y = axes.get("x"), axes.get("y")
+        if not (x and y):
+            ranked = [bar["parameter"] for bar in result["tornado"]]
+            x = x or next((p for p in ranked if p != y), None)
+            y = y or next((p for p in ranked if p != x), None)
+        if x and y:
+            for axis in (x, y):
+                _check_param(axis)
+            x_values = parsed.get(x, np.array([base[x]]))
+            y_values = parsed.get(y, np.array([base[y]]))
+            result["heatmap"] = heatmap(base, x, x_values, y, y_values)
+        if include_grid:
+            points = grid_points(parsed)
+            if points > MAX_GRID_POINTS:
+                result["grid_skipped"] = (
+                    f"Grade com {points:,} pontos excede o limite de {MAX_GRID_POINTS:,}; "
+                    f"resumo estimado com {GRID_SAMPLE_POINTS:,} pontos sorteados "
+                    "(reduza 'steps' para a grade exata)")
+                result["grid"] = sampled_grid(base, parsed, seed=seed)
+            else:
+                result["grid"] = full_grid(base, parsed)
+
+    if distributions:
+        result["monte_carlo"] = monte_carlo(base, distributions, simulations, seed)
+    return result